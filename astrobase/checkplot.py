@@ -176,6 +176,7 @@ from .varclass.starfeatures import coord_features, color_features, \
     color_classification, neighbor_gaia_features
 from .plotbase import skyview_stamp, \
     PLOTYLABELS, METHODLABELS, METHODSHORTLABELS
+from .periodbase import expand_lspdict
 from .coordutils import total_proper_motion, reduced_proper_motion
 
 
@@ -197,6 +198,9 @@ def _make_periodogram(axes,
     # get the appropriate plot ylabel
     pgramylabel = PLOTYLABELS[lspinfo['method']]
 
+    # regenerate the periodogram arrays if this is a compacted result dict
+    lspinfo = expand_lspdict(lspinfo)
+
     # get the periods and lspvals from lspinfo
     periods = lspinfo['periods']
     lspvals = lspinfo['lspvals']
@@ -769,6 +773,9 @@ def checkplot_png(lspinfo,
             with open(lspinfo,'rb') as infd:
                 lspinfo = pickle.load(infd)
 
+    # regenerate the periodogram arrays if this is a compacted result dict
+    lspinfo = expand_lspdict(lspinfo)
+
     # get the things to plot out of the data
     if ('periods' in lspinfo and
         'lspvals' in lspinfo and
@@ -1029,6 +1036,9 @@ def twolsp_checkplot_png(lspinfo1,
             with open(lspinfo2,'rb') as infd:
                 lspinfo2 = pickle.load(infd)
 
+    # regenerate the periodogram arrays if these are compacted result dicts
+    lspinfo1 = expand_lspdict(lspinfo1)
+    lspinfo2 = expand_lspdict(lspinfo2)
 
     # get the things to plot out of the data
     if ('periods' in lspinfo1 and 'periods' in lspinfo2 and
@@ -1634,6 +1644,9 @@ def _pkl_periodogram(lspinfo,
     # get the appropriate plot ylabel
     pgramylabel = PLOTYLABELS[lspinfo['method']]
 
+    # regenerate the periodogram arrays if this is a compacted result dict
+    lspinfo = expand_lspdict(lspinfo)
+
     # get the periods and lspvals from lspinfo
     periods = lspinfo['periods']
     lspvals = lspinfo['lspvals']
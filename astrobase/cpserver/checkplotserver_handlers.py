@@ -379,7 +379,7 @@ CPTOOLMAP = {
 ## CONFIG ##
 ############
 
-PFMETHODS = ['gls','pdm','acf','aov','mav','bls','win']
+PFMETHODS = ['gls','fls','tls','pdm','acf','aov','mav','bls','win']
 
 
 #####################
@@ -78,19 +78,18 @@ def LOGEXCEPTION(message):
 #############
 
 import multiprocessing as mp
+import weakref
 
 import numpy as np
 from numpy import isfinite as npisfinite, median as npmedian, abs as npabs
 
-from scipy.spatial import cKDTree as kdtree
 from scipy.signal import medfilt
 from scipy.linalg import lstsq
 from scipy.optimize import curve_fit
 
-import scipy.stats
 import numpy.random as nprand
 
-from scipy.signal import savgol_filter
+from scipy.ndimage import median_filter, uniform_filter1d
 
 
 
@@ -157,7 +156,8 @@ def normalize_magseries(times,
     'timegroups', either due to instrument changes or different filters.
 
     NOTE: this works in-place! The mags array will be replaced with normalized
-    mags when this function finishes.
+    mags when this function finishes. Read-only mags arrays (like those from a
+    CleanedMagSeries) are copied first and left as they are.
 
     The normto kwarg is one of the following strings:
 
@@ -179,6 +179,10 @@ def normalize_magseries(times,
 
     '''
 
+    # we can't normalize the shared arrays of a CleanedMagSeries in-place
+    if isinstance(mags, np.ndarray) and not mags.flags.writeable:
+        mags = mags.copy()
+
     ngroups, timegroups = find_lc_timegroups(times,
                                              mingap=mingap)
 
@@ -243,185 +247,385 @@ def normalize_magseries(times,
 ## SIGMA-CLIPPING ##
 ####################
 
-def sigclip_magseries(times, mags, errs,
-                      sigclip=None,
-                      iterative=False,
-                      magsarefluxes=False):
+def _partition_median(values, scratch=None):
+    '''This gets the median of values using np.partition instead of a sort.
+
+    scratch is an array of the same size that's used as work space so values
+    isn't changed. If scratch is None, values is partitioned in place. The
+    result is the same as np.median(values).
+
     '''
-    Select the finite times, magnitudes (or fluxes), and errors from the
-    passed values, and apply symmetric or asymmetric sigma clipping to them.
-    Returns sigma-clipped times, mags, and errs.
 
-    Args:
-        times (np.array): ...
+    nvalues = values.size
 
-        mags (np.array): numpy array to sigma-clip. Does not assume all values
-        are finite. Does not assume anything about whether they're
-        positive/negative.
+    if nvalues == 0:
+        return np.nan
 
-        errs (np.array): ...
+    if scratch is None:
+        scratch = values
+    else:
+        np.copyto(scratch, values)
 
-        iterative (bool): True if you want iterative sigma-clipping.
+    halfind = nvalues // 2
 
-        magsarefluxes (bool): True if your "mags" are in fact fluxes, i.e. if
-        "dimming" corresponds to your "mags" getting smaller.
+    if nvalues % 2:
+        scratch.partition(halfind)
+        return scratch[halfind]
+    else:
+        scratch.partition((halfind - 1, halfind))
+        return (scratch[halfind - 1] + scratch[halfind]) / 2.0
 
-        sigclip (float or list): If float, apply symmetric sigma clipping. If
-        list, e.g., [10., 3.], will sigclip out greater than 10-sigma dimmings
-        and greater than 3-sigma brightenings. Here the meaning of "dimming"
-        and "brightening" is set by *physics* (not the magnitude system), which
-        is why the `magsarefluxes` kwarg must be correctly set.
 
-    Returns:
-        stimes, smags, serrs: (sigmaclipped values of each).
-    '''
 
-    returnerrs = True
+def _sigclip_workspace(npoints):
+    '''This makes the work arrays used by _sigclip_finite_mask.
 
-    # fake the errors if they don't exist
-    # this is inconsequential to sigma-clipping
-    # we don't return these dummy values if the input errs are None
-    if errs is None:
-        # assume 0.1% errors if not given
-        # this should work for mags and fluxes
-        errs = 0.001*mags
-        returnerrs = False
+    These can be reused for any number of mag series with <= npoints values.
 
-    # filter the input times, mags, errs; do sigclipping and normalization
-    find = npisfinite(times) & npisfinite(mags) & npisfinite(errs)
-    ftimes, fmags, ferrs = times[find], mags[find], errs[find]
+    '''
 
-    # get the median and stdev = 1.483 x MAD
-    median_mag = npmedian(fmags)
-    stddev_mag = (npmedian(npabs(fmags - median_mag))) * 1.483
+    return (np.empty((5, npoints), dtype=np.float64),
+            np.empty((2, npoints), dtype=np.bool_))
 
-    # sigclip next for a single sigclip value
-    if sigclip and isinstance(sigclip,float):
 
-        if not iterative:
 
-            sigind = (npabs(fmags - median_mag)) < (sigclip * stddev_mag)
+def _asymmetric_sigclip(deviations,
+                        stddev_mag,
+                        dimmingclip,
+                        brighteningclip,
+                        magsarefluxes,
+                        out,
+                        work):
+    '''This fills out with the mask for an asymmetric sigma-clip.
 
-            stimes = ftimes[sigind]
-            smags = fmags[sigind]
-            serrs = ferrs[sigind]
+    deviations are the mags minus their median. work is a boolean array of the
+    same size as out.
 
-        else:
+    '''
+
+    if magsarefluxes:
+        # not too dim
+        np.greater(deviations, -dimmingclip*stddev_mag, out=out)
+        # not too bright
+        np.less(deviations, brighteningclip*stddev_mag, out=work)
+    else:
+        # not too dim
+        np.less(deviations, dimmingclip*stddev_mag, out=out)
+        # not too bright
+        np.greater(deviations, -brighteningclip*stddev_mag, out=work)
 
-            #
-            # iterative version adapted from scipy.stats.sigmaclip
-            #
-            delta = 1
+    np.logical_and(out, work, out=out)
 
-            this_times = ftimes
-            this_mags = fmags
-            this_errs = ferrs
+    return out
 
-            while delta:
 
-                this_median = npmedian(this_mags)
-                this_stdev = (npmedian(npabs(this_mags - this_median))) * 1.483
-                this_size = this_mags.size
 
-                # apply the sigclip
-                tsi = (npabs(this_mags - this_median)) < (sigclip * this_stdev)
+def _sigclip_finite_mask(fmags,
+                         median_mag=None,
+                         stddev_mag=None,
+                         sigclip=None,
+                         iterative=False,
+                         magsarefluxes=False,
+                         workspace=None):
+    '''This makes the sigma-clip mask for an array of finite mags.
 
-                # update the arrays
-                this_times = this_times[tsi]
-                this_mags = this_mags[tsi]
-                this_errs = this_errs[tsi]
+    median_mag and stddev_mag are the median and 1.483 x MAD of fmags. These
+    are calculated if they're None. sigclip, iterative, and magsarefluxes are
+    the same as for sigclip_magseries. workspace is the output of
+    _sigclip_workspace, which is made here if it's None.
 
-                # update delta and go to the top of the loop
-                delta = this_size - this_mags.size
+    Returns a boolean array with True for the fmags that survive the
+    sigma-clip, or None if the sigclip value means no clipping is done.
 
-            # final sigclipped versions
-            stimes, smags, serrs = this_times, this_mags, this_errs
+    The iterative version doesn't copy the arrays on each step like
+    scipy.stats.sigmaclip does. It keeps the surviving mags in the work arrays
+    and compacts them in place, so each iteration only looks at the points
+    that survived the previous one. The medians are found with np.partition
+    instead of a full sort.
 
+    '''
+
+    # sigclip is a float for a symmetric clip
+    if sigclip and isinstance(sigclip,float):
+        symmetric = True
 
     # this handles sigclipping for asymmetric +ve and -ve clip values
     elif sigclip and isinstance(sigclip,list) and len(sigclip) == 2:
 
+        symmetric = False
+
         # sigclip is passed as [dimmingclip, brighteningclip]
         dimmingclip = sigclip[0]
         brighteningclip = sigclip[1]
 
-        if not iterative:
+    else:
+        return None
 
-            if magsarefluxes:
-                nottoodimind = (
-                    (fmags - median_mag) > (-dimmingclip*stddev_mag)
-                )
-                nottoobrightind = (
-                    (fmags - median_mag) < (brighteningclip*stddev_mag)
-                )
-            else:
-                nottoodimind = (
-                    (fmags - median_mag) < (dimmingclip*stddev_mag)
-                )
-                nottoobrightind = (
-                    (fmags - median_mag) > (-brighteningclip*stddev_mag)
-                )
+    npoints = fmags.size
+
+    if workspace is None:
+        workspace = _sigclip_workspace(npoints)
+    fwork, bwork = workspace
+
+    scratch = fwork[4,:npoints]
+
+    if median_mag is None:
+        median_mag = _partition_median(fmags, scratch)
+
+    deviations = np.subtract(fmags, median_mag, out=fwork[2,:npoints])
+    absdeviations = np.abs(deviations, out=fwork[3,:npoints])
+
+    if stddev_mag is None:
+        stddev_mag = _partition_median(absdeviations, scratch) * 1.483
+
+    # the first pass is the same for the iterative and non-iterative versions
+    keepind = bwork[0,:npoints]
+    if symmetric:
+        np.less(absdeviations, sigclip * stddev_mag, out=keepind)
+    else:
+        _asymmetric_sigclip(deviations, stddev_mag,
+                            dimmingclip, brighteningclip,
+                            magsarefluxes,
+                            keepind, bwork[1,:npoints])
+
+    nkeep = np.count_nonzero(keepind)
+
+    if not iterative or nkeep == npoints:
+        return keepind.copy()
+
+    #
+    # iterative version adapted from scipy.stats.sigmaclip
+    #
+
+    # these hold the surviving mags. we ping-pong between the two rows of the
+    # work array when compacting them. the mags are partitioned in place to
+    # get the median, so each compacted array is already roughly partitioned
+    # around the next median, which makes the next partition faster.
+    this_mags, next_mags = fwork[0], fwork[1]
+
+    np.compress(keepind, fmags, out=this_mags[:nkeep])
+    this_size = nkeep
+
+    while this_size > 0:
 
-            sigind = nottoodimind & nottoobrightind
+        current_mags = this_mags[:this_size]
+        scratch = fwork[4,:this_size]
 
-            stimes = ftimes[sigind]
-            smags = fmags[sigind]
-            serrs = ferrs[sigind]
+        this_median = _partition_median(current_mags)
+        deviations = np.subtract(current_mags, this_median,
+                                 out=fwork[2,:this_size])
+        absdeviations = np.abs(deviations, out=fwork[3,:this_size])
+        this_stdev = _partition_median(absdeviations, scratch) * 1.483
 
+        # apply the sigclip
+        tsi = bwork[0,:this_size]
+        if symmetric:
+            np.less(absdeviations, sigclip * this_stdev, out=tsi)
         else:
+            _asymmetric_sigclip(deviations, this_stdev,
+                                dimmingclip, brighteningclip,
+                                magsarefluxes,
+                                tsi, bwork[1,:this_size])
 
-            #
-            # iterative version adapted from scipy.stats.sigmaclip
-            #
-            delta = 1
+        next_size = np.count_nonzero(tsi)
 
-            this_times = ftimes
-            this_mags = fmags
-            this_errs = ferrs
+        # stop once nothing else gets clipped
+        if next_size == this_size:
+            break
 
-            while delta:
+        # compact the surviving values into the other work row
+        np.compress(tsi, current_mags, out=next_mags[:next_size])
 
-                this_median = npmedian(this_mags)
-                this_stdev = (npmedian(npabs(this_mags - this_median))) * 1.483
-                this_size = this_mags.size
+        this_mags, next_mags = next_mags, this_mags
+        this_size = next_size
 
-                if magsarefluxes:
-                    nottoodimind = (
-                        (this_mags - this_median) > (-dimmingclip*this_stdev)
-                    )
-                    nottoobrightind = (
-                        (this_mags - this_median) < (brighteningclip*this_stdev)
-                    )
-                else:
-                    nottoodimind = (
-                        (this_mags - this_median) < (dimmingclip*this_stdev)
-                    )
-                    nottoobrightind = (
-                        (this_mags - this_median) > (-brighteningclip*this_stdev)
-                    )
+    if this_size == 0:
+        return np.zeros(npoints, dtype=np.bool_)
+
+    # each clip keeps the mags in a range of values, so the survivors of all
+    # of them are the mags between the smallest and largest survivor
+    current_mags = this_mags[:this_size]
+    keepind = ((fmags >= current_mags.min()) &
+               (fmags <= current_mags.max()))
 
-                # apply the sigclip
-                tsi = nottoodimind & nottoobrightind
+    return keepind
 
-                # update the arrays
-                this_times = this_times[tsi]
-                this_mags = this_mags[tsi]
-                this_errs = this_errs[tsi]
 
-                # update delta and go to top of the loop
-                delta = this_size - this_mags.size
 
-            # final sigclipped versions
-            stimes, smags, serrs = this_times, this_mags, this_errs
+def _sigclip_finite_magseries(ftimes, fmags, ferrs,
+                              median_mag, stddev_mag,
+                              sigclip=None,
+                              iterative=False,
+                              magsarefluxes=False):
+    '''This does the sigma-clipping part of sigclip_magseries.
+
+    ftimes, fmags, ferrs are the finite values of the mag series, and
+    median_mag and stddev_mag are the median and 1.483 x MAD of fmags. The
+    other args are the same as for sigclip_magseries.
+
+    Returns the sigma-clipped stimes, smags, serrs.
+
+    '''
+
+    sigind = _sigclip_finite_mask(fmags,
+                                  median_mag=median_mag,
+                                  stddev_mag=stddev_mag,
+                                  sigclip=sigclip,
+                                  iterative=iterative,
+                                  magsarefluxes=magsarefluxes)
 
+    if sigind is None:
+        return ftimes, fmags, ferrs
     else:
+        return ftimes[sigind], fmags[sigind], ferrs[sigind]
 
-        stimes = ftimes
-        smags = fmags
-        serrs = ferrs
 
-    if returnerrs:
-        return stimes, smags, serrs
+
+def sigclip_magseries_mask(times, mags, errs,
+                           sigclip=None,
+                           iterative=False,
+                           magsarefluxes=False):
+    '''This returns the mask of points that sigclip_magseries would keep.
+
+    The args are the same as for sigclip_magseries. Returns a boolean array
+    of the same size as times, with True for all points that are finite and
+    survive the sigma-clip, so times[mask], mags[mask], errs[mask] are the
+    same as the output of sigclip_magseries.
+
+    Boolean indexing copies arrays, so use this instead of sigclip_magseries
+    to avoid making the clipped copies at all, e.g. by passing the mask as the
+    where kwarg to numpy ufuncs and reductions, or to sigma-clip several
+    arrays that go with the same mags.
+
+    '''
+
+    # fake the errors if they don't exist
+    # this is inconsequential to sigma-clipping
+    if errs is None:
+        errs = mags
+
+    # filter the input times, mags, errs
+    find = npisfinite(times) & npisfinite(mags) & npisfinite(errs)
+    fmags = mags[find]
+
+    sigind = _sigclip_finite_mask(fmags,
+                                  sigclip=sigclip,
+                                  iterative=iterative,
+                                  magsarefluxes=magsarefluxes)
+
+    if sigind is not None:
+        find[find] = sigind
+
+    return find
+
+
+
+def sigclip_magseries_batch_mask(times, mags, errs=None,
+                                 sigclip=None,
+                                 iterative=False,
+                                 magsarefluxes=False):
+    '''This returns the sigma-clip masks for a 2-D stack of mag series.
+
+    times is either a 1-D array shared by all the mag series, or a 2-D array
+    of the same shape as mags. mags is a 2-D array with one mag series per row
+    (e.g. all the magcols of an LC). errs is None or a 2-D array like mags.
+    The other kwargs are the same as for sigclip_magseries.
+
+    Returns a 2-D boolean array like mags. Each row is the same as the output
+    of sigclip_magseries_mask for that row. The finite mask for shared times
+    and the work arrays for the sigma-clip are only made once for all rows.
+
+    '''
+
+    mags = np.atleast_2d(mags)
+    nseries, npoints = mags.shape
+
+    times = np.asarray(times)
+    if times.ndim == 1:
+        finitetimes = npisfinite(times)[None,:]
+    else:
+        finitetimes = npisfinite(times)
+
+    # fake the errors if they don't exist
+    if errs is None:
+        finitemask = finitetimes & npisfinite(mags)
+    else:
+        finitemask = finitetimes & npisfinite(mags) & npisfinite(errs)
+
+    workspace = _sigclip_workspace(npoints)
+
+    for row, find in enumerate(finitemask):
+
+        sigind = _sigclip_finite_mask(mags[row][find],
+                                      sigclip=sigclip,
+                                      iterative=iterative,
+                                      magsarefluxes=magsarefluxes,
+                                      workspace=workspace)
+
+        if sigind is not None:
+            find[find] = sigind
+
+    return finitemask
+
+
+
+def sigclip_magseries(times, mags, errs,
+                      sigclip=None,
+                      iterative=False,
+                      magsarefluxes=False):
+    '''
+    Select the finite times, magnitudes (or fluxes), and errors from the
+    passed values, and apply symmetric or asymmetric sigma clipping to them.
+    Returns sigma-clipped times, mags, and errs.
+
+    Args:
+        times (np.array): ...
+
+        mags (np.array): numpy array to sigma-clip. Does not assume all values
+        are finite. Does not assume anything about whether they're
+        positive/negative.
+
+        errs (np.array): ...
+
+        iterative (bool): True if you want iterative sigma-clipping.
+
+        magsarefluxes (bool): True if your "mags" are in fact fluxes, i.e. if
+        "dimming" corresponds to your "mags" getting smaller.
+
+        sigclip (float or list): If float, apply symmetric sigma clipping. If
+        list, e.g., [10., 3.], will sigclip out greater than 10-sigma dimmings
+        and greater than 3-sigma brightenings. Here the meaning of "dimming"
+        and "brightening" is set by *physics* (not the magnitude system), which
+        is why the `magsarefluxes` kwarg must be correctly set.
+
+    Returns:
+        stimes, smags, serrs: (sigmaclipped values of each).
+
+    If times, mags, and errs are the arrays of a CleanedMagSeries, the
+    results are taken from it instead. These are read-only arrays that are
+    shared with other callers.
+    '''
+
+    # reuse the finite values, median, MAD, and any earlier results for the
+    # same sigclip if these arrays are from a CleanedMagSeries
+    cleaned = get_cleaned_magseries(times, mags, errs)
+    if cleaned is not None:
+        return cleaned.sigclip(sigclip=sigclip,
+                               iterative=iterative,
+                               magsarefluxes=magsarefluxes)
+
+    find = sigclip_magseries_mask(times, mags, errs,
+                                  sigclip=sigclip,
+                                  iterative=iterative,
+                                  magsarefluxes=magsarefluxes)
+
+    # this only copies the arrays once for all of the finite-value filtering
+    # and sigma-clipping
+    stimes, smags = times[find], mags[find]
+
+    # we don't return dummy values if the input errs are None
+    if errs is not None:
+        return stimes, smags, errs[find]
     else:
         return stimes, smags, None
 
@@ -464,174 +668,280 @@ def sigclip_magseries_with_extparams(times, mags, errs, extparams,
 
     '''
 
-    returnerrs = True
-
-    # fake the errors if they don't exist
-    # this is inconsequential to sigma-clipping
-    # we don't return these dummy values if the input errs are None
-    if errs is None:
-        # assume 0.1% errors if not given
-        # this should work for mags and fluxes
-        errs = 0.001*mags
-        returnerrs = False
-
-    # filter the input times, mags, errs; do sigclipping and normalization
-    find = npisfinite(times) & npisfinite(mags) & npisfinite(errs)
-    ftimes, fmags, ferrs = times[find], mags[find], errs[find]
+    find = sigclip_magseries_mask(times, mags, errs,
+                                  sigclip=sigclip,
+                                  iterative=iterative,
+                                  magsarefluxes=magsarefluxes)
 
     # apply the same indices to the external parameters
     for epi, eparr in enumerate(extparams):
         extparams[epi] = eparr[find]
 
-    # get the median and stdev = 1.483 x MAD
-    median_mag = npmedian(fmags)
-    stddev_mag = (npmedian(npabs(fmags - median_mag))) * 1.483
+    if errs is not None:
+        return times[find], mags[find], errs[find], extparams
+    else:
+        return times[find], mags[find], None, extparams
 
-    # sigclip next for a single sigclip value
-    if sigclip and isinstance(sigclip,float):
 
-        if not iterative:
 
-            sigind = (npabs(fmags - median_mag)) < (sigclip * stddev_mag)
+########################
+## CLEANED MAG SERIES ##
+########################
 
-            stimes = ftimes[sigind]
-            smags = fmags[sigind]
-            serrs = ferrs[sigind]
+# this maps (id(times), id(mags), id(errs)) -> CleanedMagSeries for all live
+# objects, so sigclip_magseries can find the cleaned LC for passed-in arrays
+_CLEANED_MAGSERIES = weakref.WeakValueDictionary()
 
-            # apply the same indices to the external parameters
-            for epi, eparr in enumerate(extparams):
-                extparams[epi] = eparr[sigind]
 
-        else:
+def _readonly_array(values):
+    '''This returns a read-only copy of values as a numpy array.
 
-            #
-            # iterative version adapted from scipy.stats.sigmaclip
-            #
-            delta = 1
+    '''
+    if values is None:
+        return None
 
-            this_times = ftimes
-            this_mags = fmags
-            this_errs = ferrs
+    arr = np.array(values)
+    arr.setflags(write=False)
+    return arr
 
-            while delta:
 
-                this_median = npmedian(this_mags)
-                this_stdev = (npmedian(npabs(this_mags - this_median))) * 1.483
-                this_size = this_mags.size
 
-                # apply the sigclip
-                tsi = (npabs(this_mags - this_median)) < (sigclip * this_stdev)
+class CleanedMagSeries(object):
+    '''This is a light curve that's cleaned once and shared between stages.
 
-                # update the arrays
-                this_times = this_times[tsi]
-                this_mags = this_mags[tsi]
-                this_errs = this_errs[tsi]
+    The input times, mags, errs are copied into read-only arrays available as
+    the times, mags, errs attributes. The finite-value mask, the median and
+    MAD of the finite mags, sorted-time indices, and the results of each
+    distinct sigma-clip are calculated on first use and kept around.
 
-                # apply the same indices to the external parameters
-                for epi, eparr in enumerate(extparams):
-                    extparams[epi] = eparr[tsi]
+    Anything that takes times, mags, errs and calls sigclip_magseries on them
+    (the period-finders in periodbase, the feature functions in varbase and
+    varclass, checkplot_dict, etc.) can use this object's arrays directly::
 
-                # update delta and go to the top of the loop
-                delta = this_size - this_mags.size
+        lc = CleanedMagSeries(times, mags, errs)
+        pgen_lsp(lc.times, lc.mags, lc.errs, sigclip=10.0)
 
-            # final sigclipped versions
-            stimes, smags, serrs = this_times, this_mags, this_errs
+    or by unpacking it::
 
+        stellingwerf_pdm(*lc, sigclip=10.0)
 
-    # this handles sigclipping for asymmetric +ve and -ve clip values
-    elif sigclip and isinstance(sigclip,list) and len(sigclip) == 2:
+    In these cases, sigclip_magseries returns the cached arrays from this
+    object instead of masking and sigma-clipping the LC again. All arrays
+    returned by this object are read-only, so copy them before changing them
+    in place.
 
-        # sigclip is passed as [dimmingclip, brighteningclip]
-        dimmingclip = sigclip[0]
-        brighteningclip = sigclip[1]
+    '''
 
-        if not iterative:
+    def __init__(self, times, mags, errs=None, magsarefluxes=False):
+        '''Sets up the cleaned LC.
 
-            if magsarefluxes:
-                nottoodimind = (
-                    (fmags - median_mag) > (-dimmingclip*stddev_mag)
-                )
-                nottoobrightind = (
-                    (fmags - median_mag) < (brighteningclip*stddev_mag)
-                )
+        times, mags, errs are the arrays of the light curve. errs can be None.
+
+        magsarefluxes is the default value of the same kwarg for the
+        sigclip method.
+
+        '''
+
+        self.times = _readonly_array(times)
+        self.mags = _readonly_array(mags)
+        self.errs = _readonly_array(errs)
+        self.magsarefluxes = magsarefluxes
+
+        self._finiteind = None
+        self._finite = None
+        self._median = None
+        self._mad = None
+        self._sortind = None
+        self._sigclipped = {}
+
+        _CLEANED_MAGSERIES[(id(self.times),
+                            id(self.mags),
+                            id(self.errs))] = self
+
+
+    def __iter__(self):
+        '''This yields times, mags, errs so the object can be unpacked.
+
+        '''
+        return iter((self.times, self.mags, self.errs))
+
+
+    def __len__(self):
+        return self.times.size
+
+
+    def __repr__(self):
+        return '<CleanedMagSeries: %s points, %s finite>' % (
+            self.times.size,
+            self.finite_index.sum()
+        )
+
+
+    @property
+    def finite_index(self):
+        '''This is the boolean mask of the finite times, mags, errs.
+
+        '''
+        if self._finiteind is None:
+
+            # sigclip_magseries fakes errs as 0.001*mags if they're None
+            if self.errs is None:
+                errs = 0.001*self.mags
             else:
-                nottoodimind = (
-                    (fmags - median_mag) < (dimmingclip*stddev_mag)
-                )
-                nottoobrightind = (
-                    (fmags - median_mag) > (-brighteningclip*stddev_mag)
-                )
+                errs = self.errs
 
-            sigind = nottoodimind & nottoobrightind
+            finiteind = (npisfinite(self.times) &
+                         npisfinite(self.mags) &
+                         npisfinite(errs))
+            finiteind.setflags(write=False)
+            self._finiteind = finiteind
 
-            stimes = ftimes[sigind]
-            smags = fmags[sigind]
-            serrs = ferrs[sigind]
+        return self._finiteind
 
-            # apply the same indices to the external parameters
-            for epi, eparr in enumerate(extparams):
-                extparams[epi] = eparr[sigind]
 
-        else:
+    @property
+    def finite(self):
+        '''This is a tuple of the finite (times, mags, errs).
 
-            #
-            # iterative version adapted from scipy.stats.sigmaclip
-            #
-            delta = 1
+        The errs are 0.001*mags if the errs weren't given.
 
-            this_times = ftimes
-            this_mags = fmags
-            this_errs = ferrs
+        '''
+        if self._finite is None:
 
-            while delta:
+            finiteind = self.finite_index
 
-                this_median = npmedian(this_mags)
-                this_stdev = (npmedian(npabs(this_mags - this_median))) * 1.483
-                this_size = this_mags.size
+            if self.errs is None:
+                errs = 0.001*self.mags
+            else:
+                errs = self.errs
 
-                if magsarefluxes:
-                    nottoodimind = (
-                        (this_mags - this_median) > (-dimmingclip*this_stdev)
-                    )
-                    nottoobrightind = (
-                        (this_mags - this_median) < (brighteningclip*this_stdev)
-                    )
-                else:
-                    nottoodimind = (
-                        (this_mags - this_median) < (dimmingclip*this_stdev)
-                    )
-                    nottoobrightind = (
-                        (this_mags - this_median) > (-brighteningclip*this_stdev)
-                    )
+            self._finite = (_readonly_array(self.times[finiteind]),
+                            _readonly_array(self.mags[finiteind]),
+                            _readonly_array(errs[finiteind]))
 
-                # apply the sigclip
-                tsi = nottoodimind & nottoobrightind
+        return self._finite
 
-                # update the arrays
-                this_times = this_times[tsi]
-                this_mags = this_mags[tsi]
-                this_errs = this_errs[tsi]
 
-                # apply the same indices to the external parameters
-                for epi, eparr in enumerate(extparams):
-                    extparams[epi] = eparr[tsi]
+    @property
+    def median(self):
+        '''This is the median of the finite mags.
 
-                # update delta and go to top of the loop
-                delta = this_size - this_mags.size
+        '''
+        if self._median is None:
+            self._median = npmedian(self.finite[1])
+        return self._median
 
-            # final sigclipped versions
-            stimes, smags, serrs = this_times, this_mags, this_errs
 
-    else:
+    @property
+    def mad(self):
+        '''This is the median absolute deviation of the finite mags.
 
-        stimes = ftimes
-        smags = fmags
-        serrs = ferrs
+        '''
+        if self._mad is None:
+            self._mad = npmedian(npabs(self.finite[1] - self.median))
+        return self._mad
 
-    if returnerrs:
-        return stimes, smags, serrs, extparams
-    else:
-        return stimes, smags, None, extparams
+
+    @property
+    def stdev(self):
+        '''This is the robust stdev (1.483 x MAD) of the finite mags.
+
+        '''
+        return self.mad * 1.483
+
+
+    @property
+    def sortind(self):
+        '''This is the index array that sorts the times in increasing order.
+
+        '''
+        if self._sortind is None:
+            sortind = np.argsort(self.times, kind='mergesort')
+            sortind.setflags(write=False)
+            self._sortind = sortind
+        return self._sortind
+
+
+    def timesorted(self):
+        '''This returns the (times, mags, errs) sorted in time order.
+
+        '''
+        sortind = self.sortind
+        return (self.times[sortind],
+                self.mags[sortind],
+                self.errs[sortind] if self.errs is not None else None)
+
+
+    def sigclip(self,
+                sigclip=None,
+                iterative=False,
+                magsarefluxes=None):
+        '''This returns the sigma-clipped stimes, smags, serrs.
+
+        The kwargs are the same as for sigclip_magseries. If magsarefluxes is
+        None, the value used to set up this object is used. The results are
+        the same as calling sigclip_magseries on the original arrays, and are
+        cached for each distinct set of kwargs.
+
+        '''
+
+        if magsarefluxes is None:
+            magsarefluxes = self.magsarefluxes
+
+        if isinstance(sigclip, list):
+            sigclipkey = tuple(sigclip)
+        else:
+            sigclipkey = sigclip
+        cachekey = (sigclipkey, iterative, magsarefluxes)
+
+        try:
+            if cachekey in self._sigclipped:
+                return self._sigclipped[cachekey]
+        except TypeError:
+            # unhashable sigclip value, so we won't cache the results
+            cachekey = None
+
+        ftimes, fmags, ferrs = self.finite
+
+        stimes, smags, serrs = _sigclip_finite_magseries(
+            ftimes, fmags, ferrs,
+            self.median, self.stdev,
+            sigclip=sigclip,
+            iterative=iterative,
+            magsarefluxes=magsarefluxes
+        )
+
+        if self.errs is None:
+            serrs = None
+
+        for arr in (stimes, smags, serrs):
+            if arr is not None:
+                arr.setflags(write=False)
+
+        sigclipped = (stimes, smags, serrs)
+        if cachekey is not None:
+            self._sigclipped[cachekey] = sigclipped
+
+        return sigclipped
+
+
+
+def get_cleaned_magseries(times, mags, errs=None):
+    '''This returns the CleanedMagSeries that owns times, mags, errs.
+
+    Returns None if these aren't the arrays of a live CleanedMagSeries.
+
+    '''
+
+    cleaned = _CLEANED_MAGSERIES.get((id(times), id(mags), id(errs)))
+
+    if (cleaned is not None and
+        cleaned.times is times and
+        cleaned.mags is mags and
+        cleaned.errs is errs):
+        return cleaned
+
+    return None
 
 
 
@@ -728,15 +1038,175 @@ def phase_magseries_with_errs(times, mags, errs, period, epoch,
 ## BINNING LCs ##
 #################
 
+# these are the statistics that get_binned_stats can calculate for each bin
+BINSTATS = ('mean', 'median', 'std', 'count')
+
+
+def _get_bin_sums(sortedvals, bounds):
+    '''This returns the sums of sortedvals between each pair of bounds.
+
+    bounds is the flattened array of (start, end) index pairs for the bins.
+
+    '''
+
+    # reduceat sums from each index up to the next one, so every other value is
+    # the sum over a bin. the padding lets the last end be sortedvals.size.
+    return np.add.reduceat(np.append(sortedvals, 0.0), bounds)[0::2]
+
+
+
+def get_binned_stats(bincoords,
+                     values,
+                     binsize,
+                     minbinelems=7,
+                     binstats=('median',)):
+    '''This bins arrays of values on the same coordinates and gets their
+    statistics in each bin.
+
+    bincoords is an array of finite coordinates (times or phases) and values
+    is a list of finite arrays with the same length. The bins are binsize wide
+    and are centered on min(bincoords) + k x binsize for k = 0, 1, 2, ... Each
+    point goes into the bin with the nearest center, and a point right on the
+    edge between two bins goes into the later one. Only the bins with at least
+    minbinelems points are kept.
+
+    This sorts bincoords once and finds the bin edges in it using
+    np.searchsorted. The sums for the mean and std are then calculated for all
+    bins at once using np.add.reduceat, and the medians are taken from the
+    values sorted within each bin, so this takes O(N log N) time overall.
+
+    binstats is a list of the statistics to get for each array in values,
+    which can be any of BINSTATS.
+
+    Returns a dict with the following keys:
+
+    'bincenters': the centers of all the bins, including the empty ones
+    'binindices': a list of arrays of the indices of the points in each of the
+                  kept bins
+    'bincounts': the number of points in each of the kept bins
+    'binnedcoords': the median of bincoords in each of the kept bins
+    'binnedvalues': a list with a dict for each array in values, with the
+                    statistics in binstats as keys and arrays of their values
+                    in each of the kept bins as values
+
+    '''
+
+    bincoords = np.asarray(bincoords, dtype=np.float64)
+    values = [np.asarray(x) for x in values]
+
+    mincoord = bincoords.min()
+    nbins = int(np.ceil((bincoords.max() - mincoord)/binsize) + 1)
+    bincenters = mincoord + np.arange(nbins)*binsize
+
+    # sort the points once. mergesort keeps equal coords in their input order.
+    sortind = np.argsort(bincoords, kind='mergesort')
+    sortedcoords = bincoords[sortind]
+
+    # the bin edges are halfway between the bin centers
+    binedges = mincoord + (np.arange(nbins + 1) - 0.5)*binsize
+    edgeind = np.searchsorted(sortedcoords, binedges, side='left')
+    edgeind[0], edgeind[-1] = 0, sortedcoords.size
+
+    allcounts = np.diff(edgeind)
+    keep = allcounts >= max(minbinelems, 1)
+
+    starts = edgeind[:-1][keep]
+    counts = allcounts[keep]
+    ends = starts + counts
+
+    bounds = np.empty(2*starts.size, dtype=np.intp)
+    bounds[0::2] = starts
+    bounds[1::2] = ends
+
+    # the coords are sorted within each bin, so the median is in the middle
+    lowmid, highmid = starts + (counts - 1)//2, starts + counts//2
+    binnedcoords = 0.5*(sortedcoords[lowmid] + sortedcoords[highmid])
+
+    # the bin number of each of the sorted points
+    binnums = np.repeat(np.arange(nbins), allcounts)
+
+    binnedvalues = []
+
+    for vals in values:
+
+        sortedvals = vals[sortind]
+        valstats = {}
+
+        if 'mean' in binstats or 'std' in binstats:
+
+            if starts.size > 0:
+                means = _get_bin_sums(sortedvals, bounds)/counts
+            else:
+                means = np.array([])
+
+            if 'mean' in binstats:
+                valstats['mean'] = means
+
+            if 'std' in binstats:
+
+                allmeans = np.zeros(nbins)
+                allmeans[keep] = means
+                deviations = sortedvals - allmeans[binnums]
+
+                if starts.size > 0:
+                    valstats['std'] = np.sqrt(
+                        _get_bin_sums(deviations*deviations, bounds)/counts
+                    )
+                else:
+                    valstats['std'] = np.array([])
+
+        if 'median' in binstats:
+
+            # sort the values within each bin. the bins stay where they are,
+            # so the medians are in the middle of each bin as for the coords.
+            binsorted = sortedvals[np.lexsort((sortedvals, binnums))]
+            valstats['median'] = 0.5*(binsorted[lowmid] + binsorted[highmid])
+
+        if 'count' in binstats:
+            valstats['count'] = counts
+
+        binnedvalues.append(valstats)
+
+    return {'bincenters':bincenters,
+            'binindices':[sortind[x:y] for x, y in zip(starts, ends)],
+            'bincounts':counts,
+            'binnedcoords':binnedcoords,
+            'binnedvalues':binnedvalues}
+
+
+
+def _add_binstats(collected_binned_mags, binnedvalues, binstats, key):
+    '''This adds the extra binstats for a binned array to the output dict.
+
+    The counts go into 'binnedcounts' and the other stats into
+    '<key>_<stat>', e.g. 'binnedmags_std'.
+
+    '''
+
+    for stat in binstats:
+        if stat == 'count':
+            collected_binned_mags['binnedcounts'] = binnedvalues['count']
+        else:
+            collected_binned_mags['%s_%s' % (key, stat)] = binnedvalues[stat]
+
+
+
 def time_bin_magseries(times, mags,
                        binsize=540.0,
-                       minbinelems=7):
+                       minbinelems=7,
+                       binstats=None):
     '''This bins the given mag timeseries in time using the binsize given.
 
     binsize is in seconds.
 
     minbinelems is the minimum number of elements per bin.
 
+    binstats is an optional list of extra statistics from BINSTATS to get for
+    the mags in each bin. These go into the 'binnedmags_<stat>' keys of the
+    returned dict, except for 'count', which goes into 'binnedcounts'. The
+    'binnedmags' are always the medians. See get_binned_stats for how the bins
+    are made.
+
     '''
 
     # check if the input arrays are ok
@@ -752,55 +1222,28 @@ def time_bin_magseries(times, mags,
 
     # convert binsize in seconds to JD units
     binsizejd = binsize/(86400.0)
-    nbins = int(np.ceil((np.nanmax(finite_times) -
-                         np.nanmin(finite_times))/binsizejd) + 1)
-
-    minjd = np.nanmin(finite_times)
-    jdbins = [(minjd + x*binsizejd) for x in range(nbins)]
 
-    # make a KD-tree on the JDs so we can do fast distance calculations.  we
-    # need to add a bogus y coord to make this a problem that KD-trees can
-    # solve.
-    time_coords = np.array([[x,1.0] for x in finite_times])
-    jdtree = kdtree(time_coords)
-    binned_finite_timeseries_indices = []
+    binstats = tuple(binstats) if binstats else ()
+    binned = get_binned_stats(finite_times,
+                              [finite_mags],
+                              binsizejd,
+                              minbinelems=minbinelems,
+                              binstats=('median',) + binstats)
 
     collected_binned_mags = {}
 
-    for jd in jdbins:
-        # find all bin indices close to within binsizejd of this point
-        # using the kdtree query. we use the p-norm = 1 (I think this
-        # means straight-up pairwise distance? FIXME: check this)
-        bin_indices = jdtree.query_ball_point(np.array([jd,1.0]),
-                                              binsizejd/2.0, p=1.0)
-
-        # if the bin_indices have already been collected, then we're
-        # done with this bin, move to the next one. if they haven't,
-        # then this is the start of a new bin.
-        if (bin_indices not in binned_finite_timeseries_indices and
-            len(bin_indices) >= minbinelems):
-
-            binned_finite_timeseries_indices.append(bin_indices)
-
-    # convert to ndarrays
-    binned_finite_timeseries_indices = [np.array(x) for x in
-                                        binned_finite_timeseries_indices]
-
-    collected_binned_mags['jdbins_indices'] = binned_finite_timeseries_indices
-    collected_binned_mags['jdbins'] = jdbins
-    collected_binned_mags['nbins'] = len(binned_finite_timeseries_indices)
-
-    # collect the finite_times
-    binned_jd = np.array([np.median(finite_times[x])
-                          for x in binned_finite_timeseries_indices])
-    collected_binned_mags['binnedtimes'] = binned_jd
+    collected_binned_mags['jdbins_indices'] = binned['binindices']
+    collected_binned_mags['jdbins'] = binned['bincenters'].tolist()
+    collected_binned_mags['nbins'] = len(binned['binindices'])
+
+    # the median time in each bin
+    collected_binned_mags['binnedtimes'] = binned['binnedcoords']
     collected_binned_mags['binsize'] = binsize
 
-    # median bin the magnitudes according to the calculated indices
-    collected_binned_mags['binnedmags'] = (
-        np.array([np.median(finite_mags[x])
-                  for x in binned_finite_timeseries_indices])
-        )
+    # median bin the magnitudes
+    collected_binned_mags['binnedmags'] = binned['binnedvalues'][0]['median']
+    _add_binstats(collected_binned_mags, binned['binnedvalues'][0],
+                  binstats, 'binnedmags')
 
     return collected_binned_mags
 
@@ -808,13 +1251,17 @@ def time_bin_magseries(times, mags,
 
 def time_bin_magseries_with_errs(times, mags, errs,
                                  binsize=540.0,
-                                 minbinelems=7):
+                                 minbinelems=7,
+                                 binstats=None):
     '''This bins the given mag timeseries in time using the binsize given.
 
     binsize is in seconds.
 
     minbinelems is the number of minimum elements in a bin.
 
+    binstats is an optional list of extra statistics from BINSTATS to get for
+    the mags and errs in each bin (see time_bin_magseries).
+
     '''
 
     # check if the input arrays are ok
@@ -832,63 +1279,34 @@ def time_bin_magseries_with_errs(times, mags, errs,
 
     # convert binsize in seconds to JD units
     binsizejd = binsize/(86400.0)
-    nbins = int(np.ceil((np.nanmax(finite_times) -
-                         np.nanmin(finite_times))/binsizejd) + 1)
 
-    minjd = np.nanmin(finite_times)
-    jdbins = [(minjd + x*binsizejd) for x in range(nbins)]
-
-    # make a KD-tree on the JDs so we can do fast distance calculations.  we
-    # need to add a bogus y coord to make this a problem that KD-trees can
-    # solve.
-    time_coords = np.array([[x,1.0] for x in finite_times])
-    jdtree = kdtree(time_coords)
-    binned_finite_timeseries_indices = []
+    binstats = tuple(binstats) if binstats else ()
+    binned = get_binned_stats(finite_times,
+                              [finite_mags, finite_errs],
+                              binsizejd,
+                              minbinelems=minbinelems,
+                              binstats=('median',) + binstats)
 
     collected_binned_mags = {}
 
-    for jd in jdbins:
-
-        # find all bin indices close to within binsize of this point using the
-        # kdtree query. we use the p-norm = 1 for pairwise Euclidean distance.
-        bin_indices = jdtree.query_ball_point(np.array([jd,1.0]),
-                                              binsizejd/2.0, p=1.0)
-
-        # if the bin_indices have already been collected, then we're
-        # done with this bin, move to the next one. if they haven't,
-        # then this is the start of a new bin.
-        if (bin_indices not in binned_finite_timeseries_indices and
-            len(bin_indices) >= minbinelems):
+    collected_binned_mags['jdbins_indices'] = binned['binindices']
+    collected_binned_mags['jdbins'] = binned['bincenters']
+    collected_binned_mags['nbins'] = len(binned['binindices'])
 
-            binned_finite_timeseries_indices.append(bin_indices)
-
-    # convert to ndarrays
-    binned_finite_timeseries_indices = [np.array(x) for x in
-                                        binned_finite_timeseries_indices]
-
-    collected_binned_mags['jdbins_indices'] = binned_finite_timeseries_indices
-    collected_binned_mags['jdbins'] = np.array(jdbins)
-    collected_binned_mags['nbins'] = len(binned_finite_timeseries_indices)
-
-    # collect the finite_times
-    binned_jd = np.array([np.median(finite_times[x])
-                          for x in binned_finite_timeseries_indices])
-    collected_binned_mags['binnedtimes'] = binned_jd
+    # the median time in each bin
+    collected_binned_mags['binnedtimes'] = binned['binnedcoords']
     collected_binned_mags['binsize'] = binsize
 
-    # median bin the magnitudes according to the calculated indices
-    collected_binned_mags['binnedmags'] = (
-        np.array([np.median(finite_mags[x])
-                  for x in binned_finite_timeseries_indices])
-        )
+    # median bin the magnitudes
+    collected_binned_mags['binnedmags'] = binned['binnedvalues'][0]['median']
+    _add_binstats(collected_binned_mags, binned['binnedvalues'][0],
+                  binstats, 'binnedmags')
 
     # FIXME: calculate the error in the median-binned magnitude correctly
     # for now, just take the median of the errors in this bin
-    collected_binned_mags['binnederrs'] = (
-        np.array([np.median(finite_errs[x])
-                  for x in binned_finite_timeseries_indices])
-        )
-
+    collected_binned_mags['binnederrs'] = binned['binnedvalues'][1]['median']
+    _add_binstats(collected_binned_mags, binned['binnedvalues'][1],
+                  binstats, 'binnederrs')
 
     return collected_binned_mags
 
@@ -896,13 +1314,17 @@ def time_bin_magseries_with_errs(times, mags, errs,
 
 def phase_bin_magseries(phases, mags,
                         binsize=0.005,
-                        minbinelems=7):
+                        minbinelems=7,
+                        binstats=None):
     '''
     This bins a magnitude timeseries in phase using the binsize (in phase)
     provided.
 
     minbinelems is the minimum number of elements in each bin.
 
+    binstats is an optional list of extra statistics from BINSTATS to get for
+    the mags in each bin (see time_bin_magseries).
+
     '''
 
     # check if the input arrays are ok
@@ -916,58 +1338,27 @@ def phase_bin_magseries(phases, mags,
     finite_phases = phases[finiteind]
     finite_mags = mags[finiteind]
 
-    nbins = int(np.ceil((np.nanmax(finite_phases) -
-                         np.nanmin(finite_phases))/binsize) + 1)
-
-    minphase = np.nanmin(finite_phases)
-    phasebins = [(minphase + x*binsize) for x in range(nbins)]
-
-    # make a KD-tree on the PHASEs so we can do fast distance calculations.  we
-    # need to add a bogus y coord to make this a problem that KD-trees can
-    # solve.
-    time_coords = np.array([[x,1.0] for x in finite_phases])
-    phasetree = kdtree(time_coords)
-    binned_finite_phaseseries_indices = []
+    binstats = tuple(binstats) if binstats else ()
+    binned = get_binned_stats(finite_phases,
+                              [finite_mags],
+                              binsize,
+                              minbinelems=minbinelems,
+                              binstats=('median',) + binstats)
 
     collected_binned_mags = {}
 
-    for phase in phasebins:
-
-        # find all bin indices close to within binsize of this point using the
-        # kdtree query. we use the p-norm = 1 for pairwise Euclidean distance.
-        bin_indices = phasetree.query_ball_point(np.array([phase,1.0]),
-                                              binsize/2.0, p=1.0)
-
-        # if the bin_indices have already been collected, then we're
-        # done with this bin, move to the next one. if they haven't,
-        # then this is the start of a new bin.
-        if (bin_indices not in binned_finite_phaseseries_indices and
-            len(bin_indices) >= minbinelems):
-
-            binned_finite_phaseseries_indices.append(bin_indices)
-
-    # convert to ndarrays
-    binned_finite_phaseseries_indices = [np.array(x) for x in
-                                         binned_finite_phaseseries_indices]
-
-    collected_binned_mags['phasebins_indices'] = (
-        binned_finite_phaseseries_indices
-    )
-    collected_binned_mags['phasebins'] = phasebins
-    collected_binned_mags['nbins'] = len(binned_finite_phaseseries_indices)
+    collected_binned_mags['phasebins_indices'] = binned['binindices']
+    collected_binned_mags['phasebins'] = binned['bincenters'].tolist()
+    collected_binned_mags['nbins'] = len(binned['binindices'])
 
-    # collect the finite_phases
-    binned_phase = np.array([np.median(finite_phases[x])
-                             for x in binned_finite_phaseseries_indices])
-    collected_binned_mags['binnedphases'] = binned_phase
+    # the median phase in each bin
+    collected_binned_mags['binnedphases'] = binned['binnedcoords']
     collected_binned_mags['binsize'] = binsize
 
-    # median bin the magnitudes according to the calculated indices
-    collected_binned_mags['binnedmags'] = (
-        np.array([np.median(finite_mags[x])
-                  for x in binned_finite_phaseseries_indices])
-        )
-
+    # median bin the magnitudes
+    collected_binned_mags['binnedmags'] = binned['binnedvalues'][0]['median']
+    _add_binstats(collected_binned_mags, binned['binnedvalues'][0],
+                  binstats, 'binnedmags')
 
     return collected_binned_mags
 
@@ -975,13 +1366,17 @@ def phase_bin_magseries(phases, mags,
 
 def phase_bin_magseries_with_errs(phases, mags, errs,
                                   binsize=0.005,
-                                  minbinelems=7):
+                                  minbinelems=7,
+                                  binstats=None):
     '''
     This bins a magnitude timeseries in phase using the binsize (in phase)
     provided.
 
     minbinelems is the minimum number of elements in each bin.
 
+    binstats is an optional list of extra statistics from BINSTATS to get for
+    the mags and errs in each bin (see time_bin_magseries).
+
     '''
 
     # check if the input arrays are ok
@@ -996,70 +1391,93 @@ def phase_bin_magseries_with_errs(phases, mags, errs,
     finite_mags = mags[finiteind]
     finite_errs = errs[finiteind]
 
-    nbins = int(np.ceil((np.nanmax(finite_phases) -
-                         np.nanmin(finite_phases))/binsize) + 1)
+    binstats = tuple(binstats) if binstats else ()
+    binned = get_binned_stats(finite_phases,
+                              [finite_mags, finite_errs],
+                              binsize,
+                              minbinelems=minbinelems,
+                              binstats=('median',) + binstats)
 
-    minphase = np.nanmin(finite_phases)
-    phasebins = [(minphase + x*binsize) for x in range(nbins)]
+    collected_binned_mags = {}
 
-    # make a KD-tree on the PHASEs so we can do fast distance calculations.  we
-    # need to add a bogus y coord to make this a problem that KD-trees can
-    # solve.
-    time_coords = np.array([[x,1.0] for x in finite_phases])
-    phasetree = kdtree(time_coords)
-    binned_finite_phaseseries_indices = []
+    collected_binned_mags['phasebins_indices'] = binned['binindices']
+    collected_binned_mags['phasebins'] = binned['bincenters'].tolist()
+    collected_binned_mags['nbins'] = len(binned['binindices'])
 
-    collected_binned_mags = {}
+    # the median phase in each bin
+    collected_binned_mags['binnedphases'] = binned['binnedcoords']
+    collected_binned_mags['binsize'] = binsize
 
-    for phase in phasebins:
+    # median bin the magnitudes and errs
+    collected_binned_mags['binnedmags'] = binned['binnedvalues'][0]['median']
+    _add_binstats(collected_binned_mags, binned['binnedvalues'][0],
+                  binstats, 'binnedmags')
 
-        # find all bin indices close to within binsize of this point using the
-        # kdtree query. we use the p-norm = 1 for pairwise Euclidean distance.
-        bin_indices = phasetree.query_ball_point(np.array([phase,1.0]),
-                                              binsize/2.0, p=1.0)
+    collected_binned_mags['binnederrs'] = binned['binnedvalues'][1]['median']
+    _add_binstats(collected_binned_mags, binned['binnedvalues'][1],
+                  binstats, 'binnederrs')
 
-        # if the bin_indices have already been collected, then we're
-        # done with this bin, move to the next one. if they haven't,
-        # then this is the start of a new bin.
-        if (bin_indices not in binned_finite_phaseseries_indices and
-            len(bin_indices) >= minbinelems):
+    return collected_binned_mags
 
-            binned_finite_phaseseries_indices.append(bin_indices)
 
-    # convert to ndarrays
-    binned_finite_phaseseries_indices = [np.array(x) for x in
-                                         binned_finite_phaseseries_indices]
 
-    collected_binned_mags['phasebins_indices'] = (
-        binned_finite_phaseseries_indices
-    )
-    collected_binned_mags['phasebins'] = phasebins
-    collected_binned_mags['nbins'] = len(binned_finite_phaseseries_indices)
+#############################
+## FILLING TIMESERIES GAPS ##
+#############################
 
-    # collect the finite_phases
-    binned_phase = np.array([np.median(finite_phases[x])
-                          for x in binned_finite_phaseseries_indices])
-    collected_binned_mags['binnedphases'] = binned_phase
-    collected_binned_mags['binsize'] = binsize
+def _get_slice_medians(values, starts, sizes):
+    '''This gets the medians of the slices values[start:start+size].
 
-    # median bin the magnitudes according to the calculated indices
-    collected_binned_mags['binnedmags'] = (
-        np.array([np.median(finite_mags[x])
-                  for x in binned_finite_phaseseries_indices])
-        )
-    collected_binned_mags['binnederrs'] = (
-        np.array([np.median(finite_errs[x])
-                  for x in binned_finite_phaseseries_indices])
-        )
+    The slices can overlap. All the medians are found with one lexsort of the
+    values in the slices, and are the same as np.median of each slice.
 
+    '''
 
-    return collected_binned_mags
+    # the indices of the values in all slices and the slice each belongs to
+    sliceinds = np.repeat(np.arange(sizes.size), sizes)
+    slicestarts = np.cumsum(sizes) - sizes
+    valueinds = (np.arange(sliceinds.size) -
+                 slicestarts[sliceinds] +
+                 starts[sliceinds])
 
+    # sort the values within each slice
+    slicevalues = values[valueinds]
+    slicevalues = slicevalues[np.lexsort((slicevalues, sliceinds))]
+
+    # the middle elements of each slice
+    upperinds = slicestarts + sizes//2
+    lowerinds = slicestarts + (sizes - 1)//2
+
+    return (slicevalues[lowerinds] + slicevalues[upperinds]) / 2.0
+
+
+
+def _get_noiselevel(smags, filterwindow=11, sigclip=3.0):
+    '''This estimates the white noise level of a mag series.
+
+    This follows McQuillan+ 2013a: the mags are smoothed with a median filter
+    followed by a boxcar filter, both with filterwindow-point windows, and the
+    noise level is the stdev of the residuals from the smoothed mags after
+    iterative sigma-clipping with sigclip.
+
+    '''
+
+    smoothed = uniform_filter1d(
+        median_filter(smags, size=filterwindow, mode='nearest'),
+        filterwindow,
+        mode='nearest'
+    )
+    residuals = smags - smoothed
+
+    keepind = _sigclip_finite_mask(residuals,
+                                   sigclip=float(sigclip),
+                                   iterative=True)
+    if keepind is not None:
+        residuals = residuals[keepind]
+
+    return np.std(residuals)
 
 
-#############################
-## FILLING TIMESERIES GAPS ##
-#############################
 
 def fill_magseries_gaps(times, mags, errs,
                         fillgaps=0.0,
@@ -1067,6 +1485,8 @@ def fill_magseries_gaps(times, mags, errs,
                         magsarefluxes=False,
                         filterwindow=11,
                         forcetimebin=None,
+                        dtype=np.float64,
+                        out=None,
                         verbose=True):
     '''This fills in gaps in a light curve.
 
@@ -1092,10 +1512,12 @@ def fill_magseries_gaps(times, mags, errs,
     clipping of outliers."
 
     If fillgaps == 'noiselevel', fills the gaps with the noise level obtained
-    via the procedure above. If fillgaps == 'nan', fills the gaps with
-    np.nan. Otherwise, if fillgaps is a float, will use that value to fill the
-    gaps. The default is to fill the gaps with 0.0 (as in McQuillan+ 2014) to
-    "...prevent them contributing to the ACF".
+    via the procedure above, using filterwindow-point windows. If fillgaps ==
+    'nan', fills the gaps with np.nan. If fillgaps == 'interpolate', fills the
+    gaps by linear interpolation between the nearest filled cadences. Otherwise,
+    if fillgaps is a float, will use that value to fill the gaps. The default
+    is to fill the gaps with 0.0 (as in McQuillan+ 2014) to "...prevent them
+    contributing to the ACF".
 
     If forcetimebin is a float, this value will be used to generate the
     interpolated time series, effectively binning the light curve to this
@@ -1104,6 +1526,17 @@ def fill_magseries_gaps(times, mags, errs,
     NOTE: forcetimebin must be in the same units as times; e.g. if times are JD
     then forcetimebin must be in days.
 
+    dtype sets the dtype of the output imags and ierrs, e.g. np.float32 to
+    halve the memory used by the ACF for long light curves. The output itimes
+    are always np.float64.
+
+    out is an optional preallocated array of shape (2, N) to write the imags
+    and ierrs into, so repeated calls (e.g. for all magcols of an LC) don't
+    need new arrays each time. If N is at least the number of output cadences,
+    the returned imags and ierrs are views into out, and dtype is ignored in
+    favor of out.dtype. Otherwise, new arrays are used. NOTE: the next call
+    with the same out will overwrite the results of this one.
+
     '''
 
     # remove nans
@@ -1119,6 +1552,11 @@ def fill_magseries_gaps(times, mags, errs,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
 
+    if stimes.size < 2:
+        LOGERROR('not enough finite measurements '
+                 'to find the cadence of this light curve')
+        return None
+
     # normalize to zero
     if magsarefluxes:
         smags = smags / np.median(smags) - 1.0
@@ -1131,13 +1569,10 @@ def fill_magseries_gaps(times, mags, errs,
 
     elif isinstance(fillgaps, str) and fillgaps == 'noiselevel':
 
-        # figure out the gaussian noise level by subtracting a Savitsky-Golay
-        # filtered version of the light curve
-        smoothed = smags - savgol_filter(smags, filterwindow, 2)
-        noiselevel = 1.483 * np.median(np.abs(smoothed - np.median(smoothed)))
-        gapfiller = noiselevel
+        # figure out the gaussian noise level as in McQuillan+ 2013a
+        gapfiller = _get_noiselevel(smags, filterwindow=filterwindow)
 
-    elif isinstance(fillgaps, str) and fillgaps == 'nan':
+    elif isinstance(fillgaps, str) and fillgaps in ('nan', 'interpolate'):
 
         gapfiller = np.nan
 
@@ -1148,9 +1583,9 @@ def fill_magseries_gaps(times, mags, errs,
     # get the gaps
     gaps = np.diff(stimes)
 
-    # just use scipy.stats.mode instead of our hacked together nonsense earlier.
-    gapmoderes = scipy.stats.mode(gaps)
-    gapmode = np.asscalar(gapmoderes[0])
+    # this is the smallest of the most common gaps, like scipy.stats.mode
+    uniquegaps, gapcounts = np.unique(gaps, return_counts=True)
+    gapmode = float(uniquegaps[np.argmax(gapcounts)])
 
     LOGINFO('auto-cadence for mag series: %.5f' % gapmode)
 
@@ -1173,27 +1608,65 @@ def fill_magseries_gaps(times, mags, errs,
 
     # first, generate the full time series
     interpolated_times = np.linspace(starttime, endtime, ntimes)
-    interpolated_mags = np.full_like(interpolated_times, gapfiller)
-    interpolated_errs = np.full_like(interpolated_times, gapfiller)
-
-    for ind, itime in enumerate(interpolated_times[:-1]):
-
-        nextitime = itime + gapmode
-        # find the mags between this and the next time bin
-        itimeind = np.where((stimes > itime) & (stimes < nextitime))
 
-        # if there's more than one elem in this time bin, median them
-        if itimeind[0].size > 1:
+    if out is not None and out.shape[0] >= 2 and out.shape[1] >= ntimes:
+        interpolated_mags = out[0,:ntimes]
+        interpolated_errs = out[1,:ntimes]
+    else:
+        if out is not None:
+            LOGWARNING('out has shape %s, which is too small for %s cadences, '
+                       'using new arrays instead' % (out.shape, ntimes))
+        interpolated_mags = np.empty(ntimes, dtype=dtype)
+        interpolated_errs = np.empty(ntimes, dtype=dtype)
+
+    interpolated_mags[:] = gapfiller
+    interpolated_errs[:] = gapfiller
+
+    # each cadence except the last one gets the measurements with times in
+    # the open interval (itime, itime + gapmode). we find these all at once in
+    # the time-sorted arrays
+    sortind = np.argsort(stimes, kind='mergesort')
+    stimes, smags, serrs = stimes[sortind], smags[sortind], serrs[sortind]
+
+    binstarts = interpolated_times[:-1]
+    binfirst = np.searchsorted(stimes, binstarts, side='right')
+    binlast = np.searchsorted(stimes, binstarts + gapmode, side='left')
+    binsizes = binlast - binfirst
+
+    # if there's only one elem in this time bin, take it
+    singlebins = np.flatnonzero(binsizes == 1)
+    interpolated_mags[singlebins] = smags[binfirst[singlebins]]
+    interpolated_errs[singlebins] = serrs[binfirst[singlebins]]
+
+    # if there's more than one elem in this time bin, median them
+    multibins = np.flatnonzero(binsizes > 1)
+    if multibins.size > 0:
+        interpolated_mags[multibins] = _get_slice_medians(
+            smags, binfirst[multibins], binsizes[multibins]
+        )
+        interpolated_errs[multibins] = _get_slice_medians(
+            serrs, binfirst[multibins], binsizes[multibins]
+        )
 
-            interpolated_mags[ind] = np.median(smags[itimeind[0]])
-            interpolated_errs[ind] = np.median(serrs[itimeind[0]])
+    # linearly interpolate over the empty cadences if requested
+    if isinstance(fillgaps, str) and fillgaps == 'interpolate':
 
-        # otherwise, if there's only one elem in this time bin, take it
-        elif itimeind[0].size == 1:
+        filledind = np.zeros(ntimes, dtype=np.bool_)
+        filledind[:-1] = binsizes > 0
 
-            interpolated_mags[ind] = smags[itimeind[0]]
-            interpolated_errs[ind] = serrs[itimeind[0]]
+        if np.any(filledind):
 
+            emptyind = ~filledind
+            interpolated_mags[emptyind] = np.interp(
+                interpolated_times[emptyind],
+                interpolated_times[filledind],
+                interpolated_mags[filledind]
+            )
+            interpolated_errs[emptyind] = np.interp(
+                interpolated_times[emptyind],
+                interpolated_times[filledind],
+                interpolated_errs[filledind]
+            )
 
     return {'itimes':interpolated_times,
             'imags':interpolated_mags,
@@ -79,6 +79,7 @@ def LOGEXCEPTION(message):
 import os
 import os.path
 import sys
+import time
 try:
     import cPickle as pickle
     from cStringIO import StringIO as strio
@@ -91,6 +92,8 @@ import shutil
 import multiprocessing as mp
 from concurrent.futures import ProcessPoolExecutor
 import base64
+import hashlib
+import json
 
 import numpy as np
 import scipy.spatial as sps
@@ -128,8 +131,9 @@ from astrobase.astrokep import read_kepler_fitslc, read_kepler_pklc
 from astrobase import periodbase, checkplot
 from astrobase.varclass import varfeatures, starfeatures, periodicfeatures
 from astrobase.lcmath import normalize_magseries, \
-    time_bin_magseries_with_errs, sigclip_magseries
+    time_bin_magseries_with_errs, sigclip_magseries, CleanedMagSeries
 from astrobase.periodbase.kbls import bls_snr
+from astrobase.periodbase.zgls import glsp_worker, glsp_worker_notau
 
 from astrobase.checkplot import _pkl_magseries_plot, \
     _pkl_phased_magseries_plot, xmatch_external_catalogs, \
@@ -171,12 +175,17 @@ FILTEROPS = {'eq':'==',
 # used to figure out which period finder to run given a list of methods
 PFMETHODS = {'bls':periodbase.bls_parallel_pfind,
              'gls':periodbase.pgen_lsp,
+             'fls':periodbase.fast_lsp,
+             'tls':periodbase.townsend_lsp,
              'aov':periodbase.aov_periodfind,
              'mav':periodbase.aovhm_periodfind,
              'pdm':periodbase.stellingwerf_pdm,
              'acf':periodbase.macf_period_find,
              'win':periodbase.specwindow_lsp}
 
+# these are the period-finders that can run on a periodbase.PeriodFinderExecutor
+EXECUTOR_PFMETHODS = ('bls','gls','aov','mav','pdm','win')
+
 
 
 # LC format -> [default fileglob,  function to read LC format]
@@ -350,6 +359,213 @@ def register_custom_lcformat(formatkey,
 
 
 
+##########################
+## PROCESSING MANIFESTS ##
+##########################
+
+# each processing function below records the cache key of each input file it
+# processes in a manifest called <stage>-manifest.jsonl in its outdir. this
+# has one JSON line per processed input file, and later lines override
+# earlier ones for the same input file
+PROCESSING_MANIFEST = '%s-manifest.jsonl'
+
+# this is the per-process cache of the manifests read so far. this is keyed by
+# the manifest path, each value is [bytes read so far, {inputfile: entry}]
+_PROCESSING_MANIFESTS = {}
+
+
+def _get_inputfile_key(filepath, contenthash=False):
+    '''This returns what identifies the current version of an input file.
+
+    If contenthash is True, this is the SHA512 hash of the file's contents,
+    otherwise, it's the file's size and mtime. Returns None if filepath is None
+    or doesn't exist.
+
+    '''
+
+    if filepath is None or not os.path.exists(filepath):
+        return None
+
+    if contenthash:
+
+        hasher = hashlib.sha512()
+
+        with open(filepath, 'rb') as infd:
+            for chunk in iter(lambda: infd.read(1048576), b''):
+                hasher.update(chunk)
+
+        return hasher.hexdigest()
+
+    else:
+
+        filestat = os.stat(filepath)
+        return (filestat.st_size, filestat.st_mtime)
+
+
+
+def get_processing_cachekey(stage, inputfiles, kwargs, contenthash=False):
+    '''This generates the cache key for processing some input files.
+
+    stage is the name of the processing function, e.g. 'runpf'. inputfiles is
+    a list of the input files (or None for missing optional ones), and kwargs
+    is a dict of all of the kwargs that change the output of the processing.
+
+    The key is the SHA512 hash of the stage, the path of each input file and
+    its size and mtime (or its content hash if contenthash is True), and the
+    kwargs. Dicts in the kwargs are hashed in sorted key order, but lists are
+    hashed in their given order, since the order of timecols, magcols, errcols,
+    and pfmethods is part of the output.
+
+    Returns a hex string.
+
+    '''
+
+    hasher = hashlib.sha512()
+    hasher.update(stage.encode('utf-8'))
+    hasher.update(repr(bool(contenthash)).encode('utf-8'))
+
+    for inputfile in inputfiles:
+
+        if inputfile is not None:
+            inputfile = os.path.abspath(inputfile)
+
+        periodbase.update_cachekey_hash(inputfile, hasher)
+        periodbase.update_cachekey_hash(
+            _get_inputfile_key(inputfile, contenthash=contenthash),
+            hasher
+        )
+
+    periodbase.update_cachekey_hash(kwargs, hasher)
+
+    return hasher.hexdigest()
+
+
+
+def read_processing_manifest(outdir, stage):
+    '''This reads the manifest of processed input files for stage in outdir.
+
+    Returns a dict keyed by the absolute path of each input file. Each value is
+    a dict with the cachekey, the outfile (or list of outfiles), and the UTC
+    time the input file was processed. Stages that can make several outputs
+    from the same input file in the same outdir (e.g. timebinlc at several
+    binsizes) also record a variant for each entry. These entries are keyed
+    by (absolute path, variant) instead.
+
+    '''
+
+    manifestpath = os.path.join(outdir, PROCESSING_MANIFEST % stage)
+
+    if not os.path.exists(manifestpath):
+        _PROCESSING_MANIFESTS.pop(manifestpath, None)
+        return {}
+
+    offset, entries = _PROCESSING_MANIFESTS.get(manifestpath, (0, {}))
+
+    # start over if the manifest was replaced with a shorter one
+    if os.stat(manifestpath).st_size < offset:
+        offset, entries = 0, {}
+
+    # only read the lines added since the last time
+    with open(manifestpath, 'rb') as infd:
+        infd.seek(offset)
+        newlines = infd.read()
+
+    # leave any partly written line at the end for next time
+    lastnewline = newlines.rfind(b'\n')
+
+    if lastnewline > -1:
+
+        for line in newlines[:lastnewline].splitlines():
+
+            try:
+                entry = json.loads(line.decode('utf-8'))
+                entries[_get_manifest_entrykey(entry['inputfile'],
+                                               entry.get('variant'))] = entry
+            except Exception as e:
+                LOGWARNING('skipping a bad line in manifest %s' %
+                           manifestpath)
+
+        offset = offset + lastnewline + 1
+
+    _PROCESSING_MANIFESTS[manifestpath] = (offset, entries)
+
+    return entries
+
+
+
+def _get_manifest_entrykey(inputfile, variant=None):
+    '''This returns the key of an input file's entry in a manifest dict.
+
+    '''
+
+    inputfile = os.path.abspath(inputfile)
+
+    if variant is None:
+        return inputfile
+    else:
+        return (inputfile, variant)
+
+
+
+def _get_processed_outfile(outdir, stage, inputfile, cachekey, variant=None):
+    '''This returns the outfile of inputfile if it was processed with cachekey.
+
+    variant is used for stages that make several outputs from one input file
+    (see read_processing_manifest).
+
+    Returns None if inputfile isn't in the manifest, was processed with another
+    cachekey, or if any of its outfiles don't exist anymore.
+
+    '''
+
+    entry = read_processing_manifest(outdir, stage).get(
+        _get_manifest_entrykey(inputfile, variant)
+    )
+
+    if entry is None or entry['cachekey'] != cachekey:
+        return None
+
+    outfile = entry['outfile']
+
+    if isinstance(outfile, list):
+        outfiles = outfile
+    else:
+        outfiles = [outfile]
+
+    if outfiles and all(x and os.path.exists(x) for x in outfiles):
+        return outfile
+    else:
+        return None
+
+
+
+def _update_processing_manifest(outdir, stage, inputfile, cachekey, outfile,
+                                variant=None):
+    '''This records that inputfile was processed with cachekey into outfile.
+
+    variant is used for stages that make several outputs from one input file
+    (see read_processing_manifest).
+
+    The entry is appended to the manifest with a single write, so worker
+    processes writing to the same manifest don't interleave their lines.
+
+    '''
+
+    entry = {'inputfile':os.path.abspath(inputfile),
+             'cachekey':cachekey,
+             'outfile':outfile,
+             'processed':datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    if variant is not None:
+        entry['variant'] = variant
+
+    manifestpath = os.path.join(outdir, PROCESSING_MANIFEST % stage)
+
+    with open(manifestpath, 'ab') as outfd:
+        outfd.write((json.dumps(entry) + '\n').encode('utf-8'))
+
+
+
 #######################
 ## UTILITY FUNCTIONS ##
 #######################
@@ -996,11 +1212,18 @@ def timebinlc(lcfile,
               timecols=None,
               magcols=None,
               errcols=None,
-              minbinelems=7):
+              minbinelems=7,
+              excludeprocessed=False):
 
     '''
     This bins the given light curve file in time using binsizesec.
 
+    Each binned LC is recorded in the timebinlc-manifest.jsonl in outdir, with
+    a separate entry for each binsizesec. If excludeprocessed is True or
+    'contenthash', LCs that were already binned at this binsizesec with the
+    same kwargs and haven't changed since are skipped (see runpf). In this
+    case, the existing binned LC's filename is returned.
+
     '''
 
     if lcformat not in LCFORM or lcformat is None:
@@ -1019,6 +1242,32 @@ def timebinlc(lcfile,
     if errcols is None:
         errcols = derrcols
 
+    if outdir is None:
+        outdir = os.path.dirname(lcfile)
+
+    cachekey = get_processing_cachekey(
+        'timebinlc',
+        [lcfile],
+        {'binsizesec':binsizesec,
+         'lcformat':lcformat,
+         'timecols':timecols,
+         'magcols':magcols,
+         'errcols':errcols,
+         'minbinelems':minbinelems},
+        contenthash=(excludeprocessed == 'contenthash')
+    )
+
+    if excludeprocessed:
+
+        outfile = _get_processed_outfile(outdir, 'timebinlc', lcfile, cachekey,
+                                         variant=binsizesec)
+
+        if outfile is not None:
+            LOGWARNING('binned LC for %s already exists at %s, '
+                       'skipping because excludeprocessed=True'
+                       % (lcfile, outfile))
+            return outfile
+
     # get the LC into a dict
     lcdict = readerfunc(lcfile)
     if isinstance(lcdict, tuple) and isinstance(lcdict[0],dict):
@@ -1089,16 +1338,15 @@ def timebinlc(lcfile,
 
     # done with binning for all magcols, now generate the output file
     # this will always be a pickle
-
-    if outdir is None:
-        outdir = os.path.dirname(lcfile)
-
     outfile = os.path.join(outdir, '%s-binned%.1fsec-%s.pkl' %
                            (lcdict['objectid'], binsizesec, lcformat))
 
     with open(outfile, 'wb') as outfd:
         pickle.dump(lcdict, outfd, protocol=pickle.HIGHEST_PROTOCOL)
 
+    _update_processing_manifest(outdir, 'timebinlc', lcfile, cachekey, outfile,
+                                variant=binsizesec)
+
     return outfile
 
 
@@ -1109,7 +1357,8 @@ def timebinlc_worker(task):
 
     task[0] = lcfile
     task[1] = binsizesec
-    task[3] = {'outdir','lcformat','timecols','magcols','errcols','minbinelems'}
+    task[3] = {'outdir','lcformat','timecols','magcols','errcols','minbinelems',
+               'excludeprocessed'}
 
     '''
 
@@ -1135,6 +1384,7 @@ def parallel_timebin(lclist,
                      magcols=None,
                      errcols=None,
                      minbinelems=7,
+                     excludeprocessed=False,
                      nworkers=32,
                      maxworkertasks=1000):
     '''
@@ -1153,7 +1403,9 @@ def parallel_timebin(lclist,
                               'timecols':timecols,
                               'magcols':magcols,
                               'errcols':errcols,
-                              'minbinelems':minbinelems}) for x in lclist]
+                              'minbinelems':minbinelems,
+                              'excludeprocessed':excludeprocessed})
+             for x in lclist]
 
     pool = mp.Pool(nworkers, maxtasksperchild=maxworkertasks)
     results = pool.map(timebinlc_worker, tasks)
@@ -1175,6 +1427,7 @@ def parallel_timebin_lcdir(lcdir,
                            magcols=None,
                            errcols=None,
                            minbinelems=7,
+                           excludeprocessed=False,
                            nworkers=32,
                            maxworkertasks=1000):
     '''
@@ -1201,6 +1454,7 @@ def parallel_timebin_lcdir(lcdir,
                                    magcols=magcols,
                                    errcols=errcols,
                                    minbinelems=minbinelems,
+                                   excludeprocessed=excludeprocessed,
                                    nworkers=nworkers,
                                    maxworkertasks=maxworkertasks)
 
@@ -1216,10 +1470,16 @@ def get_varfeatures(lcfile,
                     magcols=None,
                     errcols=None,
                     mindet=1000,
-                    lcformat='hat-sql'):
+                    lcformat='hat-sql',
+                    excludeprocessed=False):
     '''
     This runs varfeatures on a single LC file.
 
+    Each processed LC is recorded in the varfeatures-manifest.jsonl in
+    outdir. If excludeprocessed is True or 'contenthash', LCs that were already
+    processed with the same kwargs and haven't changed since are skipped (see
+    runpf).
+
     '''
 
     if lcformat not in LCFORM or lcformat is None:
@@ -1238,6 +1498,28 @@ def get_varfeatures(lcfile,
     if errcols is None:
         errcols = derrcols
 
+    cachekey = get_processing_cachekey(
+        'varfeatures',
+        [lcfile],
+        {'timecols':timecols,
+         'magcols':magcols,
+         'errcols':errcols,
+         'mindet':mindet,
+         'lcformat':lcformat},
+        contenthash=(excludeprocessed == 'contenthash')
+    )
+
+    if excludeprocessed:
+
+        outfile = _get_processed_outfile(outdir, 'varfeatures',
+                                         lcfile, cachekey)
+
+        if outfile is not None:
+            LOGWARNING('varfeatures for %s already exist at %s, '
+                       'skipping because excludeprocessed=True'
+                       % (lcfile, outfile))
+            return outfile
+
     try:
 
         # get the LC into a dict
@@ -1330,6 +1612,9 @@ def get_varfeatures(lcfile,
         with open(outfile, 'wb') as outfd:
             pickle.dump(resultdict, outfd, protocol=4)
 
+        _update_processing_manifest(outdir, 'varfeatures',
+                                    lcfile, cachekey, outfile)
+
         return outfile
 
     except Exception as e:
@@ -1347,13 +1632,15 @@ def varfeatures_worker(task):
     '''
 
     try:
-        lcfile, outdir, timecols, magcols, errcols, mindet, lcformat = task
+        (lcfile, outdir, timecols, magcols, errcols,
+         mindet, lcformat, excludeprocessed) = task
         return get_varfeatures(lcfile, outdir,
                                timecols=timecols,
                                magcols=magcols,
                                errcols=errcols,
                                mindet=mindet,
-                               lcformat=lcformat)
+                               lcformat=lcformat,
+                               excludeprocessed=excludeprocessed)
 
     except:
         return None
@@ -1367,12 +1654,14 @@ def serial_varfeatures(lclist,
                        errcols=None,
                        mindet=1000,
                        lcformat='hat-sql',
+                       excludeprocessed=False,
                        nworkers=None):
 
     if maxobjects:
         lclist = lclist[:maxobjects]
 
-    tasks = [(x, outdir, timecols, magcols, errcols, mindet, lcformat)
+    tasks = [(x, outdir, timecols, magcols, errcols, mindet, lcformat,
+              excludeprocessed)
              for x in lclist]
 
     for task in tqdm(tasks):
@@ -1388,6 +1677,7 @@ def parallel_varfeatures(lclist,
                          errcols=None,
                          mindet=1000,
                          lcformat='hat-sql',
+                         excludeprocessed=False,
                          nworkers=None):
     '''
     This runs varfeatures in parallel for all light curves in lclist.
@@ -1400,7 +1690,8 @@ def parallel_varfeatures(lclist,
     if maxobjects:
         lclist = lclist[:maxobjects]
 
-    tasks = [(x, outdir, timecols, magcols, errcols, mindet, lcformat)
+    tasks = [(x, outdir, timecols, magcols, errcols, mindet, lcformat,
+              excludeprocessed)
              for x in lclist]
 
     with ProcessPoolExecutor(max_workers=nworkers) as executor:
@@ -1422,6 +1713,7 @@ def parallel_varfeatures_lcdir(lcdir,
                                recursive=True,
                                mindet=1000,
                                lcformat='hat-sql',
+                               excludeprocessed=False,
                                nworkers=None):
     '''
     This runs parallel variable feature extraction for a directory of LCs.
@@ -1480,6 +1772,7 @@ def parallel_varfeatures_lcdir(lcdir,
                                     errcols=errcols,
                                     mindet=mindet,
                                     lcformat=lcformat,
+                                    excludeprocessed=excludeprocessed,
                                     nworkers=nworkers)
 
     else:
@@ -1515,7 +1808,8 @@ def get_periodicfeatures(pfpickle,
                          sigclip=10.0,
                          magsarefluxes=False,
                          verbose=True,
-                         raiseonfail=False):
+                         raiseonfail=False,
+                         excludeprocessed=False):
     '''This gets all periodic features for the object.
 
     If starfeatures is not None, it should be the filename of the
@@ -1523,12 +1817,50 @@ def get_periodicfeatures(pfpickle,
     object. This is used to get the neighbor's light curve and phase it with
     this object's period to see if this object is blended.
 
+    Each processed pfpickle is recorded in the periodicfeatures-manifest.jsonl
+    in outdir. If excludeprocessed is True or 'contenthash', pfpickles that
+    were already processed with the same kwargs and haven't changed since
+    (along with the starfeatures pickle) are skipped (see runpf). The LC
+    itself isn't checked, but runpf writes a new pfpickle if it changes.
+
     '''
 
     if lcformat not in LCFORM or lcformat is None:
         LOGERROR('unknown light curve format specified: %s' % lcformat)
         return None
 
+    cachekey = get_processing_cachekey(
+        'periodicfeatures',
+        [pfpickle, starfeatures],
+        {'lcbasedir':lcbasedir,
+         'fourierorder':fourierorder,
+         'transitparams':transitparams,
+         'ebparams':ebparams,
+         'pdiff_threshold':pdiff_threshold,
+         'sidereal_threshold':sidereal_threshold,
+         'sampling_peak_multiplier':sampling_peak_multiplier,
+         'sampling_startp':sampling_startp,
+         'sampling_endp':sampling_endp,
+         'timecols':timecols,
+         'magcols':magcols,
+         'errcols':errcols,
+         'lcformat':lcformat,
+         'sigclip':sigclip,
+         'magsarefluxes':magsarefluxes},
+        contenthash=(excludeprocessed == 'contenthash')
+    )
+
+    if excludeprocessed:
+
+        outfile = _get_processed_outfile(outdir, 'periodicfeatures',
+                                         pfpickle, cachekey)
+
+        if outfile is not None:
+            LOGWARNING('periodicfeatures for %s already exist at %s, '
+                       'skipping because excludeprocessed=True'
+                       % (pfpickle, outfile))
+            return outfile
+
     (fileglob, readerfunc, dtimecols, dmagcols,
      derrcols, magsarefluxes, normfunc) = LCFORM[lcformat]
 
@@ -1811,6 +2143,9 @@ def get_periodicfeatures(pfpickle,
         with open(outfile,'wb') as outfd:
             pickle.dump(resultdict, outfd, pickle.HIGHEST_PROTOCOL)
 
+        _update_processing_manifest(outdir, 'periodicfeatures',
+                                    pfpickle, cachekey, outfile)
+
         return outfile
 
     except Exception as e:
@@ -1869,6 +2204,7 @@ def serial_periodicfeatures(pfpkl_list,
                             magsarefluxes=False,
                             verbose=False,
                             maxobjects=None,
+                            excludeprocessed=False,
                             nworkers=None):
     '''This drives the periodicfeatures collection for a list of periodfinding
     pickles.
@@ -1930,7 +2266,8 @@ def serial_periodicfeatures(pfpkl_list,
               'lcformat':lcformat,
               'sigclip':sigclip,
               'magsarefluxes':magsarefluxes,
-              'verbose':verbose}
+              'verbose':verbose,
+              'excludeprocessed':excludeprocessed}
 
     tasks = [(x, lcbasedir, outdir, y, kwargs) for (x,y) in
              zip(pfpkl_list, starfeatures_list)]
@@ -1964,6 +2301,7 @@ def parallel_periodicfeatures(pfpkl_list,
                               magsarefluxes=False,
                               verbose=False,
                               maxobjects=None,
+                              excludeprocessed=False,
                               nworkers=None):
     '''
     This runs periodicfeatures in parallel for all periodfinding pickles.
@@ -2021,7 +2359,8 @@ def parallel_periodicfeatures(pfpkl_list,
               'lcformat':lcformat,
               'sigclip':sigclip,
               'magsarefluxes':magsarefluxes,
-              'verbose':verbose}
+              'verbose':verbose,
+              'excludeprocessed':excludeprocessed}
 
     tasks = [(x, lcbasedir, outdir, y, kwargs) for (x,y) in
              zip(pfpkl_list, starfeatures_list)]
@@ -2062,6 +2401,7 @@ def parallel_periodicfeatures_lcdir(
         magsarefluxes=False,
         verbose=False,
         maxobjects=None,
+        excludeprocessed=False,
         nworkers=None,
         recursive=True,
 ):
@@ -2135,6 +2475,7 @@ def parallel_periodicfeatures_lcdir(
             magsarefluxes=magsarefluxes,
             verbose=verbose,
             maxobjects=maxobjects,
+            excludeprocessed=excludeprocessed,
             nworkers=nworkers,
         )
 
@@ -2156,7 +2497,8 @@ def get_starfeatures(lcfile,
                      lcflist,
                      neighbor_radius_arcsec,
                      deredden=True,
-                     lcformat='hat-sql'):
+                     lcformat='hat-sql',
+                     excludeprocessed=False):
     '''This runs the functions from astrobase.varclass.starfeatures on a single
     light curve file.
 
@@ -2180,6 +2522,11 @@ def get_starfeatures(lcfile,
 
     lcformat is a key in LCFORM specifying the type of light curve lcfile is
 
+    Each processed LC is recorded in the starfeatures-manifest.jsonl in
+    outdir. If excludeprocessed is True or 'contenthash', LCs that were already
+    processed with the same kwargs and neighbor catalog and haven't changed
+    since are skipped (see runpf).
+
     '''
 
     if lcformat not in LCFORM or lcformat is None:
@@ -2189,6 +2536,31 @@ def get_starfeatures(lcfile,
     (fileglob, readerfunc, dtimecols, dmagcols,
      derrcols, magsarefluxes, normfunc) = LCFORM[lcformat]
 
+    # the neighbor catalog is hashed by its contents. the str versions make
+    # sure object arrays are hashed by their values
+    cachekey = get_processing_cachekey(
+        'starfeatures',
+        [lcfile],
+        {'kdtree':getattr(kdtree, 'data', None),
+         'objlist':np.asarray(objlist).astype(np.str_),
+         'lcflist':np.asarray(lcflist).astype(np.str_),
+         'neighbor_radius_arcsec':neighbor_radius_arcsec,
+         'deredden':deredden,
+         'lcformat':lcformat},
+        contenthash=(excludeprocessed == 'contenthash')
+    )
+
+    if excludeprocessed:
+
+        outfile = _get_processed_outfile(outdir, 'starfeatures',
+                                         lcfile, cachekey)
+
+        if outfile is not None:
+            LOGWARNING('starfeatures for %s already exist at %s, '
+                       'skipping because excludeprocessed=True'
+                       % (lcfile, outfile))
+            return outfile
+
     try:
 
         # get the LC into a dict
@@ -2243,6 +2615,9 @@ def get_starfeatures(lcfile,
         with open(outfile, 'wb') as outfd:
             pickle.dump(resultdict, outfd, protocol=4)
 
+        _update_processing_manifest(outdir, 'starfeatures',
+                                    lcfile, cachekey, outfile)
+
         return outfile
 
     except Exception as e:
@@ -2261,13 +2636,15 @@ def starfeatures_worker(task):
 
     try:
         (lcfile, outdir, kdtree, objlist,
-         lcflist, neighbor_radius_arcsec, deredden, lcformat) = task
+         lcflist, neighbor_radius_arcsec,
+         deredden, lcformat, excludeprocessed) = task
 
         return get_starfeatures(lcfile, outdir,
                                 kdtree, objlist, lcflist,
                                 neighbor_radius_arcsec,
                                 deredden=deredden,
-                                lcformat=lcformat)
+                                lcformat=lcformat,
+                                excludeprocessed=excludeprocessed)
     except:
         return None
 
@@ -2279,6 +2656,7 @@ def serial_starfeatures(lclist,
                         maxobjects=None,
                         deredden=True,
                         lcformat='hat-sql',
+                        excludeprocessed=False,
                         nworkers=None):
     '''This drives the starfeatures function for a collection of LCs.
 
@@ -2310,7 +2688,8 @@ def serial_starfeatures(lclist,
     objlcfl = kdt_dict['objects']['lcfname']
 
     tasks = [(x, outdir, kdt, objlist, objlcfl,
-              neighbor_radius_arcsec, deredden, lcformat) for x in lclist]
+              neighbor_radius_arcsec, deredden, lcformat, excludeprocessed)
+             for x in lclist]
 
     for task in tqdm(tasks):
         result = starfeatures_worker(task)
@@ -2324,6 +2703,7 @@ def parallel_starfeatures(lclist,
                           maxobjects=None,
                           deredden=True,
                           lcformat='hat-sql',
+                          excludeprocessed=False,
                           nworkers=None):
     '''
     This runs starfeatures in parallel for all light curves in lclist.
@@ -2350,7 +2730,8 @@ def parallel_starfeatures(lclist,
     objlcfl = kdt_dict['objects']['lcfname']
 
     tasks = [(x, outdir, kdt, objlist, objlcfl,
-              neighbor_radius_arcsec, deredden, lcformat) for x in lclist]
+              neighbor_radius_arcsec, deredden, lcformat, excludeprocessed)
+             for x in lclist]
 
     with ProcessPoolExecutor(max_workers=nworkers) as executor:
         resultfutures = executor.map(starfeatures_worker, tasks)
@@ -2369,6 +2750,7 @@ def parallel_starfeatures_lcdir(lcdir,
                                 maxobjects=None,
                                 deredden=True,
                                 lcformat='hat-sql',
+                                excludeprocessed=False,
                                 nworkers=None,
                                 recursive=True):
     '''
@@ -2427,6 +2809,7 @@ def parallel_starfeatures_lcdir(lcdir,
                                      deredden=deredden,
                                      maxobjects=maxobjects,
                                      lcformat=lcformat,
+                                     excludeprocessed=excludeprocessed,
                                      nworkers=nworkers)
 
     else:
@@ -3128,6 +3511,188 @@ def plot_variability_thresholds(varthreshpkl,
 ## RUNNING PERIOD SEARCHES ##
 #############################
 
+def _get_batch_glsinds(pfmethods, pfkwargs):
+    '''This returns the indices of the GLS period-finders that can be batched.
+
+    These are the ones in pfmethods whose pfkwargs are all in FIELD_GLSKWARGS
+    (apart from the ones runpf sets itself) and whose glspfunc is glsp_worker
+    or glsp_worker_notau, so periodbase.pgen_lsp_batch gives the same results
+    for them as periodbase.pgen_lsp. The rest must be run with pgen_lsp.
+
+    '''
+
+    return [
+        x for x, pfm in enumerate(pfmethods)
+        if (pfm == 'gls' and
+            all(y in FIELD_GLSKWARGS or
+                y in ('verbose','nworkers','magsarefluxes','sigclip')
+                for y in pfkwargs[x]) and
+            pfkwargs[x].get('glspfunc', glsp_worker) in (glsp_worker,
+                                                         glsp_worker_notau))
+    ]
+
+
+
+def _get_magcol_batch_gls(lcdict,
+                          timecols,
+                          magcols,
+                          errcols,
+                          pfmethods,
+                          pfkwargs,
+                          sigclip,
+                          magsarefluxes,
+                          normfunc,
+                          nworkers=1,
+                          executor=None,
+                          pfresults=None):
+    '''This runs the batch GLS for the magcols of an LC that share a time
+    column.
+
+    HAT LCs usually have several aperture magcols (and their EPD and TFA
+    versions) on the same time column. These are put into 2D arrays and
+    periodbase.pgen_lsp_batch is run once for each group of them, so the sin
+    and cos terms over each frequency grid are calculated only once per group
+    instead of once per magcol. Each magcol gets the same frequency grid that
+    periodbase.pgen_lsp would use for it, and the batch kernel runs on the
+    executor's pool if it's provided, or on a pool of nworkers otherwise.
+
+    Only the GLS period-finders returned by _get_batch_glsinds are run here.
+    The others are left for runpf to run with pgen_lsp for each magcol.
+
+    Returns a pfresults dict as used by runpf, keyed by the magcol and then by
+    the index of each GLS period-finder in pfmethods. If pfresults is
+    provided, the magcols that already have results in it are skipped and the
+    new results are added to it.
+
+    '''
+
+    if pfresults is None:
+        pfresults = {}
+
+    glsinds = _get_batch_glsinds(pfmethods, pfkwargs)
+
+    if not glsinds:
+        return pfresults
+
+    # group the magcols by their time column
+    tcolgroups = {}
+    for tcol, mcol, ecol in zip(timecols, magcols, errcols):
+        tcolgroups.setdefault(tcol, []).append((mcol, ecol))
+
+    for tcol in tcolgroups:
+
+        colgroup = [
+            (mcol, ecol) for mcol, ecol in tcolgroups[tcol]
+            if not all(x in pfresults.get(mcol.split('.')[-1], {})
+                       for x in glsinds)
+        ]
+
+        # there's nothing to share for a single magcol
+        if len(colgroup) < 2:
+            continue
+
+        times = np.asarray(dict_get(lcdict, tcol.split('.')),
+                           dtype=np.float64)
+        finitetimes = np.isfinite(times)
+
+        batchmags, batcherrs = [], []
+
+        for mcol, ecol in colgroup:
+
+            mags = dict_get(lcdict, mcol.split('.'))
+            errs = dict_get(lcdict, ecol.split('.'))
+
+            # normalize here if not using special normalization
+            if normfunc is None:
+                ntimes, mags = normalize_magseries(
+                    times, mags,
+                    magsarefluxes=magsarefluxes
+                )
+
+            batchmags.append(np.asarray(mags, dtype=np.float64))
+            batcherrs.append(np.asarray(errs, dtype=np.float64))
+
+        batchmags = np.vstack(batchmags)
+        batcherrs = np.vstack(batcherrs)
+        batchmask = np.broadcast_to(finitetimes, batchmags.shape)
+
+        for glsind in glsinds:
+
+            glskwargs = {x:pfkwargs[glsind][x] for x in pfkwargs[glsind]
+                         if x in FIELD_GLSKWARGS}
+
+            batchresults = periodbase.pgen_lsp_batch(
+                times,
+                batchmags,
+                batcherrs,
+                mask=batchmask,
+                magsarefluxes=magsarefluxes,
+                sigclip=sigclip,
+                nworkers=nworkers,
+                executor=executor,
+                commongrid=False,
+                verbose=False,
+                **glskwargs
+            )
+
+            if batchresults is None:
+                continue
+
+            for (mcol, ecol), batchres in zip(colgroup, batchresults):
+                pfresults.setdefault(mcol.split('.')[-1], {})[glsind] = (
+                    batchres
+                )
+
+    return pfresults
+
+
+
+def _get_runpf_cachekey(lcfile,
+                        timecols,
+                        magcols,
+                        errcols,
+                        lcformat,
+                        pfmethods,
+                        pfkwargs,
+                        sigclip,
+                        getblssnr,
+                        fusedpf,
+                        batchmagcols,
+                        compactresults,
+                        fieldbatch,
+                        contenthash=False):
+    '''This returns the cache key for the runpf manifest entry of lcfile.
+
+    fieldbatch is True if the GLS results for lcfile come from the batch in
+    runpf_field, since these use a different frequency grid. runpf sets the
+    verbose, nworkers, magsarefluxes, and sigclip keys in each pfkwargs dict
+    itself, so these are left out.
+
+    '''
+
+    return get_processing_cachekey(
+        'runpf',
+        [lcfile],
+        {'timecols':timecols,
+         'magcols':magcols,
+         'errcols':errcols,
+         'lcformat':lcformat,
+         'pfmethods':pfmethods,
+         'pfkwargs':[{x:pfkw[x] for x in pfkw
+                      if x not in ('verbose','nworkers',
+                                   'magsarefluxes','sigclip')}
+                     for pfkw in pfkwargs],
+         'sigclip':sigclip,
+         'getblssnr':getblssnr,
+         'fusedpf':fusedpf,
+         'batchmagcols':batchmagcols,
+         'compactresults':compactresults,
+         'fieldbatch':fieldbatch},
+        contenthash=contenthash
+    )
+
+
+
 def runpf(lcfile,
           outdir,
           timecols=None,
@@ -3139,7 +3704,13 @@ def runpf(lcfile,
           sigclip=10.0,
           getblssnr=False,
           nworkers=10,
-          excludeprocessed=False):
+          excludeprocessed=False,
+          fusedpf=False,
+          batchmagcols=True,
+          compactresults=None,
+          timing=False,
+          executor=None,
+          pfresults=None):
     '''This runs the period-finding for a single LC.
 
     pfmethods is a list of period finding methods to run. Each element is a
@@ -3149,17 +3720,61 @@ def runpf(lcfile,
     pfkwargs are any special kwargs to pass along to each period-finding method
     function.
 
-    If excludeprocessing is True, light curves that have existing periodfinding
-    result pickles in outdir will not be processed.
-
-    FIXME: currently, this uses a dumb method of excluding already-processed
-    files. A smarter way to do this is to (i) generate a SHA512 cachekey based
-    on a repr of {'lcfile', 'timecols', 'magcols', 'errcols', 'lcformat',
-    'pfmethods', 'sigclip', 'getblssnr', 'pfkwargs'}, (ii) make sure all list
-    kwargs in the dict are sorted, (iii) check if the output file has the same
-    cachekey in its filename (last 8 chars of cachekey should work), so the
-    result was processed in exactly the same way as specifed in the input to
-    this function, and can therefore be ignored. Will implement this later.
+    If fusedpf is True, the period-finders are run using
+    periodbase.fused_periodfind, which sigma-clips each LC once and runs the
+    GLS, PDM, AoV, AoVMH, and spectral window period-finders in a single pass
+    over a shared frequency grid. The output pickle has the same contents. The
+    shared grid is set by any startp, endp, autofreq, and stepsize that are the
+    same in the pfkwargs of all of these period-finders (see
+    periodbase.get_fused_gridkwargs).
+
+    If batchmagcols is True and fusedpf is False, the GLS period-finders for
+    magcols that share the same time column are run together using
+    periodbase.pgen_lsp_batch (see _get_magcol_batch_gls). This calculates the
+    sin and cos terms over the frequency grid only once for all these magcols,
+    and gives the same results as running pgen_lsp for each of them. GLS
+    period-finders with pfkwargs not listed in FIELD_GLSKWARGS (e.g.
+    coarsetofine or blockmode) or with a custom glspfunc are still run for
+    each magcol separately. This is on by default.
+
+    If compactresults is True, the period-finder result dicts are written out
+    in the smaller form made by periodbase.compact_lspdict, with float32
+    periodogram values and a description of the frequency grid instead of the
+    full period arrays. This can also be a dict of kwargs for compact_lspdict,
+    e.g. {'envelopefactor':10, 'windowsize':100} to only keep an envelope of
+    each periodogram plus the full values around its best periods (the
+    spectral window is always kept in full). The checkplot functions and
+    varclass.periodicfeatures regenerate what they need from these
+    transparently.
+
+    If timing is True, the period-finder stage timings are turned on while this
+    LC is processed (see periodbase.enable_pf_timing), so each period-finder
+    result dict gets a 'timing' key with the wall and CPU time spent in its
+    sigma-clip, frequency grid, kernel, peak selection, and pool overhead
+    stages. See summarize_pf_timing to put these together for many LCs.
+
+    executor is an optional periodbase.PeriodFinderExecutor. The period-finders
+    in EXECUTOR_PFMETHODS run their workers on its pool, and its nworkers is
+    used instead of nworkers for these. If it's None, a new one with nworkers
+    workers is made for this LC and shared by all of its magcols and
+    period-finders, and is closed when this function returns.
+
+    pfresults is used by runpf_field. If it's not None, it's a dict keyed by the
+    magcol (the last part of its dereferenced name), each of which is a dict
+    keyed by the index of a period-finder in pfmethods. The values are
+    period-finder result dicts already calculated for this LC, which are used
+    as is instead of running these period-finders again.
+
+    Each processed LC is recorded in the runpf-manifest.jsonl in outdir, along
+    with a cache key made from the LC file's path, size, and mtime, the
+    timecols, magcols, errcols, lcformat, pfmethods, pfkwargs, sigclip,
+    getblssnr, fusedpf, batchmagcols, and compactresults kwargs, and whether
+    pfresults came from runpf_field (see get_processing_cachekey). If
+    excludeprocessed is True, an LC is skipped without reading it if the
+    manifest has its output pickle with the same cache key. Changing any of
+    these kwargs or the LC file makes it run again. If excludeprocessed is
+    'contenthash', the SHA512 hash of the LC file's contents is used instead of
+    its size and mtime.
 
     '''
 
@@ -3179,6 +3794,46 @@ def runpf(lcfile,
     if errcols is None:
         errcols = derrcols
 
+    cachekey = _get_runpf_cachekey(
+        lcfile,
+        timecols,
+        magcols,
+        errcols,
+        lcformat,
+        pfmethods,
+        pfkwargs,
+        sigclip,
+        getblssnr,
+        fusedpf,
+        batchmagcols,
+        compactresults,
+        pfresults is not None,
+        contenthash=(excludeprocessed == 'contenthash')
+    )
+
+    # if excludeprocessed is True, return the output file if this LC was
+    # processed the same way already
+    if excludeprocessed:
+
+        outfile = _get_processed_outfile(outdir, 'runpf', lcfile, cachekey)
+
+        if outfile is not None:
+            LOGWARNING('periodfinding result for %s already exists at %s, '
+                       'skipping because excludeprocessed=True'
+                       % (lcfile, outfile))
+            return outfile
+
+    # all of the period-finders for this LC share one worker pool
+    if executor is None:
+        pfexecutor = periodbase.PeriodFinderExecutor(nworkers=nworkers)
+    else:
+        pfexecutor = executor
+
+    # turn on the stage timings if requested, remembering if they were on
+    prevtiming = periodbase.PFTIMING
+    if timing:
+        periodbase.enable_pf_timing()
+
     try:
 
         # get the LC into a dict
@@ -3189,30 +3844,6 @@ def runpf(lcfile,
         outfile = os.path.join(outdir, 'periodfinding-%s.pkl' %
                                lcdict['objectid'])
 
-        # if excludeprocessed is True, return the output file if it exists and
-        # has a size that is at least 100 kilobytes (this should be enough to
-        # contain the minimal results of this function).
-        if excludeprocessed:
-
-            test_outfile = os.path.exists(outfile)
-            test_outfile_gz = os.path.exists(outfile+'.gz')
-
-            if (test_outfile and os.stat(outfile).st_size > 102400):
-
-                LOGWARNING('periodfinding result for %s already exists at %s, '
-                           'skipping because excludeprocessed=True'
-                           % (lcfile, outfile))
-                return outfile
-
-            elif (test_outfile_gz and os.stat(outfile+'.gz').st_size > 102400):
-
-                LOGWARNING(
-                    'gzipped periodfinding result for %s already '
-                    'exists at %s, skipping because excludeprocessed=True'
-                    % (lcfile, outfile+'.gz')
-                )
-                return outfile+'.gz'
-
 
         # this is the final returndict
         resultdict = {
@@ -3232,6 +3863,23 @@ def runpf(lcfile,
         if normfunc is not None:
            lcdict = normfunc(lcdict)
 
+        # run GLS for all magcols on the same time column at once
+        if batchmagcols and not fusedpf:
+            pfresults = _get_magcol_batch_gls(
+                lcdict,
+                timecols,
+                magcols,
+                errcols,
+                pfmethods,
+                pfkwargs,
+                sigclip,
+                magsarefluxes,
+                normfunc,
+                nworkers=nworkers,
+                executor=pfexecutor,
+                pfresults=pfresults
+            )
+
         for tcol, mcol, ecol in zip(timecols, magcols, errcols):
 
             # dereference the columns and get them from the lcdict
@@ -3263,11 +3911,32 @@ def runpf(lcfile,
 
                 times, mags, errs = ntimes, nmags, errs
 
+            # clean this magcol once. the period-finders and bls_snr all get
+            # the cleaned LC's arrays, so they share its finite-value mask,
+            # median, MAD, and sigma-clipped arrays instead of redoing these
+            cleanedlc = CleanedMagSeries(times, mags, errs,
+                                         magsarefluxes=magsarefluxes)
+            times, mags, errs = cleanedlc
+
             # run each of the requested period-finder functions
             resultdict[mcolget[-1]] = {}
 
             pfmkeys = []
 
+            # if we're fusing the period-finders, run them all at once here
+            if fusedpf:
+                fusedresults = periodbase.fused_periodfind(
+                    times, mags, errs,
+                    pfmethods=pfmethods,
+                    pfkwargs=pfkwargs,
+                    magsarefluxes=magsarefluxes,
+                    sigclip=sigclip,
+                    nworkers=nworkers,
+                    executor=pfexecutor,
+                    verbose=False,
+                    **periodbase.get_fused_gridkwargs(pfmethods, pfkwargs)
+                )
+
             for pfmind, pfm, pfkw in zip(range(len(pfmethods)),
                                          pfmethods,
                                          pfkwargs):
@@ -3288,10 +3957,25 @@ def runpf(lcfile,
                 pfmkeys.append(pfmkey)
 
                 # run this period-finder and save its results to the output dict
-                resultdict[mcolget[-1]][pfmkey] = pf_func(
-                    times, mags, errs,
-                    **pf_kwargs
-                )
+                if (pfresults is not None and
+                    mcolget[-1] in pfresults and
+                    pfmind in pfresults[mcolget[-1]]):
+                    resultdict[mcolget[-1]][pfmkey] = (
+                        pfresults[mcolget[-1]][pfmind]
+                    )
+                elif fusedpf:
+                    resultdict[mcolget[-1]][pfmkey] = fusedresults[pfmind]
+                elif pfm in EXECUTOR_PFMETHODS:
+                    resultdict[mcolget[-1]][pfmkey] = pf_func(
+                        times, mags, errs,
+                        executor=pfexecutor,
+                        **pf_kwargs
+                    )
+                else:
+                    resultdict[mcolget[-1]][pfmkey] = pf_func(
+                        times, mags, errs,
+                        **pf_kwargs
+                    )
 
 
             #
@@ -3357,10 +4041,28 @@ def runpf(lcfile,
                         })
 
 
+        # make the period-finder results smaller if requested
+        if compactresults:
+
+            if isinstance(compactresults, dict):
+                compactkwargs = compactresults
+            else:
+                compactkwargs = {}
+
+            for mcol in magcols:
+                mcolkey = mcol.split('.')[-1]
+                for pfmk in resultdict[mcolkey]['pfmethods']:
+                    resultdict[mcolkey][pfmk] = periodbase.compact_lspdict(
+                        resultdict[mcolkey][pfmk],
+                        **compactkwargs
+                    )
+
         # once all mag cols have been processed, write out the pickle
         with open(outfile, 'wb') as outfd:
             pickle.dump(resultdict, outfd, protocol=pickle.HIGHEST_PROTOCOL)
 
+        _update_processing_manifest(outdir, 'runpf', lcfile, cachekey, outfile)
+
         return outfile
 
     except Exception as e:
@@ -3368,16 +4070,29 @@ def runpf(lcfile,
         LOGEXCEPTION('failed to run for %s, because: %s' % (lcfile, e))
         return None
 
+    finally:
+
+        # only close the pool if we made it here
+        if executor is None:
+            pfexecutor.close()
+
+        if timing and not prevtiming:
+            periodbase.disable_pf_timing()
+
 
 
 def runpf_worker(task):
     '''
     This runs the runpf function.
 
+    The period-finder worker pool of this process is kept around for the next
+    task (see periodbase.get_pf_executor).
+
     '''
 
     (lcfile, outdir, timecols, magcols, errcols, lcformat,
-     pfmethods, pfkwargs, getblssnr, sigclip, nworkers, excludeprocessed) = task
+     pfmethods, pfkwargs, getblssnr, sigclip, nworkers,
+     excludeprocessed, fusedpf, batchmagcols, compactresults, timing) = task
 
     if os.path.exists(lcfile):
         pfresult = runpf(lcfile,
@@ -3391,7 +4106,12 @@ def runpf_worker(task):
                          getblssnr=getblssnr,
                          sigclip=sigclip,
                          nworkers=nworkers,
-                         excludeprocessed=excludeprocessed)
+                         excludeprocessed=excludeprocessed,
+                         fusedpf=fusedpf,
+                         batchmagcols=batchmagcols,
+                         compactresults=compactresults,
+                         timing=timing,
+                         executor=periodbase.get_pf_executor(nworkers))
         return pfresult
     else:
         LOGERROR('LC does not exist for requested file %s' % lcfile)
@@ -3399,6 +4119,592 @@ def runpf_worker(task):
 
 
 
+def runpf_incremental(lcfile,
+                      outdir,
+                      timecols=None,
+                      magcols=None,
+                      errcols=None,
+                      lcformat='hat-sql',
+                      glskwargs={},
+                      sigclip=10.0,
+                      rebuildonclip=True,
+                      nworkers=1):
+    '''This updates the GLS periodograms of an LC that grows over time.
+
+    For each magcol, this keeps a periodbase.GLSPeriodogramState in a pickle
+    called periodfinding-<objectid>-<magcol>-glsstate.pkl in outdir, next to
+    the periodfinding-<objectid>.pkl written by runpf. On each run, only the
+    observations later than the last time already in the state are added to
+    its GLS sums, which takes O(N_new x N_freq) instead of a full pgen_lsp
+    run. The state pickle is then written back.
+
+    glskwargs are passed to GLSPeriodogramState when a new state is made (e.g.
+    startp, endp, autofreq, nbestpeaks). Set endp if the LC will grow much
+    longer than it is now, since the frequency grid of a state is fixed when
+    it's made. If rebuildonclip is True, the sums are calculated again from
+    scratch when the new observations change which of the older ones get
+    sigma-clipped.
+
+    The mags are used as they are in the LC (after the lcformat's normfunc if
+    it has one). The per-timegroup normalization that runpf does isn't used
+    here, since it would change the older observations each time new ones are
+    added. The GLS fits for the mean, so a constant offset doesn't matter.
+
+    Returns a dict with the objectid and the updated GLS result dict for each
+    magcol (see GLSPeriodogramState.lspdict).
+
+    '''
+
+    if lcformat not in LCFORM or lcformat is None:
+        LOGERROR('unknown light curve format specified: %s' % lcformat)
+        return None
+
+    (fileglob, readerfunc, dtimecols, dmagcols,
+     derrcols, magsarefluxes, normfunc) = LCFORM[lcformat]
+
+    # override the default timecols, magcols, and errcols
+    # using the ones provided to the function
+    if timecols is None:
+        timecols = dtimecols
+    if magcols is None:
+        magcols = dmagcols
+    if errcols is None:
+        errcols = derrcols
+
+    try:
+
+        # get the LC into a dict
+        lcdict = readerfunc(lcfile)
+        if isinstance(lcdict, tuple) and isinstance(lcdict[0],dict):
+            lcdict = lcdict[0]
+
+        # normalize using the special function if specified
+        if normfunc is not None:
+           lcdict = normfunc(lcdict)
+
+        resultdict = {'objectid':lcdict['objectid'],
+                      'lcfbasename':os.path.basename(lcfile)}
+
+        for tcol, mcol, ecol in zip(timecols, magcols, errcols):
+
+            # dereference the columns and get them from the lcdict
+            times = np.asarray(dict_get(lcdict, tcol.split('.')))
+            mags = np.asarray(dict_get(lcdict, mcol.split('.')))
+            errs = np.asarray(dict_get(lcdict, ecol.split('.')))
+            mcolkey = mcol.split('.')[-1]
+
+            statefile = os.path.join(
+                outdir,
+                'periodfinding-%s-%s-glsstate.pkl' % (lcdict['objectid'],
+                                                      mcolkey)
+            )
+
+            if os.path.exists(statefile):
+
+                glsstate = periodbase.GLSPeriodogramState.load(statefile)
+
+                # only add the observations after the ones we already have
+                newind = times > glsstate.times.max()
+                LOGINFO('%s: adding %s new observations for %s' %
+                        (lcdict['objectid'], np.sum(newind), mcolkey))
+
+            else:
+
+                glsstate = periodbase.GLSPeriodogramState(
+                    magsarefluxes=magsarefluxes,
+                    sigclip=sigclip,
+                    rebuildonclip=rebuildonclip,
+                    nworkers=nworkers,
+                    **glskwargs
+                )
+                newind = np.isfinite(times)
+
+            if np.any(newind):
+                glsstate.update(times[newind], mags[newind], errs[newind])
+                glsstate.save(statefile)
+
+            resultdict[mcolkey] = glsstate.lspdict(verbose=False)
+
+        return resultdict
+
+    except Exception as e:
+
+        LOGEXCEPTION('failed to run incremental GLS for %s, because: %s' %
+                     (lcfile, e))
+        return None
+
+
+
+#
+# these are the pgen_lsp_batch kwargs that runpf_field takes from pfkwargs
+#
+FIELD_GLSKWARGS = ('startp','endp','autofreq','nbestpeaks','periodepsilon',
+                   'stepsize','glspfunc','blockmemory','sharedarrays')
+
+
+def runpf_field(lcfiles,
+                outdir,
+                timecols=None,
+                magcols=None,
+                errcols=None,
+                lcformat='hat-sql',
+                pfmethods=['gls','pdm','mav','win'],
+                pfkwargs=[{},{},{},{}],
+                sigclip=10.0,
+                getblssnr=False,
+                nworkers=10,
+                excludeprocessed=False,
+                fusedpf=False,
+                timetolerance=None,
+                compactresults=None,
+                timing=False,
+                executor=None):
+    '''This runs the period-finding for a batch of LCs from the same field.
+
+    LCs of objects in the same field are usually observed at the same set of
+    times. This reads all of the LCs in lcfiles, puts their mags and errs for
+    each magcol into 2D arrays on the union of all their times, and runs the
+    GLS period-finder for all of them at once using
+    periodbase.pgen_lsp_batch. This calculates the sin and cos terms over the
+    frequency grid only once for the whole batch. The observations that are
+    missing for an object are masked out. All LCs in the batch use the same
+    frequency grid for GLS, which is set up using the time span of all of them.
+
+    The rest of the period-finders in pfmethods are then run for each LC by
+    runpf as usual, which also writes the same periodfinding-<objectid>.pkl
+    output pickles. The kwargs are the same as for runpf. The GLS
+    period-finders with pfkwargs not listed in FIELD_GLSKWARGS or with a custom
+    glspfunc are left for runpf to run for each LC (see _get_batch_glsinds).
+
+    If timetolerance is None, the times of different LCs are matched
+    exactly. If it's a float (in the same units as the times, e.g. 1.0e-5
+    days), times that round to the same multiple of timetolerance are treated
+    as the same observation. This is useful if the timestamps differ slightly
+    between objects (e.g. after a barycentric correction), and then the first
+    of these times is used for all of them. This must be much smaller than the
+    cadence, since only one point per object is kept for each common time.
+
+    If excludeprocessed is set, the LCs that the runpf manifest in outdir has
+    as processed by runpf_field with the same kwargs are left out before any
+    LCs are read, so they don't go into the batch GLS, and their existing
+    output pickles are returned for them.
+
+    If executor is None, a periodbase.PeriodFinderExecutor with nworkers
+    workers is made and used by the batch GLS and by runpf for all of the LCs
+    in the batch.
+
+    Returns a list of the output pickles written for lcfiles.
+
+    '''
+
+    if lcformat not in LCFORM or lcformat is None:
+        LOGERROR('unknown light curve format specified: %s' % lcformat)
+        return None
+
+    (fileglob, readerfunc, dtimecols, dmagcols,
+     derrcols, magsarefluxes, normfunc) = LCFORM[lcformat]
+
+    # override the default timecols, magcols, and errcols
+    # using the ones provided to the function
+    if timecols is None:
+        timecols = dtimecols
+    if magcols is None:
+        magcols = dmagcols
+    if errcols is None:
+        errcols = derrcols
+
+    glsinds = _get_batch_glsinds(pfmethods, pfkwargs)
+
+    # if excludeprocessed is True, leave out the LCs that were processed the
+    # same way already, so they're neither read nor put into the batch
+    results = [None for x in lcfiles]
+
+    if excludeprocessed:
+
+        for lcind, lcfile in enumerate(lcfiles):
+
+            # runpf is run below with batchmagcols=False and field pfresults
+            results[lcind] = _get_processed_outfile(
+                outdir,
+                'runpf',
+                lcfile,
+                _get_runpf_cachekey(
+                    lcfile,
+                    timecols,
+                    magcols,
+                    errcols,
+                    lcformat,
+                    pfmethods,
+                    pfkwargs,
+                    sigclip,
+                    getblssnr,
+                    fusedpf,
+                    False,
+                    compactresults,
+                    True,
+                    contenthash=(excludeprocessed == 'contenthash')
+                )
+            )
+
+            if results[lcind] is not None:
+                LOGWARNING('periodfinding result for %s already exists at %s, '
+                           'skipping because excludeprocessed=True'
+                           % (lcfile, results[lcind]))
+
+    batchlcs = [x for x, y in enumerate(results) if y is None]
+
+    # get all of the mag series for the batch
+    lcseries = [None for x in lcfiles]
+
+    for lcind in batchlcs:
+
+        lcfile = lcfiles[lcind]
+
+        try:
+
+            lcdict = readerfunc(lcfile)
+            if isinstance(lcdict, tuple) and isinstance(lcdict[0],dict):
+                lcdict = lcdict[0]
+
+            # normalize using the special function if specified
+            if normfunc is not None:
+                lcdict = normfunc(lcdict)
+
+            colseries = {}
+
+            for tcol, mcol, ecol in zip(timecols, magcols, errcols):
+
+                # dereference the columns and get them from the lcdict
+                times = dict_get(lcdict, tcol.split('.'))
+                mags = dict_get(lcdict, mcol.split('.'))
+                errs = dict_get(lcdict, ecol.split('.'))
+
+                # normalize here if not using special normalization
+                if normfunc is None:
+                    times, mags = normalize_magseries(
+                        times, mags,
+                        magsarefluxes=magsarefluxes
+                    )
+
+                colseries[mcol.split('.')[-1]] = (np.asarray(times),
+                                                  np.asarray(mags),
+                                                  np.asarray(errs))
+
+            lcseries[lcind] = colseries
+
+        except Exception as e:
+
+            LOGEXCEPTION('could not read %s for field period-finding, '
+                         'because: %s' % (lcfile, e))
+
+    # the batch GLS and the rest of the period-finders share one worker pool
+    if executor is None:
+        pfexecutor = periodbase.PeriodFinderExecutor(nworkers=nworkers)
+    else:
+        pfexecutor = executor
+
+    # run the batch GLS for each magcol
+    pfresults = [{} for x in lcfiles]
+    goodlcs = [x for x, y in enumerate(lcseries) if y is not None]
+
+    for mcol in magcols:
+
+        mcolkey = mcol.split('.')[-1]
+
+        if not glsinds or not goodlcs:
+            break
+
+        # get the union of all the times
+        alltimes = np.concatenate([lcseries[x][mcolkey][0] for x in goodlcs])
+
+        if timetolerance:
+            allkeys = np.round(alltimes/timetolerance).astype(np.int64)
+        else:
+            allkeys = alltimes
+
+        commonkeys, commonind = np.unique(allkeys, return_index=True)
+        commontimes = alltimes[commonind]
+
+        LOGINFO('running batch GLS for %s LCs and magcol: %s '
+                'using %s common times' %
+                (len(goodlcs), mcolkey, commontimes.size))
+
+        # put the mag series on the common times
+        batchmags = np.full((len(goodlcs), commontimes.size), np.nan)
+        batcherrs = np.full((len(goodlcs), commontimes.size), np.nan)
+        batchmask = np.zeros((len(goodlcs), commontimes.size), dtype=bool)
+
+        for row, lcind in enumerate(goodlcs):
+
+            times, mags, errs = lcseries[lcind][mcolkey]
+
+            if timetolerance:
+                keys = np.round(times/timetolerance).astype(np.int64)
+            else:
+                keys = times
+
+            timeind = np.searchsorted(commonkeys, keys)
+
+            batchmags[row, timeind] = mags
+            batcherrs[row, timeind] = errs
+            batchmask[row, timeind] = True
+
+        for glsind in glsinds:
+
+            glskwargs = {x:pfkwargs[glsind][x] for x in pfkwargs[glsind]
+                         if x in FIELD_GLSKWARGS}
+
+            # turn on the stage timings for the batch if requested
+            prevtiming = periodbase.PFTIMING
+            if timing:
+                periodbase.enable_pf_timing()
+
+            try:
+                batchresults = periodbase.pgen_lsp_batch(
+                    commontimes,
+                    batchmags,
+                    batcherrs,
+                    mask=batchmask,
+                    magsarefluxes=magsarefluxes,
+                    sigclip=sigclip,
+                    nworkers=nworkers,
+                    executor=pfexecutor,
+                    verbose=False,
+                    **glskwargs
+                )
+            finally:
+                if timing and not prevtiming:
+                    periodbase.disable_pf_timing()
+
+            for row, lcind in enumerate(goodlcs):
+                pfresults[lcind].setdefault(mcolkey, {})[glsind] = (
+                    batchresults[row]
+                )
+
+    # run the rest of the period-finders and write out the pickles
+    for lcind in batchlcs:
+
+        results[lcind] = runpf(
+            lcfiles[lcind],
+            outdir,
+            timecols=timecols,
+            magcols=magcols,
+            errcols=errcols,
+            lcformat=lcformat,
+            pfmethods=pfmethods,
+            pfkwargs=pfkwargs,
+            sigclip=sigclip,
+            getblssnr=getblssnr,
+            nworkers=nworkers,
+            excludeprocessed=excludeprocessed,
+            fusedpf=fusedpf,
+            batchmagcols=False,
+            compactresults=compactresults,
+            timing=timing,
+            executor=pfexecutor,
+            pfresults=pfresults[lcind]
+        )
+
+    if executor is None:
+        pfexecutor.close()
+
+    return results
+
+
+
+def runpf_field_worker(task):
+    '''
+    This runs the runpf_field function.
+
+    '''
+
+    (lcfiles, outdir, timecols, magcols, errcols, lcformat,
+     pfmethods, pfkwargs, getblssnr, sigclip, nworkers,
+     excludeprocessed, fusedpf, timetolerance, compactresults, timing) = task
+
+    return runpf_field(lcfiles,
+                       outdir,
+                       timecols=timecols,
+                       magcols=magcols,
+                       errcols=errcols,
+                       lcformat=lcformat,
+                       pfmethods=pfmethods,
+                       pfkwargs=pfkwargs,
+                       getblssnr=getblssnr,
+                       sigclip=sigclip,
+                       nworkers=nworkers,
+                       excludeprocessed=excludeprocessed,
+                       fusedpf=fusedpf,
+                       timetolerance=timetolerance,
+                       compactresults=compactresults,
+                       timing=timing,
+                       executor=periodbase.get_pf_executor(nworkers))
+
+
+
+def _add_pf_timing(summary, key, timing):
+    '''This adds a period-finder timing dict to the totals for key in summary.
+
+    '''
+
+    totals = summary.setdefault(key, {'nruns':0,
+                                      'wall':{},
+                                      'cpu':{},
+                                      'nfreq':0,
+                                      'npoints':0,
+                                      'freqpoints':0.0})
+
+    totals['nruns'] += 1
+
+    for timekey in ('wall','cpu'):
+        for stage, val in timing.get(timekey, {}).items():
+            totals[timekey][stage] = totals[timekey].get(stage, 0.0) + val
+
+    nfreq, npoints = timing.get('nfreq', 0), timing.get('npoints', 0)
+    totals['nfreq'] += nfreq
+    totals['npoints'] += npoints
+    totals['freqpoints'] += float(nfreq)*npoints
+
+
+
+def summarize_pf_timing(pfpickles,
+                        outfile=None,
+                        runwall=None,
+                        runinfo=None):
+    '''This puts together the period-finder stage timings from many LCs.
+
+    pfpickles is a list of periodfinding-<objectid>.pkl files written by runpf
+    with timing=True. Any None items (for LCs that failed) and result dicts
+    without a 'timing' key are skipped.
+
+    Returns a dict with a 'methods' key, which is a dict keyed by period-finder
+    method (e.g. 'gls'). Each of these has the number of runs ('nruns'), the
+    total wall and CPU seconds spent in each stage ('wall', 'cpu'), the mean
+    wall seconds per run in each stage ('meanwall'), the total number of
+    frequencies and points ('nfreq', 'npoints'), and the number of frequency x
+    point evaluations per wall second of the kernel stage ('kernelrate'). The
+    timings of the fused passes from fused_periodfind are in a 'fused' key in
+    the same form, counted once per magcol. The GLS results from the batched
+    pgen_lsp_batch runs (see runpf and runpf_field) each get 1/nseries of the
+    wall and CPU time of their batch in every stage, along with their own
+    'nfreq' and 'npoints'. runwall and runinfo are stored as is, and are used
+    by parallel_pf for the wall time of the whole run and its settings.
+
+    If outfile is not None, the summary is also written to this pickle.
+
+    '''
+
+    methods, fused = {}, {}
+    npickles = 0
+
+    for pfpickle in pfpickles:
+
+        if not pfpickle or not os.path.exists(pfpickle):
+            continue
+
+        try:
+
+            if pfpickle.endswith('.gz'):
+                infd = gzip.open(pfpickle, 'rb')
+            else:
+                infd = open(pfpickle, 'rb')
+
+            with infd:
+                resultdict = pickle.load(infd)
+
+        except Exception as e:
+
+            LOGEXCEPTION('could not read period-finder results from %s' %
+                         pfpickle)
+            continue
+
+        hastiming = False
+
+        for mcolkey, mcolresults in resultdict.items():
+
+            if not (isinstance(mcolresults, dict) and
+                    'pfmethods' in mcolresults):
+                continue
+
+            fusedtiming = None
+
+            for pfmk in mcolresults['pfmethods']:
+
+                lspdict = mcolresults.get(pfmk)
+
+                if not isinstance(lspdict, dict) or not lspdict.get('timing'):
+                    continue
+
+                hastiming = True
+                timing = lspdict['timing']
+
+                # the GLS results from pgen_lsp_batch get an equal share of
+                # the batch's timings, which include their own peak finding
+                batchtiming = timing.get('batch')
+                if batchtiming:
+                    nseries = float(batchtiming.get('nseries') or 1)
+                    timing = dict(
+                        timing,
+                        wall={x:(y/nseries)
+                              for x, y in batchtiming['wall'].items()},
+                        cpu={x:(y/nseries)
+                             for x, y in batchtiming['cpu'].items()}
+                    )
+
+                _add_pf_timing(methods,
+                               lspdict.get('method', pfmk.split('-', 1)[-1]),
+                               timing)
+
+                if fusedtiming is None and timing.get('fused'):
+                    fusedtiming = timing['fused']
+
+            if fusedtiming is not None:
+                _add_pf_timing(fused, 'fused', fusedtiming)
+
+        if hastiming:
+            npickles += 1
+
+    for totals in list(methods.values()) + list(fused.values()):
+
+        totals['meanwall'] = {stage:(val/totals['nruns'])
+                              for stage, val in totals['wall'].items()}
+
+        kernelwall = totals['wall'].get('kernel', 0.0)
+        if kernelwall > 0.0:
+            totals['kernelrate'] = totals['freqpoints']/kernelwall
+        else:
+            totals['kernelrate'] = np.nan
+
+    summary = {'npickles':npickles,
+               'methods':methods,
+               'fused':fused.get('fused'),
+               'runwall':runwall,
+               'runinfo':runinfo}
+
+    LOGINFO('period-finder timing summary for %s LCs%s:' %
+            (npickles,
+             (', run wall time = %.1f sec' % runwall) if runwall else ''))
+
+    for method in sorted(methods):
+
+        totals = methods[method]
+        LOGINFO('%s: %s runs, mean wall time per run = %.3f sec (%s)' %
+                (method,
+                 totals['nruns'],
+                 totals['meanwall'].get('total', np.nan),
+                 ', '.join('%s = %.3f' % (stage, totals['meanwall'][stage])
+                           for stage in periodbase.PFTIMING_STAGES
+                           if stage in totals['meanwall'])))
+
+    if outfile is not None:
+        with open(outfile, 'wb') as outfd:
+            pickle.dump(summary, outfd, protocol=pickle.HIGHEST_PROTOCOL)
+        LOGINFO('wrote period-finder timing summary to %s' % outfile)
+
+    return summary
+
+
+
 def parallel_pf(lclist,
                 outdir,
                 timecols=None,
@@ -3413,7 +4719,13 @@ def parallel_pf(lclist,
                 ncontrolworkers=4,
                 liststartindex=None,
                 listmaxobjects=None,
-                excludeprocessed=True):
+                excludeprocessed=True,
+                fusedpf=False,
+                batchmagcols=True,
+                fieldbatch=None,
+                timetolerance=None,
+                compactresults=None,
+                timing=False):
     '''This drives the overall parallel period processing.
 
     Use pfmethods to specify which periodfinders to run. These must be in
@@ -3436,14 +4748,46 @@ def parallel_pf(lclist,
     this invocation. Together, these can be used to distribute processing over
     several independent machines if the number of light curves is very large.
 
-    If excludeprocessed is True, light curves that have been processed already
-    and have existing corresponding periodfinding-<objectid-suffix>.pkl[.gz]
-    files in outdir will be ignored.
+    If excludeprocessed is True, light curves that were processed already
+    with the same kwargs and haven't changed since are skipped, using the
+    runpf-manifest.jsonl in outdir. Set it to 'contenthash' to compare the LC
+    files by their contents instead of their sizes and mtimes (see runpf).
+
+    If fusedpf is True, the GLS, PDM, AoV, AoVMH, and spectral window
+    period-finders are run in a single pass over a shared frequency grid for
+    each LC (see periodbase.fused_periodfind).
+
+    If batchmagcols is True, the GLS period-finders for the magcols of each LC
+    that share a time column are run together (see runpf). This is ignored if
+    fusedpf is True or fieldbatch is set.
+
+    If fieldbatch is an integer, lclist is split into batches of this many LCs,
+    and each batch is sent to runpf_field instead of sending each LC to
+    runpf. This runs GLS for all LCs in a batch at once, which is much faster
+    for LCs from the same field that share most of their times. timetolerance
+    sets how the times of different LCs are matched in this case (see
+    runpf_field). The memory needed for each batch is about fieldbatch x the
+    number of GLS frequencies x 8 bytes.
+
+    If compactresults is not None, the period-finder results are written out in
+    a smaller form (see runpf).
+
+    Each control process keeps one pool of nperiodworkers period-finder workers
+    for all of its LCs (see periodbase.PeriodFinderExecutor), instead of
+    starting a new pool for every period-finder call.
+
+    If timing is True, the period-finder stage timings are recorded in the
+    output pickles (see runpf), and a summary of these for the whole run is
+    written to pf-timing-summary.pkl in outdir (see summarize_pf_timing). This
+    is also logged at the end of the run.
 
     As a rough benchmark, 25000 HATNet light curves with up to 50000 points per
     LC take about 26 days in total for an invocation of this function using
     GLS+PDM+BLS, 10 periodworkers, and 4 controlworkers (so all 40 'cores') on a
-    2 x Xeon E5-2660v3 machine.
+    2 x Xeon E5-2660v3 machine. Passing {'coarsetofine':True} in the pfkwargs
+    for each period-finder reduces the number of periodogram evaluations
+    (by ~60% for the default grids) by only searching around the best peaks
+    of a coarse grid at full resolution.
 
     '''
 
@@ -3460,15 +4804,47 @@ def parallel_pf(lclist,
     elif (liststartindex is not None) and (listmaxobjects is not None):
         lclist = lclist[liststartindex:liststartindex+listmaxobjects]
 
-    tasklist = [(x, outdir, timecols, magcols, errcols, lcformat,
-                 pfmethods, pfkwargs, getblssnr, sigclip, nperiodworkers,
-                 excludeprocessed)
-                for x in lclist]
+    runstart = time.time()
 
-    with ProcessPoolExecutor(max_workers=ncontrolworkers) as executor:
-        resultfutures = executor.map(runpf_worker, tasklist)
+    if fieldbatch:
+
+        tasklist = [(lclist[x:x+fieldbatch], outdir, timecols, magcols,
+                     errcols, lcformat, pfmethods, pfkwargs, getblssnr,
+                     sigclip, nperiodworkers, excludeprocessed, fusedpf,
+                     timetolerance, compactresults, timing)
+                    for x in range(0, len(lclist), fieldbatch)]
+
+        with ProcessPoolExecutor(max_workers=ncontrolworkers) as executor:
+            resultfutures = executor.map(runpf_field_worker, tasklist)
+
+        results = [y for x in resultfutures for y in x]
+
+    else:
+
+        tasklist = [(x, outdir, timecols, magcols, errcols, lcformat,
+                     pfmethods, pfkwargs, getblssnr, sigclip, nperiodworkers,
+                     excludeprocessed, fusedpf, batchmagcols, compactresults,
+                     timing)
+                    for x in lclist]
+
+        with ProcessPoolExecutor(max_workers=ncontrolworkers) as executor:
+            resultfutures = executor.map(runpf_worker, tasklist)
+
+        results = [x for x in resultfutures]
+
+    if timing:
+
+        summarize_pf_timing(
+            results,
+            outfile=os.path.join(outdir, 'pf-timing-summary.pkl'),
+            runwall=time.time() - runstart,
+            runinfo={'nperiodworkers':nperiodworkers,
+                     'ncontrolworkers':ncontrolworkers,
+                     'fusedpf':fusedpf,
+                     'batchmagcols':batchmagcols,
+                     'fieldbatch':fieldbatch}
+        )
 
-    results = [x for x in resultfutures]
     return results
 
 
@@ -3488,7 +4864,13 @@ def parallel_pf_lcdir(lcdir,
                       ncontrolworkers=4,
                       liststartindex=None,
                       listmaxobjects=None,
-                      excludeprocessed=True):
+                      excludeprocessed=True,
+                      fusedpf=False,
+                      batchmagcols=True,
+                      fieldbatch=None,
+                      timetolerance=None,
+                      compactresults=None,
+                      timing=False):
     '''
     This runs parallel light curve period finding for directory of LCs.
 
@@ -3555,7 +4937,13 @@ def parallel_pf_lcdir(lcdir,
                            ncontrolworkers=ncontrolworkers,
                            liststartindex=liststartindex,
                            listmaxobjects=listmaxobjects,
-                           excludeprocessed=excludeprocessed)
+                           excludeprocessed=excludeprocessed,
+                           fusedpf=fusedpf,
+                           batchmagcols=batchmagcols,
+                           fieldbatch=fieldbatch,
+                           timetolerance=timetolerance,
+                           compactresults=compactresults,
+                           timing=timing)
 
     else:
 
@@ -3813,16 +5201,60 @@ def runcp(pfpickle,
           lcformat='hat-sql',
           timecols=None,
           magcols=None,
-          errcols=None):
+          errcols=None,
+          excludeprocessed=False):
     '''This runs a checkplot for the given period-finding result pickle
     produced by runpf.
 
+    Each processed pfpickle is recorded in the runcp-manifest.jsonl in outdir.
+    If excludeprocessed is True or 'contenthash', pfpickles that were already
+    processed with the same kwargs and haven't changed since (along with the
+    lclistpkl and xmatchinfo pickles if these are paths) are skipped (see
+    runpf). The LC itself isn't checked, but runpf writes a new pfpickle if it
+    changes.
+
     '''
 
     if lcformat not in LCFORM or lcformat is None:
         LOGERROR('unknown light curve format specified: %s' % lcformat)
         return None
 
+    # lclistpkl and xmatchinfo are either paths to pickles or the loaded dicts
+    cacheinputs, cachekwargs = [pfpickle], {}
+
+    for key, val in (('lclistpkl', lclistpkl), ('xmatchinfo', xmatchinfo)):
+        if isinstance(val, str):
+            cacheinputs.append(val)
+        else:
+            cachekwargs[key] = val
+
+    cachekwargs.update({'lcbasedir':lcbasedir,
+                        'cprenorm':cprenorm,
+                        'nbrradiusarcsec':nbrradiusarcsec,
+                        'xmatchradiusarcsec':xmatchradiusarcsec,
+                        'sigclip':sigclip,
+                        'lcformat':lcformat,
+                        'timecols':timecols,
+                        'magcols':magcols,
+                        'errcols':errcols})
+
+    cachekey = get_processing_cachekey(
+        'runcp',
+        cacheinputs,
+        cachekwargs,
+        contenthash=(excludeprocessed == 'contenthash')
+    )
+
+    if excludeprocessed:
+
+        cpfs = _get_processed_outfile(outdir, 'runcp', pfpickle, cachekey)
+
+        if cpfs is not None:
+            LOGWARNING('checkplots for %s already exist at %s, '
+                       'skipping because excludeprocessed=True'
+                       % (pfpickle, repr(cpfs)))
+            return cpfs
+
     if pfpickle.endswith('.gz'):
         infd = gzip.open(pfpickle,'rb')
     else:
@@ -3914,6 +5346,11 @@ def runcp(pfpickle,
         else:
             xtimes, xmags, xerrs = times, mags, errs
 
+        # clean this magcol once, checkplot_dict will use its sigclip results
+        cleanedlc = CleanedMagSeries(xtimes, xmags, xerrs,
+                                     magsarefluxes=magsarefluxes)
+        xtimes, xmags, xerrs = cleanedlc
+
         # generate the checkplotdict
         cpd = checkplot.checkplot_dict(
             pflist,
@@ -3948,6 +5385,8 @@ def runcp(pfpickle,
 
         cpfs.append(cpf)
 
+    _update_processing_manifest(outdir, 'runcp', pfpickle, cachekey, cpfs)
+
     LOGINFO('done with %s -> %s' % (objectid, repr(cpfs)))
     return cpfs
 
@@ -3986,10 +5425,14 @@ def parallel_cp(pfpicklelist,
                 timecols=None,
                 magcols=None,
                 errcols=None,
+                excludeprocessed=False,
                 nworkers=32):
     '''This drives the parallel execution of runcp for a list of periodfinding
     result pickles.
 
+    If excludeprocessed is True or 'contenthash', pfpickles that were already
+    processed with the same kwargs are skipped (see runcp).
+
     '''
 
     if not os.path.exists(outdir):
@@ -4009,7 +5452,8 @@ def parallel_cp(pfpicklelist,
                   'xmatchinfo':xmatchinfo,
                   'xmatchradiusarcsec':xmatchradiusarcsec,
                   'sigclip':sigclip,
-                  'cprenorm':cprenorm}) for
+                  'cprenorm':cprenorm,
+                  'excludeprocessed':excludeprocessed}) for
                 x in pfpicklelist]
 
     resultfutures = []
@@ -4040,6 +5484,7 @@ def parallel_cp_pfdir(pfpickledir,
                       timecols=None,
                       magcols=None,
                       errcols=None,
+                      excludeprocessed=False,
                       nworkers=32):
 
     '''This drives the parallel execution of runcp for a directory of
@@ -4066,6 +5511,7 @@ def parallel_cp_pfdir(pfpickledir,
                        timecols=timecols,
                        magcols=magcols,
                        errcols=errcols,
+                       excludeprocessed=excludeprocessed,
                        nworkers=nworkers)
 
 
@@ -1996,10 +1996,13 @@ def runpf(lcfile,
 
     from astrobase import periodbase
     from astrobase.periodbase.kbls import bls_snr
+    from astrobase.periodbase.oldpf import townsend_lsp
 
     # used to figure out which period finder to run given a list of methods
     PFMETHODS = {'bls':periodbase.bls_parallel_pfind,
                  'gls':periodbase.pgen_lsp,
+                 'fls':periodbase.fast_lsp,
+                 'tls':townsend_lsp,
                  'aov':periodbase.aov_periodfind,
                  'mav':periodbase.aovhm_periodfind,
                  'pdm':periodbase.stellingwerf_pdm,
@@ -2416,6 +2419,8 @@ def runcp(pfpickle,
 
     PFMETHODS = ['bls',
                  'gls',
+                 'fls',
+                 'tls',
                  'aov',
                  'mav',
                  'pdm',
@@ -11,9 +11,11 @@ CURRENT:
 periodbase.spdm -> Stellingwerf (1978) phase-dispersion minimization
 periodbase.saov -> Schwarzenberg-Czerny (1989) analysis of variance
 periodbase.zgls -> Zechmeister & Kurster (2009) generalized Lomb-Scargle
+                   (with a Press & Rybicki 1989 fast version: fast_lsp)
 periodbase.kbls -> Kovacs et al. (2002) Box-Least-Squares search
 periodbase.macf -> McQuillan et al. (2013a, 2014) ACF period search
 periodbase.smav -> Schwarzenberg-Czerny (1996) multi-harmonic AoV period search
+periodbase.fused -> runs several of the above in one pass over a shared grid
 
 TO BE IMPLEMENTED:
 
@@ -91,83 +93,1676 @@ def LOGEXCEPTION(message):
 ## IMPORTS ##
 #############
 
+import os
+import os.path
+import tempfile
+import hashlib
+from multiprocessing import Pool, cpu_count
+from collections import OrderedDict
+import threading
+import time
+from copy import deepcopy
+from functools import wraps, partial
+from contextlib import contextmanager
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
 import numpy as np
 
-# import these to avoid lookup overhead
-from numpy import nan as npnan, sum as npsum, abs as npabs, \
-    roll as nproll, isfinite as npisfinite, std as npstd, \
-    sign as npsign, sqrt as npsqrt, median as npmedian, \
-    array as nparray, percentile as nppercentile, \
-    polyfit as nppolyfit, var as npvar, max as npmax, min as npmin, \
-    log10 as nplog10, arange as nparange, pi as MPI, floor as npfloor, \
-    argsort as npargsort, cos as npcos, sin as npsin, tan as nptan, \
-    where as npwhere, linspace as nplinspace, \
-    zeros_like as npzeros_like, full_like as npfull_like, \
-    arctan as nparctan, nanargmax as npnanargmax, nanargmin as npnanargmin, \
-    empty as npempty, ceil as npceil, mean as npmean, \
-    digitize as npdigitize, unique as npunique, \
-    argmax as npargmax, argmin as npargmin
+# import these to avoid lookup overhead
+from numpy import nan as npnan, sum as npsum, abs as npabs, \
+    roll as nproll, isfinite as npisfinite, std as npstd, \
+    sign as npsign, sqrt as npsqrt, median as npmedian, \
+    array as nparray, percentile as nppercentile, \
+    polyfit as nppolyfit, var as npvar, max as npmax, min as npmin, \
+    log10 as nplog10, arange as nparange, pi as MPI, floor as npfloor, \
+    argsort as npargsort, cos as npcos, sin as npsin, tan as nptan, \
+    where as npwhere, linspace as nplinspace, \
+    zeros_like as npzeros_like, full_like as npfull_like, \
+    arctan as nparctan, nanargmax as npnanargmax, nanargmin as npnanargmin, \
+    empty as npempty, ceil as npceil, mean as npmean, \
+    digitize as npdigitize, unique as npunique, \
+    argmax as npargmax, argmin as npargmin
+
+
+
+########################
+## SOME OTHER IMPORTS ##
+########################
+
+from scipy.special import gammaln
+
+from ..lcmath import sigclip_magseries
+
+
+#######################
+## UTILITY FUNCTIONS ##
+#######################
+
+def get_frequency_grid(times,
+                       samplesperpeak=5,
+                       nyquistfactor=5,
+                       minfreq=None,
+                       maxfreq=None,
+                       returnf0dfnf=False):
+    '''This calculates a frequency grid for the period finding functions in this
+    module.
+
+    Based on the autofrequency function in astropy.stats.lombscargle.
+
+    http://docs.astropy.org/en/stable/_modules/astropy/stats/lombscargle/core.html#LombScargle.autofrequency
+
+    '''
+
+    baseline = times.max() - times.min()
+    nsamples = times.size
+
+    df = 1. / baseline / samplesperpeak
+
+    if minfreq is not None:
+        f0 = minfreq
+    else:
+        f0 = 0.5 * df
+
+    if maxfreq is not None:
+        Nf = int(npceil((maxfreq - f0) / df))
+    else:
+        Nf = int(0.5 * samplesperpeak * nyquistfactor * nsamples)
+
+
+    if returnf0dfnf:
+        return f0, df, Nf, f0 + df * nparange(Nf)
+    else:
+        return f0 + df * nparange(Nf)
+
+
+
+def get_frequency_blocks(nfrequencies,
+                         npoints,
+                         blockmemory=32.0,
+                         narrays=4,
+                         minblocks=1):
+    '''This splits a frequency grid into contiguous blocks for the vectorized
+    period-finder kernels.
+
+    nfrequencies is the total number of frequencies in the grid and npoints is
+    the number of points in the mag series.
+
+    blockmemory is the memory budget in MB for the 2D (nblockfreqs x npoints)
+    float64 work arrays used by a single block. narrays is the number of these
+    work arrays that the kernel keeps around at the same time.
+
+    minblocks is the minimum number of blocks to generate (if there are enough
+    frequencies). Set this to the number of workers to make sure all of them
+    get something to do.
+
+    Returns a list of slice objects into the frequency grid.
+
+    '''
+
+    blocksize = int(blockmemory*1024.0*1024.0/(8.0*narrays*npoints))
+    blocksize = max(1, min(blocksize, nfrequencies))
+
+    # make sure there are at least minblocks blocks
+    if minblocks and minblocks > 1:
+        blocksize = max(1, min(blocksize,
+                               int(npceil(nfrequencies/float(minblocks)))))
+
+    return [slice(x, min(x + blocksize, nfrequencies))
+            for x in range(0, nfrequencies, blocksize)]
+
+
+
+def get_nbestperiods(lspvals,
+                     periods,
+                     nbestpeaks=5,
+                     periodepsilon=0.1,
+                     minimize=False):
+    '''This finds the nbestpeaks best periods in a periodogram.
+
+    This does the same thing as the peak-finding code at the end of each
+    period-finder in this package: 1. sort the lsp array by the best value
+    first, 2. go down the values until we find nbestpeaks values that are
+    separated by at least periodepsilon (as a fraction) in period.
+
+    If minimize is True, the best values are the smallest ones (e.g. for PDM).
+
+    Returns a dict with keys: bestperiod, bestlspval, nbestperiods,
+    nbestlspvals. Returns None if there are no finite periodogram values.
+
+    '''
+
+    # make sure to filter out non-finite values of lsp
+    finitepeakind = npisfinite(lspvals)
+    finlsp = lspvals[finitepeakind]
+    finperiods = periods[finitepeakind]
+
+    if finlsp.size == 0:
+        return None
+
+    if minimize:
+        bestperiodind = npargmin(finlsp)
+        sortedlspind = np.argsort(finlsp)
+    else:
+        bestperiodind = npargmax(finlsp)
+        sortedlspind = np.argsort(finlsp)[::-1]
+
+    sortedlspperiods = finperiods[sortedlspind]
+    sortedlspvals = finlsp[sortedlspind]
+
+    # now get the nbestpeaks
+    nbestperiods, nbestlspvals, peakcount = (
+        [finperiods[bestperiodind]],
+        [finlsp[bestperiodind]],
+        1
+    )
+    prevperiod = sortedlspperiods[0]
+
+    # find the best nbestpeaks in the lsp and their periods
+    for period, lspval in zip(sortedlspperiods, sortedlspvals):
+
+        if peakcount == nbestpeaks:
+            break
+        perioddiff = abs(period - prevperiod)
+        bestperiodsdiff = [abs(period - x) for x in nbestperiods]
+
+        # this ensures that this period is different from the last period and
+        # from all the other existing best periods by periodepsilon to make
+        # sure we jump to an entire different peak in the periodogram
+        if (perioddiff > (periodepsilon*prevperiod) and
+            all(x > (periodepsilon*prevperiod) for x in bestperiodsdiff)):
+            nbestperiods.append(period)
+            nbestlspvals.append(lspval)
+            peakcount = peakcount + 1
+
+        prevperiod = period
+
+    return {'bestperiod':finperiods[bestperiodind],
+            'bestlspval':finlsp[bestperiodind],
+            'nbestperiods':nbestperiods,
+            'nbestlspvals':nbestlspvals}
+
+
+
+###########################################
+## TRIG RECURRENCE FOR UNIFORM FREQUENCY ##
+###########################################
+
+def is_uniform_grid(grid, rtol=1.0e-6):
+    '''This checks if a frequency grid has a constant step between elements.
+
+    This is the case for the grids from get_frequency_grid and for the
+    arange(startf, endf, stepsize) grids used when autofreq = False.
+
+    '''
+
+    if grid.size < 3:
+        return grid.size > 0
+
+    gridsteps = np.diff(grid)
+    return np.allclose(gridsteps, gridsteps[0], rtol=rtol, atol=0.0)
+
+
+
+def get_trig_block(times, omegas, reseed=64, uniform=None):
+    '''This calculates sin(omega*times) and cos(omega*times) for a block of
+    omegas.
+
+    If omegas is a uniform grid (or uniform is True), the sin and cos for each
+    omega are obtained from those for the previous one by a rotation through
+    the constant step in omega:
+
+    sin((w + dw)t) = sin(wt) cos(dw t) + cos(wt) sin(dw t)
+    cos((w + dw)t) = cos(wt) cos(dw t) - sin(wt) sin(dw t)
+
+    This needs only multiplications and additions instead of calls to npsin and
+    npcos for each (omega, time) pair. To keep the accumulated rounding errors
+    bounded, the values are calculated directly every reseed omegas.
+
+    If omegas is not uniform, this falls back to the direct calculation.
+
+    Returns sin_omegat, cos_omegat as (omegas.size x times.size) arrays.
+
+    '''
+
+    if uniform is None:
+        uniform = is_uniform_grid(omegas)
+
+    if not uniform or omegas.size < 3:
+        omegat = np.outer(omegas, times)
+        sin_omegat = npsin(omegat)
+        cos_omegat = npcos(omegat, out=omegat)
+        return sin_omegat, cos_omegat
+
+    sin_omegat = npempty((omegas.size, times.size))
+    cos_omegat = npempty((omegas.size, times.size))
+
+    for ind, sin_wt, cos_wt in iter_trig_recurrence(times,
+                                                   omegas,
+                                                   reseed=reseed):
+        sin_omegat[ind] = sin_wt
+        cos_omegat[ind] = cos_wt
+
+    return sin_omegat, cos_omegat
+
+
+
+def iter_trig_recurrence(times, omegas, reseed=64):
+    '''This generates sin(omega*times), cos(omega*times) for each omega in a
+    uniform grid of omegas.
+
+    This uses the same rotation recurrence as get_trig_block, but goes through
+    the omegas one at a time for the period-finders that work on a single
+    frequency at a time. The values are calculated directly every reseed
+    omegas.
+
+    Yields (index into omegas, sin_omegat, cos_omegat). The yielded arrays are
+    reused for the next omega, so copy them if they need to be kept.
+
+    '''
+
+    nomegas = omegas.size
+    if nomegas > 1:
+        domega = (omegas[-1] - omegas[0])/(nomegas - 1.0)
+    else:
+        domega = 0.0
+
+    sin_domegat = npsin(domega*times)
+    cos_domegat = npcos(domega*times)
+
+    sin_wt = npempty(times.size)
+    cos_wt = npempty(times.size)
+    next_sin_wt = npempty(times.size)
+    workarr = npempty(times.size)
+
+    for ind in range(nomegas):
+
+        # calculate directly every reseed steps to bound the drift
+        if ind % reseed == 0:
+
+            np.multiply(omegas[ind], times, out=workarr)
+            npsin(workarr, out=sin_wt)
+            npcos(workarr, out=cos_wt)
+
+        else:
+
+            # sin(wt + dwt) = sin(wt)cos(dwt) + cos(wt)sin(dwt)
+            np.multiply(sin_wt, cos_domegat, out=next_sin_wt)
+            np.multiply(cos_wt, sin_domegat, out=workarr)
+            next_sin_wt += workarr
+
+            # cos(wt + dwt) = cos(wt)cos(dwt) - sin(wt)sin(dwt)
+            np.multiply(sin_wt, sin_domegat, out=workarr)
+            cos_wt *= cos_domegat
+            cos_wt -= workarr
+
+            sin_wt, next_sin_wt = next_sin_wt, sin_wt
+
+        yield ind, sin_wt, cos_wt
+
+
+
+##################################################
+## BATCHED PHASE-BINNING FOR THE PDM/AOV THETAS ##
+##################################################
+
+def get_phasebin_indices(times, frequencies, binsize, fold_time=None,
+                         phases=None):
+    '''This gets the phase-bin indices of a mag series for a batch of
+    frequencies.
+
+    The mag series is phased at each frequency using fold_time (times[0] if
+    None) as the epoch, in the same way as lcmath.phase_magseries, and the
+    phases are binned using the edges np.arange(0.0, 1.0, binsize) in the same
+    way as npdigitize. No sorting of the phases is needed.
+
+    If phases is not None, it's used as the (frequencies.size x times.size)
+    array of phases instead of calculating them here. This is used by
+    fused_periodfind to share the phases between several period-finders.
+
+    Returns (binind, nbins), where binind is a (frequencies.size x times.size)
+    array of bin indices in the range 1 to nbins.
+
+    '''
+
+    bins = nparange(0.0, 1.0, binsize)
+
+    if phases is None:
+
+        if fold_time is None:
+            fold_time = times[0]
+
+        periods = 1.0/frequencies
+        phases = (times - fold_time)[None,:]/periods[:,None]
+        phases -= npfloor(phases)
+
+    # this is the same as npdigitize(phases, bins) for increasing bins
+    binind = np.searchsorted(bins, phases, side='right')
+
+    return binind, bins.size
+
+
+
+def get_batch_bincounts(binind, nbins, weights=None):
+    '''This gets the per-bin counts (or sums of weights) for each row of a 2D
+    array of bin indices.
+
+    binind is the (nfrequencies x npoints) array from get_phasebin_indices.
+
+    weights is an optional array of npoints values (e.g. the mags or the mags
+    squared) to sum up in each bin. If None, the number of points in each bin
+    is returned.
+
+    Returns an (nfrequencies x nbins + 1) array. Column 0 is always empty
+    because the bin indices start at 1.
+
+    '''
+
+    nrows = binind.shape[0]
+    rowoffsets = (nparange(nrows)*(nbins + 1))[:,None]
+
+    if weights is not None:
+        weights = np.broadcast_to(weights, binind.shape).ravel()
+
+    bincounts = np.bincount((binind + rowoffsets).ravel(),
+                            weights=weights,
+                            minlength=nrows*(nbins + 1))
+
+    return bincounts.reshape(nrows, nbins + 1)
+
+
+
+#################################################
+## SHARED INPUT ARRAYS FOR PERIOD-FINDER POOLS ##
+#################################################
+
+NCPUS = cpu_count()
+
+# this is where the shared mag series files go. /dev/shm is a RAM-backed
+# filesystem on Linux, so memory-mapping a file from there is the same as using
+# shared memory. otherwise, we'll fall back to the usual temp directory.
+if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+    SHAREDARRAY_DIR = '/dev/shm'
+else:
+    SHAREDARRAY_DIR = None
+
+# this holds the memory-mapped arrays that a worker process has attached to,
+# keyed by the path of the shared file. each value is (inode and mtime of the
+# file, arrays). entries are dropped once their file is removed, so persistent
+# workers don't keep the memory of finished calls mapped
+_SHARED_MAGSERIES = {}
+_SHARED_MAGSERIES_MAXITEMS = 8
+
+
+class SharedMagSeries(object):
+    '''This places a set of equal-length arrays in a memory-mapped file.
+
+    Use this as a context manager around a worker pool. The arrays are written
+    once to a .npy file (in /dev/shm if possible) and workers attach to it
+    zero-copy by calling get_shared_magseries with the value of the ref
+    attribute. The file is removed when the context manager exits.
+
+    If the shared file can't be written for some reason, ref is just the tuple
+    of the input arrays, and these are then sent along with each task as
+    usual. get_shared_magseries handles both cases transparently.
+
+    '''
+
+    def __init__(self, *arrays, **kwargs):
+
+        self.arrays = arrays
+        self.sharedarrays = kwargs.get('sharedarrays', True)
+        self.shareddir = kwargs.get('shareddir', SHAREDARRAY_DIR)
+        self.path = None
+        self.ref = arrays
+
+
+    def __enter__(self):
+
+        if not self.sharedarrays:
+            return self
+
+        # writing the shared file counts as pool overhead in the timings
+        with pf_timing_stage('pool'):
+
+            try:
+
+                fd, self.path = tempfile.mkstemp(prefix='astrobase-magseries-',
+                                                 suffix='.npy',
+                                                 dir=self.shareddir)
+                with os.fdopen(fd, 'wb') as outfd:
+                    np.save(outfd, np.vstack(self.arrays).astype(np.float64))
+                self.ref = self.path
+
+            except Exception as e:
+
+                LOGWARNING('could not write shared mag series file, '
+                           'will send arrays with each task instead: %s' % e)
+                if self.path and os.path.exists(self.path):
+                    os.remove(self.path)
+                self.path = None
+                self.ref = self.arrays
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if self.path and os.path.exists(self.path):
+            with pf_timing_stage('pool'):
+                os.remove(self.path)
+        self.path = None
+        self.ref = self.arrays
+
+
+
+def get_shared_magseries(ref):
+    '''This returns the arrays for a SharedMagSeries ref.
+
+    If ref is a path to a shared mag series file, attaches to it using a
+    read-only memory map (only once per worker process and file) and returns a
+    tuple of the arrays in it. If ref is already a tuple of arrays, returns it
+    as is.
+
+    '''
+
+    if not isinstance(ref, str):
+        return ref
+
+    # drop the maps of files that SharedMagSeries has removed. the memory of
+    # an unlinked file is only freed once nothing maps it anymore
+    for path in list(_SHARED_MAGSERIES):
+        if path != ref and not os.path.exists(path):
+            _SHARED_MAGSERIES.pop(path, None)
+
+    refstat = os.stat(ref)
+    refkey = (refstat.st_ino, refstat.st_mtime_ns)
+
+    # the temp file name may have been reused for a new file
+    if ref in _SHARED_MAGSERIES and _SHARED_MAGSERIES[ref][0] != refkey:
+        _SHARED_MAGSERIES.pop(ref)
+
+    if ref not in _SHARED_MAGSERIES:
+
+        # evict the oldest attached files if we've got too many
+        while len(_SHARED_MAGSERIES) >= _SHARED_MAGSERIES_MAXITEMS:
+            _SHARED_MAGSERIES.pop(next(iter(_SHARED_MAGSERIES)))
+
+        _SHARED_MAGSERIES[ref] = (refkey, tuple(np.load(ref, mmap_mode='r')))
+
+    return _SHARED_MAGSERIES[ref][1]
+
+
+
+class PeriodFinderExecutor(object):
+    '''This is a worker pool that can be reused across period-finder calls.
+
+    The period-finders that take an executor kwarg run their work on this
+    instead of starting and stopping their own multiprocessing.Pool, and use
+    its nworkers instead of their own nworkers kwarg. This avoids forking a
+    new pool for each period-finder, magcol, and LC in lcproc.runpf.
+
+    Use this as a context manager:
+
+    with PeriodFinderExecutor(nworkers=8) as executor:
+        glsp = pgen_lsp(times, mags, errs, executor=executor)
+        pdmp = stellingwerf_pdm(times, mags, errs, executor=executor)
+
+    nworkers is the number of worker processes (NCPUS if None). chunksize is
+    the default chunksize for map. The pool is only started when it's first
+    needed, so nothing is forked if nworkers is 1 (in which case the
+    period-finders run everything in this process).
+
+    The input arrays for each call still go into shared memory (see
+    SharedMagSeries), which the workers attach to by name, so the pool doesn't
+    have to be started after these are set up.
+
+    '''
+
+    def __init__(self, nworkers=None, chunksize=None):
+
+        if (not nworkers) or (nworkers > NCPUS):
+            nworkers = NCPUS
+
+        self.nworkers = nworkers
+        self.chunksize = chunksize
+        self.pool = None
+
+        # the pool only belongs to the process that made this executor
+        self.pid = os.getpid()
+
+
+    def start(self):
+        '''This starts the pool if it's not running already.
+
+        '''
+
+        if self.pool is None:
+            with pf_timing_stage('pool'):
+                self.pool = Pool(self.nworkers)
+
+        return self
+
+
+    def map(self, func, tasks, chunksize=None):
+        '''This runs func over tasks using the pool and returns a list of the
+        results in order.
+
+        If chunksize is None, uses the chunksize of this executor.
+
+        '''
+
+        self.start()
+
+        if chunksize is None:
+            chunksize = self.chunksize
+
+        if chunksize:
+            return self.pool.map(func, tasks, chunksize=chunksize)
+        else:
+            return self.pool.map(func, tasks)
+
+
+    def close(self):
+        '''This stops the pool.
+
+        '''
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+
+
+# this is the executor kept around by get_pf_executor
+_PF_EXECUTOR = None
+
+
+def get_pf_executor(nworkers=None, chunksize=None):
+    '''This returns a PeriodFinderExecutor that lives as long as this process.
+
+    It's made on the first call and reused after that, unless nworkers or
+    chunksize change, or this process was forked from the one that made it.
+    This is for the control processes of lcproc.parallel_pf, so each one keeps
+    a single pool for all of its LCs.
+
+    '''
+
+    global _PF_EXECUTOR
+
+    if (not nworkers) or (nworkers > NCPUS):
+        nworkers = NCPUS
+
+    if (_PF_EXECUTOR is None or
+        _PF_EXECUTOR.pid != os.getpid() or
+        _PF_EXECUTOR.nworkers != nworkers or
+        _PF_EXECUTOR.chunksize != chunksize):
+
+        # a pool inherited from the parent process can't be used or closed
+        if _PF_EXECUTOR is not None and _PF_EXECUTOR.pid == os.getpid():
+            _PF_EXECUTOR.close()
+
+        _PF_EXECUTOR = PeriodFinderExecutor(nworkers=nworkers,
+                                            chunksize=chunksize)
+
+    return _PF_EXECUTOR
+
+
+
+def parallel_frequency_blocks(workerfunc,
+                              magseries,
+                              frequencies,
+                              extraargs=(),
+                              nworkers=None,
+                              blockmemory=32.0,
+                              narrays=4,
+                              sharedarrays=True,
+                              executor=None,
+                              verbose=True):
+    '''This runs a block worker over the frequency grid using a worker pool.
+
+    workerfunc is a function that takes a single task tuple of the form:
+
+    (magseries ref, block of frequencies, extraargs[0], extraargs[1], ...)
+
+    and returns an array of periodogram values, one per frequency in the
+    block. The worker should get its input arrays by calling
+    get_shared_magseries on task[0].
+
+    magseries is a tuple of the cleaned input arrays, e.g. (times, mags, errs).
+
+    frequencies is the full frequency (or omega) grid.
+
+    blockmemory and narrays set the number of frequencies in each block (see
+    get_frequency_blocks).
+
+    If sharedarrays is True, the input arrays are written once to shared memory
+    (see SharedMagSeries) so the workers get only the frequency blocks in their
+    tasks. Otherwise, the arrays are sent along with each block.
+
+    If nworkers is 1, runs the blocks in this process without starting a pool.
+
+    If executor is a PeriodFinderExecutor, its pool and nworkers are used
+    instead of starting a new pool.
+
+    Returns the concatenated periodogram values for the full frequency grid.
+    If the grid is empty, returns an empty array.
+
+    '''
+
+    # an empty grid (e.g. startp >= endp) gives an empty periodogram, which the
+    # period-finders turn into their usual nan result dicts
+    if frequencies.size == 0:
+        return npempty(0)
+
+    if executor is not None:
+        nworkers = executor.nworkers
+    elif (not nworkers) or (nworkers > NCPUS):
+        nworkers = NCPUS
+
+    blocks = get_frequency_blocks(frequencies.size,
+                                  magseries[0].size,
+                                  blockmemory=blockmemory,
+                                  narrays=narrays,
+                                  minblocks=nworkers)
+    if verbose:
+        LOGINFO('using %s workers, %s frequency blocks '
+                'of up to %s frequencies' %
+                (nworkers, len(blocks), blocks[0].stop - blocks[0].start))
+
+    # no need to set up shared arrays and a pool if there's only one worker
+    if nworkers == 1:
+
+        results = [workerfunc((magseries, frequencies[x]) + tuple(extraargs))
+                   for x in blocks]
+
+    else:
+
+        with SharedMagSeries(*magseries,
+                             sharedarrays=sharedarrays) as shared:
+
+            tasks = [(shared.ref, frequencies[x]) + tuple(extraargs)
+                     for x in blocks]
+
+            if executor is not None:
+                results = executor.map(workerfunc, tasks)
+            else:
+                with pf_timing_stage('pool'):
+                    pool = Pool(nworkers)
+                results = pool.map(workerfunc, tasks)
+                with pf_timing_stage('pool'):
+                    pool.close()
+                    pool.join()
+                del pool
+
+    return np.concatenate(results)
+
+
+####################################
+## COARSE-TO-FINE FREQUENCY SEARCH ##
+####################################
+
+def coarse_to_fine_search(evalfunc,
+                          frequencies,
+                          coarsefactor=3,
+                          npeaks=10,
+                          refinewidth=2.0,
+                          refinealiases=True,
+                          minimize=False,
+                          verbose=True):
+    '''This runs a two-stage coarse-to-fine search over a frequency grid.
+
+    evalfunc is a function that takes an array of frequencies (or omegas) and
+    returns an array of periodogram values for them.
+
+    frequencies is the full (fine) grid of frequencies, in increasing order.
+
+    First, evalfunc is run on a coarse grid made of every coarsefactor-th
+    frequency of the fine grid. Then, the npeaks best local peaks in the coarse
+    periodogram are refined by running evalfunc on the fine grid in windows
+    around them. Each window extends refinewidth coarse grid steps on either
+    side of the peak. If refinealiases is True, windows are also placed around
+    the harmonic aliases (2f and f/2) of each peak. If minimize is True, the
+    peaks are minima of the periodogram (e.g. for PDM).
+
+    The coarse grid must still sample each periodogram peak close to its top,
+    so coarsefactor should be at most about half the number of fine grid
+    points across a peak. For the grids from get_frequency_grid, there are
+    about samplesperpeak (5 by default) points across a peak, so the
+    period-finders use coarsefactor = 3 by default.
+
+    Returns (merged frequencies, merged periodogram values, info dict). The
+    merged grid is the sorted union of the coarse grid and the refinement
+    windows, i.e. a subset of the fine grid. The info dict contains the number
+    of fine grid points (nfullgrid), the number of evaluations done (ncoarse,
+    nrefined, nevaluated), and the number of evaluations saved (nsaved).
+
+    '''
+
+    nfull = frequencies.size
+    coarseind = nparange(0, nfull, coarsefactor)
+
+    coarselsp = nparray(evalfunc(frequencies[coarseind]))
+
+    # find the local peaks of the coarse periodogram
+    if minimize:
+        peakvals = -np.real(coarselsp)
+    else:
+        peakvals = np.real(coarselsp).copy()
+    peakvals[~npisfinite(peakvals)] = -np.inf
+
+    paddedvals = np.concatenate(([-np.inf], peakvals, [-np.inf]))
+    localpeaks = np.nonzero(
+        (peakvals >= paddedvals[:-2]) &
+        (peakvals >= paddedvals[2:]) &
+        npisfinite(peakvals)
+    )[0]
+    localpeaks = localpeaks[npargsort(peakvals[localpeaks])[::-1]][:npeaks]
+
+    # these are the frequencies to refine around
+    peakfreqs = frequencies[coarseind[localpeaks]]
+    if refinealiases:
+        peakfreqs = np.concatenate((peakfreqs,
+                                    2.0*peakfreqs,
+                                    0.5*peakfreqs))
+
+    peakfreqs = peakfreqs[(peakfreqs >= frequencies[0]) &
+                          (peakfreqs <= frequencies[-1])]
+    peakind = np.clip(np.searchsorted(frequencies, peakfreqs), 0, nfull - 1)
+
+    # get the fine grid points in the windows around the peaks
+    halfwidth = int(npceil(refinewidth*coarsefactor))
+    refinemask = np.zeros(nfull, dtype=bool)
+    for ind in peakind:
+        refinemask[max(ind - halfwidth, 0):ind + halfwidth + 1] = True
+
+    # don't evaluate the coarse grid points again
+    refinemask[coarseind] = False
+    refineind = np.nonzero(refinemask)[0]
+
+    if refineind.size > 0:
+        refinelsp = nparray(evalfunc(frequencies[refineind]))
+    else:
+        refinelsp = coarselsp[:0]
+
+    # merge the coarse and refined points
+    mergedind = np.concatenate((coarseind, refineind))
+    mergedlsp = np.concatenate((coarselsp, refinelsp))
+    mergedsort = npargsort(mergedind)
+
+    nevaluated = coarseind.size + refineind.size
+    ctfinfo = {'nfullgrid':nfull,
+               'ncoarse':coarseind.size,
+               'nrefined':refineind.size,
+               'nevaluated':nevaluated,
+               'nsaved':nfull - nevaluated,
+               'coarsefactor':coarsefactor,
+               'npeaks':npeaks,
+               'refinewidth':refinewidth,
+               'refinealiases':refinealiases}
+
+    if verbose:
+        LOGINFO('coarse-to-fine search: %s evaluations instead of %s, '
+                'saved %s (%.1f%%)' %
+                (nevaluated, nfull, nfull - nevaluated,
+                 100.0*(nfull - nevaluated)/nfull))
+
+    return (frequencies[mergedind[mergedsort]],
+            mergedlsp[mergedsort],
+            ctfinfo)
+
+
+
+################################
+## PERIOD-FINDER RESULT CACHE ##
+################################
+
+# these kwargs only change how the period-finders do their work, not their
+# results, so they're left out of the cache keys
+PFCACHE_IGNOREDKWARGS = ('verbose', 'nworkers', 'workchunksize',
+                         'sharedarrays', 'blockmemory', 'executor')
+
+
+class PeriodFinderCache(object):
+    '''This is a cache for period-finder results.
+
+    Results are kept in memory in an LRU dict of at most maxmemitems items. If
+    cachedir is not None, they're also written there as pickles, and the
+    least-recently used ones are removed once the total size of these goes
+    over maxdiskmb MB. The disk cache can be shared between processes, so this
+    is the one that helps for the worker processes of lcproc.parallel_pf.
+
+    The stats attribute is a dict with the number of hits (total, and from
+    memory or disk), misses, and evictions.
+
+    '''
+
+    def __init__(self, cachedir=None, maxmemitems=64, maxdiskmb=1024.0):
+
+        self.cachedir = cachedir
+        self.maxmemitems = maxmemitems
+        self.maxdiskmb = maxdiskmb
+        self.memcache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits':0, 'memhits':0, 'diskhits':0,
+                      'misses':0, 'evictions':0}
+
+        if self.cachedir and not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+
+    def _diskpath(self, key):
+
+        return os.path.join(self.cachedir, 'pfcache-%s.pkl' % key)
+
+
+    def _memput(self, key, result):
+
+        with self.lock:
+
+            self.memcache.pop(key, None)
+            self.memcache[key] = result
+
+            while len(self.memcache) > self.maxmemitems:
+                self.memcache.popitem(last=False)
+                self.stats['evictions'] += 1
+
+
+    def get(self, key):
+        '''This returns a copy of the cached result for key or None.
+
+        '''
+
+        with self.lock:
+
+            if key in self.memcache:
+
+                # mark this as the most recently used
+                result = self.memcache.pop(key)
+                self.memcache[key] = result
+
+                self.stats['hits'] += 1
+                self.stats['memhits'] += 1
+                return deepcopy(result)
+
+        if self.cachedir:
+
+            cachepath = self._diskpath(key)
+
+            try:
+
+                with open(cachepath, 'rb') as infd:
+                    result = pickle.load(infd)
+
+                # the mtimes are used for the LRU eviction on disk
+                os.utime(cachepath, None)
+
+                self._memput(key, result)
+
+                with self.lock:
+                    self.stats['hits'] += 1
+                    self.stats['diskhits'] += 1
+
+                return deepcopy(result)
+
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+
+        with self.lock:
+            self.stats['misses'] += 1
+
+        return None
+
+
+    def put(self, key, result):
+        '''This adds a copy of result to the cache for key.
+
+        '''
+
+        result = deepcopy(result)
+        self._memput(key, result)
+
+        if not self.cachedir:
+            return
+
+        try:
+
+            # write to a temporary file first so other processes never see a
+            # partial pickle
+            fd, temppath = tempfile.mkstemp(prefix='pfcache-',
+                                            suffix='.tmp',
+                                            dir=self.cachedir)
+            with os.fdopen(fd, 'wb') as outfd:
+                pickle.dump(result, outfd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(temppath, self._diskpath(key))
+
+            self._evict_disk()
+
+        except Exception as e:
+
+            LOGWARNING('could not write period-finder result '
+                       'to the disk cache: %s' % e)
+
+
+    def _evict_disk(self):
+        '''This removes the least-recently used pickles in cachedir until their
+        total size is below maxdiskmb.
+
+        '''
+
+        cached = []
+
+        for fname in os.listdir(self.cachedir):
+            if fname.startswith('pfcache-') and fname.endswith('.pkl'):
+                fpath = os.path.join(self.cachedir, fname)
+                try:
+                    fstat = os.stat(fpath)
+                    cached.append((fstat.st_mtime, fstat.st_size, fpath))
+                except OSError:
+                    pass
+
+        totalsize = sum(x[1] for x in cached)
+        maxsize = self.maxdiskmb*1024.0*1024.0
+
+        for mtime, size, fpath in sorted(cached):
+
+            if totalsize <= maxsize:
+                break
+
+            try:
+                os.remove(fpath)
+                with self.lock:
+                    self.stats['evictions'] += 1
+            except OSError:
+                pass
+
+            totalsize -= size
+
+
+    def clear(self):
+        '''This removes all cached results and resets the stats.
+
+        '''
+
+        with self.lock:
+            self.memcache.clear()
+
+        if self.cachedir and os.path.exists(self.cachedir):
+            for fname in os.listdir(self.cachedir):
+                if fname.startswith('pfcache-') and fname.endswith('.pkl'):
+                    os.remove(os.path.join(self.cachedir, fname))
+
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+
+# this is the active cache. it's None unless enable_pf_cache is called
+PFCACHE = None
+
+# depth is > 0 while a cached period-finder is running in this thread, so the
+# ones it calls internally don't get cached separately
+_PFCACHE_STATE = threading.local()
+
+
+def enable_pf_cache(cachedir=None, maxmemitems=64, maxdiskmb=1024.0):
+    '''This turns on the cache for the period-finder results.
+
+    Once this is called, all the period-finder functions in LSPMETHODS (and
+    bls_serial_pfind) look up their results in the cache before running. The
+    cache key is a hash of the sigma-clipped input arrays, the name of the
+    period-finder, and all of its kwargs (including the defaults), except for
+    the ones in PFCACHE_IGNOREDKWARGS. See PeriodFinderCache for the other
+    args.
+
+    Worker processes that are started after this is called inherit the cache
+    settings if they're forked. Use a cachedir to share results between them.
+
+    Returns the PeriodFinderCache object.
+
+    '''
+
+    global PFCACHE
+    PFCACHE = PeriodFinderCache(cachedir=cachedir,
+                                maxmemitems=maxmemitems,
+                                maxdiskmb=maxdiskmb)
+    return PFCACHE
+
+
+
+def disable_pf_cache():
+    '''This turns off the period-finder result cache.
+
+    Any results in the disk cache are left where they are.
+
+    '''
+
+    global PFCACHE
+    PFCACHE = None
+
+
+
+def get_pf_cache_stats():
+    '''This returns a copy of the stats dict for the active cache or None if
+    there isn't one.
+
+    '''
+
+    if PFCACHE is None:
+        return None
+
+    stats = dict(PFCACHE.stats)
+    stats['memitems'] = len(PFCACHE.memcache)
+    return stats
+
+
+
+def update_cachekey_hash(value, hasher):
+    '''This adds a kwarg value to a hash in a normalized form.
+
+    hasher is a hashlib hash object. Arrays are hashed by their dtype, shape,
+    and contents, dicts in sorted key order, lists and tuples in their given
+    order, and callables by their module and name. This is used for the
+    period-finder cache keys here and the processing cache keys in lcproc.
+
+    '''
+
+    if isinstance(value, np.ndarray):
+        hasher.update(b'ndarray')
+        hasher.update(repr((value.dtype.str, value.shape)).encode('utf-8'))
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        hasher.update(b'dict')
+        for key in sorted(value, key=repr):
+            hasher.update(repr(key).encode('utf-8'))
+            update_cachekey_hash(value[key], hasher)
+    elif isinstance(value, (list, tuple)):
+        hasher.update(type(value).__name__.encode('utf-8'))
+        for item in value:
+            update_cachekey_hash(item, hasher)
+    elif callable(value):
+        hasher.update(
+            ('%s.%s' % (getattr(value, '__module__', None),
+                        getattr(value, '__name__', repr(value)))
+            ).encode('utf-8')
+        )
+    else:
+        hasher.update(repr(value).encode('utf-8'))
+
+
+
+def get_pf_cachekey(method, times, mags, errs, kwargs):
+    '''This generates the cache key for a period-finder run.
+
+    method is the name of the period-finder function. kwargs is the dict of
+    all of its kwargs including the defaults. Only the finite points of times,
+    mags, and errs are hashed, so inputs that only differ in their non-finite
+    points share the same key. These aren't sigma-clipped here, since the
+    sigclip and magsarefluxes kwargs are part of the key already. This keeps
+    the key cheap to get, and the arrays aren't copied if they're float64
+    already (so the period-finder can still find their CleanedMagSeries).
+
+    Returns a hex string.
+
+    '''
+
+    times = np.asarray(times, dtype=np.float64)
+    mags = np.asarray(mags, dtype=np.float64)
+
+    if errs is not None:
+        errs = np.asarray(errs, dtype=np.float64)
+        finiteind = np.isfinite(times) & np.isfinite(mags) & np.isfinite(errs)
+    else:
+        finiteind = np.isfinite(times) & np.isfinite(mags)
+
+    hasher = hashlib.sha256()
+    hasher.update(method.encode('utf-8'))
+
+    for arr in (times, mags, errs):
+        if arr is not None and not finiteind.all():
+            arr = arr[finiteind]
+        update_cachekey_hash(arr, hasher)
+
+    update_cachekey_hash({x:kwargs[x] for x in kwargs
+                         if x not in PFCACHE_IGNOREDKWARGS},
+                        hasher)
+
+    return hasher.hexdigest()
+
+
+
+def cached_periodfinder(func):
+    '''This is a decorator that makes a period-finder function use the result
+    cache when it's enabled.
+
+    Calls with a precomputed kwarg that isn't None are never cached, since
+    these just turn an existing periodogram into a result dict. The original
+    function is available as the __wrapped__ attribute of the returned one.
+
+    This also adds the stage timings to the result when these are turned on
+    (see timed_periodfinder).
+
+    '''
+
+    code = func.__code__
+    argnames = code.co_varnames[:code.co_argcount]
+    defaults = func.__defaults__ or ()
+    defaultkwargs = dict(zip(argnames[len(argnames) - len(defaults):],
+                             defaults))
+
+    @wraps(func)
+    def cached_func(times, mags, errs, *args, **kwargs):
+
+        depth = getattr(_PFCACHE_STATE, 'depth', 0)
+
+        if (PFCACHE is None or depth > 0 or
+            kwargs.get('precomputed') is not None):
+            return func(times, mags, errs, *args, **kwargs)
+
+        callkwargs = dict(defaultkwargs)
+        callkwargs.update(zip(argnames[3:], args))
+        callkwargs.update(kwargs)
+
+        try:
+            cachekey = get_pf_cachekey(func.__name__,
+                                       times, mags, errs,
+                                       callkwargs)
+        except Exception as e:
+            LOGWARNING('could not get a cache key for %s, '
+                       'running it without the cache: %s' % (func.__name__, e))
+            return func(times, mags, errs, *args, **kwargs)
+
+        result = PFCACHE.get(cachekey)
+
+        if result is not None:
+            return result
+
+        _PFCACHE_STATE.depth = depth + 1
+        try:
+            result = func(times, mags, errs, *args, **kwargs)
+        finally:
+            _PFCACHE_STATE.depth = depth
+
+        PFCACHE.put(cachekey, result)
+        return result
+
+    cached_func = timed_periodfinder(cached_func)
+    cached_func.__wrapped__ = func
+    return cached_func
+
+
+
+################################
+## PERIOD-FINDER STAGE TIMING ##
+################################
+
+# this is True if the period-finders should record their stage timings
+PFTIMING = False
+
+# these are the stages that the period-finders record in their timing dicts
+PFTIMING_STAGES = ('sigclip', 'grid', 'kernel', 'peaks', 'pool', 'other')
+
+# this holds the stack of active timers for each thread, since period-finders
+# like fused_periodfind call other ones internally
+_PFTIMING_STATE = threading.local()
+
+
+class PeriodFinderTimer(object):
+    '''This records the wall and CPU time spent in each period-finder stage.
+
+    The period-finders call mark(stage) at the end of each stage (via
+    pf_timing_mark), which adds the time since the previous mark to that
+    stage. Work that happens inside another stage, like starting a worker pool
+    while the kernel runs, is timed using stage(name) instead (via
+    pf_timing_stage), and isn't counted again by the next mark.
+
+    The CPU time is only for this process, so it doesn't include the time
+    spent in the worker processes of a pool.
+
+    '''
+
+    def __init__(self):
+
+        self.wall = OrderedDict()
+        self.cpu = OrderedDict()
+        self.counts = {}
+
+        self.startwall = self.lastwall = time.perf_counter()
+        self.startcpu = self.lastcpu = time.process_time()
+
+        # the time spent in stage() blocks since the last mark
+        self.innerwall = 0.0
+        self.innercpu = 0.0
+
+
+    def add(self, stage, wall, cpu):
+        '''This adds some wall and CPU time to a stage.
+
+        '''
+
+        self.wall[stage] = self.wall.get(stage, 0.0) + wall
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + cpu
+
+
+    def mark(self, stage, **counts):
+        '''This ends a stage and adds the time since the last mark to it.
+
+        Any kwargs (e.g. nfreq=..., npoints=...) are stored as counts in the
+        timing dict.
+
+        '''
+
+        nowwall, nowcpu = time.perf_counter(), time.process_time()
+
+        self.add(stage,
+                 max(nowwall - self.lastwall - self.innerwall, 0.0),
+                 max(nowcpu - self.lastcpu - self.innercpu, 0.0))
+
+        self.lastwall, self.lastcpu = nowwall, nowcpu
+        self.innerwall = self.innercpu = 0.0
+        self.counts.update(counts)
+
+
+    @contextmanager
+    def stage(self, stage):
+        '''This is a context manager that adds the time spent in it to stage.
+
+        '''
+
+        startwall, startcpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield self
+        finally:
+            wall = time.perf_counter() - startwall
+            cpu = time.process_time() - startcpu
+            self.add(stage, wall, cpu)
+            self.innerwall += wall
+            self.innercpu += cpu
+
+
+    def timingdict(self):
+        '''This returns the timing dict to put in a period-finder result dict.
+
+        Any time after the last mark goes into the 'other' stage. The dict has
+        'wall' and 'cpu' dicts with the seconds spent in each stage and the
+        'total', plus the counts (usually 'nfreq' and 'npoints').
+
+        '''
+
+        self.mark('other')
+
+        timing = {'wall':dict(self.wall),
+                  'cpu':dict(self.cpu)}
+        timing['wall']['total'] = self.lastwall - self.startwall
+        timing['cpu']['total'] = self.lastcpu - self.startcpu
+        timing.update(self.counts)
+
+        return timing
+
+
+
+def enable_pf_timing():
+    '''This turns on the stage timing for the period-finders.
+
+    Once this is called, the result dicts from all the period-finder functions
+    in LSPMETHODS (and bls_serial_pfind) get a 'timing' key with the wall and
+    CPU time spent in each of PFTIMING_STAGES, and the number of frequencies
+    ('nfreq') and sigma-clipped points ('npoints') used. See
+    PeriodFinderTimer.timingdict.
+
+    '''
+
+    global PFTIMING
+    PFTIMING = True
+
+
+
+def disable_pf_timing():
+    '''This turns off the stage timing for the period-finders.
+
+    '''
+
+    global PFTIMING
+    PFTIMING = False
 
 
 
-########################
-## SOME OTHER IMPORTS ##
-########################
+def pf_timing_mark(stage, **counts):
+    '''This ends a stage for the active period-finder timer if there is one.
 
-from ..lcmath import sigclip_magseries
+    '''
 
+    timers = getattr(_PFTIMING_STATE, 'timers', None)
 
-#######################
-## UTILITY FUNCTIONS ##
-#######################
+    if timers:
+        timers[-1].mark(stage, **counts)
 
-def get_frequency_grid(times,
-                       samplesperpeak=5,
-                       nyquistfactor=5,
-                       minfreq=None,
-                       maxfreq=None,
-                       returnf0dfnf=False):
-    '''This calculates a frequency grid for the period finding functions in this
-    module.
 
-    Based on the autofrequency function in astropy.stats.lombscargle.
 
-    http://docs.astropy.org/en/stable/_modules/astropy/stats/lombscargle/core.html#LombScargle.autofrequency
+@contextmanager
+def pf_timing_stage(stage):
+    '''This is a context manager that times a stage for the active
+    period-finder timer if there is one.
 
     '''
 
-    baseline = times.max() - times.min()
-    nsamples = times.size
+    timers = getattr(_PFTIMING_STATE, 'timers', None)
 
-    df = 1. / baseline / samplesperpeak
+    if timers:
+        with timers[-1].stage(stage):
+            yield
+    else:
+        yield
 
-    if minfreq is not None:
-        f0 = minfreq
+
+
+def timed_periodfinder(func=None, listkey='fused'):
+    '''This is a decorator that adds the stage timings to the result of a
+    period-finder function when they're turned on (see enable_pf_timing).
+
+    The function is run with a new PeriodFinderTimer, which the
+    pf_timing_mark and pf_timing_stage calls in it go to, and its timing dict
+    is put in the 'timing' key of a copy of the result dict. If the function
+    returns a list of result dicts (like fused_periodfind), the timing dict
+    goes into the listkey key of the 'timing' dict of each of them instead.
+    Use @timed_periodfinder(listkey='batch') to change this from 'fused'.
+
+    '''
+
+    if func is None:
+        return partial(timed_periodfinder, listkey=listkey)
+
+    @wraps(func)
+    def timed_func(times, mags, errs, *args, **kwargs):
+
+        if not PFTIMING:
+            return func(times, mags, errs, *args, **kwargs)
+
+        if not hasattr(_PFTIMING_STATE, 'timers'):
+            _PFTIMING_STATE.timers = []
+
+        timer = PeriodFinderTimer()
+        _PFTIMING_STATE.timers.append(timer)
+
+        try:
+            result = func(times, mags, errs, *args, **kwargs)
+        finally:
+            _PFTIMING_STATE.timers.pop()
+
+        timing = timer.timingdict()
+
+        # don't change result dicts that might be in the cache
+        if isinstance(result, dict):
+            result = dict(result)
+            result['timing'] = timing
+
+        elif isinstance(result, list):
+            result = [dict(x, timing=dict(x.get('timing', {}),
+                                          **{listkey:timing}))
+                      if isinstance(x, dict) else x for x in result]
+
+        return result
+
+    return timed_func
+
+
+
+#################################
+## COMPACT PERIODOGRAM RESULTS ##
+#################################
+
+# the period-finder methods for which the best periodogram values are minima
+MINIMIZE_LSPMETHODS = ('pdm',)
+
+# the period-finder methods whose periodograms are always kept in full by
+# compact_lspdict. periodicfeatures.periodogram_features looks up the spectral
+# window at the best periods of the other methods, so an envelope won't do
+NOENVELOPE_LSPMETHODS = ('win',)
+
+# these keys hold the frequency grid of a period-finder result dict
+LSPGRIDKEYS = ('omegas', 'frequencies', 'periods')
+
+
+def compact_lspdict(lspdict,
+                    envelopefactor=None,
+                    windowsize=100,
+                    dtype=np.float32):
+    '''This makes a smaller version of a period-finder result dict for storage.
+
+    The lspvals (and any other 1D float arrays with the same length, like the
+    'acf' array from macf_period_find) are converted to dtype. If the
+    frequency grid is uniform in omegas, frequencies, or periods, the omegas,
+    frequencies, and periods arrays are replaced by a description of the grid
+    (start, step, size). The regenerated grid arrays agree with the original
+    ones to within floating point rounding, and the grid indices and original
+    grid values of the nbestperiods are also stored so these grid points are
+    restored exactly. Otherwise, only one of these arrays is kept.
+
+    If envelopefactor is an integer > 1, only an envelope of the periodogram is
+    kept: this is the best value (the max or the min for the methods in
+    MINIMIZE_LSPMETHODS) in each bin of envelopefactor grid points, plus all
+    of the values in windows of windowsize grid points on either side of each
+    of the nbestperiods. The periodograms for the methods in
+    NOENVELOPE_LSPMETHODS (the spectral window) are always kept in full.
+
+    The grid description and kept indices go into a 'compactgrid' key. Use
+    expand_lspdict to get back a dict that can be used like the original
+    one. The input dict isn't changed.
+
+    '''
+
+    if 'compactgrid' in lspdict or lspdict.get('lspvals') is None:
+        return lspdict
+
+    lspvals = np.asarray(lspdict['lspvals'], dtype=np.float64)
+
+    gridkeys = [x for x in LSPGRIDKEYS
+                if x in lspdict and lspdict[x] is not None and
+                np.size(lspdict[x]) == lspvals.size]
+
+    if lspvals.ndim != 1 or not gridkeys:
+        return lspdict
+
+    # describe the grid using the first of these that's uniform
+    for gridkey in gridkeys:
+        grid = np.asarray(lspdict[gridkey], dtype=np.float64)
+        if is_uniform_grid(grid):
+            break
     else:
-        f0 = 0.5 * df
+        gridkey = gridkeys[0]
+        grid = np.asarray(lspdict[gridkey], dtype=np.float64)
+
+    if is_uniform_grid(grid):
+        griddesc = {'key':gridkey,
+                    'start':grid[0],
+                    'step':((grid[-1] - grid[0])/(grid.size - 1.0)
+                            if grid.size > 1 else 0.0),
+                    'size':grid.size}
+    else:
+        griddesc = {'key':gridkey,
+                    'values':grid}
 
-    if maxfreq is not None:
-        Nf = int(npceil((maxfreq - f0) / df))
+    if gridkey == 'omegas':
+        periods = 2.0*np.pi/grid
+    elif gridkey == 'frequencies':
+        periods = 1.0/grid
     else:
-        Nf = int(0.5 * samplesperpeak * nyquistfactor * nsamples)
+        periods = grid
 
+    # find the grid indices of the best periods so their grid values can be
+    # put back exactly when the grid is regenerated
+    if 'periods' in gridkeys:
+        bestperiodgrid = np.asarray(lspdict['periods'], dtype=np.float64)
+    else:
+        bestperiodgrid = periods
+
+    nbestperiods = lspdict.get('nbestperiods')
+    if nbestperiods is None:
+        nbestperiods = []
+
+    bestindices = np.array(
+        [np.argmin(npabs(bestperiodgrid - x))
+         for x in nbestperiods if npisfinite(x)],
+        dtype=np.int64
+    )
+    bestgridvals = {x:np.asarray(lspdict[x], dtype=np.float64)[bestindices]
+                    for x in gridkeys}
+
+    # get the indices of the envelope and the windows around the best periods
+    if (envelopefactor and envelopefactor > 1 and
+        lspdict.get('method') not in NOENVELOPE_LSPMETHODS):
+
+        minimize = lspdict.get('method') in MINIMIZE_LSPMETHODS
+        nbins = int(npceil(lspvals.size/float(envelopefactor)))
+
+        # pad the last bin with values that are never chosen
+        padval = np.inf if minimize else -np.inf
+        binned = np.full(nbins*envelopefactor, padval)
+        binned[:lspvals.size] = np.where(npisfinite(lspvals), lspvals, padval)
+        binned = binned.reshape(nbins, envelopefactor)
+
+        if minimize:
+            binind = np.argmin(binned, axis=1)
+        else:
+            binind = np.argmax(binned, axis=1)
+
+        indices = [nparange(nbins)*envelopefactor + binind]
+
+        for bestind in bestindices:
+            indices.append(nparange(max(bestind - windowsize, 0),
+                                    min(bestind + windowsize + 1,
+                                        lspvals.size)))
+
+        indices = np.unique(np.concatenate(indices))
+        indices = indices[indices < lspvals.size].astype(np.int64)
 
-    if returnf0dfnf:
-        return f0, df, Nf, f0 + df * nparange(Nf)
     else:
-        return f0 + df * nparange(Nf)
+        indices = None
+
+    compact = {}
+    compactkeys = []
+
+    for key in lspdict:
+
+        if key in gridkeys:
+            continue
+
+        val = lspvals if key == 'lspvals' else lspdict[key]
+
+        # other arrays over the grid are cut down to the envelope as well
+        if (isinstance(val, np.ndarray) and val.ndim == 1 and
+            val.size == lspvals.size):
+
+            if indices is not None:
+                val = val[indices]
+
+            if val.dtype.kind == 'f':
+                val = val.astype(dtype)
+                compactkeys.append(key)
+
+        compact[key] = val
+
+    griddesc.update({'gridkeys':gridkeys,
+                     'compactkeys':compactkeys,
+                     'indices':indices,
+                     'bestindices':bestindices,
+                     'bestgridvals':bestgridvals})
+    compact['compactgrid'] = griddesc
+
+    return compact
+
+
+
+def expand_lspdict(lspdict):
+    '''This regenerates a period-finder result dict made by compact_lspdict.
+
+    The omegas, frequencies, and periods arrays are regenerated from the grid
+    description and the compacted arrays are converted back to float64. A
+    regenerated uniform grid matches the original one only to within floating
+    point rounding, except at the grid points of the nbestperiods, which are
+    set back to their original values. Look up grid points near a period with
+    the nearest index, not with float equality. If only an envelope was kept,
+    the grid arrays are for the kept grid points only. Dicts that weren't
+    compacted are returned as is.
+
+    '''
+
+    if not isinstance(lspdict, dict) or 'compactgrid' not in lspdict:
+        return lspdict
+
+    griddesc = lspdict['compactgrid']
+    expanded = {x:lspdict[x] for x in lspdict if x != 'compactgrid'}
+
+    if 'values' in griddesc:
+        grid = np.asarray(griddesc['values'], dtype=np.float64)
+    else:
+        grid = griddesc['start'] + griddesc['step']*nparange(griddesc['size'])
+
+    if griddesc['key'] == 'omegas':
+        periods = 2.0*np.pi/grid
+    elif griddesc['key'] == 'frequencies':
+        periods = 1.0/grid
+    else:
+        periods = grid
+
+    bestindices = griddesc.get('bestindices')
+    bestgridvals = griddesc.get('bestgridvals', {})
+
+    for key in griddesc['gridkeys']:
+
+        if key == griddesc['key']:
+            gridvals = grid.copy()
+        elif key == 'omegas':
+            gridvals = 2.0*np.pi/periods
+        elif key == 'frequencies':
+            gridvals = 1.0/periods
+        else:
+            gridvals = periods.copy()
+
+        # put back the original grid values at the best periods
+        if bestindices is not None and key in bestgridvals:
+            gridvals[bestindices] = bestgridvals[key]
+
+        if griddesc['indices'] is not None:
+            gridvals = gridvals[griddesc['indices']]
+
+        expanded[key] = gridvals
+
+    for key in griddesc['compactkeys']:
+        expanded[key] = np.asarray(expanded[key], dtype=np.float64)
+
+    return expanded
+
 
 
 ####################################################
 ## HOIST THE FINDER FUNCTIONS INTO THIS NAMESPACE ##
 ####################################################
 
-from .zgls import pgen_lsp, specwindow_lsp
+from .zgls import pgen_lsp, specwindow_lsp, fast_lsp, pgen_lsp_batch, \
+    GLSPeriodogramState
 from .spdm import stellingwerf_pdm
 from .saov import aov_periodfind
 from .smav import aovhm_periodfind
 from .kbls import bls_serial_pfind, bls_parallel_pfind
 from .macf import macf_period_find
+from .oldpf import townsend_lsp
 
 
 
@@ -178,12 +1773,143 @@ from .macf import macf_period_find
 # used to figure out which function to run for bootstrap resampling
 LSPMETHODS = {'bls':bls_parallel_pfind,
               'gls':pgen_lsp,
+              'fls':fast_lsp,
+              'tls':townsend_lsp,
               'aov':aov_periodfind,
               'mav':aovhm_periodfind,
               'pdm':stellingwerf_pdm,
               'acf':macf_period_find,
               'win':specwindow_lsp}
 
+# the fused multi-method period search uses LSPMETHODS, so import it here
+from .fused import fused_periodfind, get_fused_gridkwargs
+
+
+
+# the bootstrap trials run in the worker processes, so they use the serial BLS
+# and the batched kernels for the other methods
+BOOTSTRAP_LSPMETHODS = {'bls':bls_serial_pfind,
+                        'gls':pgen_lsp,
+                        'fls':fast_lsp,
+                        'tls':townsend_lsp,
+                        'aov':aov_periodfind,
+                        'mav':aovhm_periodfind,
+                        'pdm':stellingwerf_pdm,
+                        'acf':macf_period_find,
+                        'win':specwindow_lsp}
+
+# these override the kwargs from the lspdict for the bootstrap trials
+BOOTSTRAP_KERNELKWARGS = {'bls':{},
+                          'gls':{'nworkers':1, 'blockmode':True},
+                          'fls':{'nworkers':1},
+                          'tls':{'nworkers':1},
+                          'aov':{'nworkers':1},
+                          'mav':{'nworkers':1, 'batchkernel':True},
+                          'pdm':{'nworkers':1},
+                          'acf':{'nworkers':1},
+                          'win':{'nworkers':1, 'blockmode':True}}
+
+
+
+def bootstrap_trial_worker(task):
+    '''This runs a chunk of bootstrap trials for bootstrap_falsealarmprob.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = method key in BOOTSTRAP_LSPMETHODS
+    task[2] = seeds for the trials in this chunk, one per trial
+    task[3] = kwargs for the period-finder
+
+    Each trial scrambles the mags and errs using a np.random.RandomState with
+    its own seed, so the results of a trial don't depend on which worker runs
+    it.
+
+    Returns an array of the best periodogram values for the trials. Trials that
+    fail get nans.
+
+    '''
+
+    times, mags, errs = get_shared_magseries(task[0])
+    method, trialseeds, kwargs = task[1:]
+
+    # the scrambled trials never repeat, so skip the result cache for them
+    pffunc = BOOTSTRAP_LSPMETHODS[method]
+    pffunc = getattr(pffunc, '__wrapped__', pffunc)
+
+    trialbestpeaks = []
+
+    for seed in trialseeds:
+
+        # get a scrambled index
+        tindex = np.random.RandomState(seed).randint(0,
+                                                     high=mags.size,
+                                                     size=mags.size)
+
+        try:
+
+            # run the periodogram with scrambled mags and errs
+            # and the appropriate keyword arguments
+            lspres = pffunc(
+                times, mags[tindex], errs[tindex],
+                **kwargs
+            )
+            trialbestpeaks.append(lspres['bestlspval'])
+
+        except Exception as e:
+
+            LOGEXCEPTION('bootstrap trial with seed %s failed' % seed)
+            trialbestpeaks.append(npnan)
+
+    return nparray(trialbestpeaks, dtype=np.float64)
+
+
+
+def _get_bootstrap_faps(trialbestpeaks, peaks, method):
+    '''This gets the number of trials with best peaks more significant than
+    each of the peaks, the number of finite trials, and the FAPs.
+
+    '''
+
+    trialbestpeaks = trialbestpeaks[npisfinite(trialbestpeaks)]
+    ntrials = trialbestpeaks.size
+
+    # for PDM, we're looking for a peak smaller than the best peak because
+    # values closer to 0.0 are more significant
+    if method != 'pdm':
+        nexceed = nparray([npsum(trialbestpeaks > x) for x in peaks])
+    else:
+        nexceed = nparray([npsum(trialbestpeaks < x) for x in peaks])
+
+    # calculate the FAP for a trial peak j = FAP[j] =
+    # (1.0 + sum(trialbestpeaks[i] > peak[j]))/(ntrialbestpeaks + 1)
+    faps = (1.0 + nexceed)/(ntrials + 1.0)
+
+    return nexceed, ntrials, faps
+
+
+
+def _fap_resolved(nexceed, ntrials, faplimit, fapsigma):
+    '''This checks if the FAPs are resolved with respect to faplimit.
+
+    A FAP is resolved if the Wilson score interval of width fapsigma for the
+    fraction of trials with a more significant peak doesn't include faplimit.
+
+    Returns a boolean array, one element per FAP.
+
+    '''
+
+    if ntrials == 0:
+        return np.zeros(nexceed.size, dtype=np.bool_)
+
+    frac = nexceed/float(ntrials)
+    zsq = fapsigma*fapsigma
+
+    center = (frac + zsq/(2.0*ntrials))/(1.0 + zsq/ntrials)
+    halfwidth = fapsigma*npsqrt(
+        frac*(1.0 - frac)/ntrials + zsq/(4.0*ntrials*ntrials)
+    )/(1.0 + zsq/ntrials)
+
+    return ((center - halfwidth) > faplimit) | ((center + halfwidth) < faplimit)
+
 
 
 def bootstrap_falsealarmprob(lspdict,
@@ -193,7 +1919,13 @@ def bootstrap_falsealarmprob(lspdict,
                              nbootstrap=250,
                              magsarefluxes=False,
                              sigclip=10.0,
-                             npeaks=None):
+                             npeaks=None,
+                             nworkers=None,
+                             seed=None,
+                             trialchunksize=10,
+                             faplimit=None,
+                             fapsigma=3.0,
+                             sharedarrays=True):
     '''Calculates the false alarm probabilities of periodogram peaks using
     bootstrap resampling of the magnitude time series.
 
@@ -209,6 +1941,8 @@ def bootstrap_falsealarmprob(lspdict,
     the current best peak and divide this by the total number of trials. The
     distribution of these trial best peaks is obtained after scrambling the mag
     values and rerunning the specified periodogram method for a bunch of trials.
+    The trials don't depend on the peak, so a single set of trials is used for
+    the FAPs of all peaks.
 
     The total number of trials is nbootstrap. This is set to 250 by default, but
     should probably be around 1000 for realistic results.
@@ -221,6 +1955,23 @@ def bootstrap_falsealarmprob(lspdict,
     periodogram function as it was run originally, to keep everything the same
     during the bootstrap runs. If this is missing, default values will be used.
 
+    The trials are split into chunks of trialchunksize trials and run by
+    nworkers parallel workers. Each trial runs the period-finder serially with
+    its batched kernel (see BOOTSTRAP_LSPMETHODS and BOOTSTRAP_KERNELKWARGS), so
+    no worker pools are started for the individual trials. If nworkers is 1,
+    the trials are run in this process.
+
+    seed sets the seed for the random number generator used to make the
+    per-trial seeds. The results for a given seed are the same no matter how
+    many workers are used.
+
+    If faplimit is not None, the trials stop early once the FAPs of all peaks
+    are known to be either above or below faplimit. This happens when the
+    Wilson score interval of width fapsigma (in units of sigma) for the
+    fraction of trials with more significant peaks excludes faplimit. The
+    check is done after each chunk of trials, in order, so early stopping is
+    also reproducible for a given seed and trialchunksize.
+
     FIXME: this may not be strictly correct; must look more into bootstrap
     significance testing. Also look into if we're doing resampling correctly for
     time series because the samples are not iid. Look into moving block
@@ -247,89 +1998,299 @@ def bootstrap_falsealarmprob(lspdict,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
 
-    allpeaks = []
-    allperiods = []
-    allfaps = []
-    alltrialbestpeaks = []
-
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
 
-        for ind, period, peak in zip(range(len(nbestperiods)),
-                                     nbestperiods,
-                                     nbestpeaks):
+        method = lspdict['method']
 
-            LOGINFO('peak %s: running %s trials...' % (ind+1, nbootstrap))
+        # get the kwargs dict out of the lspdict
+        if 'kwargs' in lspdict:
+            kwargs = lspdict['kwargs'].copy()
+        else:
+            kwargs = {}
 
-            trialbestpeaks = []
+        # update the kwargs with some local stuff
+        kwargs.update({'magsarefluxes':magsarefluxes,
+                       'sigclip':sigclip,
+                       'verbose':False})
+        kwargs.update(BOOTSTRAP_KERNELKWARGS[method])
 
-            for trial in range(nbootstrap):
+        # the serial BLS doesn't take these
+        if method == 'bls':
+            kwargs.pop('nworkers', None)
+            kwargs.pop('sharedarrays', None)
 
-                # get a scrambled index
-                tindex = np.random.randint(0,
-                                           high=mags.size,
-                                           size=mags.size)
+        # get the seeds for all trials and split them into chunks
+        trialseeds = np.random.RandomState(seed).randint(0,
+                                                         high=2**31 - 1,
+                                                         size=nbootstrap)
+        trialchunks = [trialseeds[x:x+trialchunksize]
+                       for x in range(0, nbootstrap, trialchunksize)]
 
+        if (not nworkers) or (nworkers > NCPUS):
+            nworkers = NCPUS
 
-                # get the kwargs dict out of the lspdict
-                if 'kwargs' in lspdict:
+        LOGINFO('running %s bootstrap trials for %s peaks '
+                'using %s workers...' % (nbootstrap, len(nbestpeaks), nworkers))
 
-                    kwargs = lspdict['kwargs']
+        trialbestpeaks = []
+        earlystop = False
 
-                    # update the kwargs with some local stuff
-                    kwargs.update({'magsarefluxes':magsarefluxes,
-                                   'sigclip':sigclip,
-                                   'verbose':False})
-                else:
-                    kwargs = {'magsarefluxes':magsarefluxes,
-                              'sigclip':sigclip,
-                              'verbose':False}
+        with SharedMagSeries(times, mags, errs,
+                             sharedarrays=(sharedarrays and
+                                           nworkers > 1)) as shared:
 
+            tasks = [(shared.ref, method, x, kwargs) for x in trialchunks]
 
-                # run the periodogram with scrambled mags and errs
-                # and the appropriate keyword arguments
-                lspres = LSPMETHODS[lspdict['method']](
-                    times, mags[tindex], errs[tindex],
-                    **kwargs
-                )
-                trialbestpeaks.append(lspres['bestlspval'])
+            if nworkers == 1:
+                pool = None
+                chunkresults = (bootstrap_trial_worker(x) for x in tasks)
+            else:
+                pool = Pool(nworkers)
+                chunkresults = pool.imap(bootstrap_trial_worker, tasks)
 
-            trialbestpeaks = np.array(trialbestpeaks)
-            alltrialbestpeaks.append(trialbestpeaks)
+            # go through the chunks in order so early stopping doesn't depend
+            # on the number of workers
+            for chunkresult in chunkresults:
 
-            # calculate the FAP for a trial peak j = FAP[j] =
-            # (1.0 + sum(trialbestpeaks[i] > peak[j]))/(ntrialbestpeaks + 1)
-            if lspdict['method'] != 'pdm':
-                falsealarmprob = (
-                    (1.0 + trialbestpeaks[trialbestpeaks > peak].size) /
-                    (trialbestpeaks.size + 1.0)
-                )
-            # for PDM, we're looking for a peak smaller than the best peak
-            # because values closer to 0.0 are more significant
-            else:
-                falsealarmprob = (
-                    (1.0 + trialbestpeaks[trialbestpeaks < peak].size) /
-                    (trialbestpeaks.size + 1.0)
-                )
+                trialbestpeaks.append(chunkresult)
+
+                if faplimit is not None:
+
+                    nexceed, ntrials, faps = _get_bootstrap_faps(
+                        np.concatenate(trialbestpeaks),
+                        nbestpeaks,
+                        method
+                    )
+
+                    if np.all(_fap_resolved(nexceed, ntrials,
+                                           faplimit, fapsigma)):
+                        earlystop = True
+                        break
 
+            if pool is not None:
+                if earlystop:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+                del pool
+
+        trialbestpeaks = np.concatenate(trialbestpeaks)
+        nexceed, ntrials, allfaps = _get_bootstrap_faps(trialbestpeaks,
+                                                        nbestpeaks,
+                                                        method)
+
+        if earlystop:
+            LOGINFO('all FAPs resolved with respect to FAP limit %s '
+                    'after %s trials, stopping early' %
+                    (faplimit, trialbestpeaks.size))
+
+        for ind, period, falsealarmprob in zip(range(len(nbestperiods)),
+                                               nbestperiods,
+                                               allfaps):
             LOGINFO('FAP for peak %s, period: %.6f = %.3g' % (ind+1,
                                                               period,
                                                               falsealarmprob))
 
-            allpeaks.append(peak)
-            allperiods.append(period)
-            allfaps.append(falsealarmprob)
+        return {'peaks':list(nbestpeaks),
+                'periods':list(nbestperiods),
+                'probabilities':list(allfaps),
+                'alltrialbestpeaks':[trialbestpeaks for x in nbestpeaks],
+                'trialbestpeaks':trialbestpeaks,
+                'ntrials':trialbestpeaks.size,
+                'nfinitetrials':ntrials,
+                'earlystop':earlystop,
+                'seed':seed}
+
+    else:
+        LOGERROR('not enough mag series points to calculate periodogram')
+        return None
+
+
+##############################################
+## ANALYTIC FALSE ALARM PROBABILITY FOR GLS ##
+##############################################
+
+# the GLS periodograms with the standard normalization (0 <= p <= 1) that the
+# analytic FAPs apply to
+ANALYTIC_FAP_LSPMETHODS = ('gls', 'fls')
+
+
+
+def gls_fap_single(power, ndet):
+    '''This gets the probability that the GLS power at a single frequency is
+    larger than power for pure noise.
+
+    This is for the standard normalization of the floating-mean GLS, where the
+    null hypothesis has one parameter and the model has three (Zechmeister &
+    Kurster 2009, Baluev 2008). power can be a scalar or an array.
+
+    '''
+
+    power = np.clip(np.asarray(power, dtype=np.float64), 0.0, 1.0)
+    return (1.0 - power)**(0.5*(ndet - 3))
+
 
-        return {'peaks':allpeaks,
-                'periods':allperiods,
-                'probabilities':allfaps,
-                'alltrialbestpeaks':alltrialbestpeaks}
+
+def gls_fap_tau(power, ndet, fmax, times, errs):
+    '''This gets the Davies upper bound term tau for the GLS FAP.
+
+    This uses the effective time base from the weighted variance of the
+    times and the maximum frequency searched (Baluev 2008, eqns. 5-6 for the
+    standard normalization).
+
+    '''
+
+    power = np.clip(np.asarray(power, dtype=np.float64), 0.0, 1.0)
+
+    # the effective time base
+    weights = 1.0/(errs*errs)
+    meantimes = npsum(weights*times)/npsum(weights)
+    timevar = npsum(weights*(times - meantimes)**2)/npsum(weights)
+    teff = npsqrt(4.0*MPI*timevar)
+
+    # degrees of freedom for the null and periodic hypotheses
+    nh = ndet - 1
+    nk = ndet - 3
+
+    gammah = npsqrt(2.0/nh)*np.exp(gammaln(0.5*nh) - gammaln(0.5*(nh - 1)))
+
+    return (gammah*fmax*teff*(1.0 - power)**(0.5*(nk - 1)) *
+            npsqrt(0.5*nh*power))
+
+
+
+def gls_falsealarmprob(power,
+                       times,
+                       errs,
+                       fmax,
+                       fapmethod='baluev'):
+    '''This calculates the analytic FAP for a GLS periodogram power.
+
+    power is the GLS power (standard normalization) of the peak, either a
+    scalar or an array.
+
+    times and errs are the cleaned arrays used for the periodogram.
+
+    fmax is the maximum frequency searched (in 1/time units).
+
+    fapmethod is one of:
+
+    'baluev': the Baluev (2008) approximation 1 - (1 - FAP_single)*exp(-tau)
+    'davies': the Davies upper bound FAP_single + tau
+    'naive': the effective number of frequencies approximation
+             1 - (1 - FAP_single)^N_eff, where N_eff = fmax*time base
+    'single': the FAP at a single frequency, i.e. no look-elsewhere effect
+
+    Returns the FAP(s), clipped to be at most 1.0.
+
+    '''
+
+    ndet = times.size
+    fapsingle = gls_fap_single(power, ndet)
+
+    if fapmethod == 'single':
+        fap = fapsingle
+
+    elif fapmethod == 'naive':
+        neff = fmax*(npmax(times) - npmin(times))
+        fap = -np.expm1(neff*np.log1p(-fapsingle))
+
+    elif fapmethod == 'davies':
+        fap = fapsingle + gls_fap_tau(power, ndet, fmax, times, errs)
+
+    elif fapmethod == 'baluev':
+        tau = gls_fap_tau(power, ndet, fmax, times, errs)
+        fap = -np.expm1(-tau) + fapsingle*np.exp(-tau)
+
+    else:
+        raise ValueError('unknown FAP method: %s' % fapmethod)
+
+    return np.clip(fap, 0.0, 1.0)
+
+
+
+def analytic_falsealarmprob(lspdict,
+                            times,
+                            mags,
+                            errs,
+                            fapmethod='baluev',
+                            magsarefluxes=False,
+                            sigclip=10.0,
+                            npeaks=None):
+    '''Calculates analytic false alarm probabilities for GLS periodogram
+    peaks.
+
+    This is a fast alternative to bootstrap_falsealarmprob for the periodograms
+    from pgen_lsp (and fast_lsp), which use the standard GLS normalization. It
+    takes the same inputs, and uses the analytic FAP approximations in
+    gls_falsealarmprob (see there for the fapmethod options). These assume
+    white Gaussian noise with the given errs, so the FAPs will be too small for
+    light curves with a lot of red noise.
+
+    The maximum frequency is taken from the shortest period in
+    lspdict['periods'].
+
+    Returns a dict with the same keys as bootstrap_falsealarmprob (except
+    for the bootstrap trial ones). This dict is also added to the lspdict under
+    the 'fap' key.
+
+    '''
+
+    if lspdict['method'] not in ANALYTIC_FAP_LSPMETHODS:
+        LOGERROR('analytic FAPs are only available for these '
+                 'periodogram methods: %s, not %s' %
+                 (', '.join(ANALYTIC_FAP_LSPMETHODS), lspdict['method']))
+        return None
+
+    if lspdict['nbestperiods'] is None:
+        LOGERROR('no periodogram peaks to calculate FAPs for')
+        return None
+
+    # figure out how many periods to work on
+    if (npeaks and (0 < npeaks < len(lspdict['nbestperiods']))):
+        nperiods = npeaks
+    else:
+        nperiods = len(lspdict['nbestperiods'])
+
+    nbestperiods = lspdict['nbestperiods'][:nperiods]
+    nbestpeaks = lspdict['nbestlspvals'][:nperiods]
+
+    # get rid of nans first and sigclip
+    stimes, smags, serrs = sigclip_magseries(times,
+                                             mags,
+                                             errs,
+                                             magsarefluxes=magsarefluxes,
+                                             sigclip=sigclip)
+
+    # make sure there are enough points to calculate a spectrum
+    if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
+
+        fmax = 1.0/npmin(lspdict['periods'])
+
+        allfaps = gls_falsealarmprob(nparray(nbestpeaks),
+                                     stimes,
+                                     serrs,
+                                     fmax,
+                                     fapmethod=fapmethod)
+
+        fapdict = {'peaks':list(nbestpeaks),
+                   'periods':list(nbestperiods),
+                   'probabilities':list(allfaps),
+                   'fapmethod':fapmethod,
+                   'ndet':stimes.size,
+                   'fmax':fmax}
+
+        lspdict['fap'] = fapdict
+        return fapdict
 
     else:
         LOGERROR('not enough mag series points to calculate periodogram')
         return None
 
 
+
 ############################################
 ## FUNCTIONS FOR COMPARING PERIOD-FINDERS ##
 ############################################
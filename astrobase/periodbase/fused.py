@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''fused.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2026
+
+Contains a fused multi-method period search for periodbase. This runs several
+of the period-finders over one shared frequency grid, calculating the phases
+and trig terms for each block of frequencies once for all of them.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+from datetime import datetime
+from traceback import format_exc
+
+# setup a logger
+LOGGER = None
+LOGMOD = __name__
+DEBUG = False
+
+def set_logger_parent(parent_name):
+    globals()['LOGGER'] = logging.getLogger('%s.%s' % (parent_name, LOGMOD))
+
+def LOGDEBUG(message):
+    if LOGGER:
+        LOGGER.debug(message)
+    elif DEBUG:
+        print('[%s - DBUG] %s' % (
+            datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            message)
+        )
+
+def LOGINFO(message):
+    if LOGGER:
+        LOGGER.info(message)
+    else:
+        print('[%s - INFO] %s' % (
+            datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            message)
+        )
+
+def LOGERROR(message):
+    if LOGGER:
+        LOGGER.error(message)
+    else:
+        print('[%s - ERR!] %s' % (
+            datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            message)
+        )
+
+def LOGWARNING(message):
+    if LOGGER:
+        LOGGER.warning(message)
+    else:
+        print('[%s - WRN!] %s' % (
+            datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            message)
+        )
+
+def LOGEXCEPTION(message):
+    if LOGGER:
+        LOGGER.exception(message)
+    else:
+        print(
+            '[%s - EXC!] %s\nexception was: %s' % (
+                datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                message, format_exc()
+                )
+            )
+
+
+#############
+## IMPORTS ##
+#############
+
+import numpy as np
+
+# import these to avoid lookup overhead
+from numpy import nan as npnan, sum as npsum, std as npstd, \
+    median as npmedian, floor as npfloor, pi as MPI, cos as npcos, \
+    sin as npsin, empty as npempty, any as npany
+
+
+###################
+## LOCAL IMPORTS ##
+###################
+
+from ..lcmath import sigclip_magseries
+
+from . import get_frequency_grid, get_shared_magseries, get_trig_block, \
+    parallel_frequency_blocks, LSPMETHODS, timed_periodfinder, pf_timing_mark
+
+from .zgls import generalized_lsp_block, generalized_lsp_block_notau, \
+    specwindow_lsp_block, glsp_worker, glsp_worker_notau
+from .spdm import stellingwerf_pdm_theta_batch
+from .saov import aov_theta_batch
+from .smav import aovhm_theta_batch
+
+
+
+############
+## CONFIG ##
+############
+
+# these are the period-finders that can be run in the fused pass
+FUSED_PFMETHODS = ('gls', 'win', 'pdm', 'aov', 'mav')
+
+# these kwargs set the frequency grid and must be the same for all
+# period-finders in the fused pass
+FUSED_GRIDKWARGS = ('startp', 'endp', 'autofreq', 'stepsize')
+
+# the GLS workers that have a fused equivalent
+FUSED_GLSPFUNCS = {glsp_worker:False,
+                   glsp_worker_notau:True}
+
+
+
+######################
+## FUSED PERIODBASE ##
+######################
+
+def _get_function_kwargs(func, kwargs):
+    '''This gets the default kwargs of func updated with the ones in kwargs.
+
+    '''
+
+    # get the original function if this one uses the result cache
+    func = getattr(func, '__wrapped__', func)
+
+    code = func.__code__
+    argnames = code.co_varnames[:code.co_argcount]
+    defaults = func.__defaults__ or ()
+
+    funckwargs = dict(zip(argnames[len(argnames) - len(defaults):], defaults))
+    funckwargs.update(kwargs)
+
+    return funckwargs
+
+
+
+def fused_block_worker(task):
+    '''This calculates the periodograms for several period-finders for a block
+    of frequencies.
+
+    task[0] = (times, errs, mags_0, mags_1, ...) or a SharedMagSeries ref to
+              them. The mags_i are the working mags for the period-finders.
+    task[1] = block of frequencies
+    task[2] = list of specs for the period-finders, each of the form:
+              (method, index of its mags in task[0], params tuple)
+
+    The mag series is phased at each frequency in the block once. The phases
+    are shared by PDM and AoV, and the trig terms for 2.0*pi*phases are shared
+    by the spectral window and AoVMH. The GLS trig terms for the unshifted
+    times are obtained from these by a rotation through omega*times[0] for
+    each frequency.
+
+    Returns a (frequencies.size x len(specs)) array of periodogram values.
+
+    '''
+
+    frequencies, specs = task[1], task[2]
+    results = npempty((frequencies.size, len(specs)))
+
+    try:
+        magseries = get_shared_magseries(task[0])
+        times, errs = magseries[0], magseries[1]
+    except Exception as e:
+        LOGEXCEPTION('could not get the mag series for this block')
+        results[:] = npnan
+        return results
+
+    methods = [x[0] for x in specs]
+    omegas = 2.0*MPI*frequencies
+    utimes = times - times[0]
+
+    # these are the phases used by lcmath.phase_magseries and
+    # periodbase.get_phasebin_indices
+    if 'pdm' in methods or 'aov' in methods:
+        periods = 1.0/frequencies
+        phases = utimes[None,:]/periods[:,None]
+        phases -= npfloor(phases)
+    else:
+        phases = None
+
+    # the trig terms for omega*(times - times[0])
+    if 'gls' in methods or 'win' in methods or 'mav' in methods:
+        trig = get_trig_block(utimes, omegas)
+    else:
+        trig = None
+
+    # the GLS trig terms for omega*times
+    if 'gls' in methods:
+        rot = omegas*times[0]
+        cos_rot, sin_rot = npcos(rot)[:,None], npsin(rot)[:,None]
+        glstrig = (trig[0]*cos_rot + trig[1]*sin_rot,
+                   trig[1]*cos_rot - trig[0]*sin_rot)
+    else:
+        glstrig = None
+
+    for ind, (method, magind, params) in enumerate(specs):
+
+        mags = magseries[magind]
+
+        try:
+
+            if method == 'gls':
+                if params[0]:
+                    results[:,ind] = generalized_lsp_block_notau(
+                        times, mags, errs, omegas, trig=glstrig
+                    )
+                else:
+                    results[:,ind] = generalized_lsp_block(
+                        times, mags, errs, omegas, trig=glstrig
+                    )
+
+            elif method == 'win':
+                results[:,ind] = specwindow_lsp_block(
+                    times, mags, errs, omegas, trig=trig
+                )
+
+            elif method == 'pdm':
+                results[:,ind] = stellingwerf_pdm_theta_batch(
+                    times, mags, errs, frequencies,
+                    binsize=params[0], minbin=params[1], phases=phases
+                )
+
+            elif method == 'aov':
+                results[:,ind] = aov_theta_batch(
+                    times, mags, errs, frequencies,
+                    binsize=params[0], minbin=params[1], binstat=params[2],
+                    phases=phases
+                )
+
+            elif method == 'mav':
+                results[:,ind] = aovhm_theta_batch(
+                    times, mags, errs, frequencies,
+                    params[0], params[1], trig=trig
+                )
+
+        except Exception as e:
+            LOGEXCEPTION('%s failed for this block of frequencies' % method)
+            results[:,ind] = npnan
+
+    return results
+
+
+
+def get_fused_gridkwargs(pfmethods, pfkwargs):
+    '''This gets the frequency grid kwargs for fused_periodfind from the
+    kwargs of the period-finders.
+
+    A grid kwarg (one of FUSED_GRIDKWARGS) is returned if all of the
+    period-finders in pfmethods that can be fused set it to the same value in
+    their pfkwargs. The others are left at the fused_periodfind defaults.
+
+    Returns a dict that can be passed to fused_periodfind as **kwargs.
+
+    '''
+
+    fusedkwargs = [pfkw for pfm, pfkw in zip(pfmethods, pfkwargs)
+                   if pfm in FUSED_PFMETHODS]
+
+    gridkwargs = {}
+
+    for gkw in FUSED_GRIDKWARGS:
+
+        if (fusedkwargs and
+            all(gkw in pfkw for pfkw in fusedkwargs) and
+            all(pfkw[gkw] == fusedkwargs[0][gkw] for pfkw in fusedkwargs)):
+            gridkwargs[gkw] = fusedkwargs[0][gkw]
+
+    return gridkwargs
+
+
+
+@timed_periodfinder
+def fused_periodfind(times,
+                     mags,
+                     errs,
+                     pfmethods=('gls','pdm','mav','win'),
+                     pfkwargs=None,
+                     magsarefluxes=False,
+                     startp=None,
+                     endp=None,
+                     autofreq=True,
+                     stepsize=1.0e-4,
+                     sigclip=10.0,
+                     nworkers=None,
+                     blockmemory=32.0,
+                     sharedarrays=True,
+                     executor=None,
+                     verbose=True):
+    '''This runs several period-finders in a single pass over one frequency
+    grid.
+
+    pfmethods is a list of period-finders to run, using the keys in
+    periodbase.LSPMETHODS. pfkwargs is a list of kwargs dicts for each of these
+    (as in lcproc.runpf).
+
+    The mag series is sigma-clipped once, and the frequency grid is made once
+    from startp, endp, autofreq, and stepsize in the same way as the
+    period-finders do it. The grid is split into blocks, and the phases and
+    trig terms for each block are calculated once and shared by all of the
+    period-finders in the block worker (see fused_block_worker). nworkers,
+    blockmemory, and sharedarrays work like they do for
+    periodbase.parallel_frequency_blocks.
+
+    startp, endp, autofreq, and stepsize are also passed on to each of the
+    period-finders that takes them, unless its pfkwargs set them already
+    (startp and endp are only passed on if they aren't None, so the BLS keeps
+    its own defaults). The period-finders in FUSED_PFMETHODS are run in the
+    fused pass, unless their kwargs (their defaults updated with those in
+    pfkwargs) give a different frequency grid from the fused one, or ask for a
+    coarse-to-fine search. These and any other period-finders (e.g. 'bls',
+    'acf') are run separately with their kwargs. Use get_fused_gridkwargs to
+    get the fused grid from the pfkwargs instead. magsarefluxes, sigclip,
+    nworkers, and verbose are used for all of the period-finders.
+
+    Returns a list of the usual result dicts from each period-finder in the
+    same order as pfmethods. The periodogram values for the fused
+    period-finders are the same as those from running them separately to
+    within floating point precision.
+
+    If the stage timings are turned on (see periodbase.enable_pf_timing), the
+    timing dict of each result dict has a 'fused' key with the timings of the
+    shared sigma-clip, frequency grid, and fused pass. The time spent running
+    the period-finders after the fused pass is in the 'other' stage of these.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
+    '''
+
+    if pfkwargs is None:
+        pfkwargs = [{} for x in pfmethods]
+
+    # the kwargs common to all of the period-finders
+    commonkwargs = {'magsarefluxes':magsarefluxes,
+                    'sigclip':sigclip,
+                    'nworkers':nworkers,
+                    'verbose':verbose}
+    gridkwargs = {'startp':startp,
+                  'endp':endp,
+                  'autofreq':autofreq,
+                  'stepsize':stepsize}
+
+    allkwargs = []
+    for pfm, pfkw in zip(pfmethods, pfkwargs):
+        kwargs = pfkw.copy()
+        kwargs.update(commonkwargs)
+        # use the fused grid for the period-finders that don't set their own
+        funcargs = _get_function_kwargs(LSPMETHODS[pfm], {})
+        for gkw in FUSED_GRIDKWARGS:
+            if gkw in funcargs and gridkwargs[gkw] is not None:
+                kwargs.setdefault(gkw, gridkwargs[gkw])
+        # hand the executor on to the period-finders that can use it
+        if executor is not None and 'executor' in funcargs:
+            kwargs['executor'] = executor
+        allkwargs.append(kwargs)
+
+    # get rid of nans first and sigclip
+    stimes, smags, serrs = sigclip_magseries(times,
+                                             mags,
+                                             errs,
+                                             magsarefluxes=magsarefluxes,
+                                             sigclip=sigclip)
+    pf_timing_mark('sigclip', npoints=stimes.size)
+
+    # figure out which period-finders we can fuse
+    fusedinds = []
+
+    if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
+
+        for ind, pfm, kwargs in zip(range(len(pfmethods)),
+                                    pfmethods,
+                                    allkwargs):
+
+            funckwargs = _get_function_kwargs(LSPMETHODS[pfm], kwargs)
+
+            if pfm not in FUSED_PFMETHODS:
+                continue
+
+            samegrid = all(funckwargs[x] == gridkwargs[x]
+                           for x in FUSED_GRIDKWARGS)
+
+            if (samegrid and
+                not funckwargs['coarsetofine'] and
+                (pfm != 'gls' or funckwargs['glspfunc'] in FUSED_GLSPFUNCS) and
+                # pgen_lsp throws out points with zero errs
+                (pfm not in ('gls','win') or not npany(serrs == 0.0))):
+                fusedinds.append(ind)
+
+            elif not samegrid and verbose:
+                LOGWARNING('%s sets its own frequency grid in pfkwargs, '
+                           'running it separately from the fused pass' % pfm)
+
+    if fusedinds:
+
+        # get the frequencies to use
+        if startp:
+            endf = 1.0/startp
+        else:
+            # default start period is 0.1 day
+            endf = 1.0/0.1
+
+        if endp:
+            startf = 1.0/endp
+        else:
+            # default end period is length of time series
+            startf = 1.0/(stimes.max() - stimes.min())
+
+        # if we're not using autofreq, then use the provided frequencies
+        if not autofreq:
+            frequencies = np.arange(startf, endf, stepsize)
+        else:
+            # this gets an automatic grid of frequencies to use
+            frequencies = get_frequency_grid(stimes,
+                                             minfreq=startf,
+                                             maxfreq=endf)
+
+        pf_timing_mark('grid', nfreq=frequencies.size)
+
+        # the period-finders return their usual nan result dicts for an empty
+        # grid, so leave them to it
+        if frequencies.size == 0:
+            fusedinds = []
+
+    if fusedinds:
+
+        if verbose:
+            LOGINFO('fused pass for %s over %s frequency points, '
+                    'start P = %.3f, end P = %.3f' %
+                    (', '.join(pfmethods[x] for x in fusedinds),
+                     frequencies.size,
+                     1.0/frequencies.max(),
+                     1.0/frequencies.min()))
+
+        # get the working mags and parameters for each period-finder in the
+        # same way as they do it
+        magarrays = [smags]
+        specs = []
+
+        for ind in fusedinds:
+
+            pfm = pfmethods[ind]
+            funckwargs = _get_function_kwargs(LSPMETHODS[pfm], allkwargs[ind])
+
+            if pfm in ('pdm','aov','mav') and funckwargs['normalize']:
+                magarrays.append((smags - npmedian(smags))/npstd(smags))
+                magind = len(magarrays) + 1
+            else:
+                magind = 2
+
+            if pfm == 'gls':
+                params = (FUSED_GLSPFUNCS[funckwargs['glspfunc']],)
+            elif pfm == 'win':
+                params = ()
+            elif pfm == 'pdm':
+                params = (funckwargs['phasebinsize'],
+                          funckwargs['mindetperbin'])
+            elif pfm == 'aov':
+                params = (funckwargs['phasebinsize'],
+                          funckwargs['mindetperbin'],
+                          funckwargs['binstat'])
+            elif pfm == 'mav':
+                nmags = magarrays[magind - 2]
+                magvariance_top = npsum(nmags/(serrs*serrs))
+                magvariance_bot = (
+                    (nmags.size - 1)*npsum(1.0/(serrs*serrs)) / nmags.size
+                )
+                params = (funckwargs['nharmonics'],
+                          magvariance_top/magvariance_bot)
+
+            specs.append((pfm, magind, params))
+
+        fusedlsp = parallel_frequency_blocks(
+            fused_block_worker,
+            (stimes, serrs) + tuple(magarrays),
+            frequencies,
+            extraargs=(specs,),
+            nworkers=nworkers,
+            blockmemory=blockmemory,
+            narrays=3 + 3*len(specs),
+            sharedarrays=sharedarrays,
+            executor=executor,
+            verbose=verbose
+        )
+        pf_timing_mark('kernel')
+
+    # now get the result dicts from each period-finder, using the fused
+    # periodograms where we have them
+    results = []
+
+    for ind, pfm, kwargs in zip(range(len(pfmethods)), pfmethods, allkwargs):
+
+        if ind in fusedinds:
+            kwargs = kwargs.copy()
+            kwargs['precomputed'] = {
+                'frequencies':frequencies,
+                'lspvals':fusedlsp[:,fusedinds.index(ind)]
+            }
+
+        results.append(LSPMETHODS[pfm](times, mags, errs, **kwargs))
+
+    return results
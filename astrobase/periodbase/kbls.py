@@ -3,7 +3,9 @@
 '''kbls.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Jan 2017
 
 Contains the Kovacs, et al. (2002) Box-Least-squared-Search period-search
-algorithm implementation for periodbase.
+algorithm implementation for periodbase. This uses the eebls Fortran code from
+the pyeebls package if it's available, and a numpy implementation of the same
+algorithm otherwise (see _bls_numpy_block below).
 
 '''
 
@@ -103,7 +105,16 @@ from ..lcmath import phase_magseries, sigclip_magseries, \
     time_bin_magseries, phase_bin_magseries, \
     phase_magseries_with_errs, phase_bin_magseries_with_errs
 
-from pyeebls import eebls
+# the Fortran eebls is optional, we'll use the numpy BLS engine without it
+try:
+    from pyeebls import eebls
+    EEBLS = True
+except:
+    EEBLS = False
+
+from . import SharedMagSeries, get_shared_magseries, coarse_to_fine_search, \
+    get_frequency_blocks, parallel_frequency_blocks, cached_periodfinder, \
+    pf_timing_mark, pf_timing_stage
 
 from ..varbase.lcfit import spline_fit_magseries, savgol_fit_magseries, \
     traptransit_fit_magseries
@@ -139,6 +150,228 @@ def auto_transit_duration(min_radius_hint,
 ## BLS (Kovacs, Zucker, Mazeh 2002) ##
 ######################################
 
+def _bls_numpy_block(times,
+                     mags,
+                     frequencies,
+                     nbins,
+                     minduration,
+                     maxduration):
+    '''
+    This runs the numpy BLS engine for a block of frequencies.
+
+    This does the same calculations as eebls.f from Kovacs et al. (2002), but
+    for all frequencies in the block at once:
+
+    - the mag series is phased at each frequency and the number of points and
+      the sum of the mean-subtracted mags in each phase bin are obtained using
+      np.bincount, without sorting the phases
+
+    - the bins are extended by wrapping around in phase, and the cumulative
+      sums over the bins give the number of points and the sum of the mags
+      for all transit windows of a given duration (in bins) at once
+
+    - the BLS power s^2/(n_in*(n - n_in)) is evaluated for every duration from
+      minduration to maxduration and every starting bin. Like eebls, windows
+      with fewer than max(n*minduration, 5) points are skipped, and the last of
+      any tied maxima is kept.
+
+    The calculations for each frequency are independent of the others, so the
+    results don't depend on how the frequency grid is split into blocks.
+
+    Returns (power, windowsums, windowndets, ingressbins, egressbins) for the
+    best window at each frequency. power is sqrt(max BLS power) as in eebls.
+    The bins are 1-based as in eebls, and egressbins isn't wrapped around yet.
+
+    '''
+
+    ndet = times.size
+    rn = float(ndet)
+    nfreqs = frequencies.size
+
+    # these are the same limits used by eebls
+    kmi = max(int(minduration*nbins), 1)
+    kma = int(maxduration*nbins) + 1
+    kkmi = max(int(rn*minduration), 5)
+
+    utimes = times - times[0]
+    vmags = mags - npmean(mags)
+
+    # phase the mag series and get the bin indices
+    phases = np.outer(frequencies, utimes)
+    phases -= npfloor(phases)
+    binind = (nbins*phases).astype(np.int64)
+    del phases
+
+    binind += (nparange(nfreqs)*nbins)[:,None]
+    binind = binind.ravel()
+
+    binndets = np.bincount(
+        binind,
+        minlength=nfreqs*nbins
+    ).reshape(nfreqs, nbins)
+    binsums = np.bincount(
+        binind,
+        weights=np.broadcast_to(vmags, (nfreqs, ndet)).ravel(),
+        minlength=nfreqs*nbins
+    ).reshape(nfreqs, nbins)
+    del binind
+
+    # extend the bins by wrapping around in phase and get the cumulative sums
+    wrapind = nparange(nbins + kma) % nbins
+
+    # the counts are kept as floats so they don't need conversion below
+    cumndets = np.zeros((nfreqs, nbins + kma + 1))
+    cumsums = np.zeros((nfreqs, nbins + kma + 1))
+    np.cumsum(binndets[:,wrapind], axis=1, out=cumndets[:,1:])
+    np.cumsum(binsums[:,wrapind], axis=1, out=cumsums[:,1:])
+
+    # the best power for each starting bin. -1.0 means that no window starting
+    # in this bin was good enough. we use work buffers for the windows to avoid
+    # allocating new arrays for each duration.
+    startpower = np.full((nfreqs, nbins), -1.0)
+    windowndets = npempty((nfreqs, nbins))
+    windowsums = npempty((nfreqs, nbins))
+    windowoutdets = npempty((nfreqs, nbins))
+    windowpower = npempty((nfreqs, nbins))
+    badwindows = npempty((nfreqs, nbins), dtype=np.bool_)
+
+    # the number of points in a window only goes up with its duration, so once
+    # all windows have enough points, we can stop checking for this
+    checkwindows = True
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        for duration in range(kmi, kma + 2):
+
+            np.subtract(cumndets[:,duration:duration+nbins],
+                        cumndets[:,:nbins],
+                        out=windowndets)
+            np.subtract(cumsums[:,duration:duration+nbins],
+                        cumsums[:,:nbins],
+                        out=windowsums)
+
+            # power = s^2/(n_in*(n - n_in))
+            np.subtract(rn, windowndets, out=windowoutdets)
+            np.multiply(windowoutdets, windowndets, out=windowoutdets)
+            np.multiply(windowsums, windowsums, out=windowpower)
+            np.divide(windowpower, windowoutdets, out=windowpower)
+
+            if checkwindows:
+                np.less(windowndets, kkmi, out=badwindows)
+                np.copyto(windowpower, -1.0, where=badwindows)
+                checkwindows = badwindows.any()
+
+            # windows with all points in them give nans, fmax skips these
+            np.fmax(startpower, windowpower, out=startpower)
+
+        # get the best starting bin for each frequency, this is the last one of
+        # any tied maxima like in eebls
+        freqind = nparange(nfreqs)
+        beststart = nbins - 1 - npargmax(startpower[:,::-1], axis=1)
+        bestpower = startpower[freqind, beststart]
+
+        # now get the best duration for the best starting bins, again the last
+        # one of any tied maxima
+        durations = nparange(kmi, kma + 2)
+        startbins = beststart[:,None]
+        windowndets = (cumndets[freqind[:,None], startbins + durations] -
+                       cumndets[freqind, beststart][:,None])
+        windowsums = (cumsums[freqind[:,None], startbins + durations] -
+                      cumsums[freqind, beststart][:,None])
+        windowpower = windowsums*windowsums/(windowndets*(rn - windowndets))
+        windowpower[(windowndets < kkmi) | ~npisfinite(windowpower)] = -1.0
+
+        bestdurind = durations.size - 1 - npargmax(windowpower[:,::-1], axis=1)
+        bestduration = durations[bestdurind]
+        windowndets = windowndets[freqind, bestdurind]
+        windowsums = windowsums[freqind, bestdurind]
+
+    # frequencies without any good windows get zero power
+    bestpower[bestpower < 0.0] = 0.0
+
+    return (npsqrt(bestpower),
+            windowsums,
+            windowndets,
+            beststart + 1,
+            beststart + bestduration)
+
+
+
+def _bls_numpy_runner(times,
+                      mags,
+                      frequencies,
+                      nbins,
+                      minduration,
+                      maxduration,
+                      blockmemory=32.0):
+    '''
+    This runs the numpy BLS engine over an array of frequencies.
+
+    The frequencies are split into blocks so that the 2D work arrays take up at
+    most blockmemory MB. Returns a dict with the same keys as _bls_runner.
+
+    '''
+
+    # the phase-bin arrays are (nfreqs, ndets) and the window arrays are about
+    # (nfreqs, 8*nbins) in total
+    blocks = get_frequency_blocks(frequencies.size,
+                                  times.size + 8*nbins,
+                                  blockmemory=blockmemory,
+                                  narrays=3)
+
+    blockresults = [_bls_numpy_block(times, mags, frequencies[x],
+                                     nbins, minduration, maxduration)
+                    for x in blocks]
+
+    power, windowsums, windowndets, ingressbins, egressbins = (
+        np.concatenate([x[ind] for x in blockresults]) for ind in range(5)
+    )
+
+    # like eebls, the best frequency is the last one of any tied maxima
+    bestind = power.size - 1 - npargmax(power[::-1])
+
+    rn = float(times.size)
+    rn3 = float(windowndets[bestind])
+    s3 = windowsums[bestind]
+
+    transegressbin = int(egressbins[bestind])
+    if transegressbin > nbins:
+        transegressbin = transegressbin - nbins
+
+    return {'power':power,
+            'bestperiod':1.0/frequencies[bestind],
+            'bestpower':power[bestind],
+            'transdepth':-s3*rn/(rn3*(rn - rn3)),
+            'transduration':rn3/rn,
+            'transingressbin':int(ingressbins[bestind]),
+            'transegressbin':transegressbin}
+
+
+
+def bls_numpy_block_worker(task):
+    '''
+    This is the parallel worker for the numpy BLS engine.
+
+    task[0] = (times, mags) or a SharedMagSeries ref to them
+    task[1] = block of frequencies
+    task[2] = nbins
+    task[3] = minduration
+    task[4] = maxduration
+
+    Returns the BLS power for each frequency in the block.
+
+    '''
+
+    try:
+        times, mags = get_shared_magseries(task[0])
+        return _bls_numpy_block(times, mags, task[1],
+                                task[2], task[3], task[4])[0]
+    except Exception as e:
+        LOGEXCEPTION('numpy BLS failed for this frequency block')
+        return npfull_like(task[1], npnan)
+
+
+
 def _bls_runner(times,
                 mags,
                 nfreq,
@@ -146,12 +379,20 @@ def _bls_runner(times,
                 stepsize,
                 nbins,
                 minduration,
-                maxduration):
+                maxduration,
+                blsengine='eebls'):
     '''
     This runs the bls.eebls function using the given inputs.
 
+    If blsengine is 'numpy', this uses the numpy BLS engine instead.
+
     '''
 
+    if blsengine == 'numpy' or not EEBLS:
+        return _bls_numpy_runner(times, mags,
+                                 freqmin + nparange(nfreq)*stepsize,
+                                 nbins, minduration, maxduration)
+
     workarr_u = np.ones(times.size)
     workarr_v = np.ones(times.size)
 
@@ -170,26 +411,68 @@ def _bls_runner(times,
 
 
 
+def _get_bls_freqchunks(frequencies, maxchunksize=None):
+    '''
+    This splits an array of frequencies into uniform chunks for eebls.
+
+    frequencies is a subset of a uniform frequency grid, e.g. the coarse grid or
+    the refinement windows from periodbase.coarse_to_fine_search. This is split
+    wherever there's a gap in the frequencies, and each uniform run of
+    frequencies is further split into chunks of at most maxchunksize
+    frequencies if this is provided.
+
+    Returns a list of (nfreq, minfreq, stepsize) tuples, one per chunk, in the
+    same order as the input frequencies.
+
+    '''
+
+    if frequencies.size < 2:
+        return [(frequencies.size, frequencies[0], 1.0)]
+
+    freqsteps = np.diff(frequencies)
+    minstep = freqsteps.min()
+
+    runs = np.split(frequencies, np.nonzero(freqsteps > 1.5*minstep)[0] + 1)
+
+    chunks = []
+
+    for run in runs:
+
+        if run.size > 1:
+            runstep = (run[-1] - run[0])/(run.size - 1.0)
+        else:
+            runstep = minstep
+
+        if maxchunksize:
+            chunks.extend([(run[x:x+maxchunksize].size, run[x], runstep)
+                           for x in range(0, run.size, maxchunksize)])
+        else:
+            chunks.append((run.size, run[0], runstep))
+
+    return chunks
+
+
+
 def parallel_bls_worker(task):
     '''
     This wraps _bls_runner for the parallel function below.
 
-    task[0] = times
-    task[1] = mags
-    task[2] = nfreq
-    task[3] = freqmin
-    task[4] = stepsize
-    task[5] = nbins
-    task[6] = minduration
-    task[7] = maxduration
+    task[0] = (times, mags) or a SharedMagSeries ref to them
+    task[1] = nfreq
+    task[2] = freqmin
+    task[3] = stepsize
+    task[4] = nbins
+    task[5] = minduration
+    task[6] = maxduration
 
     '''
 
     try:
-        return _bls_runner(*task)
+        times, mags = get_shared_magseries(task[0])
+        return _bls_runner(times, mags, *task[1:])
     except Exception as e:
-        LOGEXCEPTION('BLS failed for task %s' % repr(task[2:]))
-    return {'power':np.array([npnan for x in range(nfreq)]),
+        LOGEXCEPTION('BLS failed for task %s' % repr(task[1:]))
+    return {'power':np.array([npnan for x in range(task[1])]),
             'bestperiod':npnan,
             'bestpower':npnan,
             'transdepth':npnan,
@@ -200,6 +483,7 @@ def parallel_bls_worker(task):
 
 
 
+@cached_periodfinder
 def bls_serial_pfind(times, mags, errs,
                      magsarefluxes=False,
                      startp=0.1, # search from 0.1 d to...
@@ -212,6 +496,10 @@ def bls_serial_pfind(times, mags, errs,
                      periodepsilon=0.1,
                      nbestpeaks=5,
                      sigclip=10.0,
+                     coarsetofine=False,
+                     coarsefactor=3,
+                     coarsenpeaks=10,
+                     blsengine=None,
                      verbose=True):
     '''Runs the Box Least Squares Fitting Search for transit-shaped signals.
 
@@ -220,6 +508,24 @@ def bls_serial_pfind(times, mags, errs,
     because BLS in Fortran is fairly fast). If nfreq > 5e5, this will take a
     while.
 
+    If coarsetofine is True, the BLS spectrum is first calculated on a coarse
+    grid made of every coarsefactor-th frequency, and then at full resolution
+    around the best coarsenpeaks peaks and their aliases only (see
+    periodbase.coarse_to_fine_search). The lspvals, frequencies, and periods
+    returned are then on this merged grid, and the 'coarsetofine' key in the
+    returned dict gives the number of frequencies saved. The coarse grid must
+    still sample the BLS peaks, which are narrower than those for the other
+    period-finders, so coarsefactor should be small (autofreq = True uses a
+    step of 1/4 of the minimum transit duration over the time base, so
+    coarsefactor = 2-4 is reasonable).
+
+    blsengine sets the BLS engine to use: 'eebls' for the Fortran eebls from
+    the pyeebls package or 'numpy' for the numpy BLS engine. If this is None,
+    uses 'eebls' if pyeebls is available and 'numpy' otherwise. The numpy
+    engine gives the same periodogram as eebls to floating point precision. For
+    the best peak, it may pick the complementary window (the rest of the phased
+    LC with the opposite sign of transit depth) if this has the same power.
+
     '''
 
     # get rid of nans first and sigclip
@@ -229,6 +535,14 @@ def bls_serial_pfind(times, mags, errs,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
 
+    # use the numpy BLS engine if eebls isn't available
+    if blsengine is None:
+        blsengine = 'eebls' if EEBLS else 'numpy'
+    elif blsengine == 'eebls' and not EEBLS:
+        LOGWARNING('pyeebls is not available, '
+                   'using the numpy BLS engine instead')
+        blsengine = 'numpy'
+
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
 
@@ -299,14 +613,70 @@ def bls_serial_pfind(times, mags, errs,
         # run BLS
         try:
 
-            blsresult = _bls_runner(stimes,
-                                    smags,
-                                    nfreq,
-                                    minfreq,
-                                    stepsize,
-                                    nphasebins,
-                                    mintransitduration,
-                                    maxtransitduration)
+            if coarsetofine:
+
+                blsruns = []
+
+                # this runs BLS for an array of frequencies from the full grid
+                def lspfunc(lspfreqs):
+
+                    # the numpy engine can take the frequencies directly
+                    if blsengine == 'numpy':
+                        runresult = _bls_numpy_runner(stimes,
+                                                      smags,
+                                                      lspfreqs,
+                                                      nphasebins,
+                                                      mintransitduration,
+                                                      maxtransitduration)
+                        blsruns.append(runresult)
+                        return runresult['power']
+
+                    lspvals = []
+
+                    for chunk_nf, chunk_minf, chunk_stepsize in (
+                            _get_bls_freqchunks(lspfreqs)
+                    ):
+                        runresult = _bls_runner(stimes,
+                                                smags,
+                                                chunk_nf,
+                                                chunk_minf,
+                                                chunk_stepsize,
+                                                nphasebins,
+                                                mintransitduration,
+                                                maxtransitduration)
+                        blsruns.append(runresult)
+                        lspvals.append(runresult['power'])
+
+                    return np.concatenate(lspvals)
+
+                frequencies, lsp, ctfinfo = coarse_to_fine_search(
+                    lspfunc,
+                    minfreq + nparange(nfreq)*stepsize,
+                    coarsefactor=coarsefactor,
+                    npeaks=coarsenpeaks,
+                    verbose=verbose
+                )
+
+                # use the BLS result from the run with the best peak
+                blsresult = blsruns[
+                    npnanargmax([x['bestpower'] for x in blsruns])
+                ]
+
+            else:
+
+                blsresult = _bls_runner(stimes,
+                                        smags,
+                                        nfreq,
+                                        minfreq,
+                                        stepsize,
+                                        nphasebins,
+                                        mintransitduration,
+                                        maxtransitduration,
+                                        blsengine=blsengine)
+
+                frequencies = minfreq + nparange(nfreq)*stepsize
+                lsp = blsresult['power']
+                ctfinfo = None
 
             # find the peaks in the BLS. this uses wavelet transforms to
             # smooth the spectrum and find peaks. a similar thing would be
@@ -318,9 +688,7 @@ def bls_serial_pfind(times, mags, errs,
 
 
 
-            frequencies = minfreq + nparange(nfreq)*stepsize
             periods = 1.0/frequencies
-            lsp = blsresult['power']
 
             # find the nbestpeaks for the periodogram: 1. sort the lsp array
             # by highest value first 2. go down the values until we find
@@ -358,7 +726,8 @@ def bls_serial_pfind(times, mags, errs,
                                   'autofreq':autofreq,
                                   'periodepsilon':periodepsilon,
                                   'nbestpeaks':nbestpeaks,
-                                  'sigclip':sigclip}}
+                                  'sigclip':sigclip,
+                                  'blsengine':blsengine}}
 
             sortedlspind = np.argsort(finlsp)[::-1]
             sortedlspperiods = finperiods[sortedlspind]
@@ -409,6 +778,7 @@ def bls_serial_pfind(times, mags, errs,
                 'frequencies':frequencies,
                 'periods':periods,
                 'blsresult':blsresult,
+                'coarsetofine':ctfinfo,
                 'stepsize':stepsize,
                 'nfreq':nfreq,
                 'nphasebins':nphasebins,
@@ -424,7 +794,8 @@ def bls_serial_pfind(times, mags, errs,
                           'autofreq':autofreq,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
-                          'sigclip':sigclip}
+                          'sigclip':sigclip,
+                          'blsengine':blsengine}
             }
 
             return resultdict
@@ -454,7 +825,8 @@ def bls_serial_pfind(times, mags, errs,
                               'autofreq':autofreq,
                               'periodepsilon':periodepsilon,
                               'nbestpeaks':nbestpeaks,
-                              'sigclip':sigclip}}
+                              'sigclip':sigclip,
+                              'blsengine':blsengine}}
 
 
     else:
@@ -482,10 +854,12 @@ def bls_serial_pfind(times, mags, errs,
                           'autofreq':autofreq,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
-                          'sigclip':sigclip}}
+                          'sigclip':sigclip,
+                          'blsengine':blsengine}}
 
 
 
+@cached_periodfinder
 def bls_parallel_pfind(
         times, mags, errs,
         magsarefluxes=False,
@@ -500,6 +874,12 @@ def bls_parallel_pfind(
         periodepsilon=0.1, # 0.1
         nworkers=None,
         sigclip=10.0,
+        sharedarrays=True,
+        executor=None,
+        coarsetofine=False,
+        coarsefactor=3,
+        coarsenpeaks=10,
+        blsengine=None,
         verbose=True
 ):
     '''Runs the Box Least Squares Fitting Search for transit-shaped signals.
@@ -508,14 +888,37 @@ def bls_parallel_pfind(
     et al. 2015. Breaks up the full frequency space into chunks and passes them
     to parallel BLS workers.
 
-    NOTE: the combined BLS spectrum produced by this function is not identical
-    to that produced by running BLS in one shot for the entire frequency
-    space. There are differences on the order of 1.0e-3 or so in the respective
-    peak values, but peaks appear at the same frequencies for both methods. This
-    is likely due to different aliasing caused by smaller chunks of the
-    frequency space used by the parallel workers in this function. When in
-    doubt, confirm results for this parallel implementation by comparing to
-    those from the serial implementation above.
+    If sharedarrays is True, the cleaned mag series is placed in shared memory
+    once and the workers only get their frequency chunk parameters.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
+    If coarsetofine is True, this runs a coarse-to-fine search with the coarse
+    grid and the refinement windows spread out over the workers. See
+    bls_serial_pfind for details.
+
+    blsengine sets the BLS engine to use: 'eebls' for the Fortran eebls from
+    the pyeebls package or 'numpy' for the numpy BLS engine. If this is None,
+    uses 'eebls' if pyeebls is available and 'numpy' otherwise. The numpy
+    engine doesn't need a compiled extension, but is a few times slower than
+    eebls.
+
+    NOTE: with blsengine = 'eebls', the combined BLS spectrum produced by this
+    function is not identical to that produced by running BLS in one shot for
+    the entire frequency space. There are differences on the order of 1.0e-3 or
+    so in the respective peak values, but peaks appear at the same frequencies
+    for both methods. This is likely due to different aliasing caused by
+    smaller chunks of the frequency space used by the parallel workers in this
+    function. When in doubt, confirm results for this parallel implementation
+    by comparing to those from the serial implementation above.
+
+    With blsengine = 'numpy', each frequency is calculated independently of
+    the others, so the spectrum is identical to that from bls_serial_pfind
+    with blsengine = 'numpy'. In this case, the 'blsresult' key in the returned
+    dict is a list with a single item: the transit parameters at the best
+    period.
 
     '''
 
@@ -525,6 +928,15 @@ def bls_parallel_pfind(
                                              errs,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
+    pf_timing_mark('sigclip', npoints=stimes.size)
+
+    # use the numpy BLS engine if eebls isn't available
+    if blsengine is None:
+        blsengine = 'eebls' if EEBLS else 'numpy'
+    elif blsengine == 'eebls' and not EEBLS:
+        LOGWARNING('pyeebls is not available, '
+                   'using the numpy BLS engine instead')
+        blsengine = 'numpy'
 
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
@@ -589,7 +1001,9 @@ def bls_parallel_pfind(
         #############################
 
         # fix number of CPUs if needed
-        if not nworkers or nworkers > NCPUS:
+        if executor is not None:
+            nworkers = executor.nworkers
+        elif not nworkers or nworkers > NCPUS:
             nworkers = NCPUS
             if verbose:
                 LOGINFO('using %s workers...' % nworkers)
@@ -600,35 +1014,134 @@ def bls_parallel_pfind(
         chunk_minfreqs = [frequencies[x*chunksize] for x in range(nworkers)]
         chunk_nfreqs = [frequencies[x*chunksize:x*chunksize+chunksize].size
                         for x in range(nworkers)]
+        pf_timing_mark('grid', nfreq=frequencies.size)
+
+
+        if blsengine == 'numpy':
+
+            # the numpy engine works on each frequency independently, so
+            # running it in blocks spread over the workers gives exactly the
+            # same results as the serial version
+            blsnarrays = 3 + int(np.ceil(8.0*nphasebins/stimes.size))
+
+            def lspfunc(lspfreqs):
+
+                return parallel_frequency_blocks(
+                    bls_numpy_block_worker,
+                    (stimes, smags),
+                    lspfreqs,
+                    extraargs=(nphasebins,
+                               mintransitduration,
+                               maxtransitduration),
+                    nworkers=nworkers,
+                    narrays=blsnarrays,
+                    sharedarrays=sharedarrays,
+                    executor=executor,
+                    verbose=verbose
+                )
 
+            if coarsetofine:
 
-        # populate the tasks list
-        tasks = [(stimes, smags,
-                  chunk_minf, chunk_nf,
-                  stepsize, nphasebins,
-                  mintransitduration, maxtransitduration)
-                 for (chunk_nf, chunk_minf)
-                 in zip(chunk_minfreqs, chunk_nfreqs)]
+                frequencies, lsp, ctfinfo = coarse_to_fine_search(
+                    lspfunc,
+                    frequencies,
+                    coarsefactor=coarsefactor,
+                    npeaks=coarsenpeaks,
+                    verbose=verbose
+                )
 
-        if verbose:
-            for ind, task in enumerate(tasks):
-                LOGINFO('worker %s: minfreq = %.3f, nfreqs = %s' %
-                        (ind+1, task[3], task[2]))
-            LOGINFO('running...')
+            else:
 
-        # return tasks
+                lsp = lspfunc(frequencies)
+                ctfinfo = None
 
-        # start the pool
-        pool = Pool(nworkers)
-        results = pool.map(parallel_bls_worker, tasks)
+            # get the transit parameters at the best frequency. this is the
+            # last one of any tied maxima like in the serial version.
+            bestind = lsp.size - 1 - npnanargmax(lsp[::-1])
+            results = [_bls_numpy_runner(stimes,
+                                         smags,
+                                         frequencies[bestind:bestind+1],
+                                         nphasebins,
+                                         mintransitduration,
+                                         maxtransitduration)]
 
-        pool.close()
-        pool.join()
-        del pool
+        else:
+
+            # the mag series goes into shared memory once for all workers
+            with SharedMagSeries(stimes, smags,
+                                 sharedarrays=sharedarrays) as shared:
+
+                # start the pool or use the one we were given
+                if executor is not None:
+                    pool = executor
+                else:
+                    with pf_timing_stage('pool'):
+                        pool = Pool(nworkers)
+
+                if coarsetofine:
+
+                    results = []
+
+                    # this runs BLS for an array of frequencies from the
+                    # full grid
+                    def lspfunc(lspfreqs):
+
+                        maxchunksize = int(float(lspfreqs.size)/nworkers) + 1
+                        tasks = [(shared.ref,
+                                  chunk_nf, chunk_minf,
+                                  chunk_stepsize, nphasebins,
+                                  mintransitduration, maxtransitduration)
+                                 for (chunk_nf, chunk_minf, chunk_stepsize)
+                                 in _get_bls_freqchunks(
+                                     lspfreqs,
+                                     maxchunksize=maxchunksize
+                                 )]
+
+                        chunkresults = pool.map(parallel_bls_worker, tasks)
+                        results.extend(chunkresults)
+
+                        return np.concatenate(
+                            [x['power'] for x in chunkresults]
+                        )
+
+                    frequencies, lsp, ctfinfo = coarse_to_fine_search(
+                        lspfunc,
+                        frequencies,
+                        coarsefactor=coarsefactor,
+                        npeaks=coarsenpeaks,
+                        verbose=verbose
+                    )
+
+                else:
+
+                    # populate the tasks list
+                    tasks = [(shared.ref,
+                              chunk_nf, chunk_minf,
+                              stepsize, nphasebins,
+                              mintransitduration, maxtransitduration)
+                             for (chunk_minf, chunk_nf)
+                             in zip(chunk_minfreqs, chunk_nfreqs)]
+
+                    if verbose:
+                        for ind, task in enumerate(tasks):
+                            LOGINFO('worker %s: minfreq = %.3f, nfreqs = %s' %
+                                    (ind+1, task[2], task[1]))
+                        LOGINFO('running...')
+
+                    results = pool.map(parallel_bls_worker, tasks)
+
+                    # now concatenate the output lsp arrays
+                    lsp = np.concatenate([x['power'] for x in results])
+                    ctfinfo = None
+
+                if executor is None:
+                    with pf_timing_stage('pool'):
+                        pool.close()
+                        pool.join()
+                del pool
 
-        # now concatenate the output lsp arrays
-        lsp = np.concatenate([x['power'] for x in results])
         periods = 1.0/frequencies
+        pf_timing_mark('kernel')
 
         # find the nbestpeaks for the periodogram: 1. sort the lsp array
         # by highest value first 2. go down the values until we find
@@ -667,7 +1180,8 @@ def bls_parallel_pfind(
                               'autofreq':autofreq,
                               'periodepsilon':periodepsilon,
                               'nbestpeaks':nbestpeaks,
-                              'sigclip':sigclip}}
+                              'sigclip':sigclip,
+                              'blsengine':blsengine}}
 
         sortedlspind = np.argsort(finlsp)[::-1]
         sortedlspperiods = finperiods[sortedlspind]
@@ -707,6 +1221,7 @@ def bls_parallel_pfind(
 
             prevperiod = period
 
+        pf_timing_mark('peaks')
 
         # generate the return dict
         resultdict = {
@@ -719,6 +1234,7 @@ def bls_parallel_pfind(
             'frequencies':frequencies,
             'periods':periods,
             'blsresult':results,
+            'coarsetofine':ctfinfo,
             'stepsize':stepsize,
             'nfreq':nfreq,
             'nphasebins':nphasebins,
@@ -734,7 +1250,8 @@ def bls_parallel_pfind(
                       'autofreq':autofreq,
                       'periodepsilon':periodepsilon,
                       'nbestpeaks':nbestpeaks,
-                      'sigclip':sigclip}
+                      'sigclip':sigclip,
+                      'blsengine':blsengine}
         }
 
         return resultdict
@@ -765,7 +1282,8 @@ def bls_parallel_pfind(
                           'autofreq':autofreq,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
-                          'sigclip':sigclip}}
+                          'sigclip':sigclip,
+                          'blsengine':blsengine}}
 
 
 
@@ -778,6 +1296,7 @@ def bls_snr(blsdict,
             perioddeltapercent=10,
             npeaks=None,
             assumeserialbls=False,
+            blsengine='numpy',
             verbose=True):
     '''Calculates the signal to noise ratio for each best peak in the BLS
     periodogram.
@@ -810,6 +1329,11 @@ def bls_snr(blsdict,
     global best peaks in the periodogram, so we need to rerun bls_serial_pfind
     around each peak in blsdict['nbestperiods'] to get correct values for these.
 
+    blsengine sets the BLS engine used for these reruns. This is 'numpy' by
+    default, which doesn't need the pyeebls package and gives the same results
+    no matter how the frequencies were split up in the initial run. Use 'eebls'
+    to use the Fortran BLS instead, or None to use the one from the initial run.
+
     FIXME: for now, we're only doing simple RMS. Need to calculate red and
     white-noise RMS as outlined below:
 
@@ -879,12 +1403,14 @@ def bls_snr(blsdict,
             if not assumeserialbls:
 
                 # run bls_serial_pfind with the kwargs copied over from the
-                # initial run. replace only the startp, endp, and verbose kwarg
-                # values
+                # initial run. replace only the startp, endp, verbose, and
+                # blsengine kwarg values
                 prevkwargs = blsdict['kwargs'].copy()
                 prevkwargs['verbose'] = verbose
                 prevkwargs['startp'] = startp
                 prevkwargs['endp'] = endp
+                if blsengine is not None:
+                    prevkwargs['blsengine'] = blsengine
 
                 blsres = bls_serial_pfind(times, mags, errs,
                                           **prevkwargs)
@@ -108,6 +108,8 @@ from ..lcmath import phase_magseries, sigclip_magseries, time_bin_magseries, \
 
 from ..varbase.autocorr import autocorr_magseries
 
+from . import cached_periodfinder, pf_timing_mark
+
 
 ############
 ## CONFIG ##
@@ -272,6 +274,7 @@ def plot_acf_results(acfp, outfile, maxlags=5000, yrange=[-0.4,0.4]):
 ## PERIOD FINDER FUNCTION ##
 ############################
 
+@cached_periodfinder
 def macf_period_find(
         times,
         mags,
@@ -284,6 +287,7 @@ def macf_period_find(
         smoothacf=21, # set for Kepler-type LCs, see details below
         smoothfunc=_smooth_acf_savgol,
         smoothfunckwargs={},
+        usefft=True,
         magsarefluxes=False,
         sigclip=3.0,
         verbose=True,
@@ -342,6 +346,12 @@ def macf_period_find(
     be an actual low-pass filter (generated using scipy.signal?) to remove all
     high frequency noise from the ACF.
 
+    usefft is True if the ACF should be calculated using an FFT of the
+    gap-filled light curve. This gives the same ACF as the direct calculation
+    in varbase.autocorr.autocorr_magseries, but is O(N log N) instead of O(N^2),
+    so it's usable for Kepler short-cadence light curves. Set this to False to
+    use the direct calculation.
+
     magarefluxes is True if the measurements provided in mags are actually
     fluxes, False otherwise.
 
@@ -377,6 +387,7 @@ def macf_period_find(
         mags,
         errs,
         maxlags=maxlags,
+        usefft=usefft,
         fillgaps=fillgaps,
         forcetimebin=forcetimebin,
         sigclip=sigclip,
@@ -385,6 +396,12 @@ def macf_period_find(
         verbose=verbose
     )
 
+    # the sigma-clipping and gap-filling happen inside autocorr_magseries, so
+    # these are timed with the ACF itself. nfreq is the number of lags here.
+    pf_timing_mark('kernel',
+                   npoints=acfres['itimes'].size,
+                   nfreq=acfres['lags'].size)
+
     xlags = acfres['lags']
 
     # smooth the ACF if requested
@@ -448,6 +465,7 @@ def macf_period_find(
     else:
         bestperiod = naivebestperiod
 
+    pf_timing_mark('peaks')
 
     return {'bestperiod':bestperiod,
             'bestlspval':bestlspval,
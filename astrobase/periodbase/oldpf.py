@@ -7,7 +7,7 @@ This contains deprecated and incomplete period-finding tools from periodbase.py:
 
 - dworetsky period finder
 - scipy LSP
-- townsend LSP
+- townsend LSP (see townsend_lsp for a vectorized period-finder version)
 
 Kept around just in case.
 
@@ -110,6 +110,10 @@ from scipy.signal import lombscargle, find_peaks_cwt
 from ..lcmath import phase_magseries, sigclip_magseries, time_bin_magseries, \
     phase_bin_magseries
 
+from . import get_shared_magseries, parallel_frequency_blocks, \
+    is_uniform_grid, iter_trig_recurrence, get_trig_block, get_nbestperiods, \
+    cached_periodfinder, pf_timing_mark
+
 
 ############
 ## CONFIG ##
@@ -363,6 +367,33 @@ def pdw_worker(task):
 
 
 
+def pdw_block_worker(task):
+    '''
+    This is the parallel worker for a block of frequencies.
+
+    task[0] = (times, modmags) or a SharedMagSeries ref to them
+    task[1] = block of frequencies
+    task[2] = fold_time
+    task[3] = j_range
+    task[4] = keep_threshold_1
+    task[5] = keep_threshold_2
+    task[6] = phasebinsize
+
+    Returns an array of (period, strlen, goodflag) rows, one per frequency.
+
+    '''
+
+    try:
+        times, modmags = get_shared_magseries(task[0])
+    except Exception as e:
+        LOGEXCEPTION('could not get the mag series for this DWP block')
+        return nparray([(1.0/x, npnan, False) for x in task[1]])
+
+    return nparray([pdw_worker((x, times, modmags) + tuple(task[2:]))
+                    for x in task[1]], dtype=np.float64)
+
+
+
 def pdw_period_find(times,
                     mags,
                     errs,
@@ -373,6 +404,7 @@ def pdw_period_find(times,
                     phasebinsize=None,
                     sigclip=10.0,
                     nworkers=None,
+                    sharedarrays=True,
                     verbose=False):
     '''This is the parallel version of the function above.
 
@@ -380,6 +412,9 @@ def pdw_period_find(times,
     time-series of magnitude measurements and associated magnitude errors. This
     can optionally bin in phase to try to speed up the calculation.
 
+    If sharedarrays is True, the mag series is placed in shared memory once and
+    the workers only get blocks of the frequency grid in their tasks.
+
     PARAMETERS:
 
     time: series of times at which mags were measured (usually some form of JD)
@@ -477,31 +512,24 @@ def pdw_period_find(times,
             sig_l = len(ftimes)/37.5
             keep_threshold_2 = l + 4.0*sig_l
 
-            # generate the tasks
-            tasks = [(x,
-                      ftimes,
-                      mod_mags,
-                      fold_time,
-                      j_range,
-                      keep_threshold_1,
-                      keep_threshold_2,
-                      phasebinsize) for x in frequencies]
-
-            # fire up the pool and farm out the tasks
-            if (not nworkers) or (nworkers > NCPUS):
-                nworkers = NCPUS
-                LOGINFO('using %s workers...' % nworkers)
-
-            pool = Pool(nworkers)
-            strlen_results = pool.map(pdw_worker, tasks)
-            pool.close()
-            pool.join()
-            del pool
-
-            periods, strlens, goodflags = zip(*strlen_results)
-            periods, strlens, goodflags = (np.array(periods),
-                                           np.array(strlens),
-                                           np.array(goodflags))
+            # fire up the pool and farm out the frequency blocks
+            strlen_results = parallel_frequency_blocks(
+                pdw_block_worker,
+                (ftimes, mod_mags),
+                frequencies,
+                extraargs=(fold_time,
+                           j_range,
+                           keep_threshold_1,
+                           keep_threshold_2,
+                           phasebinsize),
+                nworkers=nworkers,
+                sharedarrays=sharedarrays,
+                verbose=verbose
+            )
+
+            periods, strlens, goodflags = (strlen_results[:,0],
+                                           strlen_results[:,1],
+                                           strlen_results[:,2].astype(bool))
 
             strlensort = npargsort(strlens)
             nbeststrlens = strlens[strlensort[:5]]
@@ -549,17 +577,22 @@ def pdw_period_find(times,
 
 ##################################
 ## TOWNSEND LSP (Townsend 2010) ##
-## don't use this! - incomplete ##
 ##################################
 
-def townsend_lombscargle_value(times, mags, omega):
+def townsend_lombscargle_value(times, mags, omega,
+                               sin_omegat=None, cos_omegat=None):
     '''
     This calculates the periodogram value for each omega (= 2*pi*f). Mags must
     be normalized to zero with variance scaled to unity.
 
+    sin_omegat and cos_omegat are optional precomputed values of
+    sin(omega*times) and cos(omega*times), e.g. from iter_trig_recurrence.
+
     '''
-    cos_omegat = npcos(omega*times)
-    sin_omegat = npsin(omega*times)
+
+    if sin_omegat is None or cos_omegat is None:
+        cos_omegat = npcos(omega*times)
+        sin_omegat = npsin(omega*times)
 
     xc = npsum(mags*cos_omegat)
     xs = npsum(mags*sin_omegat)
@@ -606,14 +639,57 @@ def townsend_lombscargle_wrapper(task):
 
 
 
+def townsend_lombscargle_block_worker(task):
+    '''
+    This is the parallel worker for a block of omegas.
+
+    task[0] = (times, mags) or a SharedMagSeries ref to them
+    task[1] = block of omegas
+
+    If the block of omegas is uniform, the trig terms for each omega are
+    obtained using the trig recurrence in iter_trig_recurrence.
+
+    '''
+
+    try:
+        times, mags = get_shared_magseries(task[0])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
+
+    omegas = task[1]
+
+    if not is_uniform_grid(omegas):
+        return nparray([townsend_lombscargle_wrapper((times, mags, x))
+                        for x in omegas])
+
+    lsp = npfull_like(omegas, npnan)
+
+    for ind, sin_omegat, cos_omegat in iter_trig_recurrence(times, omegas):
+
+        try:
+            lsp[ind] = townsend_lombscargle_value(times, mags, omegas[ind],
+                                                  sin_omegat=sin_omegat,
+                                                  cos_omegat=cos_omegat)
+        except Exception as e:
+            pass
+
+    return lsp
+
+
+
 def parallel_townsend_lsp(times, mags, startp, endp,
                           stepsize=1.0e-4,
-                          nworkers=4):
+                          nworkers=4,
+                          sharedarrays=True):
     '''
     This calculates the Lomb-Scargle periodogram for the frequencies
     corresponding to the period interval (startp, endp) using a frequency step
     size of stepsize cycles/day. This uses the algorithm in Townsend 2010.
 
+    The workers get blocks of the frequency grid and use the trig recurrence
+    for uniform grids. If sharedarrays is True, the mag series is placed in
+    shared memory once instead of being sent along with each block.
+
     '''
 
     # make sure there are no nans anywhere
@@ -628,36 +704,228 @@ def parallel_townsend_lsp(times, mags, startp, endp,
     omegas = 2*np.pi*np.arange(startf, endf, stepsize)
 
     # parallel map the lsp calculations
-    if (not nworkers) or (nworkers > NCPUS):
-        nworkers = NCPUS
-        LOGINFO('using %s workers...' % nworkers)
+    lsp = parallel_frequency_blocks(townsend_lombscargle_block_worker,
+                                    (ftimes, nmags),
+                                    omegas,
+                                    nworkers=nworkers,
+                                    sharedarrays=sharedarrays)
 
-    pool = Pool(nworkers)
+    return np.array(omegas), np.array(lsp)
 
-    tasks = [(ftimes, nmags, x) for x in omegas]
-    lsp = pool.map(townsend_lombscargle_wrapper, tasks)
 
-    pool.close()
-    pool.join()
 
-    return np.array(omegas), np.array(lsp)
+def townsend_lombscargle_block(times, mags, omegas):
+    '''
+    This calculates the periodogram values for a block of omegas at once.
+
+    This evaluates the same sums as townsend_lombscargle_value, but for all
+    omegas in the block using (omegas.size x times.size) arrays of the trig
+    terms from get_trig_block. Mags must be normalized to zero with variance
+    scaled to unity.
+
+    '''
+
+    sin_omegat, cos_omegat = get_trig_block(times, omegas)
+
+    xc = cos_omegat.dot(mags)
+    xs = sin_omegat.dot(mags)
+
+    cs = npsum(cos_omegat*sin_omegat, axis=1)
+
+    cc = npsum(cos_omegat*cos_omegat, axis=1)
+    ss = npsum(sin_omegat*sin_omegat, axis=1)
+
+    tau = nparctan(2*cs/(cc - ss))/(2*omegas)
+
+    ctau = npcos(omegas*tau)
+    stau = npsin(omegas*tau)
+
+    leftsumtop = (ctau*xc + stau*xs)*(ctau*xc + stau*xs)
+    leftsumbot = ctau*ctau*cc + 2.0*ctau*stau*cs + stau*stau*ss
+    leftsum = leftsumtop/leftsumbot
+
+    rightsumtop = (ctau*xs - stau*xc)*(ctau*xs - stau*xc)
+    rightsumbot = ctau*ctau*ss - 2.0*ctau*stau*cs + stau*stau*cc
+    rightsum = rightsumtop/rightsumbot
+
+    return 0.5*(leftsum + rightsum)
+
+
+
+def townsend_lombscargle_vector_worker(task):
+    '''
+    This is the parallel worker for a block of omegas that calculates the
+    periodogram values for all of them at once.
+
+    task[0] = (times, mags) or a SharedMagSeries ref to them
+    task[1] = block of omegas
+
+    '''
+
+    try:
+        times, mags = get_shared_magseries(task[0])
+        return townsend_lombscargle_block(times, mags, task[1])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
 
 
 
 def parallel_townsend_lsp_sharedarray(times, mags, startp, endp,
                                       stepsize=1.0e-4,
-                                      nworkers=16):
+                                      nworkers=16,
+                                      blockmemory=32.0,
+                                      omegas=None):
     '''
-    This is a version of the above which uses shared ctypes arrays for the times
-    and mags arrays so as not to copy them to each worker process.
+    This is a version of parallel_townsend_lsp which puts the times and mags
+    arrays in shared memory so they're not copied to each worker process, and
+    evaluates each block of frequencies at once in the worker using
+    townsend_lombscargle_block.
+
+    blockmemory is the memory budget in MB for the 2D (nblockfreqs x
+    times.size) work arrays of a single block.
 
-    TODO: we'll need to pass a single argument to the worker so make a 2D array
-    and wrap the worker function with partial?
+    If omegas is not None, it's used as the grid of angular frequencies instead
+    of the one from startp, endp, and stepsize.
 
-    FIXME: implement this later.
+    Returns omegas, lsp like parallel_townsend_lsp.
 
     '''
 
+    # make sure there are no nans anywhere
+    finiteind = np.isfinite(times) & np.isfinite(mags)
+    ftimes, fmags = times[finiteind], mags[finiteind]
+
+    # renormalize the mags to zero and scale them so that the variance = 1
+    nmags = (fmags - np.median(fmags))/np.std(fmags)
+
+    if omegas is None:
+        startf = 1.0/endp
+        endf = 1.0/startp
+        omegas = 2*np.pi*np.arange(startf, endf, stepsize)
+
+    lsp = parallel_frequency_blocks(townsend_lombscargle_vector_worker,
+                                    (ftimes, nmags),
+                                    omegas,
+                                    nworkers=nworkers,
+                                    blockmemory=blockmemory,
+                                    narrays=4,
+                                    sharedarrays=True,
+                                    verbose=False)
+
+    return omegas, lsp
+
+
+
+@cached_periodfinder
+def townsend_lsp(times,
+                 mags,
+                 errs,
+                 magsarefluxes=False,
+                 startp=None,
+                 endp=None,
+                 nbestpeaks=5,
+                 periodepsilon=0.1, # 0.1
+                 stepsize=1.0e-4,
+                 nworkers=None,
+                 sigclip=10.0,
+                 blockmemory=32.0,
+                 verbose=True):
+    '''
+    This runs the Townsend (2010) LSP as a period-finder.
+
+    This has the same call signature and result dict as the other
+    period-finders, so it can be selected as the 'tls' method in
+    periodbase.LSPMETHODS and lcproc.PFMETHODS and compared with
+    scipylsp_parallel and periodbase.pgen_lsp. The periodogram is calculated
+    using parallel_townsend_lsp_sharedarray over the uniform frequency grid
+    arange(1/endp, 1/startp, stepsize). startp defaults to 0.1 day and endp to
+    the time-span of the mag series.
+
+    Returns a dict with the same keys as pgen_lsp and method = 'tls'.
+
+    '''
+
+    # get rid of nans first and sigclip
+    stimes, smags, serrs = sigclip_magseries(times,
+                                             mags,
+                                             errs,
+                                             magsarefluxes=magsarefluxes,
+                                             sigclip=sigclip)
+    pf_timing_mark('sigclip', npoints=stimes.size)
+
+    resultkwargs = {'startp':startp,
+                    'endp':endp,
+                    'stepsize':stepsize,
+                    'periodepsilon':periodepsilon,
+                    'nbestpeaks':nbestpeaks,
+                    'sigclip':sigclip}
+
+    # make sure there are enough points to calculate a spectrum
+    if len(stimes) > 9 and len(smags) > 9:
+
+        if not startp:
+            startp = 0.1
+        if not endp:
+            endp = stimes.max() - stimes.min()
+
+        omegas = 2*np.pi*np.arange(1.0/endp, 1.0/startp, stepsize)
+        pf_timing_mark('grid', nfreq=omegas.size)
+
+        omegas, lsp = parallel_townsend_lsp_sharedarray(
+            stimes, smags, startp, endp,
+            stepsize=stepsize,
+            nworkers=nworkers,
+            blockmemory=blockmemory,
+            omegas=omegas
+        )
+        periods = 2.0*np.pi/omegas
+        pf_timing_mark('kernel')
+
+        if verbose:
+            LOGINFO('using %s frequency points, start P = %.3f, end P = %.3f' %
+                    (omegas.size, startp, endp))
+
+        # find the nbestpeaks for the periodogram
+        bestpeaks = get_nbestperiods(lsp,
+                                     periods,
+                                     nbestpeaks=nbestpeaks,
+                                     periodepsilon=periodepsilon)
+
+        if bestpeaks is not None:
+
+            pf_timing_mark('peaks')
+
+            return {'bestperiod':bestpeaks['bestperiod'],
+                    'bestlspval':bestpeaks['bestlspval'],
+                    'nbestpeaks':nbestpeaks,
+                    'nbestlspvals':bestpeaks['nbestlspvals'],
+                    'nbestperiods':bestpeaks['nbestperiods'],
+                    'lspvals':lsp,
+                    'omegas':omegas,
+                    'periods':periods,
+                    'method':'tls',
+                    'kwargs':resultkwargs}
+
+        LOGERROR('no finite periodogram values '
+                 'for this mag series, skipping...')
+
+    else:
+
+        LOGERROR('no good detections for these times and mags, skipping...')
+
+    return {'bestperiod':npnan,
+            'bestlspval':npnan,
+            'nbestpeaks':nbestpeaks,
+            'nbestlspvals':None,
+            'nbestperiods':None,
+            'lspvals':None,
+            'omegas':None,
+            'periods':None,
+            'method':'tls',
+            'kwargs':resultkwargs}
+
+
+
 ############################################################
 ## SCIPY LOMB-SCARGLE (basically Townsend 2010 in Cython) ##
 ##     don't use this either - not fully implemented!     ##
@@ -76,7 +76,7 @@ def LOGEXCEPTION(message):
 ## IMPORTS ##
 #############
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 import numpy as np
 
 # import these to avoid lookup overhead
@@ -102,7 +102,10 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
 from ..lcmath import phase_magseries, sigclip_magseries, time_bin_magseries, \
     phase_bin_magseries
 
-from . import get_frequency_grid
+from . import get_frequency_grid, get_shared_magseries, \
+    parallel_frequency_blocks, get_phasebin_indices, get_batch_bincounts, \
+    coarse_to_fine_search, cached_periodfinder, \
+    pf_timing_mark
 
 
 ############
@@ -117,11 +120,21 @@ NCPUS = cpu_count()
 #####################################################
 
 def aov_theta(times, mags, errs, frequency,
-              binsize=0.05, minbin=9):
+              binsize=0.05, minbin=9, binstat='median'):
     '''Calculates the Schwarzenberg-Czerny AoV statistic at a test frequency.
 
+    binstat sets the statistic used for the central value of the mags in each
+    phase bin and for the whole mag series: 'median' or 'mean'.
+
     '''
 
+    if binstat == 'median':
+        binstatfunc = npmedian
+    elif binstat == 'mean':
+        binstatfunc = npmean
+    else:
+        raise ValueError("binstat must be one of 'median' or 'mean'")
+
     period = 1.0/frequency
     fold_time = times[0]
 
@@ -145,7 +158,7 @@ def aov_theta(times, mags, errs, frequency,
     binndets = []
     goodbins = 0
 
-    all_xbar = npmedian(pmags)
+    all_xbar = binstatfunc(pmags)
 
     for x in npunique(binnedphaseinds):
 
@@ -156,7 +169,7 @@ def aov_theta(times, mags, errs, frequency,
         if thisbin_mags.size > minbin:
 
             thisbin_ndet = thisbin_mags.size
-            thisbin_xbar = npmedian(thisbin_mags)
+            thisbin_xbar = binstatfunc(thisbin_mags)
 
             # get s1
             thisbin_s1_top = (
@@ -192,6 +205,99 @@ def aov_theta(times, mags, errs, frequency,
 
 
 
+def aov_theta_batch(times, mags, errs, frequencies,
+                    binsize=0.05, minbin=9, binstat='median', phases=None):
+    '''Calculates the Schwarzenberg-Czerny AoV statistic for a batch of test
+    frequencies at once.
+
+    This gives the same results as aov_theta, but doesn't sort the phased mag
+    series or loop over the phase bins. The number of points, the sum of the
+    mags, and the sum of the squared mags in each phase bin are obtained for all
+    frequencies in the batch using np.bincount.
+
+    binstat sets the statistic used for the central value of the mags in each
+    phase bin and for the whole mag series: 'median' or 'mean'. With 'mean',
+    everything comes from the bin sums. With 'median', the bin medians are
+    found by sorting the mags once, and then doing a stable sort of the (small
+    integer) bin indices for each frequency, which keeps the mags in each bin
+    in sorted order.
+
+    phases is an optional array of precomputed phases (see
+    get_phasebin_indices).
+
+    Returns an array of theta values, one per frequency.
+
+    '''
+
+    if binstat not in ('median', 'mean'):
+        raise ValueError("binstat must be one of 'median' or 'mean'")
+
+    ndets = times.size
+    binind, nbins = get_phasebin_indices(times, frequencies, binsize,
+                                         phases=phases)
+
+    if binstat == 'median':
+        all_xbar = npmedian(mags)
+    else:
+        all_xbar = npmean(mags)
+
+    cmags = mags - all_xbar
+
+    binndets = get_batch_bincounts(binind, nbins)
+    binsumsqs = get_batch_bincounts(binind, nbins, weights=cmags*cmags)
+
+    # only use bins with more than minbin points
+    goodbins = binndets > minbin
+    ngoodbins = npsum(goodbins, axis=1)
+
+    if binstat == 'median':
+
+        # sort the mags once, then do a stable sort of the bin indices for each
+        # frequency. this puts the mags in each bin together in sorted order.
+        magsort = npargsort(cmags)
+        sortedcmags = cmags[magsort]
+        binind = binind[:,magsort]
+
+        if nbins < 32767:
+            binind = binind.astype(np.int16)
+
+        # mergesort is a stable sort
+        binsorted = sortedcmags[np.argsort(binind, axis=1, kind='mergesort')]
+
+        # the start of each bin in the sorted rows. bin 0 is always empty.
+        binstarts = np.cumsum(binndets, axis=1) - binndets
+
+        lowind = np.clip(binstarts + (binndets - 1)//2, 0, ndets - 1)
+        highind = np.clip(binstarts + binndets//2, 0, ndets - 1)
+        rowind = nparange(binsorted.shape[0])[:,None]
+
+        # this is thisbin_xbar - all_xbar
+        binxbars = 0.5*(binsorted[rowind, lowind] + binsorted[rowind, highind])
+
+    else:
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            binxbars = (get_batch_bincounts(binind, nbins, weights=cmags) /
+                        binndets)
+
+    # get the s1 and s2 tops for the good bins
+    bin_s1_tops = npwhere(goodbins, binndets*binxbars*binxbars, 0.0)
+    bin_s2_tops = npwhere(goodbins, binsumsqs, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        # calculate s1 first
+        s1 = npsum(bin_s1_tops, axis=1)/(ngoodbins - 1.0)
+
+        # then calculate s2
+        s2 = npsum(bin_s2_tops, axis=1)/(ndets - ngoodbins)
+
+        theta_aov = s1/s2
+
+    return theta_aov
+
+
+
 def aov_worker(task):
     '''
     This is a parallel worker for the function below.
@@ -202,15 +308,17 @@ def aov_worker(task):
     task[3] = frequency
     task[4] = binsize
     task[5] = minbin
+    task[6] = binstat (optional, 'median' by default)
 
     '''
 
-    times, mags, errs, frequency, binsize, minbin = task
+    times, mags, errs, frequency, binsize, minbin = task[:6]
+    binstat = task[6] if len(task) > 6 else 'median'
 
     try:
 
         theta = aov_theta(times, mags, errs, frequency,
-                          binsize=binsize, minbin=minbin)
+                          binsize=binsize, minbin=minbin, binstat=binstat)
 
         return theta
 
@@ -219,7 +327,31 @@ def aov_worker(task):
         return npnan
 
 
+def aov_block_worker(task):
+    '''
+    This is a parallel worker for a block of frequencies.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = block of frequencies
+    task[2] = binsize
+    task[3] = minbin
+    task[4] = binstat
+
+    This uses the batched kernel aov_theta_batch.
+
+    '''
+
+    try:
+        times, mags, errs = get_shared_magseries(task[0])
+        return aov_theta_batch(times, mags, errs, task[1],
+                               binsize=task[2], minbin=task[3],
+                               binstat=task[4])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
 
+
+
+@cached_periodfinder
 def aov_periodfind(times,
                    mags,
                    errs,
@@ -231,16 +363,45 @@ def aov_periodfind(times,
                    stepsize=1.0e-4,
                    phasebinsize=0.05,
                    mindetperbin=9,
+                   binstat='median',
                    nbestpeaks=5,
                    periodepsilon=0.1, # 0.1
                    sigclip=10.0,
                    nworkers=None,
+                   sharedarrays=True,
+                   executor=None,
+                   coarsetofine=False,
+                   coarsefactor=3,
+                   coarsenpeaks=10,
+                   precomputed=None,
                    verbose=True):
     '''This runs a parallel AoV period search.
 
     NOTE: normalize = True here as recommended by Schwarzenberg-Czerny 1996,
     i.e. mags will be normalized to zero and rescaled so their variance = 1.0
 
+    binstat is the statistic used for the central value of the mags in each
+    phase bin: 'median' (the default) or 'mean' (the classic AoV).
+
+    If sharedarrays is True, the cleaned mag series is placed in shared memory
+    once and the workers only get blocks of the frequency grid in their tasks.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
+    If coarsetofine is True, the periodogram is first calculated on a coarse
+    grid made of every coarsefactor-th frequency, and then at full resolution
+    around the best coarsenpeaks peaks and their aliases only (see
+    periodbase.coarse_to_fine_search). The lspvals and periods returned are
+    then on this merged grid, and the 'coarsetofine' key in the returned dict
+    gives the number of periodogram evaluations saved.
+
+    precomputed is used by periodbase.fused_periodfind. If it's not None, it's
+    a dict with 'frequencies' and 'lspvals' keys for a periodogram that was
+    already calculated for the cleaned mag series. These are used as is
+    instead of running the period-finder kernel here.
+
     '''
 
     # get rid of nans first and sigclip
@@ -249,6 +410,7 @@ def aov_periodfind(times,
                                              errs,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
+    pf_timing_mark('sigclip', npoints=stimes.size)
 
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
@@ -288,14 +450,6 @@ def aov_periodfind(times,
                      1.0/frequencies.min())
                 )
 
-        # map to parallel workers
-        if (not nworkers) or (nworkers > NCPUS):
-            nworkers = NCPUS
-            if verbose:
-                LOGINFO('using %s workers...' % nworkers)
-
-        pool = Pool(nworkers)
-
         # renormalize the working mags to zero and scale them so that the
         # variance = 1 for use with our LSP functions
         if normalize:
@@ -303,17 +457,39 @@ def aov_periodfind(times,
         else:
             nmags = smags
 
-        tasks = [(stimes, nmags, serrs, x, phasebinsize, mindetperbin)
-                 for x in frequencies]
-
-        lsp = pool.map(aov_worker, tasks)
+        pf_timing_mark('grid', nfreq=frequencies.size)
+
+        # this calculates the periodogram for an array of frequencies
+        def lspfunc(lspfreqs):
+            return parallel_frequency_blocks(
+                aov_block_worker,
+                (stimes, nmags, serrs),
+                lspfreqs,
+                extraargs=(phasebinsize, mindetperbin, binstat),
+                nworkers=nworkers,
+                narrays=6,
+                sharedarrays=sharedarrays,
+                executor=executor,
+                verbose=verbose
+            )
 
-        pool.close()
-        pool.join()
-        del pool
+        if precomputed is not None:
+            frequencies = precomputed['frequencies']
+            lsp, ctfinfo = precomputed['lspvals'], None
+        elif coarsetofine:
+            frequencies, lsp, ctfinfo = coarse_to_fine_search(
+                lspfunc,
+                frequencies,
+                coarsefactor=coarsefactor,
+                npeaks=coarsenpeaks,
+                verbose=verbose
+            )
+        else:
+            lsp, ctfinfo = lspfunc(frequencies), None
 
         lsp = nparray(lsp)
         periods = 1.0/frequencies
+        pf_timing_mark('kernel')
 
         # find the nbestpeaks for the periodogram: 1. sort the lsp array by
         # highest value first 2. go down the values until we find five
@@ -347,6 +523,7 @@ def aov_periodfind(times,
                               'normalize':normalize,
                               'phasebinsize':phasebinsize,
                               'mindetperbin':mindetperbin,
+                              'binstat':binstat,
                               'autofreq':autofreq,
                               'periodepsilon':periodepsilon,
                               'nbestpeaks':nbestpeaks,
@@ -389,6 +566,7 @@ def aov_periodfind(times,
 
             prevperiod = period
 
+        pf_timing_mark('peaks')
 
         return {'bestperiod':finperiods[bestperiodind],
                 'bestlspval':finlsp[bestperiodind],
@@ -397,6 +575,7 @@ def aov_periodfind(times,
                 'nbestperiods':nbestperiods,
                 'lspvals':lsp,
                 'periods':periods,
+                'coarsetofine':ctfinfo,
                 'method':'aov',
                 'kwargs':{'startp':startp,
                           'endp':endp,
@@ -404,6 +583,7 @@ def aov_periodfind(times,
                           'normalize':normalize,
                           'phasebinsize':phasebinsize,
                           'mindetperbin':mindetperbin,
+                          'binstat':binstat,
                           'autofreq':autofreq,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
@@ -426,6 +606,7 @@ def aov_periodfind(times,
                           'normalize':normalize,
                           'phasebinsize':phasebinsize,
                           'mindetperbin':mindetperbin,
+                          'binstat':binstat,
                           'autofreq':autofreq,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
@@ -77,7 +77,7 @@ def LOGEXCEPTION(message):
 ## IMPORTS ##
 #############
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 import numpy as np
 
 # import these to avoid lookup overhead
@@ -103,7 +103,10 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
 from ..lcmath import phase_magseries_with_errs, sigclip_magseries, \
     time_bin_magseries, phase_bin_magseries
 
-from . import get_frequency_grid
+from . import get_frequency_grid, get_shared_magseries, \
+    parallel_frequency_blocks, is_uniform_grid, iter_trig_recurrence, \
+    get_trig_block, coarse_to_fine_search, cached_periodfinder, \
+    pf_timing_mark
 
 
 ############
@@ -119,7 +122,8 @@ NCPUS = cpu_count()
 
 
 def aovhm_theta(times, mags, errs, frequency,
-                       nharmonics, magvariance):
+                       nharmonics, magvariance,
+                       sin_phase=None, cos_phase=None):
     '''This calculates the harmonic AoV theta for a frequency.
 
     Schwarzenberg-Czerny 1996 equation 11:
@@ -141,6 +145,13 @@ def aovhm_theta(times, mags, errs, frequency,
     magvariance is the (weighted by errors) variance of the magnitude time
     series.
 
+    sin_phase and cos_phase are optional precomputed values of
+    sin(2.0*pi*frequency*(times - times[0])) and cos(...) of the same. If these
+    are provided, they're used instead of phasing the mag series at this
+    frequency (the sums below don't depend on the order of the points, so the
+    phased series doesn't need to be sorted). aovhm_block_worker uses this to
+    get them from the trig recurrence for uniform frequency grids.
+
     This is a mostly faithful translation of the inner loop in aovper.f90.
 
     See http://users.camk.edu.pl/alex/ and Schwarzenberg-Czerny (1996).
@@ -149,36 +160,51 @@ def aovhm_theta(times, mags, errs, frequency,
 
     '''
 
-    period = 1.0/frequency
-
     ndet = times.size
     two_nharmonics = nharmonics + nharmonics
 
-    # phase with test period
-    phasedseries = phase_magseries_with_errs(
-        times, mags, errs, period, times[0],
-        sort=True, wrap=False
-    )
+    if sin_phase is not None and cos_phase is not None:
 
-    # get the phased quantities
-    phase = phasedseries['phase']
-    pmags = phasedseries['mags']
-    perrs = phasedseries['errs']
+        pmags, perrs = mags, errs
 
-    # this is sqrt(1.0/errs^2) -> the weights
-    pweights = 1.0/perrs
+        # this is sqrt(1.0/errs^2) -> the weights
+        pweights = 1.0/perrs
 
-    # multiply by 2.0*PI (for omega*time)
-    phase = phase * 2.0 * MPI
+        # this is the z complex vector
+        z = cos_phase + 1.0j*sin_phase
 
-    # this is the z complex vector
-    z = np.cos(phase) + 1.0j*np.sin(phase)
+        # this is the psi complex vector
+        psi = pmags * pweights * (z**nharmonics)
 
-    # multiply phase with N
-    phase = nharmonics * phase
+    else:
+
+        period = 1.0/frequency
+
+        # phase with test period
+        phasedseries = phase_magseries_with_errs(
+            times, mags, errs, period, times[0],
+            sort=True, wrap=False
+        )
 
-    # this is the psi complex vector
-    psi = pmags * pweights * (np.cos(phase) + 1j*np.sin(phase))
+        # get the phased quantities
+        phase = phasedseries['phase']
+        pmags = phasedseries['mags']
+        perrs = phasedseries['errs']
+
+        # this is sqrt(1.0/errs^2) -> the weights
+        pweights = 1.0/perrs
+
+        # multiply by 2.0*PI (for omega*time)
+        phase = phase * 2.0 * MPI
+
+        # this is the z complex vector
+        z = np.cos(phase) + 1.0j*np.sin(phase)
+
+        # multiply phase with N
+        phase = nharmonics * phase
+
+        # this is the psi complex vector
+        psi = pmags * pweights * (np.cos(phase) + 1j*np.sin(phase))
 
     # this is the initial value of z^n
     zn = 1.0 + 0.0j
@@ -229,6 +255,141 @@ def aovhm_theta(times, mags, errs, frequency,
 
 
 
+def aovhm_theta_batch(times, mags, errs, frequencies,
+                      nharmonics, magvariance,
+                      batchpoints=8192,
+                      trig=None):
+    '''This calculates the harmonic AoV theta for a batch of frequencies.
+
+    This runs the same orthogonal polynomial recurrence as aovhm_theta, but for
+    several frequencies at once using 2D (nfrequencies x times.size) complex
+    arrays. The phased mag series isn't sorted because none of the sums depend
+    on the order of the points. The z vectors come from get_trig_block, which
+    uses the trig recurrence for uniform frequency grids. The work arrays are
+    allocated once and reused for all of the harmonics.
+
+    The recurrence makes many passes over the work arrays, so it's limited by
+    memory bandwidth if they don't fit into the CPU cache. The frequencies are
+    therefore processed in sub-batches of about batchpoints/times.size
+    frequencies at a time.
+
+    trig is an optional tuple of precomputed (sin_phase, cos_phase) arrays for
+    2.0*pi*frequencies*(times - times[0]), e.g. from get_trig_block. This is
+    used by fused_periodfind to share these between several period-finders.
+
+    Returns an array of theta values, one per frequency. Unlike aovhm_theta,
+    these are real values (the imaginary parts of the complex sums here are
+    only rounding noise).
+
+    '''
+
+    nbatch = max(1, int(batchpoints/times.size))
+
+    if trig is None:
+        return np.concatenate([
+            _aovhm_theta_subbatch(times, mags, errs,
+                                  frequencies[x:x+nbatch],
+                                  nharmonics, magvariance)
+            for x in range(0, frequencies.size, nbatch)
+        ])
+    else:
+        return np.concatenate([
+            _aovhm_theta_subbatch(times, mags, errs,
+                                  frequencies[x:x+nbatch],
+                                  nharmonics, magvariance,
+                                  sin_phase=trig[0][x:x+nbatch],
+                                  cos_phase=trig[1][x:x+nbatch])
+            for x in range(0, frequencies.size, nbatch)
+        ])
+
+
+
+def _aovhm_theta_subbatch(times, mags, errs, frequencies,
+                          nharmonics, magvariance,
+                          sin_phase=None, cos_phase=None):
+    '''This runs the harmonic AoV recurrence for a sub-batch of frequencies.
+
+    This is used by aovhm_theta_batch above.
+
+    '''
+
+    ndet = times.size
+    two_nharmonics = nharmonics + nharmonics
+
+    # this is sqrt(1.0/errs^2) -> the weights
+    pweights = 1.0/errs
+
+    # this is the z complex vector for each frequency
+    if sin_phase is None or cos_phase is None:
+        sin_phase, cos_phase = get_trig_block(times - times[0],
+                                              2.0*MPI*frequencies)
+    z = cos_phase + 1.0j*sin_phase
+    del sin_phase, cos_phase
+
+    # this is pweights*z, used for the alpha_n numerator
+    wz = pweights*z
+
+    # this is the psi complex vector for each frequency
+    psi = np.power(z, nharmonics)
+    psi *= mags*pweights
+
+    # this is the initial value of z^n
+    zn = np.ones_like(z)
+
+    # this is the initial value of phi
+    phi = npempty(z.shape, dtype=np.complex128)
+    phi[:] = pweights
+
+    # the work arrays
+    phiconj = npempty(z.shape, dtype=np.complex128)
+    workarr = npempty(z.shape, dtype=np.complex128)
+
+    # initialize theta to zero
+    theta_aov = np.zeros(frequencies.size)
+
+    # go through all the harmonics now up to 2N
+    for n in range(two_nharmonics):
+
+        np.conjugate(phi, out=phiconj)
+
+        # this is <phi, phi> = sum(phi.real^2 + phi.imag^2)
+        phiview = phi.view(np.float64)
+        phi_dot_phi = np.einsum('ij,ij->i', phiview, phiview)
+
+        # this is the alpha_n numerator
+        alpha = np.einsum('ij,ij->i', wz, phi)
+
+        # this is <phi, psi> (with the complex conjugate of phi)
+        phi_dot_psi = np.einsum('ij,ij->i', phiconj, psi)
+
+        # make sure phi_dot_phi is not zero
+        phi_dot_phi = np.maximum(phi_dot_phi, 10.0e-9)
+
+        # this is the expression for alpha_n
+        alpha = alpha / phi_dot_phi
+
+        # update theta_aov for this harmonic
+        theta_aov += npabs(phi_dot_psi) * npabs(phi_dot_psi) / phi_dot_phi
+
+        # use the recurrence relation to find the next phi
+        np.multiply(zn, phiconj, out=workarr)
+        workarr *= alpha[:,None]
+        phi *= z
+        phi -= workarr
+
+        # update z^n
+        zn *= z
+
+    # done with all harmonics, calculate the theta_aov for each freq
+    # the max below makes sure that magvariance - theta_aov > zero
+    theta_aov = ( (ndet - two_nharmonics - 1.0) * theta_aov /
+                  (two_nharmonics * np.maximum(magvariance - theta_aov,
+                                               1.0e-9)) )
+
+    return theta_aov
+
+
+
 def aovhm_theta_worker(task):
     '''
     This is a parallel worker for the function below.
@@ -256,7 +417,70 @@ def aovhm_theta_worker(task):
         return npnan
 
 
+def aovhm_block_worker(task):
+    '''
+    This is a parallel worker for a block of frequencies.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = block of frequencies
+    task[2] = nharmonics
+    task[3] = magvariance
+    task[4] = batchkernel (optional, True by default)
+
+    If batchkernel is True, this uses the batched kernel aovhm_theta_batch.
 
+    Otherwise, this runs aovhm_theta for each frequency. If the block of
+    frequencies is uniform, the phase terms for each frequency are obtained
+    using the trig recurrence in iter_trig_recurrence.
+
+    Both kernels return real theta values.
+
+    '''
+
+    try:
+        times, mags, errs = get_shared_magseries(task[0])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
+
+    frequencies, nharmonics, magvariance = task[1], task[2], task[3]
+    batchkernel = task[4] if len(task) > 4 else True
+
+    if batchkernel:
+        try:
+            return aovhm_theta_batch(times, mags, errs, frequencies,
+                                     nharmonics, magvariance)
+        except Exception as e:
+            return npfull_like(frequencies, npnan)
+
+    # aovhm_theta returns complex values with imaginary parts that are only
+    # rounding noise, so keep the real parts like aovhm_theta_batch does
+    if not is_uniform_grid(frequencies):
+        return np.real(nparray([aovhm_theta_worker((times, mags, errs,
+                                                    x, nharmonics,
+                                                    magvariance))
+                                for x in frequencies]))
+
+    thetas = npfull_like(frequencies, npnan, dtype=np.float64)
+
+    for ind, sin_phase, cos_phase in iter_trig_recurrence(
+            times - times[0],
+            2.0*MPI*frequencies
+    ):
+
+        try:
+            thetas[ind] = np.real(aovhm_theta(times, mags, errs,
+                                              frequencies[ind],
+                                              nharmonics, magvariance,
+                                              sin_phase=sin_phase,
+                                              cos_phase=cos_phase))
+        except Exception as e:
+            pass
+
+    return thetas
+
+
+
+@cached_periodfinder
 def aovhm_periodfind(times,
                      mags,
                      errs,
@@ -271,12 +495,42 @@ def aovhm_periodfind(times,
                      periodepsilon=0.1, # 0.1
                      sigclip=10.0,
                      nworkers=None,
+                     sharedarrays=True,
+                     executor=None,
+                     coarsetofine=False,
+                     coarsefactor=3,
+                     coarsenpeaks=10,
+                     batchkernel=True,
+                     precomputed=None,
                      verbose=True):
     '''This runs a parallel AoV period search.
 
     NOTE: normalize = True here as recommended by Schwarzenberg-Czerny 1996,
     i.e. mags will be normalized to zero and rescaled so their variance = 1.0
 
+    If sharedarrays is True, the cleaned mag series is placed in shared memory
+    once and the workers only get blocks of the frequency grid in their tasks.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
+    If batchkernel is True, the workers calculate theta for their whole block
+    of frequencies at once using aovhm_theta_batch. If it's False, they go
+    through the frequencies one at a time using aovhm_theta.
+
+    If coarsetofine is True, the periodogram is first calculated on a coarse
+    grid made of every coarsefactor-th frequency, and then at full resolution
+    around the best coarsenpeaks peaks and their aliases only (see
+    periodbase.coarse_to_fine_search). The lspvals and periods returned are
+    then on this merged grid, and the 'coarsetofine' key in the returned dict
+    gives the number of periodogram evaluations saved.
+
+    precomputed is used by periodbase.fused_periodfind. If it's not None, it's
+    a dict with 'frequencies' and 'lspvals' keys for a periodogram that was
+    already calculated for the cleaned mag series. These are used as is
+    instead of running the period-finder kernel here.
+
     '''
 
     # get rid of nans first and sigclip
@@ -285,6 +539,7 @@ def aovhm_periodfind(times,
                                              errs,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
+    pf_timing_mark('sigclip', npoints=stimes.size)
 
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
@@ -324,14 +579,6 @@ def aovhm_periodfind(times,
                      1.0/frequencies.min())
                 )
 
-        # map to parallel workers
-        if (not nworkers) or (nworkers > NCPUS):
-            nworkers = NCPUS
-            if verbose:
-                LOGINFO('using %s workers...' % nworkers)
-
-        pool = Pool(nworkers)
-
         # renormalize the working mags to zero and scale them so that the
         # variance = 1 for use with our LSP functions
         if normalize:
@@ -345,17 +592,38 @@ def aovhm_periodfind(times,
         magvariance_bot = (nmags.size - 1)*npsum(1.0/(serrs*serrs)) / nmags.size
         magvariance = magvariance_top/magvariance_bot
 
-        tasks = [(stimes, nmags, serrs, x, nharmonics, magvariance)
-                 for x in frequencies]
-
-        lsp = pool.map(aovhm_theta_worker, tasks)
+        pf_timing_mark('grid', nfreq=frequencies.size)
+
+        # this calculates the periodogram for an array of frequencies
+        def lspfunc(lspfreqs):
+            return parallel_frequency_blocks(
+                aovhm_block_worker,
+                (stimes, nmags, serrs),
+                lspfreqs,
+                extraargs=(nharmonics, magvariance, batchkernel),
+                nworkers=nworkers,
+                sharedarrays=sharedarrays,
+                executor=executor,
+                verbose=verbose
+            )
 
-        pool.close()
-        pool.join()
-        del pool
+        if precomputed is not None:
+            frequencies = precomputed['frequencies']
+            lsp, ctfinfo = precomputed['lspvals'], None
+        elif coarsetofine:
+            frequencies, lsp, ctfinfo = coarse_to_fine_search(
+                lspfunc,
+                frequencies,
+                coarsefactor=coarsefactor,
+                npeaks=coarsenpeaks,
+                verbose=verbose
+            )
+        else:
+            lsp, ctfinfo = lspfunc(frequencies), None
 
         lsp = nparray(lsp)
         periods = 1.0/frequencies
+        pf_timing_mark('kernel')
 
         # find the nbestpeaks for the periodogram: 1. sort the lsp array by
         # highest value first 2. go down the values until we find five
@@ -430,6 +698,7 @@ def aovhm_periodfind(times,
 
             prevperiod = period
 
+        pf_timing_mark('peaks')
 
         return {'bestperiod':finperiods[bestperiodind],
                 'bestlspval':finlsp[bestperiodind],
@@ -438,6 +707,7 @@ def aovhm_periodfind(times,
                 'nbestperiods':nbestperiods,
                 'lspvals':lsp,
                 'periods':periods,
+                'coarsetofine':ctfinfo,
                 'method':'mav',
                 'kwargs':{'startp':startp,
                           'endp':endp,
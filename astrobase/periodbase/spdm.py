@@ -76,7 +76,7 @@ def LOGEXCEPTION(message):
 ## IMPORTS ##
 #############
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 import numpy as np
 
 # import these to avoid lookup overhead
@@ -102,7 +102,10 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
 from ..lcmath import phase_magseries, sigclip_magseries, time_bin_magseries, \
     phase_bin_magseries
 
-from . import get_frequency_grid
+from . import get_frequency_grid, get_shared_magseries, \
+    parallel_frequency_blocks, get_phasebin_indices, get_batch_bincounts, \
+    coarse_to_fine_search, cached_periodfinder, \
+    pf_timing_mark
 
 
 ############
@@ -169,6 +172,59 @@ def stellingwerf_pdm_theta(times, mags, errs, frequency,
 
 
 
+def stellingwerf_pdm_theta_batch(times, mags, errs, frequencies,
+                                 binsize=0.05, minbin=9, phases=None):
+    '''
+    This calculates the Stellingwerf PDM theta values for a batch of test
+    frequencies at once.
+
+    This gives the same results as stellingwerf_pdm_theta, but doesn't sort the
+    phased mag series or loop over the phase bins. The number of points, the
+    sum of the mags, and the sum of the squared mags in each phase bin are
+    obtained for all frequencies in the batch using np.bincount, and the bin
+    variances are calculated from these.
+
+    phases is an optional array of precomputed phases (see
+    get_phasebin_indices).
+
+    Returns an array of theta values, one per frequency.
+
+    '''
+
+    binind, nbins = get_phasebin_indices(times, frequencies, binsize,
+                                         phases=phases)
+
+    # the variances don't depend on the mean, so take it out to keep the sums
+    # of squares well-conditioned
+    cmags = mags - npmean(mags)
+
+    binndets = get_batch_bincounts(binind, nbins)
+    binsums = get_batch_bincounts(binind, nbins, weights=cmags)
+    binsumsqs = get_batch_bincounts(binind, nbins, weights=cmags*cmags)
+
+    # only use bins with more than minbin points
+    goodbins = binndets > minbin
+    ngoodbins = npsum(goodbins, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        # this is binvariance*(binndet - 1)
+        binsumsqdevs = npwhere(goodbins,
+                               binsumsqs - binsums*binsums/binndets,
+                               0.0)
+
+        theta_top = (
+            npsum(binsumsqdevs, axis=1) /
+            (npsum(npwhere(goodbins, binndets, 0.0), axis=1) - ngoodbins)
+        )
+
+    theta_bot = npvar(mags,ddof=1)
+    theta = theta_top/theta_bot
+
+    return theta
+
+
+
 def stellingwerf_pdm_worker(task):
     '''
     This is a parallel worker for the function below.
@@ -196,7 +252,29 @@ def stellingwerf_pdm_worker(task):
         return npnan
 
 
+def stellingwerf_pdm_block_worker(task):
+    '''
+    This is a parallel worker for a block of frequencies.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = block of frequencies
+    task[2] = binsize
+    task[3] = minbin
+
+    This uses the batched kernel stellingwerf_pdm_theta_batch.
 
+    '''
+
+    try:
+        times, mags, errs = get_shared_magseries(task[0])
+        return stellingwerf_pdm_theta_batch(times, mags, errs, task[1],
+                                            binsize=task[2], minbin=task[3])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
+
+
+
+@cached_periodfinder
 def stellingwerf_pdm(times,
                      mags,
                      errs,
@@ -212,9 +290,34 @@ def stellingwerf_pdm(times,
                      periodepsilon=0.1, # 0.1
                      sigclip=10.0,
                      nworkers=None,
+                     sharedarrays=True,
+                     executor=None,
+                     coarsetofine=False,
+                     coarsefactor=3,
+                     coarsenpeaks=10,
+                     precomputed=None,
                      verbose=True):
     '''This runs a parallel Stellingwerf PDM period search.
 
+    If sharedarrays is True, the cleaned mag series is placed in shared memory
+    once and the workers only get blocks of the frequency grid in their tasks.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
+    If coarsetofine is True, the periodogram is first calculated on a coarse
+    grid made of every coarsefactor-th frequency, and then at full resolution
+    around the best coarsenpeaks peaks and their aliases only (see
+    periodbase.coarse_to_fine_search). The lspvals and periods returned are
+    then on this merged grid, and the 'coarsetofine' key in the returned dict
+    gives the number of periodogram evaluations saved.
+
+    precomputed is used by periodbase.fused_periodfind. If it's not None, it's
+    a dict with 'frequencies' and 'lspvals' keys for a periodogram that was
+    already calculated for the cleaned mag series. These are used as is
+    instead of running the period-finder kernel here.
+
     '''
 
     # get rid of nans first and sigclip
@@ -223,6 +326,7 @@ def stellingwerf_pdm(times,
                                              errs,
                                              magsarefluxes=magsarefluxes,
                                              sigclip=sigclip)
+    pf_timing_mark('sigclip', npoints=stimes.size)
 
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
@@ -262,14 +366,6 @@ def stellingwerf_pdm(times,
                      1.0/frequencies.min())
                 )
 
-        # map to parallel workers
-        if (not nworkers) or (nworkers > NCPUS):
-            nworkers = NCPUS
-            if verbose:
-                LOGINFO('using %s workers...' % nworkers)
-
-        pool = Pool(nworkers)
-
         # renormalize the working mags to zero and scale them so that the
         # variance = 1 for use with our LSP functions
         if normalize:
@@ -277,17 +373,40 @@ def stellingwerf_pdm(times,
         else:
             nmags = smags
 
-        tasks = [(stimes, nmags, serrs, x, phasebinsize, mindetperbin)
-                 for x in frequencies]
-
-        lsp = pool.map(stellingwerf_pdm_worker, tasks)
+        pf_timing_mark('grid', nfreq=frequencies.size)
+
+        # this calculates the periodogram for an array of frequencies
+        def lspfunc(lspfreqs):
+            return parallel_frequency_blocks(
+                stellingwerf_pdm_block_worker,
+                (stimes, nmags, serrs),
+                lspfreqs,
+                extraargs=(phasebinsize, mindetperbin),
+                nworkers=nworkers,
+                narrays=6,
+                sharedarrays=sharedarrays,
+                executor=executor,
+                verbose=verbose
+            )
 
-        pool.close()
-        pool.join()
-        del pool
+        if precomputed is not None:
+            frequencies = precomputed['frequencies']
+            lsp, ctfinfo = precomputed['lspvals'], None
+        elif coarsetofine:
+            frequencies, lsp, ctfinfo = coarse_to_fine_search(
+                lspfunc,
+                frequencies,
+                coarsefactor=coarsefactor,
+                npeaks=coarsenpeaks,
+                minimize=True,
+                verbose=verbose
+            )
+        else:
+            lsp, ctfinfo = lspfunc(frequencies), None
 
         lsp = nparray(lsp)
         periods = 1.0/frequencies
+        pf_timing_mark('kernel')
 
         # find the nbestpeaks for the periodogram: 1. sort the lsp array by
         # lowest value first 2. go down the values until we find five values
@@ -365,6 +484,7 @@ def stellingwerf_pdm(times,
 
             prevperiod = period
 
+        pf_timing_mark('peaks')
 
         return {'bestperiod':finperiods[bestperiodind],
                 'bestlspval':finlsp[bestperiodind],
@@ -373,6 +493,7 @@ def stellingwerf_pdm(times,
                 'nbestperiods':nbestperiods,
                 'lspvals':lsp,
                 'periods':periods,
+                'coarsetofine':ctfinfo,
                 'method':'pdm',
                 'kwargs':{'startp':startp,
                           'endp':endp,
@@ -79,6 +79,11 @@ def LOGEXCEPTION(message):
 from multiprocessing import Pool, cpu_count
 import numpy as np
 
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
 # import these to avoid lookup overhead
 from numpy import nan as npnan, sum as npsum, abs as npabs, \
     roll as nproll, isfinite as npisfinite, std as npstd, \
@@ -92,7 +97,8 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
     arctan as nparctan, nanargmax as npnanargmax, nanargmin as npnanargmin, \
     empty as npempty, ceil as npceil, mean as npmean, \
     digitize as npdigitize, unique as npunique, \
-    argmax as npargmax, argmin as npargmin, zeros as npzeros, nanmax as npnanmax
+    argmax as npargmax, argmin as npargmin, zeros as npzeros, \
+    nanmax as npnanmax, full as npfull
 
 
 ###################
@@ -100,9 +106,12 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
 ###################
 
 from ..lcmath import phase_magseries, sigclip_magseries, time_bin_magseries, \
-    phase_bin_magseries
+    phase_bin_magseries, sigclip_magseries_batch_mask, sigclip_magseries_mask
 
-from . import get_frequency_grid
+from . import get_frequency_grid, get_shared_magseries, \
+    parallel_frequency_blocks, get_nbestperiods, get_trig_block, \
+    coarse_to_fine_search, cached_periodfinder, pf_timing_mark, \
+    pf_timing_stage, timed_periodfinder
 
 
 ############
@@ -289,6 +298,313 @@ def specwindow_lsp_value(times, mags, errs, omega):
     return lspval
 
 
+
+#########################################################
+## PERIODOGRAM VALUE EXPRESSIONS FOR A BLOCK OF OMEGAS ##
+#########################################################
+
+def _glsp_block_sums(times, mags, errs, omegas, trig=None):
+    '''This calculates the GLS sums for a block of omegas at once.
+
+    This does the same calculations as generalized_lsp_value, but uses 2D
+    (omegas.size x times.size) arrays for the trig terms and matrix-vector
+    products for the sums over the observations. If the omegas are a uniform
+    grid, the trig terms are obtained using the recurrence in get_trig_block.
+
+    trig is an optional tuple of precomputed (sin_omegat, cos_omegat) arrays.
+    These aren't changed here. The GLS doesn't depend on the zero point of the
+    times, so these can also be for times - times[0] like the ones that
+    fused_periodfind shares between several period-finders.
+
+    Returns YY, YC, YS, CC, SS, CS, each an array with omegas.size elements.
+
+    '''
+
+    one_over_errs2 = 1.0/(errs*errs)
+
+    W = npsum(one_over_errs2)
+    wi = one_over_errs2/W
+    wimags = wi*mags
+
+    # for uniform grids of omegas, this uses the trig recurrence
+    if trig is None:
+        sin_omegat, cos_omegat = get_trig_block(times, omegas)
+        sincos_work, coscos_work = sin_omegat, cos_omegat
+    else:
+        sin_omegat, cos_omegat = trig
+        sincos_work = npempty(sin_omegat.shape)
+        coscos_work = sincos_work
+
+    # calculate some more sums and terms
+    Y = npsum(wimags)
+    C = np.dot(cos_omegat, wi)
+    S = np.dot(sin_omegat, wi)
+
+    YpY = npsum(wimags*mags)
+
+    YpC = np.dot(cos_omegat, wimags)
+    YpS = np.dot(sin_omegat, wimags)
+
+    # reuse the sin array for the cross-term if we calculated it here
+    CpS = np.dot(np.multiply(sin_omegat, cos_omegat, out=sincos_work), wi)
+    CpC = np.dot(np.multiply(cos_omegat, cos_omegat, out=coscos_work), wi)
+
+    # the final terms
+    YY = YpY - Y*Y
+    YC = YpC - Y*C
+    YS = YpS - Y*S
+    CC = CpC - C*C
+    SS = 1 - CpC - S*S # use SpS = 1 - CpC
+    CS = CpS - C*S
+
+    return YY, YC, YS, CC, SS, CS
+
+
+
+def generalized_lsp_block(times, mags, errs, omegas, trig=None):
+    '''Generalized LSP values for a block of omegas.
+
+    This is the vectorized version of generalized_lsp_value. See that function
+    for the expressions used, and _glsp_block_sums for trig.
+
+    '''
+
+    YY, YC, YS, CC, SS, CS = _glsp_block_sums(times, mags, errs, omegas,
+                                              trig=trig)
+
+    return (YC*YC/CC + YS*YS/SS)/YY
+
+
+
+def generalized_lsp_block_notau(times, mags, errs, omegas, trig=None):
+    '''Generalized LSP values for a block of omegas (not using tau).
+
+    This is the vectorized version of generalized_lsp_value_notau. See that
+    function for the expressions used, and _glsp_block_sums for trig.
+
+    '''
+
+    YY, YC, YS, CC, SS, CS = _glsp_block_sums(times, mags, errs, omegas,
+                                              trig=trig)
+
+    Domega = CC*SS - CS*CS
+    return (SS*YC*YC + CC*YS*YS - 2.0*CS*YC*YS)/(YY*Domega)
+
+
+
+def specwindow_lsp_block(times, mags, errs, omegas, trig=None):
+    '''This calculates the spectral window function peaks for a block of omegas.
+
+    This is the vectorized version of specwindow_lsp_value.
+
+    trig is an optional tuple of precomputed (sin_omegat, cos_omegat) arrays
+    for omegas*(times - times.min()). If this is provided, the sums over
+    sin(omega*(t - tau)) and cos(omega*(t - tau)) are obtained from the sums
+    over these using the angle-difference identities instead.
+
+    '''
+
+    if trig is not None:
+
+        sin_omegat, cos_omegat = trig
+        ndet = float(times.size)
+
+        sum_c = npsum(cos_omegat, axis=1)
+        sum_s = npsum(sin_omegat, axis=1)
+        sum_cc = np.einsum('ij,ij->i', cos_omegat, cos_omegat)
+        sum_sc = np.einsum('ij,ij->i', sin_omegat, cos_omegat)
+
+        # sin(2wt) = 2 sin(wt) cos(wt), cos(2wt) = 2 cos^2(wt) - 1
+        omegatau = 0.5*nparctan((2.0*sum_sc)/(2.0*sum_cc - ndet))
+        cos_wtau, sin_wtau = npcos(omegatau), npsin(omegatau)
+
+        sum_cos = cos_wtau*sum_c + sin_wtau*sum_s
+        sum_sin = cos_wtau*sum_s - sin_wtau*sum_c
+
+        lspval_bot_cos = (cos_wtau*cos_wtau*sum_cc +
+                          2.0*sin_wtau*cos_wtau*sum_sc +
+                          sin_wtau*sin_wtau*(ndet - sum_cc))
+        lspval_bot_sin = ndet - lspval_bot_cos
+
+        return 0.5 * ( (sum_cos*sum_cos/lspval_bot_cos) +
+                       (sum_sin*sum_sin/lspval_bot_sin) )
+
+    norm_times = times - times.min()
+
+    omegat = np.outer(omegas, norm_times)
+
+    tau = (
+        (1.0/(2.0*omegas)) *
+        nparctan( npsum(npsin(2.0*omegat), axis=1) /
+                  npsum(npcos(2.0*omegat), axis=1) )
+    )
+
+    # omega*(t - tau) for each omega
+    omegat -= (omegas*tau)[:,None]
+
+    cos_omegat = npcos(omegat)
+    sin_omegat = npsin(omegat, out=omegat)
+
+    sum_cos = npsum(cos_omegat, axis=1)
+    sum_sin = npsum(sin_omegat, axis=1)
+
+    lspval_bot_cos = npsum(cos_omegat*cos_omegat, axis=1)
+    lspval_bot_sin = npsum(sin_omegat*sin_omegat, axis=1)
+
+    lspval = 0.5 * ( (sum_cos*sum_cos/lspval_bot_cos) +
+                     (sum_sin*sum_sin/lspval_bot_sin) )
+
+    return lspval
+
+
+
+######################################################
+## FAST TRIG SUMS USING EXTIRPOLATION AND A FFT     ##
+## Press & Rybicki (1989), ApJ 338, 277             ##
+######################################################
+
+def extirpolate(x, y, ngrid, nterms=4):
+    '''This extirpolates the values y at positions x onto an integer grid.
+
+    The grid has ngrid points 0, 1, ... ngrid-1. Each y value is spread over the
+    nterms grid points closest to its position x such that the sum of the grid
+    values times any polynomial of degree < nterms is the same as the sum over
+    the original points. This is the reverse of Lagrange interpolation, see
+    Press & Rybicki (1989).
+
+    Based on the extirpolate function in astropy.stats.lombscargle (BSD
+    licensed):
+
+    http://docs.astropy.org/en/stable/_modules/astropy/stats/lombscargle/implementations/utils.html
+
+    Returns an array of size ngrid with the extirpolated values.
+
+    '''
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y)
+    result = npzeros(ngrid, dtype=y.dtype)
+
+    # values that fall exactly on the grid go straight in
+    onpoint = (x % 1.0) == 0.0
+    np.add.at(result, x[onpoint].astype(np.int64), y[onpoint])
+    x, y = x[~onpoint], y[~onpoint]
+
+    # the first of the nterms grid points to use for each value
+    ilo = np.clip((x - nterms//2).astype(np.int64), 0, ngrid - nterms)
+
+    numerator = y*np.prod(x - ilo - nparange(nterms)[:,None], axis=0)
+    denominator = float(np.prod(nparange(1, nterms)))
+
+    for j in range(nterms):
+        if j > 0:
+            denominator *= float(j)/(j - nterms)
+        ind = ilo + (nterms - 1 - j)
+        np.add.at(result, ind, numerator/(denominator*(x - ind)))
+
+    return result
+
+
+
+def fast_trig_sums(times,
+                   weights,
+                   f0,
+                   df,
+                   nfreq,
+                   oversampling=5,
+                   nterms=4):
+    '''This calculates the trig sums over a uniform frequency grid using a FFT.
+
+    The frequency grid is f0 + df*arange(nfreq). The sums are:
+
+    S_k = sum_i weights_i * sin(2 pi f_k times_i)
+    C_k = sum_i weights_i * cos(2 pi f_k times_i)
+
+    The weights are extirpolated onto a regular grid using nterms points per
+    weight and the sums are then calculated for all frequencies at once with
+    an inverse FFT. This takes O(N log N) operations instead of the O(N x
+    nfreq) for the direct sums. oversampling sets the size of the FFT grid
+    relative to nfreq; higher values are more accurate but slower.
+
+    Based on the trig_sum function in astropy.stats.lombscargle (BSD licensed):
+
+    http://docs.astropy.org/en/stable/_modules/astropy/stats/lombscargle/implementations/utils.html
+
+    Returns S, C.
+
+    '''
+
+    # the FFT grid size is the next power of 2 above nfreq*oversampling
+    nfft = 1 << int(npceil(np.log2(nfreq*oversampling)))
+
+    t0 = times.min()
+    h = weights.astype(np.complex128)
+
+    # shift the frequencies to start at f0
+    if f0 > 0.0:
+        h = h*np.exp(2.0j*MPI*f0*(times - t0))
+
+    tnorm = ((times - t0)*nfft*df) % nfft
+    fftgrid = np.fft.ifft(extirpolate(tnorm, h, nfft, nterms=nterms))[:nfreq]
+
+    # shift the times back to start at t0
+    if t0 != 0.0:
+        freqs = f0 + df*nparange(nfreq)
+        fftgrid *= np.exp(2.0j*MPI*t0*freqs)
+
+    return nfft*fftgrid.imag, nfft*fftgrid.real
+
+
+
+def fast_lsp_value(times,
+                   mags,
+                   errs,
+                   f0,
+                   df,
+                   nfreq,
+                   oversampling=5,
+                   nterms=4):
+    '''This calculates the fast floating-mean LSP for a uniform frequency grid.
+
+    This gives the same periodogram as generalized_lsp_value_notau (i.e. the
+    Zechmeister & Kurster 2009 GLS with a floating mean), but gets the trig
+    sums from fast_trig_sums instead of calculating them directly.
+
+    Returns an array of nfreq LSP values for frequencies f0 + df*arange(nfreq).
+
+    '''
+
+    # an empty grid (e.g. startp >= endp) gives an empty periodogram
+    if nfreq == 0:
+        return npempty(0)
+
+    wi = 1.0/(errs*errs)
+    wi = wi/npsum(wi)
+
+    # center the mags on their weighted mean
+    ymags = mags - npsum(wi*mags)
+    YY = npsum(wi*ymags*ymags)
+
+    fastsums = dict(oversampling=oversampling, nterms=nterms)
+
+    Sh, Ch = fast_trig_sums(times, wi*ymags, f0, df, nfreq, **fastsums)
+    S2, C2 = fast_trig_sums(times, wi, 2.0*f0, 2.0*df, nfreq, **fastsums)
+    S, C = fast_trig_sums(times, wi, f0, df, nfreq, **fastsums)
+
+    # the floating mean version of tau
+    tan_2omega_tau = (S2 - 2.0*S*C)/(C2 - (C*C - S*S))
+    S2w = tan_2omega_tau/npsqrt(1.0 + tan_2omega_tau*tan_2omega_tau)
+    C2w = 1.0/npsqrt(1.0 + tan_2omega_tau*tan_2omega_tau)
+    Cw = npsqrt(0.5)*npsqrt(1.0 + C2w)
+    Sw = npsqrt(0.5)*npsign(S2w)*npsqrt(1.0 - C2w)
+
+    YC = Ch*Cw + Sh*Sw
+    YS = Sh*Cw - Ch*Sw
+    CC = 0.5*(1.0 + C2*C2w + S2*S2w) - (C*Cw + S*Sw)**2
+    SS = 0.5*(1.0 - C2*C2w - S2*S2w) - (S*Cw - C*Sw)**2
+
+    return (YC*YC/CC + YS*YS/SS)/YY
+
+
 ##############################
 ## GENERALIZED LOMB-SCARGLE ##
 ##############################
@@ -333,6 +649,64 @@ def glsp_worker_notau(task):
 
 
 
+def glsp_block_worker(task):
+    '''This is a worker to wrap the generalized Lomb-Scargle block function.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = block of omegas
+
+    '''
+
+    try:
+        times, mags, errs = get_shared_magseries(task[0])
+        return generalized_lsp_block(times, mags, errs, task[1])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
+
+
+
+def glsp_block_worker_specwindow(task):
+    '''This is a worker to wrap the spectral window block function.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = block of omegas
+
+    '''
+
+    try:
+        times, mags, errs = get_shared_magseries(task[0])
+        return specwindow_lsp_block(times, mags, errs, task[1])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
+
+
+
+def glsp_block_worker_notau(task):
+    '''This is a worker to wrap the generalized Lomb-Scargle block function.
+
+    This version doesn't use tau.
+
+    task[0] = (times, mags, errs) or a SharedMagSeries ref to them
+    task[1] = block of omegas
+
+    '''
+
+    try:
+        times, mags, errs = get_shared_magseries(task[0])
+        return generalized_lsp_block_notau(times, mags, errs, task[1])
+    except Exception as e:
+        return npfull_like(task[1], npnan)
+
+
+
+# this maps the single-frequency workers to their block equivalents
+GLSP_BLOCK_WORKERS = {glsp_worker:glsp_block_worker,
+                      glsp_worker_specwindow:glsp_block_worker_specwindow,
+                      glsp_worker_notau:glsp_block_worker_notau}
+
+
+
+@cached_periodfinder
 def pgen_lsp(
         times,
         mags,
@@ -348,6 +722,14 @@ def pgen_lsp(
         workchunksize=None,
         sigclip=10.0,
         glspfunc=glsp_worker,
+        blockmode=True,
+        blockmemory=32.0,
+        sharedarrays=True,
+        executor=None,
+        coarsetofine=False,
+        coarsefactor=3,
+        coarsenpeaks=10,
+        precomputed=None,
         verbose=True
 ):
     '''This calculates the generalized LSP given times, mags, errors.
@@ -357,6 +739,34 @@ def pgen_lsp(
     function from astropy.stats.lombscargle. If startp and endp are provided,
     will generate a frequency grid based on these instead.
 
+    If blockmode is True and glspfunc has a block equivalent in
+    GLSP_BLOCK_WORKERS, the frequency grid is split into blocks and each worker
+    evaluates a whole block at once using 2D numpy arrays. This avoids sending
+    the full mag series to the workers once per frequency. blockmemory sets the
+    memory budget in MB for the work arrays of a single block, which in turn
+    sets the number of frequencies per block. If blockmode is False (or
+    glspfunc is a custom single-frequency worker), each frequency is sent to
+    the workers separately.
+
+    If sharedarrays is True, the cleaned mag series is placed in shared memory
+    once for the block workers instead of being sent along with each block.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
+    If coarsetofine is True, the periodogram is first calculated on a coarse
+    grid made of every coarsefactor-th frequency, and then at full resolution
+    around the best coarsenpeaks peaks and their aliases only (see
+    periodbase.coarse_to_fine_search). The lspvals and omegas returned are then
+    on this merged grid, and the 'coarsetofine' key in the returned dict gives
+    the number of periodogram evaluations saved.
+
+    precomputed is used by periodbase.fused_periodfind. If it's not None, it's
+    a dict with 'frequencies' and 'lspvals' keys for a periodogram that was
+    already calculated for the cleaned mag series. These are used as is
+    instead of running the period-finder kernel here.
+
     '''
 
     # get rid of nans first and sigclip
@@ -369,6 +779,7 @@ def pgen_lsp(
     # get rid of zero errs
     nzind = np.nonzero(serrs)
     stimes, smags, serrs = stimes[nzind], smags[nzind], serrs[nzind]
+    pf_timing_mark('sigclip', npoints=stimes.size)
 
 
     # make sure there are enough points to calculate a spectrum
@@ -408,26 +819,76 @@ def pgen_lsp(
                     (omegas.size, 1.0/freqs.max(), 1.0/freqs.min())
                 )
 
-        # map to parallel workers
-        if (not nworkers) or (nworkers > NCPUS):
-            nworkers = NCPUS
-            if verbose:
-                LOGINFO('using %s workers...' % nworkers)
+        pf_timing_mark('grid', nfreq=omegas.size)
 
-        pool = Pool(nworkers)
+        # this calculates the periodogram for an array of omegas
+        def lspfunc(lspomegas):
 
-        tasks = [(stimes, smags, serrs, x) for x in omegas]
-        if workchunksize:
-            lsp = pool.map(glspfunc, tasks, chunksize=workchunksize)
-        else:
-            lsp = pool.map(glspfunc, tasks)
+            # if we're working on blocks of frequencies, the mag series goes
+            # into shared memory and the workers only get the blocks of omegas
+            if blockmode and glspfunc in GLSP_BLOCK_WORKERS:
 
-        pool.close()
-        pool.join()
-        del pool
+                return parallel_frequency_blocks(
+                    GLSP_BLOCK_WORKERS[glspfunc],
+                    (stimes, smags, serrs),
+                    lspomegas,
+                    nworkers=nworkers,
+                    blockmemory=blockmemory,
+                    sharedarrays=sharedarrays,
+                    executor=executor,
+                    verbose=verbose
+                )
+
+            # otherwise, work on one frequency at a time
+            elif executor is not None:
+
+                tasks = [(stimes, smags, serrs, x) for x in lspomegas]
+                return executor.map(glspfunc, tasks, chunksize=workchunksize)
+
+            else:
+
+                # map to parallel workers
+                if (not nworkers) or (nworkers > NCPUS):
+                    poolworkers = NCPUS
+                    if verbose:
+                        LOGINFO('using %s workers...' % poolworkers)
+                else:
+                    poolworkers = nworkers
+
+                with pf_timing_stage('pool'):
+                    pool = Pool(poolworkers)
+
+                tasks = [(stimes, smags, serrs, x) for x in lspomegas]
+                if workchunksize:
+                    poollsp = pool.map(glspfunc, tasks,
+                                       chunksize=workchunksize)
+                else:
+                    poollsp = pool.map(glspfunc, tasks)
+
+                with pf_timing_stage('pool'):
+                    pool.close()
+                    pool.join()
+                del pool
+
+                return poollsp
+
+        if precomputed is not None:
+            omegas = 2.0*np.pi*precomputed['frequencies']
+            lsp, ctfinfo = precomputed['lspvals'], None
+        elif coarsetofine:
+            omegas, lsp, ctfinfo = coarse_to_fine_search(
+                lspfunc,
+                omegas,
+                coarsefactor=coarsefactor,
+                npeaks=coarsenpeaks,
+                verbose=verbose
+            )
+        else:
+            lsp, ctfinfo = lspfunc(omegas), None
 
         lsp = np.array(lsp)
         periods = 2.0*np.pi/omegas
+        pf_timing_mark('kernel')
 
         # find the nbestpeaks for the periodogram: 1. sort the lsp array by
         # highest value first 2. go down the values until we find five
@@ -503,6 +964,7 @@ def pgen_lsp(
 
             prevperiod = period
 
+        pf_timing_mark('peaks')
 
         return {'bestperiod':finperiods[bestperiodind],
                 'bestlspval':finlsp[bestperiodind],
@@ -512,6 +974,7 @@ def pgen_lsp(
                 'lspvals':lsp,
                 'omegas':omegas,
                 'periods':periods,
+                'coarsetofine':ctfinfo,
                 'method':'gls',
                 'kwargs':{'startp':startp,
                           'endp':endp,
@@ -543,6 +1006,7 @@ def pgen_lsp(
 
 
 
+@cached_periodfinder
 def specwindow_lsp(
         times,
         mags,
@@ -557,15 +1021,31 @@ def specwindow_lsp(
         nworkers=None,
         sigclip=10.0,
         glspfunc=glsp_worker_specwindow,
+        blockmode=True,
+        blockmemory=32.0,
+        sharedarrays=True,
+        executor=None,
+        coarsetofine=False,
+        coarsefactor=3,
+        coarsenpeaks=10,
+        precomputed=None,
         verbose=True
 ):
     '''
     This calculates the spectral window function.
 
+    blockmode, blockmemory, sharedarrays, precomputed, and the coarse-to-fine
+    search options are passed through to pgen_lsp.
+
+    executor is an optional periodbase.PeriodFinderExecutor. If this is
+    provided, the workers run on its pool instead of a new one, and its
+    nworkers is used instead of nworkers.
+
     '''
 
-    # run the LSP using glsp_worker_specwindow as the worker
-    lspres = pgen_lsp(
+    # run the LSP using glsp_worker_specwindow as the worker. this uses the
+    # function under the cache decorator, so its stage timings go into ours.
+    lspres = pgen_lsp.__wrapped__(
         times,
         mags,
         errs,
@@ -579,6 +1059,14 @@ def specwindow_lsp(
         nworkers=nworkers,
         sigclip=sigclip,
         glspfunc=glsp_worker_specwindow,
+        blockmode=blockmode,
+        blockmemory=blockmemory,
+        sharedarrays=sharedarrays,
+        executor=executor,
+        coarsetofine=coarsetofine,
+        coarsefactor=coarsefactor,
+        coarsenpeaks=coarsenpeaks,
+        precomputed=precomputed,
         verbose=verbose
     )
 
@@ -599,3 +1087,847 @@ def specwindow_lsp(
             lspres['bestlspval'] = lspres['bestlspval']/lspmax
 
     return lspres
+
+
+
+@cached_periodfinder
+def fast_lsp(
+        times,
+        mags,
+        errs,
+        magsarefluxes=False,
+        startp=None,
+        endp=None,
+        autofreq=True,
+        nbestpeaks=5,
+        periodepsilon=0.1, # 0.1
+        stepsize=1.0e-4,
+        nworkers=None,
+        sigclip=10.0,
+        oversampling=5,
+        nterms=4,
+        verbose=True
+):
+    '''This calculates the generalized LSP using the Press & Rybicki (1989)
+    O(N log N) method.
+
+    This calculates the same floating-mean periodogram as pgen_lsp with
+    glspfunc=glsp_worker_notau, but the trig sums needed for all frequencies
+    are obtained at once by extirpolating the mag series onto a regular grid
+    and taking its FFT. This is much faster than pgen_lsp for long mag series
+    and fine frequency grids, and runs in a single process (nworkers is ignored
+    and is only here to keep the same call signature as the other
+    period-finders).
+
+    The frequency grid must be uniform, so this uses the same grids as pgen_lsp:
+    the autofreq grid from get_frequency_grid if autofreq is True, or
+    arange(1/endp, 1/startp, stepsize) otherwise.
+
+    oversampling and nterms control the accuracy of the FFT trig sums: the FFT
+    grid has at least oversampling times the number of frequencies, and each
+    point is extirpolated onto nterms grid points. With the defaults of
+    oversampling = 5 and nterms = 4 and the autofreq grid, the periodogram
+    values agree with the exact GLS (generalized_lsp_value_notau) to an
+    absolute tolerance of 2.0e-3 for a few hundred points, falling to about
+    2.0e-5 for 20000 points (the median differences are ~100x smaller than
+    this). The best periods found are the same. Increase oversampling if more
+    accuracy is required.
+
+    Returns a dict with the same keys as pgen_lsp and method = 'fls'.
+
+    '''
+
+    # get rid of nans first and sigclip
+    stimes, smags, serrs = sigclip_magseries(times,
+                                             mags,
+                                             errs,
+                                             magsarefluxes=magsarefluxes,
+                                             sigclip=sigclip)
+
+    # get rid of zero errs
+    nzind = np.nonzero(serrs)
+    stimes, smags, serrs = stimes[nzind], smags[nzind], serrs[nzind]
+    pf_timing_mark('sigclip', npoints=stimes.size)
+
+    resultkwargs = {'startp':startp,
+                    'endp':endp,
+                    'stepsize':stepsize,
+                    'autofreq':autofreq,
+                    'periodepsilon':periodepsilon,
+                    'nbestpeaks':nbestpeaks,
+                    'sigclip':sigclip,
+                    'oversampling':oversampling,
+                    'nterms':nterms}
+
+    # make sure there are enough points to calculate a spectrum
+    if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
+
+        # get the frequencies to use
+        if startp:
+            endf = 1.0/startp
+        else:
+            # default start period is 0.1 day
+            endf = 1.0/0.1
+
+        if endp:
+            startf = 1.0/endp
+        else:
+            # default end period is length of time series
+            startf = 1.0/(stimes.max() - stimes.min())
+
+        # if we're not using autofreq, then use the provided frequencies
+        if not autofreq:
+            freqs = np.arange(startf, endf, stepsize)
+            f0, df, nfreq = startf, stepsize, freqs.size
+            if verbose:
+                LOGINFO(
+                    'using %s frequency points, start P = %.3f, end P = %.3f' %
+                    (nfreq, 1.0/endf, 1.0/startf)
+                )
+        else:
+            # this gets an automatic grid of frequencies to use
+            f0, df, nfreq, freqs = get_frequency_grid(stimes,
+                                                      minfreq=startf,
+                                                      maxfreq=endf,
+                                                      returnf0dfnf=True)
+            if verbose:
+                LOGINFO(
+                    'using autofreq with %s frequency points, '
+                    'start P = %.3f, end P = %.3f' %
+                    (nfreq, 1.0/freqs.max(), 1.0/freqs.min())
+                )
+
+        omegas = 2*np.pi*freqs
+        pf_timing_mark('grid', nfreq=nfreq)
+
+        lsp = fast_lsp_value(stimes, smags, serrs, f0, df, nfreq,
+                             oversampling=oversampling,
+                             nterms=nterms)
+        periods = 1.0/freqs
+        pf_timing_mark('kernel')
+
+        # find the nbestpeaks for the periodogram
+        bestpeaks = get_nbestperiods(lsp,
+                                     periods,
+                                     nbestpeaks=nbestpeaks,
+                                     periodepsilon=periodepsilon)
+
+        if bestpeaks is None:
+
+            LOGERROR('no finite periodogram values '
+                     'for this mag series, skipping...')
+            return {'bestperiod':npnan,
+                    'bestlspval':npnan,
+                    'nbestpeaks':nbestpeaks,
+                    'nbestlspvals':None,
+                    'nbestperiods':None,
+                    'lspvals':None,
+                    'omegas':omegas,
+                    'periods':None,
+                    'method':'fls',
+                    'kwargs':resultkwargs}
+
+        pf_timing_mark('peaks')
+
+        return {'bestperiod':bestpeaks['bestperiod'],
+                'bestlspval':bestpeaks['bestlspval'],
+                'nbestpeaks':nbestpeaks,
+                'nbestlspvals':bestpeaks['nbestlspvals'],
+                'nbestperiods':bestpeaks['nbestperiods'],
+                'lspvals':lsp,
+                'omegas':omegas,
+                'periods':periods,
+                'method':'fls',
+                'kwargs':resultkwargs}
+
+    else:
+
+        LOGERROR('no good detections for these times and mags, skipping...')
+        return {'bestperiod':npnan,
+                'bestlspval':npnan,
+                'nbestpeaks':nbestpeaks,
+                'nbestlspvals':None,
+                'nbestperiods':None,
+                'lspvals':None,
+                'omegas':None,
+                'periods':None,
+                'method':'fls',
+                'kwargs':resultkwargs}
+
+
+
+###################################################
+## GLS FOR MANY MAG SERIES ON A COMMON TIME BASE ##
+###################################################
+
+def _glsp_batch_sums(mags, wi, sin_omegat, cos_omegat, work):
+    '''This calculates the GLS sums for many mag series at once.
+
+    This does the same calculations as _glsp_block_sums, but for a 2D
+    (nseries x times.size) array of mags and normalized weights wi. Masked
+    points have wi = 0.0 (and finite mags), so they drop out of all the sums.
+    The sums over the observations then become matrix products of the
+    (omegas.size x times.size) trig arrays with wi.T and (wi*mags).T.
+
+    work is a scratch array with the same shape as sin_omegat.
+
+    Returns YY, YC, YS, CC, SS, CS, each an (omegas.size x nseries) array.
+
+    '''
+
+    wimags = wi*mags
+
+    Y = npsum(wimags, axis=1)
+    YpY = npsum(wimags*mags, axis=1)
+
+    C = np.dot(cos_omegat, wi.T)
+    S = np.dot(sin_omegat, wi.T)
+
+    YpC = np.dot(cos_omegat, wimags.T)
+    YpS = np.dot(sin_omegat, wimags.T)
+
+    CpS = np.dot(np.multiply(sin_omegat, cos_omegat, out=work), wi.T)
+    CpC = np.dot(np.multiply(cos_omegat, cos_omegat, out=work), wi.T)
+
+    # the final terms
+    YY = YpY - Y*Y
+    YC = YpC - Y*C
+    YS = YpS - Y*S
+    CC = CpC - C*C
+    SS = 1 - CpC - S*S # use SpS = 1 - CpC
+    CS = CpS - C*S
+
+    return YY, YC, YS, CC, SS, CS
+
+
+
+def glsp_batch_block_worker(task):
+    '''This is a worker for a block of omegas for pgen_lsp_batch.
+
+    task[0] = (times, wi[0], ..., wi[nseries-1], mags[0], ..., mags[nseries-1])
+              or a SharedMagSeries ref to them, where wi are the normalized
+              weights of each series (zero for its masked points)
+    task[1] = block of omegas
+    task[2] = True to leave out tau (as in glsp_worker_notau)
+    task[3] = nseries
+
+    Returns an (omegas.size x nseries) array of periodogram values.
+
+    '''
+
+    omegas, notau, nseries = task[1], task[2], task[3]
+
+    try:
+
+        arrays = get_shared_magseries(task[0])
+        times = arrays[0]
+        wi = np.vstack(arrays[1:nseries+1])
+        mags = np.vstack(arrays[nseries+1:])
+
+        sin_omegat, cos_omegat = get_trig_block(times, omegas)
+        work = npempty(sin_omegat.shape)
+
+        YY, YC, YS, CC, SS, CS = _glsp_batch_sums(mags,
+                                                  wi,
+                                                  sin_omegat,
+                                                  cos_omegat,
+                                                  work)
+
+        if notau:
+            Domega = CC*SS - CS*CS
+            return (SS*YC*YC + CC*YS*YS - 2.0*CS*YC*YS)/(YY*Domega)
+        else:
+            return (YC*YC/CC + YS*YS/SS)/YY
+
+    except Exception as e:
+
+        return npfull((omegas.size, nseries), npnan)
+
+
+
+@timed_periodfinder(listkey='batch')
+def pgen_lsp_batch(
+        times,
+        mags,
+        errs,
+        mask=None,
+        magsarefluxes=False,
+        startp=None,
+        endp=None,
+        autofreq=True,
+        nbestpeaks=5,
+        periodepsilon=0.1, # 0.1
+        stepsize=1.0e-4,
+        sigclip=10.0,
+        glspfunc=glsp_worker,
+        blockmemory=32.0,
+        nworkers=1,
+        sharedarrays=True,
+        executor=None,
+        commongrid=True,
+        verbose=True
+):
+    '''This calculates the generalized LSP for many mag series that share the
+    same time base.
+
+    This is meant for light curves of all the objects in a field, which are
+    observed at (nearly) the same times. times is the 1D array of the common
+    times. mags and errs are 2D (nseries x times.size) arrays, with one row per
+    object. errs can also be a 1D array of times.size elements, which is then
+    used for all of the objects. mask is an optional boolean array with the
+    same shape as mags, which is True for the points to use. Missing
+    observations for an object should be marked False here. If mask is None,
+    all points with finite mags and errs are used.
+
+    Each row is sigma-clipped and has its zero errs removed in the same way as
+    in pgen_lsp, and these points are then masked out. The sin and cos terms
+    for each block of frequencies are calculated only once for the common
+    times, and the GLS sums for all of the objects are obtained from matrix
+    products with these. blockmemory sets the memory budget in MB for the 2D
+    (nblockfreqs x times.size) work arrays of a single block.
+
+    The blocks are run in this process if nworkers is 1 (the default).
+    Otherwise, they're run on a pool of nworkers workers (NCPUS if None), or
+    on the pool of executor if this is a periodbase.PeriodFinderExecutor, with
+    the arrays in shared memory if sharedarrays is True (see
+    periodbase.parallel_frequency_blocks).
+
+    If commongrid is True, all objects use the same frequency grid, which is
+    set up as in pgen_lsp using all the times with at least one good point for
+    any of the objects. This is the same grid that pgen_lsp uses for an object
+    if its cleaned times start and end at the same times as these (or if
+    autofreq is False and startp and endp are both set). If commongrid is
+    False, the objects are grouped by the first and last times of their
+    cleaned points instead, and each group gets its own grid. Each object then
+    gets the same frequency grid and periodogram as from pgen_lsp, and the sin
+    and cos terms are calculated once per group.
+
+    glspfunc is either glsp_worker (the default, same as pgen_lsp) or
+    glsp_worker_notau.
+
+    Returns a list of nseries dicts, one per row of mags, with the same keys
+    as the dicts returned by pgen_lsp and method = 'gls'. If the period-finder
+    timings are on (see periodbase.enable_pf_timing), the timing dict of each
+    of these has a 'batch' key with the timings of the whole batch, and its
+    'nseries'.
+
+    '''
+
+    if glspfunc not in (glsp_worker, glsp_worker_notau):
+        LOGERROR('glspfunc must be one of glsp_worker or glsp_worker_notau '
+                 'for pgen_lsp_batch')
+        return None
+
+    times = np.asarray(times, dtype=np.float64)
+    mags = np.atleast_2d(np.asarray(mags, dtype=np.float64))
+    errs = np.asarray(errs, dtype=np.float64)
+    if errs.ndim == 1:
+        errs = np.broadcast_to(errs, mags.shape)
+
+    nseries = mags.shape[0]
+
+    if mask is None:
+        mask = npisfinite(mags) & npisfinite(errs)
+    else:
+        mask = (np.asarray(mask, dtype=bool) &
+                npisfinite(mags) & npisfinite(errs))
+
+    # sigclip each row and remove its zero errs the same way as pgen_lsp
+    goodmask = sigclip_magseries_batch_mask(times,
+                                            np.where(mask, mags, npnan),
+                                            errs,
+                                            magsarefluxes=magsarefluxes,
+                                            sigclip=sigclip)
+    goodmask &= (errs != 0.0)
+    pf_timing_mark('sigclip', npoints=times.size, nseries=nseries)
+
+    ngood = npsum(goodmask, axis=1)
+    goodrows = ngood > 9
+
+    # these are the frequency grid and periodogram of each good row
+    rowfreqs, rowlsp = {}, {}
+
+    if not np.any(goodrows):
+
+        LOGERROR('no good detections for any of these mag series')
+
+    else:
+
+        # the weights are zero for the masked points. their mags are set to
+        # zero as well so NaNs there don't leak into the sums
+        wi = npzeros(mags.shape)
+        wi[goodmask] = 1.0/(errs[goodmask]*errs[goodmask])
+        wi[goodrows] = wi[goodrows]/npsum(wi[goodrows], axis=1)[:,None]
+        wmags = np.where(goodmask, mags, 0.0)
+
+        goodrowinds = np.flatnonzero(goodrows)
+
+        # group the rows that get the same frequency grid
+        if commongrid:
+            rowgroups = [goodrowinds]
+        else:
+            rowspans = {}
+            for ind in goodrowinds:
+                rowtimes = times[goodmask[ind]]
+                rowspans.setdefault((rowtimes.min(), rowtimes.max()),
+                                    []).append(ind)
+            rowgroups = [nparray(rowspans[x]) for x in sorted(rowspans)]
+
+        for grouprows in rowgroups:
+
+            # the frequency grid from all the good times of this group
+            goodtimes = times[np.any(goodmask[grouprows], axis=0)]
+
+            if startp:
+                endf = 1.0/startp
+            else:
+                # default start period is 0.1 day
+                endf = 1.0/0.1
+
+            if endp:
+                startf = 1.0/endp
+            else:
+                # default end period is length of time series
+                startf = 1.0/(goodtimes.max() - goodtimes.min())
+
+            if not autofreq:
+                freqs = np.arange(startf, endf, stepsize)
+            else:
+                freqs = get_frequency_grid(goodtimes,
+                                           minfreq=startf,
+                                           maxfreq=endf)
+            omegas = 2*np.pi*freqs
+            pf_timing_mark('grid', nfreq=omegas.size)
+
+            if verbose:
+                LOGINFO(
+                    'using %s frequency points for %s mag series with %s '
+                    'common times, start P = %.3f, end P = %.3f' %
+                    (omegas.size, grouprows.size, times.size,
+                     1.0/freqs.max(), 1.0/freqs.min())
+                )
+
+            # the workers get the common times and the weights and mags of
+            # each row, and return the periodogram values of all of these rows
+            # for their block of omegas
+            blocklsp = parallel_frequency_blocks(
+                glsp_batch_block_worker,
+                (times,) + tuple(wi[grouprows]) + tuple(wmags[grouprows]),
+                omegas,
+                extraargs=(glspfunc is glsp_worker_notau, grouprows.size),
+                nworkers=nworkers,
+                blockmemory=blockmemory,
+                narrays=3,
+                sharedarrays=sharedarrays,
+                executor=executor,
+                verbose=verbose
+            )
+            grouplsp = np.ascontiguousarray(blocklsp.T)
+
+            for row, ind in enumerate(grouprows):
+                rowfreqs[ind], rowlsp[ind] = freqs, grouplsp[row]
+
+            pf_timing_mark('kernel')
+
+    # generate the result dicts using pgen_lsp on the precomputed periodograms
+    results = []
+
+    for ind in range(nseries):
+
+        rowmask = mask[ind]
+
+        if ind in rowlsp:
+            precomputed = {'frequencies':rowfreqs[ind],
+                           'lspvals':rowlsp[ind]}
+        else:
+            # this makes pgen_lsp return its usual failure dict
+            precomputed = {'frequencies':npempty(0), 'lspvals':npempty(0)}
+
+        results.append(
+            pgen_lsp(times[rowmask],
+                     mags[ind][rowmask],
+                     errs[ind][rowmask],
+                     magsarefluxes=magsarefluxes,
+                     startp=startp,
+                     endp=endp,
+                     autofreq=autofreq,
+                     nbestpeaks=nbestpeaks,
+                     periodepsilon=periodepsilon,
+                     stepsize=stepsize,
+                     sigclip=sigclip,
+                     glspfunc=glspfunc,
+                     precomputed=precomputed,
+                     verbose=False)
+        )
+
+    pf_timing_mark('peaks')
+
+    return results
+
+
+
+##############################################
+## INCREMENTAL GLS FOR GROWING LIGHT CURVES ##
+##############################################
+
+def glsp_state_block_worker(task):
+    '''This calculates the raw weighted GLS sums for a block of omegas.
+
+    task[0] = (times, mags, weights) or a SharedMagSeries ref to them
+    task[1] = block of omegas
+
+    The weights are 1/errs^2 and aren't normalized, so the sums for different
+    sets of observations can just be added together.
+
+    Returns an (omegas.size x 6) array with the columns: sum(w*cos),
+    sum(w*sin), sum(w*mags*cos), sum(w*mags*sin), sum(w*cos*cos),
+    sum(w*cos*sin).
+
+    '''
+
+    times, mags, weights = get_shared_magseries(task[0])
+    omegas = task[1]
+
+    sin_omegat, cos_omegat = get_trig_block(times, omegas)
+    wmags = weights*mags
+
+    sums = npempty((omegas.size, 6))
+    sums[:,0] = np.dot(cos_omegat, weights)
+    sums[:,1] = np.dot(sin_omegat, weights)
+    sums[:,2] = np.dot(cos_omegat, wmags)
+    sums[:,3] = np.dot(sin_omegat, wmags)
+    sums[:,5] = np.dot(np.multiply(sin_omegat, cos_omegat, out=sin_omegat),
+                       weights)
+    sums[:,4] = np.dot(np.multiply(cos_omegat, cos_omegat, out=cos_omegat),
+                       weights)
+
+    return sums
+
+
+
+class GLSPeriodogramState(object):
+    '''This keeps the GLS sums for a light curve that grows over time.
+
+    The GLS only depends on weighted sums over the observations at each
+    frequency. This object keeps these sums on a fixed frequency grid, so new
+    observations can be added using update in O(N_new x N_freq) instead of
+    running pgen_lsp again over all of the observations. The result dict is
+    then obtained from the sums using lspdict.
+
+    The frequency grid is set up when the first observations are added, in the
+    same way as in pgen_lsp. If endp is None, the longest period is the time
+    span of the first observations, so set endp if the light curve is
+    expected to grow much longer. The sums are kept for times measured from the
+    first time seen, and are rotated back to the absolute times in lspdict, so
+    the results match pgen_lsp for any glspfunc.
+
+    All of the input observations are kept as well, since sigma-clipping
+    depends on all of them. At each update, all of the observations are
+    sigma-clipped again using sigclip. If the points kept out of the older
+    observations change and rebuildonclip is True, the sums are calculated
+    again from scratch for all the kept points. If rebuildonclip is False, the
+    old points are left as they were, and only the new points are clipped
+    using the statistics of all the observations. Use rebuild to calculate
+    everything from scratch at any time.
+
+    The other args are the same as for pgen_lsp. Use save and load to keep the
+    state on disk between runs.
+
+    '''
+
+    def __init__(self,
+                 magsarefluxes=False,
+                 startp=None,
+                 endp=None,
+                 autofreq=True,
+                 nbestpeaks=5,
+                 periodepsilon=0.1,
+                 stepsize=1.0e-4,
+                 sigclip=10.0,
+                 glspfunc=glsp_worker,
+                 rebuildonclip=True,
+                 nworkers=1,
+                 blockmemory=32.0):
+
+        if glspfunc not in (glsp_worker, glsp_worker_notau):
+            raise ValueError('glspfunc must be one of glsp_worker '
+                             'or glsp_worker_notau')
+
+        self.magsarefluxes = magsarefluxes
+        self.startp = startp
+        self.endp = endp
+        self.autofreq = autofreq
+        self.nbestpeaks = nbestpeaks
+        self.periodepsilon = periodepsilon
+        self.stepsize = stepsize
+        self.sigclip = sigclip
+        self.notau = glspfunc is glsp_worker_notau
+        self.rebuildonclip = rebuildonclip
+        self.nworkers = nworkers
+        self.blockmemory = blockmemory
+
+        # all of the observations and which ones are in the sums
+        self.times = npempty(0)
+        self.mags = npempty(0)
+        self.errs = npempty(0)
+        self.keepmask = npempty(0, dtype=bool)
+
+        self.timezero = None
+        self.omegas = None
+        self.totalsums = None
+        self.freqsums = None
+
+        self.nupdates = 0
+        self.nrebuilds = 0
+
+
+    def _get_keepmask(self, times, mags, errs):
+        '''This gets the points that survive sigma-clipping and have non-zero
+        errs in the same way as in pgen_lsp.
+
+        '''
+
+        keepmask = sigclip_magseries_mask(times,
+                                          mags,
+                                          errs,
+                                          magsarefluxes=self.magsarefluxes,
+                                          sigclip=self.sigclip)
+
+        return keepmask & (errs != 0.0)
+
+
+    def _setup_grid(self, times):
+        '''This sets up the frequency grid from the first good times.
+
+        '''
+
+        if self.startp:
+            endf = 1.0/self.startp
+        else:
+            # default start period is 0.1 day
+            endf = 1.0/0.1
+
+        if self.endp:
+            startf = 1.0/self.endp
+        else:
+            # default end period is length of time series
+            startf = 1.0/(times.max() - times.min())
+
+        if not self.autofreq:
+            self.omegas = 2*np.pi*np.arange(startf, endf, self.stepsize)
+        else:
+            self.omegas = 2*np.pi*get_frequency_grid(times,
+                                                     minfreq=startf,
+                                                     maxfreq=endf)
+
+        self.timezero = times.min()
+        self.totalsums = npzeros(3)
+        self.freqsums = npzeros((self.omegas.size, 6))
+
+
+    def _add_points(self, times, mags, errs):
+        '''This adds the sums for these points to the stored ones.
+
+        '''
+
+        if times.size == 0 or self.omegas.size == 0:
+            return
+
+        weights = 1.0/(errs*errs)
+
+        self.totalsums += (npsum(weights),
+                           npsum(weights*mags),
+                           npsum(weights*mags*mags))
+
+        self.freqsums += parallel_frequency_blocks(
+            glsp_state_block_worker,
+            (times - self.timezero, mags, weights),
+            self.omegas,
+            nworkers=self.nworkers,
+            blockmemory=self.blockmemory,
+            narrays=3,
+            verbose=False
+        )
+
+
+    def rebuild(self):
+        '''This sigma-clips all of the observations again and calculates the
+        sums from scratch. The frequency grid isn't changed.
+
+        '''
+
+        if self.times.size == 0:
+            return
+
+        self.keepmask = self._get_keepmask(self.times, self.mags, self.errs)
+
+        if self.omegas is None:
+            if npsum(self.keepmask) < 10:
+                return
+            self._setup_grid(self.times[self.keepmask])
+
+        self.totalsums = npzeros(3)
+        self.freqsums = npzeros((self.omegas.size, 6))
+        self._add_points(self.times[self.keepmask],
+                         self.mags[self.keepmask],
+                         self.errs[self.keepmask])
+        self.nrebuilds += 1
+
+
+    def update(self, times, mags, errs):
+        '''This adds new observations and updates the sums.
+
+        Returns True if the sums had to be calculated again from scratch and
+        False otherwise.
+
+        '''
+
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        mags = np.atleast_1d(np.asarray(mags, dtype=np.float64))
+        errs = np.atleast_1d(np.asarray(errs, dtype=np.float64))
+
+        nold = self.times.size
+
+        self.times = np.concatenate((self.times, times))
+        self.mags = np.concatenate((self.mags, mags))
+        self.errs = np.concatenate((self.errs, errs))
+        self.nupdates += 1
+
+        keepmask = self._get_keepmask(self.times, self.mags, self.errs)
+        oldchanged = not np.array_equal(keepmask[:nold], self.keepmask)
+
+        # the grid is set up by rebuild once there are at least 10 good points
+        if self.omegas is None or (oldchanged and self.rebuildonclip):
+            self.rebuild()
+            return True
+
+        newkeep = keepmask[nold:]
+        self.keepmask = np.concatenate((self.keepmask, newkeep))
+        self._add_points(times[newkeep], mags[newkeep], errs[newkeep])
+
+        return False
+
+
+    def lspdict(self, verbose=True):
+        '''This returns the result dict for the current sums.
+
+        This has the same keys as the dicts returned by pgen_lsp, with an extra
+        'ndet' key for the number of observations used.
+
+        '''
+
+        resultkwargs = {'startp':self.startp,
+                        'endp':self.endp,
+                        'stepsize':self.stepsize,
+                        'autofreq':self.autofreq,
+                        'periodepsilon':self.periodepsilon,
+                        'nbestpeaks':self.nbestpeaks,
+                        'sigclip':self.sigclip}
+        ndet = int(npsum(self.keepmask))
+
+        if self.omegas is None or ndet < 10:
+
+            if verbose:
+                LOGERROR('no good detections for these times and mags, '
+                         'skipping...')
+            return {'bestperiod':npnan,
+                    'bestlspval':npnan,
+                    'nbestpeaks':self.nbestpeaks,
+                    'nbestlspvals':None,
+                    'nbestperiods':None,
+                    'lspvals':None,
+                    'omegas':None,
+                    'periods':None,
+                    'ndet':ndet,
+                    'method':'gls',
+                    'kwargs':resultkwargs}
+
+        W, Wy, Wyy = self.totalsums
+        C, S, YpC, YpS, CpC, CpS = (self.freqsums/W).T
+        Y = Wy/W
+
+        # the sums are for omega*(times - timezero). the GLS with tau depends
+        # on the time origin, so rotate them by omega*timezero to get the sums
+        # for omega*times like pgen_lsp uses
+        rot = self.omegas*self.timezero
+        cos_rot, sin_rot = npcos(rot), npsin(rot)
+        SpS = 1 - CpC
+
+        cos2_rot, sin2_rot = cos_rot*cos_rot, sin_rot*sin_rot
+        sincos_rot = sin_rot*cos_rot
+
+        C, S = C*cos_rot - S*sin_rot, S*cos_rot + C*sin_rot
+        YpC, YpS = YpC*cos_rot - YpS*sin_rot, YpS*cos_rot + YpC*sin_rot
+        CpC, CpS = (cos2_rot*CpC - 2.0*sincos_rot*CpS + sin2_rot*SpS,
+                    sincos_rot*(CpC - SpS) + (cos2_rot - sin2_rot)*CpS)
+
+        # the final terms
+        YY = Wyy/W - Y*Y
+        YC = YpC - Y*C
+        YS = YpS - Y*S
+        CC = CpC - C*C
+        SS = 1 - CpC - S*S # use SpS = 1 - CpC
+        CS = CpS - C*S
+
+        if self.notau:
+            Domega = CC*SS - CS*CS
+            lsp = (SS*YC*YC + CC*YS*YS - 2.0*CS*YC*YS)/(YY*Domega)
+        else:
+            lsp = (YC*YC/CC + YS*YS/SS)/YY
+
+        periods = 2.0*np.pi/self.omegas
+
+        bestpeaks = get_nbestperiods(lsp,
+                                     periods,
+                                     nbestpeaks=self.nbestpeaks,
+                                     periodepsilon=self.periodepsilon)
+
+        if bestpeaks is None:
+
+            if verbose:
+                LOGERROR('no finite periodogram values '
+                         'for this mag series, skipping...')
+            return {'bestperiod':npnan,
+                    'bestlspval':npnan,
+                    'nbestpeaks':self.nbestpeaks,
+                    'nbestlspvals':None,
+                    'nbestperiods':None,
+                    'lspvals':None,
+                    'omegas':self.omegas,
+                    'periods':None,
+                    'ndet':ndet,
+                    'method':'gls',
+                    'kwargs':resultkwargs}
+
+        return {'bestperiod':bestpeaks['bestperiod'],
+                'bestlspval':bestpeaks['bestlspval'],
+                'nbestpeaks':self.nbestpeaks,
+                'nbestlspvals':bestpeaks['nbestlspvals'],
+                'nbestperiods':bestpeaks['nbestperiods'],
+                'lspvals':lsp,
+                'omegas':self.omegas,
+                'periods':periods,
+                'ndet':ndet,
+                'method':'gls',
+                'kwargs':resultkwargs}
+
+
+    def save(self, outfile):
+        '''This writes the state to a pickle.
+
+        '''
+
+        with open(outfile, 'wb') as outfd:
+            pickle.dump(self, outfd, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return outfile
+
+
+    @classmethod
+    def load(cls, infile):
+        '''This reads a state written by save.
+
+        '''
+
+        with open(infile, 'rb') as infd:
+            return pickle.load(infd)
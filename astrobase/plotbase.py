@@ -710,30 +710,36 @@ def skyview_stamp(ra, decl,
 ##################
 
 PLOTYLABELS = {'gls':'Generalized Lomb-Scargle normalized power',
+               'fls':'Generalized Lomb-Scargle normalized power',
                'pdm':'Stellingwerf PDM $\Theta$',
                'aov':'Schwarzenberg-Czerny AoV $\Theta$',
                'mav':'Schwarzenberg-Czerny AoVMH $\Theta$',
                'bls':'Box Least-squared Search SR',
                'acf':'Autocorrelation Function',
                'sls':'Lomb-Scargle normalized power',
+               'tls':'Lomb-Scargle normalized power',
                'win':'Lomb-Scargle normalized power'}
 
 METHODLABELS = {'gls':'Generalized Lomb-Scargle periodogram',
+                'fls':'Fast Generalized Lomb-Scargle periodogram',
                 'pdm':'Stellingwerf phase-dispersion minimization',
                 'aov':'Schwarzenberg-Czerny AoV',
                 'mav':'Schwarzenberg-Czerny AoV multi-harmonic',
                 'bls':'Box Least-squared Search',
                 'acf':'McQuillan+ ACF Period Search',
                 'sls':'Lomb-Scargle periodogram (Scipy)',
+                'tls':'Lomb-Scargle periodogram (Townsend 2010)',
                 'win':'Timeseries Sampling Lomb-Scargle periodogram'}
 
 METHODSHORTLABELS = {'gls':'Generalized L-S',
+                     'fls':'Fast Generalized L-S',
                      'pdm':'Stellingwerf PDM',
                      'aov':'Schwarzenberg-Czerny AoV',
                      'mav':'Schwarzenberg-Czerny AoVMH',
                      'acf':'McQuillan+ ACF',
                      'bls':'BLS',
                      'sls':'L-S (Scipy)',
+                     'tls':'L-S (Townsend)',
                      'win':'Sampling L-S'}
 
 
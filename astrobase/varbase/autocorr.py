@@ -18,7 +18,13 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
     where as npwhere, linspace as nplinspace, \
     zeros_like as npzeros_like, full_like as npfull_like, all as npall, \
     correlate as npcorrelate, nonzero as npnonzero, diff as npdiff, \
-    sort as npsort, ceil as npceil, int64 as npint64
+    sort as npsort, ceil as npceil, int64 as npint64, \
+    cumsum as npcumsum, log2 as nplog2, \
+    float64 as npfloat64
+
+from numpy.fft import rfft as nprfft, irfft as npirfft
+
+from time import time as unixtime
 
 from ..lcmath import sigclip_magseries, fill_magseries_gaps
 
@@ -98,14 +104,96 @@ def _autocorr_func3(mags, lag, maglen, magmed, magstd):
 
 
 
+def _autocorr_fft_products(mags, magmed, nlags):
+    '''This calculates the lagged product sums of a mag series using an FFT.
+
+    Returns an array with sum_i (mags[i] - magmed)*(mags[i+lag] - magmed) for
+    each lag in 0 ... nlags-1. The series is zero-padded to a power of two at
+    least mags.size + nlags - 1 long so the circular correlation from the FFT
+    doesn't wrap around for these lags. This is O(N log N) instead of O(N) per
+    lag.
+
+    '''
+
+    maglen = mags.size
+    nfft = int(2**npceil(nplog2(maglen + nlags - 1)))
+
+    xmags = mags - magmed
+    fmags = nprfft(xmags, n=nfft)
+    products = npirfft(fmags*fmags.conjugate(), n=nfft)
+
+    return products[:nlags]
+
+
+
+def _autocorr_fft_func1(mags, lags, maglen, magmed, magstd):
+    '''This is the FFT version of _autocorr_func1 for all lags at once.
+
+    lags MUST be the array nparange(0, nlags).
+
+    '''
+
+    xmags = mags - magmed
+    products = _autocorr_fft_products(mags, magmed, lags.size)
+
+    # _autocorr_func1 leaves out the first point of the series
+    products = products - xmags[0]*xmags[lags]
+
+    return products/((maglen - lags)*magstd)
+
+
+
+def _autocorr_fft_func2(mags, lags, maglen, magmed, magstd):
+    '''This is the FFT version of _autocorr_func2 for all lags at once.
+
+    lags MUST be the array nparange(0, nlags).
+
+    '''
+
+    xmags = mags - magmed
+    products = _autocorr_fft_products(mags, magmed, lags.size)
+
+    autocovarfunc = products/(maglen - lags)
+
+    # the variance for each lag only uses the first maglen - lag points
+    varfunc = npcumsum(xmags*xmags)[maglen - lags - 1]/maglen
+
+    return autocovarfunc/varfunc
+
+
+
+def _autocorr_fft_func3(mags, lags, maglen, magmed, magstd):
+    '''This is the FFT version of _autocorr_func3 for all lags at once.
+
+    lags MUST be the array nparange(0, nlags). Unlike _autocorr_func3, this
+    only returns the ACF for these lags.
+
+    '''
+
+    # the zero-lag product is the maximum of the full correlation
+    products = _autocorr_fft_products(mags, 0.0, lags.size)
+    return products/products[0]
+
+
+
+# these are the FFT versions of the ACF estimators above
+AUTOCORR_FFT_FUNCS = {_autocorr_func1:_autocorr_fft_func1,
+                      _autocorr_func2:_autocorr_fft_func2,
+                      _autocorr_func3:_autocorr_fft_func3}
+
+
+
 def autocorr_magseries(times, mags, errs,
                        maxlags=1000,
                        func=_autocorr_func3,
+                       usefft=False,
                        fillgaps=0.0,
                        forcetimebin=None,
                        sigclip=3.0,
                        magsarefluxes=False,
                        filterwindow=11,
+                       filldtype=npfloat64,
+                       fillbuffer=None,
                        verbose=True):
     '''This calculates the ACF of a light curve.
 
@@ -114,6 +202,17 @@ def autocorr_magseries(times, mags, errs,
     noise level obtained via the procedure above. If fillgaps == 'nan', fills
     the gaps with np.nan.
 
+    func is the ACF estimator to use, one of _autocorr_func1, _autocorr_func2,
+    or _autocorr_func3. If usefft is True, calculates the same estimator for all
+    lags at once using an FFT of the zero-padded gap-filled series (see
+    AUTOCORR_FFT_FUNCS). This is much faster for long light curves, since the
+    direct estimators are O(N) per lag (_autocorr_func3 is O(N^2) overall).
+
+    filldtype and fillbuffer are passed to fill_magseries_gaps as its dtype
+    and out kwargs. Reuse the same fillbuffer when calculating the ACFs of
+    several magcols to avoid new gap-filled arrays each time, but note that
+    the imags and ierrs in the returned dict then change on the next call.
+
     '''
 
     # get the gap-filled timeseries
@@ -123,6 +222,8 @@ def autocorr_magseries(times, mags, errs,
                                        sigclip=sigclip,
                                        magsarefluxes=magsarefluxes,
                                        filterwindow=filterwindow,
+                                       dtype=filldtype,
+                                       out=fillbuffer,
                                        verbose=verbose)
 
     if not interpolated:
@@ -133,15 +234,21 @@ def autocorr_magseries(times, mags, errs,
                             interpolated['imags'],
                             interpolated['ierrs'])
 
-    # calculate the lags up to maxlags
+    # calculate the lags up to maxlags. these must be less than the number of
+    # points in the gap-filled series
     if maxlags:
-        lags = nparange(0, maxlags)
+        lags = nparange(0, min(maxlags, imags.size))
     else:
-        lags = nparange(itimes.size)
+        lags = nparange(imags.size)
 
     series_stdev = 1.483*npmedian(npabs(imags))
 
-    if func != _autocorr_func3:
+    if usefft and func in AUTOCORR_FFT_FUNCS:
+
+        autocorr = AUTOCORR_FFT_FUNCS[func](imags, lags, imags.size,
+                                            0.0, series_stdev)
+
+    elif func != _autocorr_func3:
 
         # get the autocorrelation as a function of the lag of the mag series
         autocorr = nparray([func(imags, x, imags.size, 0.0, series_stdev)
@@ -158,3 +265,72 @@ def autocorr_magseries(times, mags, errs,
                          'acf':autocorr})
 
     return interpolated
+
+
+
+def benchmark_autocorr(npoints=(1000, 10000, 100000),
+                       maxlags=1000,
+                       funcs=(_autocorr_func1,
+                              _autocorr_func2,
+                              _autocorr_func3),
+                       directlimit=20000,
+                       randomseed=42):
+    '''This compares the direct ACF estimators to their FFT versions.
+
+    Generates a noisy sinusoid for each number of points in npoints and times
+    the direct and FFT calculations of the ACF for each func in funcs for lags
+    up to maxlags (or all lags for _autocorr_func3, which doesn't use
+    maxlags). The direct calculation is skipped for series longer than
+    directlimit points, since _autocorr_func3 is O(N^2).
+
+    Returns a list of dicts, one per npoints and func, with the times taken by
+    each calculation and the maximum absolute difference between them.
+
+    '''
+
+    from numpy.random import RandomState
+    randgen = RandomState(randomseed)
+
+    results = []
+
+    for npts in npoints:
+
+        mags = npsin(2.0*MPI*nparange(npts)/137.0) + randgen.randn(npts)
+        mags = mags - npmedian(mags)
+        magstd = 1.483*npmedian(npabs(mags))
+
+        for func in funcs:
+
+            if func == _autocorr_func3:
+                lags = nparange(npts)
+            else:
+                lags = nparange(min(maxlags, npts))
+
+            start = unixtime()
+            fftacf = AUTOCORR_FFT_FUNCS[func](mags, lags, npts, 0.0, magstd)
+            ffttime = unixtime() - start
+
+            if npts <= directlimit:
+
+                start = unixtime()
+                if func == _autocorr_func3:
+                    directacf = func(mags, 0, npts, 0.0, magstd)
+                else:
+                    directacf = nparray([func(mags, x, npts, 0.0, magstd)
+                                         for x in lags])
+                directtime = unixtime() - start
+                maxdiff = npmax(npabs(directacf - fftacf))
+
+            else:
+
+                directtime = npnan
+                maxdiff = npnan
+
+            results.append({'npoints':npts,
+                            'func':func.__name__,
+                            'nlags':lags.size,
+                            'directtime':directtime,
+                            'ffttime':ffttime,
+                            'maxdiff':maxdiff})
+
+    return results
@@ -92,6 +92,7 @@ from .. import lcmath
 from ..varbase import lcfit
 from ..lcmodels import sinusoidal, eclipses, transits
 from ..periodbase.zgls import specwindow_lsp
+from ..periodbase import expand_lspdict
 from .varfeatures import lightcurve_ptp_measures
 
 
@@ -432,7 +433,13 @@ def periodogram_features(pgramlist, times, mags, errs,
     a spectral window LSP and this must be obtained from the times, mags, errs
     directly by running periodbase.specwindow_lsp.
 
+    The dicts in pgramlist can also be compacted ones from
+    periodbase.compact_lspdict.
+
     '''
+    # regenerate the periodogram arrays of any compacted result dicts
+    pgramlist = [expand_lspdict(pgram) for pgram in pgramlist]
+
     # run the sampling peak periodogram if necessary
     pfmethodlist = [pgram['method'] for pgram in pgramlist]
 
@@ -492,7 +499,9 @@ def periodogram_features(pgramlist, times, mags, errs,
                     #
                     # first, get the normalized peak ratio
                     #
-                    thisp_norm_pgrampeak = normalized_peaks[periods == bp]
+                    thisp_norm_pgrampeak = normalized_peaks[
+                        np.argmin(np.abs(periods - bp))
+                    ]
 
                     thisp_sampling_pgramind = (
                         np.abs(normalized_sampling_periods -
@@ -507,7 +516,7 @@ def periodogram_features(pgramlist, times, mags, errs,
                         )
                     elif thisp_sampling_peaks.size == 1:
                         thisp_sampling_ratio = (
-                            thisp_norm_pgrampeak/thisp_sampling_peaks
+                            thisp_norm_pgrampeak/thisp_sampling_peaks[0]
                         )
                     else:
                         LOGERROR('sampling periodogram is not defined '
@@ -567,7 +576,9 @@ def periodogram_features(pgramlist, times, mags, errs,
 
                 if np.isfinite(bp):
 
-                    thisp_norm_pgrampeak = normalized_peaks[periods == bp]
+                    thisp_norm_pgrampeak = normalized_peaks[
+                        np.argmin(np.abs(periods - bp))
+                    ]
 
                     thisp_sampling_pgramind = (
                         np.abs(normalized_sampling_periods -
@@ -582,7 +593,7 @@ def periodogram_features(pgramlist, times, mags, errs,
                         )
                     elif thisp_sampling_peaks.size == 1:
                         thisp_sampling_ratio = (
-                            thisp_norm_pgrampeak/thisp_sampling_peaks
+                            thisp_norm_pgrampeak/thisp_sampling_peaks[0]
                         )
                     else:
                         LOGERROR('sampling periodogram is not defined '
@@ -0,0 +1,235 @@
+'''test_lcmath.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Feb 2018
+License: MIT - see the LICENSE file for details.
+
+This tests the following:
+
+- bins random time and phase series using astrobase.lcmath and checks the
+  binned values against a direct calculation for each bin
+
+- checks that sigma-clipping a CleanedMagSeries gives the same results as
+  sigma-clipping the raw arrays, and that these results are cached
+
+- checks the sigma-clip masks for single and stacked mag series against an
+  iterative sigma-clip done with np.median and fancy-indexing
+
+- fills the gaps in a regularly sampled light curve and checks the filled
+  values against a direct calculation for each cadence
+
+'''
+from __future__ import print_function
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from astrobase import lcmath
+
+
+###########
+## TESTS ##
+###########
+
+def test_phase_bin_magseries():
+    '''
+    Tests lcmath.phase_bin_magseries and its binstats.
+
+    '''
+
+    randgen = np.random.RandomState(42)
+    phases = randgen.rand(5000)
+    mags = randgen.randn(5000)
+
+    binned = lcmath.phase_bin_magseries(phases, mags,
+                                        binsize=0.0137,
+                                        minbinelems=7,
+                                        binstats=['mean','std','count'])
+
+    # each point goes into the bin with the nearest center
+    bincenters = np.array(binned['phasebins'])
+    for binind in binned['phasebins_indices']:
+        nearest = np.argmin(np.abs(phases[binind,None] - bincenters), axis=1)
+        assert np.unique(nearest).size == 1
+
+    assert binned['nbins'] == len(binned['phasebins_indices'])
+    assert_allclose(binned['binnedphases'],
+                    [np.median(phases[x]) for x in binned['phasebins_indices']])
+    assert_allclose(binned['binnedmags'],
+                    [np.median(mags[x]) for x in binned['phasebins_indices']])
+    assert_allclose(binned['binnedmags_mean'],
+                    [np.mean(mags[x]) for x in binned['phasebins_indices']])
+    assert_allclose(binned['binnedmags_std'],
+                    [np.std(mags[x]) for x in binned['phasebins_indices']])
+    assert_allclose(binned['binnedcounts'],
+                    [x.size for x in binned['phasebins_indices']])
+
+
+
+def test_time_bin_magseries_with_errs():
+    '''
+    Tests lcmath.time_bin_magseries_with_errs.
+
+    '''
+
+    randgen = np.random.RandomState(42)
+    times = 2455000.0 + np.sort(randgen.rand(3000))*30.0
+    mags = randgen.randn(3000)
+    errs = np.abs(randgen.randn(3000))
+    mags[10] = np.nan
+
+    binned = lcmath.time_bin_magseries_with_errs(times, mags, errs,
+                                                 binsize=3600.0,
+                                                 minbinelems=3)
+
+    finiteind = np.isfinite(mags)
+    ftimes, fmags, ferrs = times[finiteind], mags[finiteind], errs[finiteind]
+
+    assert all(x.size >= 3 for x in binned['jdbins_indices'])
+    assert (np.sum([x.size for x in binned['jdbins_indices']]) <=
+            ftimes.size)
+    assert_allclose(binned['binnedtimes'],
+                    [np.median(ftimes[x]) for x in binned['jdbins_indices']])
+    assert_allclose(binned['binnedmags'],
+                    [np.median(fmags[x]) for x in binned['jdbins_indices']])
+    assert_allclose(binned['binnederrs'],
+                    [np.median(ferrs[x]) for x in binned['jdbins_indices']])
+
+
+
+def test_cleaned_magseries_sigclip():
+    '''
+    Tests lcmath.CleanedMagSeries against lcmath.sigclip_magseries.
+
+    '''
+
+    randgen = np.random.RandomState(42)
+    times = 2455000.0 + np.sort(randgen.rand(2000))*30.0
+    mags = 12.0 + 0.05*randgen.randn(2000)
+    errs = np.full_like(mags, 0.05)
+    mags[[10, 20]] = np.nan
+    mags[[100, 200, 300]] = [14.0, 10.0, 13.0]
+
+    cleanedlc = lcmath.CleanedMagSeries(times, mags, errs)
+
+    for sigclip in (None, 3.0, [3.0, 10.0]):
+        for iterative in (False, True):
+
+            rawclip = lcmath.sigclip_magseries(times, mags, errs,
+                                               sigclip=sigclip,
+                                               iterative=iterative)
+            lcclip = lcmath.sigclip_magseries(*cleanedlc,
+                                              sigclip=sigclip,
+                                              iterative=iterative)
+
+            for rawarr, lcarr in zip(rawclip, lcclip):
+                assert_allclose(rawarr, lcarr)
+
+            # the second call should return the cached arrays
+            lcclip_again = cleanedlc.sigclip(sigclip=sigclip,
+                                             iterative=iterative)
+            assert all(x is y for x, y in zip(lcclip, lcclip_again))
+
+    assert cleanedlc.finite_index.sum() == 1998
+    assert not cleanedlc.mags.flags.writeable
+
+
+
+def test_sigclip_magseries_mask():
+    '''
+    Tests lcmath.sigclip_magseries_mask and sigclip_magseries_batch_mask.
+
+    '''
+
+    randgen = np.random.RandomState(42)
+    times = 2455000.0 + np.sort(randgen.rand(5001))*30.0
+    mags = 12.0 + 0.05*randgen.standard_t(3, size=(3, 5001))
+    mags[0, 100] = np.nan
+    times[200] = np.nan
+
+    for magrow in mags:
+
+        # iterative sigma-clip done the obvious way
+        finiteind = np.isfinite(times) & np.isfinite(magrow)
+        expected = np.flatnonzero(finiteind)
+        delta = 1
+        while delta:
+            median = np.median(magrow[expected])
+            stdev = np.median(np.abs(magrow[expected] - median)) * 1.483
+            keep = np.abs(magrow[expected] - median) < 3.0*stdev
+            delta = expected.size - keep.sum()
+            expected = expected[keep]
+
+        mask = lcmath.sigclip_magseries_mask(times, magrow, None,
+                                             sigclip=3.0,
+                                             iterative=True)
+        assert_array_equal(np.flatnonzero(mask), expected)
+
+        stimes, smags, serrs = lcmath.sigclip_magseries(times, magrow, None,
+                                                         sigclip=3.0,
+                                                         iterative=True)
+        assert_array_equal(smags, magrow[expected])
+        assert serrs is None
+
+    batchmask = lcmath.sigclip_magseries_batch_mask(times, mags,
+                                                    sigclip=[3.0, 5.0],
+                                                    iterative=True)
+    for magrow, rowmask in zip(mags, batchmask):
+        assert_array_equal(
+            rowmask,
+            lcmath.sigclip_magseries_mask(times, magrow, None,
+                                          sigclip=[3.0, 5.0],
+                                          iterative=True)
+        )
+
+
+
+def test_fill_magseries_gaps():
+    '''
+    Tests lcmath.fill_magseries_gaps.
+
+    '''
+
+    randgen = np.random.RandomState(42)
+    times = 2455000.0 + np.arange(3000)*0.0204
+    keepind = randgen.rand(3000) > 0.1
+    keepind[1000:1200] = False
+    times = times[keepind]
+    mags = 12.0 + 0.01*randgen.randn(times.size)
+    errs = 0.01 + 0.001*randgen.rand(times.size)
+
+    # bin to three cadences so some of the new cadences have several points
+    filled = lcmath.fill_magseries_gaps(times, mags, errs,
+                                        fillgaps='nan',
+                                        sigclip=None,
+                                        forcetimebin=0.0612,
+                                        verbose=False)
+
+    itimes, imags, ierrs = filled['itimes'], filled['imags'], filled['ierrs']
+    nmags = mags - np.median(mags)
+
+    assert filled['cadence'] == 0.0612
+    assert_allclose(np.diff(itimes), 0.0612, rtol=1.0e-3)
+    assert np.isnan(imags[-1])
+
+    for itime, imag, ierr in zip(itimes[:-1], imags[:-1], ierrs[:-1]):
+
+        inbin = (times > itime) & (times < itime + 0.0612)
+
+        if inbin.any():
+            assert_allclose(imag, np.median(nmags[inbin]))
+            assert_allclose(ierr, np.median(errs[inbin]))
+        else:
+            assert np.isnan(imag) and np.isnan(ierr)
+
+    # the same thing written into a float32 buffer, with interpolated gaps
+    fillbuffer = np.empty((2, itimes.size), dtype=np.float32)
+    interpolated = lcmath.fill_magseries_gaps(times, mags, errs,
+                                              fillgaps='interpolate',
+                                              sigclip=None,
+                                              forcetimebin=0.0612,
+                                              out=fillbuffer,
+                                              verbose=False)
+
+    assert np.shares_memory(interpolated['imags'], fillbuffer)
+    assert np.all(np.isfinite(interpolated['imags']))
+    filledind = np.isfinite(imags)
+    assert_allclose(interpolated['imags'][filledind], imags[filledind],
+                    rtol=1.0e-5, atol=1.0e-6)
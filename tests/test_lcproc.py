@@ -0,0 +1,436 @@
+'''test_lcproc.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Feb 2018
+License: MIT - see the LICENSE file for details.
+
+This tests the following:
+
+- makes a fake light curve with several magcols on the same time column
+- registers a custom LC format for it with astrobase.lcproc
+- runs lcproc.runpf on it with and without the batched GLS for its magcols
+- checks the stage timings of the batched GLS in lcproc.summarize_pf_timing
+- runs lcproc.runpf_incremental on it as it grows between runs
+- checks the processing cache keys and manifests, and runpf_field skipping
+  the LCs that were processed already
+
+'''
+from __future__ import print_function
+import os
+import os.path
+import shutil
+import tempfile
+try:
+    import cPickle as pickle
+except:
+    import pickle
+import numpy as np
+from numpy.testing import assert_allclose
+
+from astrobase import lcproc, periodbase
+
+
+############
+## CONFIG ##
+############
+
+# these are the magcols of the fake LC, all on the same time column
+FAKEMAGCOLS = ['ap1','ap2','ap3']
+FAKEERRCOLS = ['err1','err2','err3']
+FAKEPERIODS = [1.3, 2.7, 0.77]
+
+
+def read_fake_lc(lcfile):
+    '''
+    This reads the fake LC pickles made by make_fake_lc.
+
+    '''
+
+    with open(lcfile,'rb') as infd:
+        return pickle.load(infd)
+
+
+def make_fake_lc(lcdir, objectid='FAKE-0001', seed=42):
+    '''
+    This writes a fake LC with sinusoids in each magcol and returns its path.
+
+    The magcols have NaNs in different places and an outlier at one end of the
+    LC, so their sigma-clipped time spans aren't all the same.
+
+    '''
+
+    rng = np.random.RandomState(seed)
+    ndet = 1500
+
+    times = 56000.0 + np.sort(rng.rand(ndet))*30.0
+
+    lcdict = {'objectid':objectid,
+              'objectinfo':{'ra':100.0, 'decl':-30.0},
+              'rjd':times}
+
+    for mcol, ecol, period in zip(FAKEMAGCOLS, FAKEERRCOLS, FAKEPERIODS):
+
+        mags = (12.0 + 0.05*np.sin(2.0*np.pi*times/period) +
+                0.01*rng.randn(ndet))
+        errs = np.full_like(mags, 0.01)
+
+        mags[rng.randint(0, ndet, size=20)] = np.nan
+        lcdict[mcol] = mags
+        lcdict[ecol] = errs
+
+    # an outlier at the end of one magcol and a missing first point in another
+    lcdict['ap2'][-1] = 20.0
+    lcdict['ap3'][0] = np.nan
+
+    lcfile = os.path.join(lcdir, '%s-fakelc.pkl' % objectid)
+    with open(lcfile,'wb') as outfd:
+        pickle.dump(lcdict, outfd, pickle.HIGHEST_PROTOCOL)
+
+    return lcfile
+
+
+lcproc.register_custom_lcformat('fake-test',
+                                '*-fakelc.pkl',
+                                read_fake_lc,
+                                ['rjd']*len(FAKEMAGCOLS),
+                                FAKEMAGCOLS,
+                                FAKEERRCOLS,
+                                magsarefluxes=False)
+
+
+###########
+## TESTS ##
+###########
+
+def test_runpf_batchmagcols():
+    '''
+    Tests lcproc.runpf with batchmagcols=True against batchmagcols=False.
+
+    '''
+
+    tempdir = tempfile.mkdtemp()
+
+    try:
+
+        lcfile = make_fake_lc(tempdir)
+
+        pfresults = []
+
+        for batchmagcols in (False, True):
+
+            outdir = os.path.join(tempdir, 'batch-%s' % batchmagcols)
+            os.mkdir(outdir)
+
+            # the second GLS run can't be batched, so it uses pgen_lsp
+            outfile = lcproc.runpf(
+                lcfile,
+                outdir,
+                lcformat='fake-test',
+                pfmethods=['gls','gls'],
+                pfkwargs=[{'startp':0.5, 'endp':10.0},
+                          {'startp':0.5, 'endp':10.0, 'coarsetofine':True}],
+                sigclip=5.0,
+                nworkers=2,
+                batchmagcols=batchmagcols
+            )
+
+            with open(outfile,'rb') as infd:
+                pfresults.append(pickle.load(infd))
+
+        unbatched, batched = pfresults
+
+        for mcol, period in zip(FAKEMAGCOLS, FAKEPERIODS):
+
+            for pfmkey in ('0-gls','1-gls'):
+
+                assert_allclose(batched[mcol][pfmkey]['periods'],
+                                unbatched[mcol][pfmkey]['periods'])
+                assert_allclose(batched[mcol][pfmkey]['lspvals'],
+                                unbatched[mcol][pfmkey]['lspvals'],
+                                rtol=1.0e-8, atol=1.0e-10)
+                assert_allclose(batched[mcol][pfmkey]['nbestperiods'],
+                                unbatched[mcol][pfmkey]['nbestperiods'])
+
+            assert_allclose(batched[mcol]['0-gls']['bestperiod'],
+                            period, rtol=1.0e-2)
+
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+
+def test_runpf_batchmagcols_timing():
+    '''
+    Tests that lcproc.summarize_pf_timing includes the batched GLS timings.
+
+    '''
+
+    tempdir = tempfile.mkdtemp()
+
+    try:
+
+        lcfile = make_fake_lc(tempdir)
+
+        outfile = lcproc.runpf(
+            lcfile,
+            tempdir,
+            lcformat='fake-test',
+            pfmethods=['gls'],
+            pfkwargs=[{}],
+            nworkers=2,
+            batchmagcols=True,
+            timing=True
+        )
+
+        with open(outfile,'rb') as infd:
+            pfresults = pickle.load(infd)
+
+        batchtiming = pfresults['ap1']['0-gls']['timing']['batch']
+        assert batchtiming['nseries'] == len(FAKEMAGCOLS)
+
+        summary = lcproc.summarize_pf_timing([outfile])
+        glstiming = summary['methods']['gls']
+
+        assert glstiming['nruns'] == len(FAKEMAGCOLS)
+        assert_allclose(glstiming['wall']['kernel'],
+                        batchtiming['wall']['kernel'])
+        assert glstiming['kernelrate'] > 0.0
+
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+
+def test_runpf_incremental():
+    '''
+    Tests lcproc.runpf_incremental on an LC that grows between runs.
+
+    '''
+
+    tempdir = tempfile.mkdtemp()
+
+    try:
+
+        lcfile = make_fake_lc(tempdir)
+        lcdict = read_fake_lc(lcfile)
+        times = lcdict['rjd']
+
+        # add an outlier at the same time as a good point in the second half
+        dupind = 1200
+        lcdict['rjd'] = np.insert(times, dupind, times[dupind])
+        for col in FAKEMAGCOLS + FAKEERRCOLS:
+            lcdict[col] = np.insert(lcdict[col], dupind, lcdict[col][dupind])
+        lcdict['ap1'][dupind] = 20.0
+
+        glskwargs = {'startp':1.0, 'endp':10.0, 'autofreq':False}
+
+        # run on the first part of the LC, then again after it grows
+        for ndet in (800, lcdict['rjd'].size):
+
+            with open(lcfile,'wb') as outfd:
+                pickle.dump({x:(lcdict[x][:ndet]
+                                if isinstance(lcdict[x], np.ndarray)
+                                else lcdict[x]) for x in lcdict},
+                            outfd, pickle.HIGHEST_PROTOCOL)
+
+            incremental = lcproc.runpf_incremental(lcfile,
+                                                   tempdir,
+                                                   lcformat='fake-test',
+                                                   glskwargs=glskwargs,
+                                                   sigclip=5.0)
+
+        for mcol, ecol in zip(FAKEMAGCOLS, FAKEERRCOLS):
+
+            full = periodbase.pgen_lsp(lcdict['rjd'],
+                                       lcdict[mcol],
+                                       lcdict[ecol],
+                                       sigclip=5.0,
+                                       nworkers=1,
+                                       verbose=False,
+                                       **glskwargs)
+
+            assert_allclose(incremental[mcol]['omegas'], full['omegas'])
+            assert_allclose(incremental[mcol]['lspvals'], full['lspvals'],
+                            rtol=1.0e-7, atol=1.0e-9)
+            assert_allclose(incremental[mcol]['bestperiod'],
+                            full['bestperiod'])
+
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+
+def test_processing_manifest():
+    '''
+    Tests lcproc.get_processing_cachekey and the processing manifest.
+
+    '''
+
+    tempdir = tempfile.mkdtemp()
+
+    try:
+
+        lcfile = make_fake_lc(tempdir)
+        outfile = os.path.join(tempdir, 'output.pkl')
+        with open(outfile,'wb') as outfd:
+            outfd.write(b'output')
+
+        cachekey = lcproc.get_processing_cachekey('runpf', [lcfile],
+                                                  {'sigclip':10.0})
+
+        # the key changes with the kwargs and the LC file's mtime
+        assert cachekey == lcproc.get_processing_cachekey('runpf', [lcfile],
+                                                          {'sigclip':10.0})
+        assert cachekey != lcproc.get_processing_cachekey('runpf', [lcfile],
+                                                          {'sigclip':5.0})
+
+        lcstat = os.stat(lcfile)
+        os.utime(lcfile, (lcstat.st_atime, lcstat.st_mtime + 10.0))
+        newkey = lcproc.get_processing_cachekey('runpf', [lcfile],
+                                                {'sigclip':10.0})
+        assert newkey != cachekey
+
+        lcproc._update_processing_manifest(tempdir, 'runpf', lcfile,
+                                           newkey, outfile)
+        assert lcproc._get_processed_outfile(tempdir, 'runpf',
+                                             lcfile, newkey) == outfile
+        assert lcproc._get_processed_outfile(tempdir, 'runpf',
+                                             lcfile, cachekey) is None
+
+        # a partly written line at the end is left for the next read
+        manifest = os.path.join(tempdir, lcproc.PROCESSING_MANIFEST % 'runpf')
+        otherfile = os.path.abspath(os.path.join(tempdir, 'other.pkl'))
+        with open(manifest,'ab') as outfd:
+            outfd.write(b'{"inputfile": "%s", "cachekey": "abc", '
+                        % otherfile.encode('utf-8'))
+
+        entries = lcproc.read_processing_manifest(tempdir, 'runpf')
+        assert otherfile not in entries
+        assert entries[os.path.abspath(lcfile)]['cachekey'] == newkey
+
+        with open(manifest,'ab') as outfd:
+            outfd.write(b'"outfile": null}\n')
+
+        entries = lcproc.read_processing_manifest(tempdir, 'runpf')
+        assert entries[otherfile]['cachekey'] == 'abc'
+
+        # a missing output means the LC is processed again
+        os.remove(outfile)
+        assert lcproc._get_processed_outfile(tempdir, 'runpf',
+                                             lcfile, newkey) is None
+
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+
+def test_timebinlc_excludeprocessed():
+    '''
+    Tests that lcproc.timebinlc keeps a manifest entry for each binsize.
+
+    '''
+
+    tempdir = tempfile.mkdtemp()
+
+    try:
+
+        lcfile = make_fake_lc(tempdir)
+        outdir = os.path.join(tempdir, 'binned')
+        os.mkdir(outdir)
+
+        outfiles = [lcproc.timebinlc(lcfile, binsizesec, outdir=outdir,
+                                     lcformat='fake-test',
+                                     excludeprocessed=True)
+                    for binsizesec in (3600.0, 7200.0)]
+        assert outfiles[0] != outfiles[1]
+        outmtimes = [os.stat(x).st_mtime for x in outfiles]
+
+        # keep track of the LCs that get read
+        readlcs = []
+
+        def read_and_record(lcfile):
+            readlcs.append(lcfile)
+            return read_fake_lc(lcfile)
+
+        lcproc.LCFORM['fake-test'][1] = read_and_record
+
+        try:
+            newoutfiles = [lcproc.timebinlc(lcfile, binsizesec, outdir=outdir,
+                                            lcformat='fake-test',
+                                            excludeprocessed=True)
+                           for binsizesec in (3600.0, 7200.0)]
+        finally:
+            lcproc.LCFORM['fake-test'][1] = read_fake_lc
+
+        # neither binned LC is made again
+        assert readlcs == []
+        assert newoutfiles == outfiles
+        assert [os.stat(x).st_mtime for x in outfiles] == outmtimes
+
+        manifest = lcproc.read_processing_manifest(outdir, 'timebinlc')
+        assert set(manifest) == {(os.path.abspath(lcfile), 3600.0),
+                                 (os.path.abspath(lcfile), 7200.0)}
+
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+
+def test_runpf_field_excludeprocessed():
+    '''
+    Tests that lcproc.runpf_field leaves out the LCs processed already.
+
+    '''
+
+    tempdir = tempfile.mkdtemp()
+
+    try:
+
+        lcfiles = [make_fake_lc(tempdir, objectid='FAKE-%04d' % x, seed=x)
+                   for x in range(3)]
+        runkwargs = {'lcformat':'fake-test',
+                     'pfmethods':['gls'],
+                     'pfkwargs':[{'startp':0.5, 'endp':10.0}],
+                     'nworkers':1,
+                     'excludeprocessed':True}
+
+        outfiles = lcproc.runpf_field(lcfiles[:2], tempdir, **runkwargs)
+        outmtimes = [os.stat(x).st_mtime for x in outfiles]
+
+        # keep track of the LCs that get read
+        readlcs = []
+
+        def read_and_record(lcfile):
+            readlcs.append(lcfile)
+            return read_fake_lc(lcfile)
+
+        lcproc.LCFORM['fake-test'][1] = read_and_record
+
+        try:
+            newoutfiles = lcproc.runpf_field(lcfiles, tempdir, **runkwargs)
+        finally:
+            lcproc.LCFORM['fake-test'][1] = read_fake_lc
+
+        # only the new LC is read and processed
+        assert set(readlcs) == {lcfiles[2]}
+        assert newoutfiles[:2] == outfiles
+        assert [os.stat(x).st_mtime for x in outfiles] == outmtimes
+        assert newoutfiles[2] is not None and os.path.exists(newoutfiles[2])
+
+        # runpf doesn't reuse the output made from the runpf_field batch
+        manifest = lcproc.read_processing_manifest(tempdir, 'runpf')
+        fieldkey = manifest[os.path.abspath(lcfiles[0])]['cachekey']
+
+        lcproc.runpf(lcfiles[0], tempdir, batchmagcols=False, **runkwargs)
+
+        manifest = lcproc.read_processing_manifest(tempdir, 'runpf')
+        runpfkey = manifest[os.path.abspath(lcfiles[0])]['cachekey']
+        assert runpfkey != fieldkey
+
+        # and runs again if batchmagcols changes
+        lcproc.runpf(lcfiles[0], tempdir, batchmagcols=True, **runkwargs)
+
+        manifest = lcproc.read_processing_manifest(tempdir, 'runpf')
+        assert manifest[os.path.abspath(lcfiles[0])]['cachekey'] not in (
+            fieldkey, runpfkey
+        )
+
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
@@ -11,14 +11,20 @@ This tests the following:
 from __future__ import print_function
 import os
 import os.path
+import shutil
+import tempfile
 try:
     from urllib import urlretrieve
 except:
     from urllib.request import urlretrieve
+import numpy as np
 from numpy.testing import assert_allclose
 
 from astrobase.hatsurveys import hatlc
-from astrobase import periodbase
+from astrobase import periodbase, lcmath
+from astrobase.periodbase import zgls, saov, spdm, oldpf
+from astrobase.varbase import autocorr
+from astrobase.varclass import periodicfeatures
 
 
 ############
@@ -63,6 +69,108 @@ def test_gls():
 
 
 
+def test_gls_blockmode():
+    '''
+    Tests periodbase.pgen_lsp with the block-frequency workers against the
+    single-frequency workers.
+
+    '''
+
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    gls_block = periodbase.pgen_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'],
+                                    blockmode=True)
+    gls_single = periodbase.pgen_lsp(lcd['rjd'], lcd['aep_000'],
+                                     lcd['aie_000'], blockmode=False)
+
+    assert_allclose(gls_block['bestperiod'], 1.54289477)
+    assert_allclose(gls_block['lspvals'], gls_single['lspvals'], atol=1.0e-10)
+
+
+
+def test_trig_recurrence():
+    '''
+    Tests the trig recurrence for uniform frequency grids against the direct
+    calculation.
+
+    '''
+
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    times = lcd['rjd'][np.isfinite(lcd['rjd'])]
+    omegas = 2.0*np.pi*periodbase.get_frequency_grid(times)[:1000]
+
+    sin_rec, cos_rec = periodbase.get_trig_block(times, omegas)
+    sin_dir, cos_dir = periodbase.get_trig_block(times, omegas, uniform=False)
+
+    assert periodbase.is_uniform_grid(omegas)
+    assert_allclose(sin_rec, sin_dir, atol=1.0e-8)
+    assert_allclose(cos_rec, cos_dir, atol=1.0e-8)
+
+
+
+def test_fls():
+    '''
+    Tests periodbase.fast_lsp against the exact floating-mean GLS.
+
+    '''
+
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    fls = periodbase.fast_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'])
+    gls = periodbase.pgen_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'],
+                              glspfunc=zgls.glsp_worker_notau)
+
+    assert isinstance(fls, dict)
+    assert fls['method'] == 'fls'
+    assert_allclose(fls['bestperiod'], gls['bestperiod'])
+    assert_allclose(fls['lspvals'], gls['lspvals'], atol=2.0e-3)
+
+
+
+def test_townsend_lsp():
+    '''
+    Tests the vectorized Townsend LSP against the single-omega version.
+
+    '''
+
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    tls = oldpf.townsend_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'],
+                             startp=1.0, endp=2.0, nworkers=2)
+
+    assert isinstance(tls, dict)
+    assert tls['method'] == 'tls'
+    assert_allclose(tls['bestperiod'], 1.54289477, rtol=1.0e-3)
+
+    times = lcd['rjd'][np.isfinite(lcd['rjd']) & np.isfinite(lcd['aep_000'])]
+    mags = lcd['aep_000'][np.isfinite(lcd['rjd']) &
+                          np.isfinite(lcd['aep_000'])]
+    mags = (mags - np.median(mags))/np.std(mags)
+    omegas = tls['omegas'][:200]
+
+    blocklsp = oldpf.townsend_lombscargle_block(times, mags, omegas)
+    singlelsp = np.array([oldpf.townsend_lombscargle_value(times, mags, x)
+                          for x in omegas])
+    assert_allclose(blocklsp, singlelsp, rtol=1.0e-6, atol=1.0e-6)
+
+
+
+def test_gls_coarsetofine():
+    '''
+    Tests periodbase.pgen_lsp with the coarse-to-fine frequency search.
+
+    '''
+
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    gls = periodbase.pgen_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'],
+                              coarsetofine=True)
+
+    assert isinstance(gls, dict)
+    assert_allclose(gls['bestperiod'], 1.54289477)
+    assert gls['lspvals'].size == gls['omegas'].size
+    assert gls['coarsetofine']['nsaved'] > 0
+    assert (gls['coarsetofine']['nevaluated'] + gls['coarsetofine']['nsaved']
+            == gls['coarsetofine']['nfullgrid'])
+
+
+
 def test_win():
     '''
     Tests periodbase.specwindow_lsp
@@ -107,6 +215,38 @@ def test_aov():
 
 
 
+def test_aov_pdm_batch():
+    '''
+    Tests the batched AoV and PDM theta kernels against the single-frequency
+    ones.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    finind = (np.isfinite(lcd['rjd']) & np.isfinite(lcd['aep_000']) &
+              np.isfinite(lcd['aie_000']))
+    times = lcd['rjd'][finind]
+    mags = lcd['aep_000'][finind]
+    errs = lcd['aie_000'][finind]
+
+    freqs = periodbase.get_frequency_grid(times)[:200]
+
+    for binstat in ('median','mean'):
+        aov_batch = saov.aov_theta_batch(times, mags, errs, freqs,
+                                         binstat=binstat)
+        aov_single = [saov.aov_theta(times, mags, errs, x, binstat=binstat)
+                      for x in freqs]
+        assert_allclose(aov_batch, aov_single, rtol=1.0e-10)
+
+    pdm_batch = spdm.stellingwerf_pdm_theta_batch(times, mags, errs, freqs)
+    pdm_single = [spdm.stellingwerf_pdm_theta(times, mags, errs, x)
+                  for x in freqs]
+
+    # the batched bin variances are sum(x^2) - sum(x)^2/n instead of the
+    # two-pass sum((x - mean)^2), so these only agree to ~1e-7
+    assert_allclose(pdm_batch, pdm_single, rtol=1.0e-7)
+
+
+
 def test_aovhm():
     '''
     Tests periodbase.aov_periodfind.
@@ -122,6 +262,30 @@ def test_aovhm():
 
 
 
+def test_aovhm_batch():
+    '''
+    Tests periodbase.aovhm_periodfind with the batched kernel against the
+    single-frequency kernel.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    mav_batch = periodbase.aovhm_periodfind(lcd['rjd'],
+                                            lcd['aep_000'],
+                                            lcd['aie_000'],
+                                            batchkernel=True)
+    mav_single = periodbase.aovhm_periodfind(lcd['rjd'],
+                                             lcd['aep_000'],
+                                             lcd['aie_000'],
+                                             batchkernel=False)
+
+    assert_allclose(mav_batch['bestperiod'], 3.08578956)
+    assert mav_batch['lspvals'].dtype == np.float64
+    assert mav_single['lspvals'].dtype == np.float64
+    assert_allclose(mav_batch['lspvals'], mav_single['lspvals'],
+                    rtol=1.0e-8)
+
+
+
 def test_acf():
     '''
     Tests periodbase.macf_period_find.
@@ -138,6 +302,70 @@ def test_acf():
 
 
 
+def test_acf_fft():
+    '''
+    Tests the FFT ACF estimators against the direct ones.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+
+    randgen = np.random.RandomState(42)
+    shorttimes = 2455000.0 + np.arange(300)*0.0204
+    shortmags = 12.0 + 0.01*randgen.randn(300)
+    shorterrs = np.full_like(shortmags, 0.01)
+
+    for func in autocorr.AUTOCORR_FFT_FUNCS:
+
+        direct = autocorr.autocorr_magseries(lcd['rjd'],
+                                             lcd['aep_000'],
+                                             lcd['aie_000'],
+                                             maxlags=500,
+                                             func=func,
+                                             verbose=False)
+        fft = autocorr.autocorr_magseries(lcd['rjd'],
+                                          lcd['aep_000'],
+                                          lcd['aie_000'],
+                                          maxlags=500,
+                                          func=func,
+                                          usefft=True,
+                                          verbose=False)
+
+        assert fft['acf'].size == fft['lags'].size
+        assert_allclose(fft['acf'], direct['acf'][:fft['lags'].size],
+                        rtol=1.0e-7, atol=1.0e-9)
+
+        # maxlags longer than the gap-filled series only goes up to its end
+        shortdirect = autocorr.autocorr_magseries(shorttimes,
+                                                  shortmags,
+                                                  shorterrs,
+                                                  maxlags=100000,
+                                                  func=func,
+                                                  verbose=False)
+        shortfft = autocorr.autocorr_magseries(shorttimes,
+                                               shortmags,
+                                               shorterrs,
+                                               maxlags=100000,
+                                               func=func,
+                                               usefft=True,
+                                               verbose=False)
+
+        # the last lags of _autocorr_func2 can be 0/0 for both versions
+        assert shortfft['lags'].size == shortfft['imags'].size
+        assert shortdirect['acf'].size == shortfft['acf'].size
+        finiteind = np.isfinite(shortdirect['acf'])
+        assert_allclose(shortfft['acf'][finiteind],
+                        shortdirect['acf'][finiteind],
+                        rtol=1.0e-7, atol=1.0e-9)
+
+    acf = periodbase.macf_period_find(lcd['rjd'],
+                                      lcd['aep_000'],
+                                      lcd['aie_000'],
+                                      smoothacf=721,
+                                      usefft=False)
+    assert_allclose(acf['bestperiod'], 3.0750854011348565)
+
+
+
 def test_bls_serial():
     '''
     Tests periodbase.bls_serial_pfind.
@@ -167,3 +395,404 @@ def test_bls_parallel():
 
     assert isinstance(bls, dict)
     assert_allclose(bls['bestperiod'], 3.08560655)
+
+
+
+def test_bls_numpy():
+    '''
+    Tests the numpy BLS engine against eebls and its parallel version against
+    the serial version.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    bls_eebls = periodbase.bls_serial_pfind(lcd['rjd'],
+                                            lcd['aep_000'],
+                                            lcd['aie_000'],
+                                            startp=1.0,
+                                            blsengine='eebls')
+    bls_numpy = periodbase.bls_serial_pfind(lcd['rjd'],
+                                            lcd['aep_000'],
+                                            lcd['aie_000'],
+                                            startp=1.0,
+                                            blsengine='numpy')
+    bls_parallel = periodbase.bls_parallel_pfind(lcd['rjd'],
+                                                 lcd['aep_000'],
+                                                 lcd['aie_000'],
+                                                 startp=1.0,
+                                                 nworkers=2,
+                                                 blsengine='numpy')
+
+    assert_allclose(bls_numpy['bestperiod'], 3.08560655)
+    assert_allclose(bls_numpy['lspvals'], bls_eebls['lspvals'], rtol=1.0e-8)
+    assert np.array_equal(bls_parallel['lspvals'], bls_numpy['lspvals'])
+    assert bls_parallel['bestperiod'] == bls_numpy['bestperiod']
+
+
+
+def test_bootstrap_fap():
+    '''
+    Tests periodbase.bootstrap_falsealarmprob with shared trials.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    gls = periodbase.pgen_lsp(lcd['rjd'],
+                              lcd['aep_000'],
+                              lcd['aie_000'])
+
+    fap_serial = periodbase.bootstrap_falsealarmprob(gls,
+                                                     lcd['rjd'],
+                                                     lcd['aep_000'],
+                                                     lcd['aie_000'],
+                                                     nbootstrap=20,
+                                                     npeaks=2,
+                                                     nworkers=1,
+                                                     seed=42)
+    fap_parallel = periodbase.bootstrap_falsealarmprob(gls,
+                                                       lcd['rjd'],
+                                                       lcd['aep_000'],
+                                                       lcd['aie_000'],
+                                                       nbootstrap=20,
+                                                       npeaks=2,
+                                                       nworkers=2,
+                                                       seed=42)
+
+    assert fap_serial['ntrials'] == 20
+    assert_allclose(fap_serial['probabilities'][0], 1.0/21.0)
+    assert np.array_equal(fap_serial['trialbestpeaks'],
+                          fap_parallel['trialbestpeaks'])
+    assert fap_serial['probabilities'] == fap_parallel['probabilities']
+
+
+
+def test_analytic_fap():
+    '''
+    Tests periodbase.analytic_falsealarmprob.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    gls = periodbase.pgen_lsp(lcd['rjd'],
+                              lcd['aep_000'],
+                              lcd['aie_000'])
+
+    faps = {}
+    for fapmethod in ('single', 'naive', 'baluev', 'davies'):
+        fap = periodbase.analytic_falsealarmprob(gls,
+                                                 lcd['rjd'],
+                                                 lcd['aep_000'],
+                                                 lcd['aie_000'],
+                                                 fapmethod=fapmethod)
+        faps[fapmethod] = np.array(fap['probabilities'])
+
+    assert gls['fap']['fapmethod'] == 'davies'
+    assert faps['baluev'][0] < 1.0e-10
+    assert np.all(faps['single'] <= faps['baluev'])
+    assert np.all(faps['baluev'] <= faps['davies'])
+
+
+
+def test_fused_periodfind():
+    '''
+    Tests periodbase.fused_periodfind against the separate period-finders.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    pfmethods = ['gls','pdm','mav','win','aov']
+    fused = periodbase.fused_periodfind(lcd['rjd'],
+                                        lcd['aep_000'],
+                                        lcd['aie_000'],
+                                        pfmethods=pfmethods)
+
+    for pfm, fusedres in zip(pfmethods, fused):
+
+        separate = periodbase.LSPMETHODS[pfm](lcd['rjd'],
+                                              lcd['aep_000'],
+                                              lcd['aie_000'])
+
+        assert fusedres['method'] == separate['method']
+        assert fusedres['kwargs'] == separate['kwargs']
+        assert_allclose(fusedres['bestperiod'], separate['bestperiod'])
+        assert_allclose(fusedres['lspvals'], separate['lspvals'],
+                        rtol=1.0e-8, atol=1.0e-10)
+
+
+
+def test_fused_periodfind_grid():
+    '''
+    Tests that periodbase.fused_periodfind uses its grid kwargs for all of the
+    period-finders.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    pfmethods = ['gls','pdm','mav','win','aov']
+    fused = periodbase.fused_periodfind(lcd['rjd'],
+                                        lcd['aep_000'],
+                                        lcd['aie_000'],
+                                        pfmethods=pfmethods,
+                                        startp=0.5,
+                                        endp=5.0)
+
+    for pfm, fusedres in zip(pfmethods, fused):
+
+        separate = periodbase.LSPMETHODS[pfm](lcd['rjd'],
+                                              lcd['aep_000'],
+                                              lcd['aie_000'],
+                                              startp=0.5,
+                                              endp=5.0)
+
+        assert fusedres['kwargs'] == separate['kwargs']
+        assert fusedres['periods'].size == separate['periods'].size
+        assert fusedres['periods'].min() >= 0.5
+        assert fusedres['periods'].max() <= 5.0
+        assert_allclose(fusedres['lspvals'], separate['lspvals'],
+                        rtol=1.0e-8, atol=1.0e-10)
+
+
+
+def test_pgen_lsp_batch():
+    '''
+    Tests periodbase.pgen_lsp_batch against pgen_lsp for each mag series.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    times, errs = lcd['rjd'], lcd['aie_000']
+
+    # the second series is missing some points in the middle
+    mags = np.vstack((lcd['aep_000'], lcd['aep_000'][::-1]))
+    mask = np.ones(mags.shape, dtype=bool)
+    mask[1, 100:200] = False
+
+    batch = periodbase.pgen_lsp_batch(times,
+                                      mags,
+                                      np.vstack((errs, errs)),
+                                      mask=mask)
+
+    for ind, batchres in enumerate(batch):
+
+        single = periodbase.pgen_lsp(times[mask[ind]],
+                                     mags[ind][mask[ind]],
+                                     errs[mask[ind]])
+
+        assert batchres['kwargs'] == single['kwargs']
+        assert batchres['nbestperiods'] == single['nbestperiods']
+        assert_allclose(batchres['lspvals'], single['lspvals'],
+                        rtol=1.0e-8, atol=1.0e-10)
+
+
+
+def test_gls_state():
+    '''
+    Tests the incremental GLS against pgen_lsp over all of the points.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    times, mags, errs = lcd['rjd'], lcd['aep_000'], lcd['aie_000']
+    half = times.size//2
+
+    glsstate = periodbase.GLSPeriodogramState(startp=1.0, endp=10.0,
+                                              autofreq=False)
+    glsstate.update(times[:half], mags[:half], errs[:half])
+    glsstate.update(times[half:], mags[half:], errs[half:])
+    incremental = glsstate.lspdict()
+
+    full = periodbase.pgen_lsp(times, mags, errs,
+                               startp=1.0, endp=10.0, autofreq=False)
+
+    assert_allclose(incremental['omegas'], full['omegas'])
+    assert_allclose(incremental['lspvals'], full['lspvals'],
+                    rtol=1.0e-7, atol=1.0e-9)
+    assert_allclose(incremental['bestperiod'], full['bestperiod'])
+
+
+
+def test_compact_lspdict():
+    '''
+    Tests compacting and expanding period-finder result dicts.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    gls = periodbase.pgen_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'])
+
+    compact = periodbase.compact_lspdict(gls)
+    assert 'periods' not in compact and 'omegas' not in compact
+    assert compact['lspvals'].dtype == np.float32
+
+    expanded = periodbase.expand_lspdict(compact)
+    assert_allclose(expanded['periods'], gls['periods'], rtol=1.0e-10)
+    assert_allclose(expanded['omegas'], gls['omegas'], rtol=1.0e-10)
+    assert_allclose(expanded['lspvals'], gls['lspvals'], atol=1.0e-6)
+
+    envelope = periodbase.expand_lspdict(
+        periodbase.compact_lspdict(gls, envelopefactor=10, windowsize=50)
+    )
+    assert envelope['lspvals'].size < gls['lspvals'].size/5
+    assert_allclose(envelope['lspvals'].max(), gls['bestlspval'], rtol=1.0e-6)
+    bestind = np.argmax(envelope['lspvals'])
+    assert_allclose(envelope['periods'][bestind], gls['bestperiod'])
+
+    # the best periods are on the regenerated grid exactly
+    for bestperiod in gls['nbestperiods']:
+        assert bestperiod in expanded['periods']
+        assert bestperiod in envelope['periods']
+
+
+
+def test_compact_lspdict_features():
+    '''
+    Tests getting periodogram features from compacted result dicts.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    times, mags, errs = lcd['rjd'], lcd['aep_000'], lcd['aie_000']
+
+    gls = periodbase.pgen_lsp(times, mags, errs)
+    pdm = periodbase.stellingwerf_pdm(times, mags, errs)
+    win = periodbase.specwindow_lsp(times, mags, errs)
+
+    features = periodicfeatures.periodogram_features(
+        [gls, pdm, win], times, mags, errs
+    )
+
+    # the spectral window is never cut down to an envelope
+    compactwin = periodbase.compact_lspdict(win, envelopefactor=10)
+    assert compactwin['lspvals'].size == win['lspvals'].size
+
+    for envelopefactor in (None, 10):
+
+        compactfeatures = periodicfeatures.periodogram_features(
+            [periodbase.compact_lspdict(x, envelopefactor=envelopefactor)
+             for x in (gls, pdm, win)],
+            times, mags, errs
+        )
+        assert compactfeatures == features
+
+
+
+def test_pf_cache():
+    '''
+    Tests the period-finder result cache.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+    cachedir = tempfile.mkdtemp()
+
+    periodbase.enable_pf_cache(cachedir=cachedir)
+
+    try:
+
+        first = periodbase.pgen_lsp(lcd['rjd'],
+                                    lcd['aep_000'],
+                                    lcd['aie_000'])
+        second = periodbase.pgen_lsp(lcd['rjd'],
+                                     lcd['aep_000'],
+                                     lcd['aie_000'],
+                                     nworkers=2)
+        stats = periodbase.get_pf_cache_stats()
+
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert second is not first
+        assert_allclose(second['lspvals'], first['lspvals'])
+
+        # a different kwarg misses, and a fresh cache hits from disk
+        periodbase.pgen_lsp(lcd['rjd'],
+                            lcd['aep_000'],
+                            lcd['aie_000'],
+                            nbestpeaks=3)
+        assert periodbase.get_pf_cache_stats()['misses'] == 2
+
+        periodbase.enable_pf_cache(cachedir=cachedir)
+        periodbase.pgen_lsp(lcd['rjd'],
+                            lcd['aep_000'],
+                            lcd['aie_000'])
+        assert periodbase.get_pf_cache_stats()['diskhits'] == 1
+
+        # non-finite points don't change the key
+        kwargs = {'sigclip':10.0, 'magsarefluxes':False}
+        times = np.append(lcd['rjd'], lcd['rjd'][-1] + 1.0)
+        mags = np.append(lcd['aep_000'], np.nan)
+        errs = np.append(lcd['aie_000'], 0.01)
+        assert (periodbase.get_pf_cachekey('pgen_lsp', times, mags, errs,
+                                           kwargs) ==
+                periodbase.get_pf_cachekey('pgen_lsp', lcd['rjd'],
+                                           lcd['aep_000'], lcd['aie_000'],
+                                           kwargs))
+
+        # the period-finder still gets the arrays of a CleanedMagSeries, so it
+        # uses its cached sigma-clip
+        cleanedlc = lcmath.CleanedMagSeries(times, mags, errs)
+        periodbase.pgen_lsp(*cleanedlc, nbestpeaks=2)
+        assert len(cleanedlc._sigclipped) == 1
+
+    finally:
+
+        periodbase.disable_pf_cache()
+        shutil.rmtree(cachedir)
+
+
+
+def test_pf_executor():
+    '''
+    Tests running several period-finders on one PeriodFinderExecutor.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+
+    with periodbase.PeriodFinderExecutor(nworkers=2) as executor:
+
+        gls = periodbase.pgen_lsp(lcd['rjd'],
+                                  lcd['aep_000'],
+                                  lcd['aie_000'],
+                                  executor=executor)
+        pool = executor.pool
+        pdm = periodbase.stellingwerf_pdm(lcd['rjd'],
+                                          lcd['aep_000'],
+                                          lcd['aie_000'],
+                                          executor=executor)
+
+        # the second period-finder reuses the same pool
+        assert executor.pool is pool
+
+    assert executor.pool is None
+    assert_allclose(gls['bestperiod'], 1.54289477)
+    assert_allclose(pdm['bestperiod'], 3.08578956)
+
+
+
+def test_pf_timing():
+    '''
+    Tests the period-finder stage timings.
+
+    '''
+    lcd, msg = hatlc.read_and_filter_sqlitecurve(LCPATH)
+
+    periodbase.enable_pf_timing()
+
+    try:
+
+        gls = periodbase.pgen_lsp(lcd['rjd'],
+                                  lcd['aep_000'],
+                                  lcd['aie_000'])
+        fused = periodbase.fused_periodfind(lcd['rjd'],
+                                            lcd['aep_000'],
+                                            lcd['aie_000'],
+                                            pfmethods=['gls','pdm'],
+                                            pfkwargs=[{},{}])
+
+    finally:
+
+        periodbase.disable_pf_timing()
+
+    timing = gls['timing']
+    for stage in ('sigclip','grid','kernel','peaks','total'):
+        assert stage in timing['wall']
+        assert timing['wall'][stage] >= 0.0
+    assert timing['wall']['total'] >= timing['wall']['kernel']
+    assert timing['nfreq'] == gls['periods'].size
+    assert timing['npoints'] > 0
+
+    assert 'kernel' in fused[1]['timing']['fused']['wall']
+    assert_allclose(fused[0]['bestperiod'], gls['bestperiod'])
+
+    # no timings when these are turned off
+    gls = periodbase.pgen_lsp(lcd['rjd'], lcd['aep_000'], lcd['aie_000'])
+    assert 'timing' not in gls